@@ -75,6 +75,9 @@ directory_watcher = None
 # MetadataManager for local items
 local_metadata_manager = None
 
+# MetadataCache shared by all MetadataManagers
+metadata_cache = None
+
 # signal emiters for when config data changes
 backend_config_watcher = None
 frontend_config_watcher = None
@@ -65,6 +65,9 @@ class Controller:
         if app.local_metadata_manager is not None:
             logging.info("Sending pending metadata updates")
             app.local_metadata_manager.run_updates()
+        if app.metadata_cache is not None:
+            app.metadata_cache.log_stats()
+            app.metadata_cache.commit()
         logging.info("Shutting down donation manager")
         if app.donate_manager is not None:
             app.donate_manager.shutdown()
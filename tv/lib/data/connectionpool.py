@@ -35,6 +35,7 @@ import sqlite3
 
 from miro import messages
 from miro.data import dbcollations
+from miro.data import sqlcache
 
 class ConnectionLimitError(StandardError):
     """We've hit our connection limits."""
@@ -43,7 +44,8 @@ class Connection(object):
     """Wraps the sqlite3.Connection object."""
     def __init__(self, path):
         self._connection = sqlite3.connect(
-            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=sqlcache.CACHED_STATEMENTS)
 
     def execute(self, sql, values=()):
         return self._connection.execute(sql, values)
@@ -0,0 +1,223 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.feedcounts -- Keep per-feed item counts in our SQLite DB
+
+The feed_item_count table stores how many downloaded, downloading,
+unwatched, etc. items each feed has.  Triggers on the item and
+remote_downloader tables keep the counts up to date as items change state,
+so Feed.num_downloaded() and friends can read them without running a
+COUNT(*) query.  reconcile_feed_counts() recalculates the counts from
+scratch and fixes any that have drifted.
+"""
+
+from miro import app
+
+# columns in the feed_item_count table
+COUNT_COLUMNS = ('downloaded', 'downloading', 'unwatched', 'new_items',
+                 'not_downloaded', 'eligible')
+
+DOWNLOADED_STATES = "('finished', 'uploading', 'uploading-paused')"
+DOWNLOADING_STATES = "('downloading', 'uploading')"
+
+def _count_expressions(row):
+    """Get SQL expressions for how much an item adds to each count.
+
+    Each expression evaluates to 0 or 1.  They match the WHERE clauses for
+    Item.feed_downloaded_view(), feed_downloading_view(), etc.
+
+    :param row: name to reference the item row with (for example "new" or
+    "old" inside a trigger)
+    :returns: list of expressions in the same order as COUNT_COLUMNS
+    """
+    rd_state_check = ("EXISTS (SELECT 1 FROM remote_downloader rd "
+                      "WHERE rd.id=%s.downloader_id AND rd.state IN %%s%%s)" %
+                      row)
+    downloaded = "(%s.is_file_item OR %s)" % (
+        row, rd_state_check % (DOWNLOADED_STATES, ''))
+    downloading = rd_state_check % (DOWNLOADING_STATES,
+                                    ' AND rd.main_item_id=%s.id' % row)
+    unwatched = ("(%s.watched_time IS NULL AND "
+                 "%s.file_type IN ('audio', 'video') AND %s)" %
+                 (row, row, downloaded))
+    new_items = "%s.new" % row
+    not_downloaded = "NOT %s.was_downloaded" % row
+    eligible = ("(NOT %s.was_downloaded AND %s.eligible_for_autodownload)" %
+                (row, row))
+    return ["CASE WHEN %s THEN 1 ELSE 0 END" % expr
+            for expr in (downloaded, downloading, unwatched, new_items,
+                         not_downloaded, eligible)]
+
+def _item_update_sql(row, op):
+    """Get SQL to add/subtract an item from the counts for its feed."""
+    setters = ', '.join('%s=%s %s (%s)' % (column, column, op, expr)
+                        for column, expr in zip(COUNT_COLUMNS,
+                                                _count_expressions(row)))
+    return ("UPDATE feed_item_count SET %s WHERE feed_id=%s.feed_id; " %
+            (setters, row))
+
+def _item_ensure_row_sql(row):
+    return ("INSERT OR IGNORE INTO feed_item_count (feed_id) "
+            "SELECT %s.feed_id WHERE %s.feed_id IS NOT NULL; " % (row, row))
+
+def _downloader_update_sql(row, op):
+    """Get SQL to add/subtract the part of the counts that depends on a
+    remote_downloader row.
+
+    This is used when a downloader's state changes, so we only need to
+    account for the columns that depend on the downloader state.
+    """
+    item_count = ("(SELECT COUNT(*) FROM item "
+                  "WHERE item.downloader_id=%s.id AND "
+                  "item.feed_id=feed_item_count.feed_id%%s)" % row)
+    downloaded_check = ("(CASE WHEN %s.state IN %s THEN 1 ELSE 0 END)" %
+                        (row, DOWNLOADED_STATES))
+    downloading_check = ("(CASE WHEN %s.state IN %s THEN 1 ELSE 0 END)" %
+                         (row, DOWNLOADING_STATES))
+    # file items count as downloaded no matter what their downloader's state
+    # is.
+    downloaded = "%s * %s" % (item_count % ' AND NOT item.is_file_item',
+                              downloaded_check)
+    downloading = "%s * %s" % (item_count % (' AND item.id=%s.main_item_id' %
+                                             row),
+                               downloading_check)
+    unwatched = "%s * %s" % (item_count % (' AND NOT item.is_file_item AND '
+                                           'item.watched_time IS NULL AND '
+                                           "item.file_type IN "
+                                           "('audio', 'video')"),
+                             downloaded_check)
+    setters = ', '.join('%s=%s %s %s' % (column, column, op, expr)
+                        for column, expr in (('downloaded', downloaded),
+                                             ('downloading', downloading),
+                                             ('unwatched', unwatched)))
+    return ("UPDATE feed_item_count SET %s WHERE feed_id IN "
+            "(SELECT feed_id FROM item WHERE downloader_id=%s.id); " %
+            (setters, row))
+
+def setup_feed_counts(connection):
+    """Create the feed_item_count table and the triggers that update it.
+
+    :param connection: sqlite connection or cursor to use
+    """
+    if hasattr(app, 'in_unit_tests') and _missing_tables(connection):
+        # handle unittests not defining the tables in their schemas
+        return
+    connection.execute("CREATE TABLE feed_item_count ("
+                       "feed_id integer PRIMARY KEY, %s)" %
+                       ', '.join('%s integer NOT NULL DEFAULT 0' % column
+                                 for column in COUNT_COLUMNS))
+    item_columns = ('feed_id, downloader_id, is_file_item, watched_time, '
+                    'file_type, new, was_downloaded, '
+                    'eligible_for_autodownload')
+    connection.execute("CREATE TRIGGER item_count_ai "
+                       "AFTER INSERT ON item BEGIN %s%s END;" %
+                       (_item_ensure_row_sql('new'),
+                        _item_update_sql('new', '+')))
+    connection.execute("CREATE TRIGGER item_count_au "
+                       "AFTER UPDATE OF %s ON item BEGIN %s%s%s END;" %
+                       (item_columns, _item_update_sql('old', '-'),
+                        _item_ensure_row_sql('new'),
+                        _item_update_sql('new', '+')))
+    connection.execute("CREATE TRIGGER item_count_ad "
+                       "AFTER DELETE ON item BEGIN %s END;" %
+                       _item_update_sql('old', '-'))
+    connection.execute("CREATE TRIGGER downloader_count_ai "
+                       "AFTER INSERT ON remote_downloader BEGIN %s END;" %
+                       _downloader_update_sql('new', '+'))
+    connection.execute("CREATE TRIGGER downloader_count_au "
+                       "AFTER UPDATE OF state, main_item_id "
+                       "ON remote_downloader BEGIN %s%s END;" %
+                       (_downloader_update_sql('old', '-'),
+                        _downloader_update_sql('new', '+')))
+    connection.execute("CREATE TRIGGER downloader_count_ad "
+                       "AFTER DELETE ON remote_downloader BEGIN %s END;" %
+                       _downloader_update_sql('old', '-'))
+    connection.execute("CREATE TRIGGER feed_count_ad "
+                       "AFTER DELETE ON feed BEGIN "
+                       "DELETE FROM feed_item_count WHERE feed_id=old.id; "
+                       "END;")
+    connection.execute("INSERT INTO feed_item_count (feed_id, %s) %s" %
+                       (', '.join(COUNT_COLUMNS), _calc_counts_sql()))
+
+def _calc_counts_sql():
+    return ("SELECT item.feed_id, %s FROM item "
+            "WHERE item.feed_id IS NOT NULL GROUP BY item.feed_id" %
+            ', '.join('SUM(%s)' % expr
+                      for expr in _count_expressions('item')))
+
+def _missing_tables(connection):
+    cursor = connection.execute("SELECT COUNT(*) FROM sqlite_master "
+                                "WHERE type='table' AND name IN "
+                                "('item', 'feed', 'remote_downloader')")
+    return (cursor.fetchone()[0] < 3)
+
+def get_feed_counts(db, feed_id):
+    """Get the item counts for a feed.
+
+    :param db: LiveStorage object to use
+    :returns: dict mapping the names in COUNT_COLUMNS to their values
+    """
+    rows = db.execute("SELECT %s FROM feed_item_count WHERE feed_id=?" %
+                      ', '.join(COUNT_COLUMNS), (feed_id,))
+    if rows:
+        return dict(zip(COUNT_COLUMNS, rows[0]))
+    else:
+        # feed_item_count rows get created when the first item for a feed
+        # is added
+        return dict((column, 0) for column in COUNT_COLUMNS)
+
+def reconcile_feed_counts(db):
+    """Recalculate the feed counts and fix any that are wrong.
+
+    The triggers should keep the counts correct, but this gives us a safety
+    net in case one of them misses a change.
+
+    :param db: LiveStorage object to use
+    :returns: list of feed ids whose counts were wrong
+    """
+    correct_counts = dict((row[0], tuple(row[1:]))
+                          for row in db.execute(_calc_counts_sql()))
+    current_counts = dict((row[0], tuple(row[1:]))
+                          for row in db.execute(
+                              "SELECT feed_id, %s FROM feed_item_count" %
+                              ', '.join(COUNT_COLUMNS)))
+    zeros = (0,) * len(COUNT_COLUMNS)
+    wrong_feed_ids = [feed_id
+                      for feed_id in set(correct_counts).union(current_counts)
+                      if (correct_counts.get(feed_id, zeros) !=
+                          current_counts.get(feed_id, zeros))]
+    if wrong_feed_ids:
+        db.execute("INSERT OR REPLACE INTO feed_item_count (feed_id, %s) "
+                   "VALUES (?, %s)" %
+                   (', '.join(COUNT_COLUMNS),
+                    ', '.join('?' for column in COUNT_COLUMNS)),
+                   [(feed_id,) + correct_counts.get(feed_id, zeros)
+                    for feed_id in wrong_feed_ids],
+                   is_update=True, many=True)
+    return wrong_feed_ids
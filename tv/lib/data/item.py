@@ -46,10 +46,10 @@ from miro import app
 from miro import displaytext
 from miro.fileobject import FilenameType
 from miro import filetypes
-from miro import fileutil
 from miro import prefs
 from miro import schema
 from miro import util
+from miro.data import sqlcache
 from miro.gtcache import gettext as _
 from miro.plat import resources
 from miro.plat.utils import PlatformFilenameType
@@ -157,6 +157,7 @@ class ItemSelectInfo(object):
         SelectColumn('item', 'net_lookup_enabled'),
         SelectColumn('item', 'eligible_for_autodownload'),
         SelectColumn('item', 'thumbnail_url'),
+        SelectColumn('item', 'thumbnail_path', 'thumbnail_path_unicode'),
         SelectColumn('feed', 'orig_url', 'feed_url'),
         SelectColumn('feed', 'expire', 'feed_expire'),
         SelectColumn('feed', 'expire_timedelta', 'feed_expire_timedelta'),
@@ -315,6 +316,7 @@ class ItemInfoBase(object):
     auto_sync = None
     screenshot_path_unicode = None
     cover_art_path_unicode = None
+    thumbnail_path_unicode = None
     resume_time = 0
     play_count = 0
     skip_count = 0
@@ -404,6 +406,10 @@ class ItemInfoBase(object):
     def screenshot_path(self):
         return _unicode_to_filename(self.screenshot_path_unicode)
 
+    @property
+    def thumbnail_path(self):
+        return _unicode_to_filename(self.thumbnail_path_unicode)
+
     @property
     def feed_thumbnail_path(self):
         return _unicode_to_filename(self.feed_thumbnail_path_unicode)
@@ -441,15 +447,12 @@ class ItemInfoBase(object):
 
     @property
     def thumbnail(self):
-        if (self.cover_art_path_unicode is not None
-            and fileutil.exists(self.cover_art_path)):
-            return self.cover_art_path
-        if (self.icon_cache_path_unicode is not None and
-            fileutil.exists(self.icon_cache_path)):
-            return self.icon_cache_path
-        if (self.screenshot_path_unicode is not None
-            and fileutil.exists(self.screenshot_path)):
-            return self.screenshot_path
+        # thumbnail_path gets calculated by the backend when our cover art,
+        # icon cache or screenshot files change, so we don't need to check
+        # the filesystem here.
+        path = self.thumbnail_path
+        if path is not None:
+            return path
         if self.is_container_item:
             return resources.path("images/thumb-default-folder.png")
         if self.feed_thumbnail_path is not None:
@@ -743,11 +746,15 @@ def _fetch_item_rows(connection, item_ids, select_info):
 
     columns = ','.join('%s.%s' % (c.table, c.column)
                        for c in select_info.select_columns)
-    item_ids = ','.join(str(item_id) for item_id in item_ids)
-    sql = ("SELECT %s FROM %s %s WHERE %s.id IN (%s)" %
-           (columns, select_info.table_name, select_info.join_sql(),
-            select_info.table_name, item_ids))
-    return connection.execute(sql)
+    def builder(placeholders):
+        return ("SELECT %s FROM %s %s WHERE %s.id IN (%s)" %
+                (columns, select_info.table_name, select_info.join_sql(),
+                 select_info.table_name, placeholders))
+    key = ('_fetch_item_rows', select_info.table_name, columns)
+    # we may get duplicate rows from padding the id chunks, filter those out.
+    rows = dict((row[0], row) for row in sqlcache.execute_for_ids(
+        connection, key, builder, item_ids))
+    return rows.values()
 
 def fetch_item_infos(connection, item_ids):
     """Fetch a list of ItemInfos """
@@ -865,6 +872,15 @@ class DeviceItemInfo(ItemInfoBase):
         relative_filename = ItemInfo.filename.__get__(self, self.__class__)
         return os.path.join(self.mount, relative_filename)
 
+    @property
+    def thumbnail_path(self):
+        # The device's MetadataManager only sets cover_art and screenshot
+        # once it has created the files, so we can use them without checking
+        # that they exist.
+        if self.cover_art_path_unicode is not None:
+            return self.cover_art_path
+        return self.screenshot_path
+
 class SharingItemSelectInfo(ItemSelectInfo):
     """ItemSelectInfo for SharingItems."""
 
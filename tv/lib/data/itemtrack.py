@@ -44,6 +44,7 @@ from miro import schema
 from miro import signals
 from miro import util
 from miro.data import item
+from miro.data import sqlcache
 from miro.gtcache import gettext as _
 
 ItemTrackerCondition = util.namedtuple(
@@ -95,6 +96,16 @@ class ItemTrackerQueryBase(object):
             return True
         return False
 
+    def could_update_incrementally(self, message):
+        """Given a ItemChanges message, can we update the id list using only
+        the items in the message?
+
+        This is True if the only way the list could have changed is through
+        the items listed in added/changed/removed.  If it's False, the entire
+        query needs to be re-run.
+        """
+        return self.limit is None
+
     def _parse_column(self, column):
         """Parse a column specification.
 
@@ -262,6 +273,58 @@ class ItemTrackerQueryBase(object):
         logging.debug("ItemTracker: done running query")
         return item_ids
 
+    def select_matching_ids(self, connection, id_list):
+        """Check which items from a list match our conditions.
+
+        :returns: set of item ids
+        """
+        sql_parts = []
+        arg_list = []
+        sql_parts.append("SELECT %s.id FROM %s" %
+                         (self.table_name(), self.table_name()))
+        self._add_joins(sql_parts, arg_list)
+        sql_prefix = ' '.join(sql_parts)
+        matching_ids = set()
+        for size, chunk in sqlcache.id_chunks(id_list):
+            where_parts = []
+            where_values = list(arg_list)
+            self._add_conditions(where_parts, where_values,
+                                 id_count=size)
+            sql = ' '.join([sql_prefix] + where_parts)
+            where_values.extend(chunk)
+            matching_ids.update(row[0] for row in
+                                connection.execute(sql, where_values))
+        return matching_ids
+
+    def sort_ids(self, connection, id_list):
+        """Sort a list of ids using our ORDER BY clause.
+
+        This is used to figure out where to put items in the list without
+        re-running the entire query.
+
+        :returns: list of sorted ids.  Ids for items that aren't in the
+        database won't be included.
+        """
+        chunks = list(sqlcache.id_chunks(id_list))
+        if len(chunks) > 1:
+            raise ValueError("Too many ids to sort: %s" % len(id_list))
+        elif not chunks:
+            return []
+        size, chunk = chunks[0]
+        sql_parts = []
+        arg_list = []
+        sql_parts.append("SELECT %s.id FROM %s" %
+                         (self.table_name(), self.table_name()))
+        self._add_joins(sql_parts, arg_list)
+        sql_parts.append("WHERE %s.id IN (%s)" %
+                         (self.table_name(), sqlcache.placeholders(size)))
+        arg_list.extend(chunk)
+        self._add_order_by(sql_parts, arg_list)
+        sql = ' '.join(sql_parts)
+        # the id list may have duplicates from padding the chunk, but the
+        # IN clause won't return a row twice.
+        return [row[0] for row in connection.execute(sql, arg_list)]
+
     def select_item_data(self, connection):
         """Run the select statement for this query
 
@@ -321,9 +384,12 @@ class ItemTrackerQueryBase(object):
         if self.match_string:
             sql_parts.append(self.join_sql('item_fts'))
 
-    def _add_conditions(self, sql_parts, arg_list):
-        if not (self.conditions or self.match_string):
-            return
+    def _add_conditions(self, sql_parts, arg_list, id_count=None):
+        """Add the WHERE clause
+
+        :param id_count: if given, also limit the results to this many ids.
+        The caller needs to add the ids to arg_list.
+        """
         where_parts = []
         for c in self.conditions:
             where_parts.append(c.sql)
@@ -331,12 +397,24 @@ class ItemTrackerQueryBase(object):
         if self.match_string:
             where_parts.append("item_fts MATCH ?")
             arg_list.append(self.match_string)
+        if id_count is not None:
+            where_parts.append("%s.id IN (%s)" %
+                               (self.table_name(),
+                                sqlcache.placeholders(id_count)))
+        if not where_parts:
+            return
         sql_parts.append("WHERE %s" % ' AND '.join(
             '(%s)' % part for part in where_parts))
 
     def _add_order_by(self, sql_parts, arg_list):
+        # Always end with the id, so that the order is the same each time we
+        # run the query.  ItemTracker relies on this when it updates the list
+        # incrementally.
         if self.order_by:
-            sql_parts.append("ORDER BY %s" % self.order_by.sql)
+            sql_parts.append("ORDER BY %s, %s.id" % (self.order_by.sql,
+                                                     self.table_name()))
+        else:
+            sql_parts.append("ORDER BY %s.id" % self.table_name())
 
     def _add_limit(self, sql_parts, arg_list):
         if self.limit is not None:
@@ -362,6 +440,14 @@ class ItemTrackerQuery(ItemTrackerQueryBase):
             return True
         return ItemTrackerQueryBase.could_list_change(self, message)
 
+    def could_update_incrementally(self, message):
+        other_tables = self.get_other_tables_to_track()
+        if message.dlstats_changed and 'remote_downloader' in other_tables:
+            return False
+        if message.playlists_changed and 'playlist_item_map' in other_tables:
+            return False
+        return ItemTrackerQueryBase.could_update_incrementally(self, message)
+
 class DeviceItemTrackerQuery(ItemTrackerQueryBase):
     """ItemTrackerQuery for DeviceItems."""
 
@@ -385,6 +471,13 @@ class SharingItemTrackerQuery(ItemTrackerQueryBase):
         else:
             return ItemTrackerQueryBase.could_list_change(self, message)
 
+    def could_update_incrementally(self, message):
+        if message.changed_playlists and self.tracking_playlist_map():
+            return False
+        else:
+            return ItemTrackerQueryBase.could_update_incrementally(self,
+                                                                   message)
+
 class ItemTracker(signals.SignalEmitter):
     """Track items in the database
 
@@ -408,6 +501,12 @@ class ItemTracker(signals.SignalEmitter):
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
+    # Max number of items in an ItemChanges message that we will try to
+    # handle incrementally.  For more than that we just refetch the entire
+    # list.  This can't be more than half of the biggest
+    # sqlcache.ID_CHUNK_SIZES, since we sort the new items together with a
+    # probe item for each one.
+    INCREMENTAL_UPDATE_LIMIT = 400
 
     def __init__(self, idle_scheduler, query, item_source):
         """Create an ItemTracker
@@ -684,7 +783,8 @@ class ItemTracker(signals.SignalEmitter):
                        if self.item_in_list(item_id)]
         self._uncache_row_data(changed_ids)
         if self._could_list_change(message):
-            self._refetch_id_list(send_signals=False)
+            if not self._try_incremental_update(message):
+                self._refetch_id_list(send_signals=False)
             self.emit("list-changed")
         else:
             if len(self.id_list) == 0:
@@ -710,6 +810,98 @@ class ItemTracker(signals.SignalEmitter):
         """Calculate if an ItemChanges means the list may have changed."""
         return self.query.could_list_change(message)
 
+    def _try_incremental_update(self, message):
+        """Try to update our id list using only the items in an ItemChanges
+        message.
+
+        Rather than re-running our query for the entire list, we check if the
+        added/changed items match our conditions, remove the old entries, then
+        use a binary search to find where the matching items go.
+
+        :returns: True if we updated the list, False if we need to refetch
+        the entire list instead.
+        """
+        if (self.item_fetcher is None or
+                not self.query.could_update_incrementally(message)):
+            return False
+        added = set(message.added)
+        removed = set(message.removed)
+        ids_to_check = added.union(message.changed)
+        if len(ids_to_check) > self.INCREMENTAL_UPDATE_LIMIT:
+            return False
+        try:
+            # make sure we read the current data for the items
+            if self.item_fetcher.refresh_items(ids_to_check, added, removed):
+                return False
+            connection = self.item_fetcher.connection
+            matching_ids = self.query.select_matching_ids(connection,
+                                                          ids_to_check)
+            old_indexes = [self.id_to_index[id_]
+                           for id_ in removed.union(ids_to_check)
+                           if id_ in self.id_to_index]
+            # Remove the old entries first.  Changed items get added back
+            # below, since their position may have changed.
+            old_indexes.sort(reverse=True)
+            removed_ids = set()
+            for index in old_indexes:
+                removed_ids.add(self.id_list.pop(index))
+            positions = self._find_insert_positions(connection,
+                                                    matching_ids)
+        except sqlite3.DatabaseError, e:
+            logging.warn("%s while updating item list", e, exc_info=True)
+            return False
+        if positions is None:
+            # an item in our list was deleted, but we haven't gotten the
+            # ItemChanges message for it yet (see #19823)
+            return False
+        for pos, rank, id_ in reversed(positions):
+            self.id_list.insert(pos, id_)
+        for id_ in removed_ids.difference(matching_ids):
+            del self.id_to_index[id_]
+        self._uncache_row_data(removed_ids)
+        changed_indexes = old_indexes + [pos for pos, rank, id_ in positions]
+        if changed_indexes:
+            # everything before the first changed index stays the same
+            for i in xrange(min(changed_indexes), len(self.id_list)):
+                self.id_to_index[self.id_list[i]] = i
+        return True
+
+    def _find_insert_positions(self, connection, new_ids):
+        """Find where to insert items in our id list.
+
+        We do a binary search for all of the new items at once.  For each
+        step of the search, we let SQLite sort the new items together with
+        the item they are being compared against.
+
+        :returns: sorted list of (position, rank, id) tuples, or None if one
+        of the items in our list is no longer in the database.
+        """
+        if not new_ids:
+            return []
+        new_order = self.query.sort_ids(connection, new_ids)
+        bounds = dict((id_, [0, len(self.id_list)]) for id_ in new_order)
+        while True:
+            probes = {}
+            for id_, (low, high) in bounds.iteritems():
+                if low < high:
+                    probes[id_] = self.id_list[(low + high) // 2]
+            if not probes:
+                break
+            to_sort = set(probes.keys()).union(probes.values())
+            rank = dict((id_, i) for i, id_ in enumerate(
+                self.query.sort_ids(connection, to_sort)))
+            for id_, probe_id in probes.iteritems():
+                if probe_id not in rank or id_ not in rank:
+                    return None
+                low, high = bounds[id_]
+                middle = (low + high) // 2
+                if rank[id_] < rank[probe_id]:
+                    bounds[id_][1] = middle
+                else:
+                    bounds[id_][0] = middle + 1
+        return sorted((bounds[id_][0], i, id_)
+                      for i, id_ in enumerate(new_order))
+
 class ItemFetcher(object):
     """Create ItemInfo objects for ItemTracker
 
@@ -786,13 +978,18 @@ class ItemFetcher(object):
         """
         raise NotImplementedError()
 
-    def refresh_items(self, changed_ids):
+    def refresh_items(self, changed_ids, added_ids=(), removed_ids=()):
         """Refresh item data.
 
         Normally ItemFetcher uses data from the read transaction that the
         connection it was created with was in.  Use this method to force
         ItemFetcher to use new data for a list of items.
 
+        :param changed_ids: ids of items to refresh
+        :param added_ids: ids of items that we know were added since the
+        last refresh
+        :param removed_ids: ids of items that we know were removed since the
+        last refresh
         :returns True: if we can't refresh the items and we should refetch the
         entire list instead.  This is a hack to work around #19823
         """
@@ -812,6 +1009,32 @@ class ItemFetcher(object):
         """
         raise NotImplementedError()
 
+    def _playable_where(self, placeholders):
+        return ("WHERE %s IS NOT NULL AND "
+                "file_type != 'other' AND "
+                "id in (%s)" % (self.path_column(), placeholders))
+
+    def _select_playable_ids(self):
+        def builder(placeholders):
+            return "SELECT id FROM %s %s" % (self.table_name(),
+                                              self._playable_where(
+                                                  placeholders))
+        key = ('select_playable_ids', self.table_name(), self.path_column())
+        # use a set to drop the duplicate ids from padding the id chunks
+        return list(set(row[0] for row in sqlcache.execute_for_ids(
+            self.connection, key, builder, self.id_list)))
+
+    def _select_has_playables(self):
+        def builder(placeholders):
+            return "SELECT EXISTS (SELECT 1 FROM %s %s)" % (
+                self.table_name(), self._playable_where(placeholders))
+        key = ('select_has_playables', self.table_name(), self.path_column())
+        for row in sqlcache.execute_for_ids(self.connection, key, builder,
+                                            self.id_list):
+            if row[0] == 1:
+                return True
+        return False
+
 class ItemFetcherWAL(ItemFetcher):
     def __init__(self, connection, item_source, id_list):
         ItemFetcher.__init__(self, connection, item_source, id_list)
@@ -844,58 +1067,52 @@ class ItemFetcherWAL(ItemFetcher):
                    for c in self.select_columns()]
         self._sql = ("SELECT %s FROM %s %s" %
                      (', '.join(columns), self.table_name(), self.join_sql()))
+        self._sql_key = ('ItemFetcherWAL.fetch_items', self.table_name(),
+                         tuple(columns))
+
+    def _fetch_items_sql(self, placeholders):
+        return "%s WHERE %s.id in (%s)" % (self._sql, self.table_name(),
+                                           placeholders)
 
     def fetch_items(self, id_list):
         """Create Item objects."""
-        where = ("WHERE %s.id in (%s)" %
-                 (self.table_name(), ', '.join(str(i) for i in id_list)))
-        sql = ' '.join((self._sql, where))
-        cursor = self.connection.execute(sql)
-        return [self.item_source.make_item_info(row) for row in cursor]
+        # we may get duplicate rows from padding the id chunks, filter those
+        # out.
+        rows = dict((row[0], row) for row in sqlcache.execute_for_ids(
+            self.connection, self._sql_key, self._fetch_items_sql, id_list))
+        return [self.item_source.make_item_info(row)
+                for row in rows.itervalues()]
 
-    def refresh_items(self, changed_ids):
+    def refresh_items(self, changed_ids, added_ids=(), removed_ids=()):
         # We ignore changed_ids and just start a new transaction which will
         # refresh all the data.
         self.connection.commit()
         self.connection.execute("BEGIN TRANSACTION")
         # check if an item has been added/removed from the DB now that we have
-        # a new transaction.  This can happen if the backend changes some
-        # items sends an ItemsChanged message, then deletes them before we
-        # process the message (see #19823)
-
-        new_max_id = self.calc_max_item_id()
-        new_item_count = self.calc_item_count()
+        # a new transaction, other than the ones we know about.  This can
+        # happen if the backend changes some items sends an ItemsChanged
+        # message, then deletes them before we process the message (see
+        # #19823)
+        expected_max_id = max([self.max_item_id] + list(added_ids))
+        expected_item_count = (self.item_count + len(added_ids) -
+                               len(removed_ids))
+        self.max_item_id = self.calc_max_item_id()
+        self.item_count = self.calc_item_count()
         # checks for items have been added
-        if new_max_id != self.max_item_id:
-            self.max_item_id = new_max_id
-            # update item_count since that could have changed too
-            self.item_count = new_item_count
+        if self.max_item_id != expected_max_id:
             return True
         # given that items haven't been added, we can use the total number of
         # items to check if any have been deleted
-        if new_item_count != self.item_count:
-            self.item_count = new_item_count
+        if self.item_count != expected_item_count:
             return True
         # nothing has changed, we can return false
         return False
 
     def select_playable_ids(self):
-        sql = ("SELECT id FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s)" % 
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return [row[0] for row in self.connection.execute(sql)]
+        return self._select_playable_ids()
 
     def select_has_playables(self):
-        sql = ("SELECT EXISTS (SELECT 1 FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s))" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return self.connection.execute(sql).fetchone()[0] == 1
+        return self._select_has_playables()
 
 class ItemFetcherNoWAL(ItemFetcher):
     def __init__(self, connection, item_source, id_list):
@@ -917,24 +1134,33 @@ class ItemFetcherNoWAL(ItemFetcher):
         self.connection.execute(index_sql)
 
     def _select_into_temp_table(self, id_list):
+        key = ('ItemFetcherNoWAL._select_into_temp_table', self.table_name(),
+               tuple(ci.attr_name for ci in self.select_columns()))
+        template_values = {'temp_table_name': self.temp_table_name}
+        for sql, chunk in sqlcache.statements_for_ids(
+                key, self._select_into_temp_sql, id_list, template_values):
+            self.connection.execute(sql, chunk)
+
+    def _select_into_temp_sql(self, placeholders):
+        # The temp table name is different for each ItemFetcherNoWAL, so we
+        # leave $temp_table_name in the template for statements_for_ids() to
+        # fill in.
         template = string.Template("""\
-INSERT OR REPLACE INTO $temp_table_name($dest_columns)
+INSERT OR REPLACE INTO $$temp_table_name($dest_columns)
 SELECT $source_columns
 FROM $table_name
 $join_sql
-WHERE $table_name.id in ($id_list)""")
+WHERE $table_name.id in ($id_placeholders)""")
         d = {
-            'temp_table_name': self.temp_table_name,
             'table_name': self.table_name(),
             'join_sql': self.join_sql(),
-            'id_list': ', '.join(str(id_) for id_ in id_list),
+            'id_placeholders': placeholders,
             'dest_columns': ','.join(ci.attr_name
                                      for ci in self.select_columns()),
             'source_columns': ','.join('%s.%s' % (ci.table, ci.column)
                                        for ci in self.select_columns()),
         }
-        sql = template.substitute(d)
-        self.connection.execute(sql)
+        return template.substitute(d)
 
     def destroy(self):
         if self.connection is not None:
@@ -943,37 +1169,32 @@ WHERE $table_name.id in ($id_list)""")
             self.release_connection()
             self.temp_table_name = None
 
-    def fetch_items(self, id_list):
-        """Create Item objects."""
+    def _fetch_items_sql(self, placeholders):
         # We can use SELECT * here because we know that we defined the columns
         # in the same order as select_columns() returned them.
-        id_list_str = ', '.join(str(i) for i in id_list)
-        sql = "SELECT * FROM %s WHERE id IN (%s)" % (self.temp_table_name,
-                                                     id_list_str)
+        return "SELECT * FROM $temp_table_name WHERE id IN (%s)" % (
+            placeholders,)
+
+    def fetch_items(self, id_list):
+        """Create Item objects."""
+        template_values = {'temp_table_name': self.temp_table_name}
+        # we may get duplicate rows from padding the id chunks, filter those
+        # out.
+        rows = dict((row[0], row) for row in sqlcache.execute_for_ids(
+            self.connection, ('ItemFetcherNoWAL.fetch_items',),
+            self._fetch_items_sql, id_list, template_values))
         return [self.item_source.make_item_info(row)
-                for row in self.connection.execute(sql)]
+                for row in rows.itervalues()]
 
-    def refresh_items(self, changed_ids):
+    def refresh_items(self, changed_ids, added_ids=(), removed_ids=()):
         self._select_into_temp_table(changed_ids)
         return False
 
     def select_playable_ids(self):
-        sql = ("SELECT id FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s)" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return [row[0] for row in self.connection.execute(sql)]
+        return self._select_playable_ids()
 
     def select_has_playables(self):
-        sql = ("SELECT EXISTS (SELECT 1 FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s))" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return self.connection.execute(sql).fetchone()[0] == 1
+        return self._select_has_playables()
 
 class BackendItemTracker(signals.SignalEmitter):
     """Item tracker used by the backend
@@ -1031,9 +1252,13 @@ class BackendItemTracker(signals.SignalEmitter):
             return
 
         if self.query.could_list_change(msg):
-            # items may have been added/removed from the list.  We need to
-            # re-fetch the items and calculate changes
-            self.refetch_items(msg.changed)
+            # items may have been added/removed from the list.
+            if self.query.could_update_incrementally(msg):
+                # We only need to check the items in the message
+                self.update_items(msg)
+            else:
+                # We need to re-fetch the items and calculate changes
+                self.refetch_items(msg.changed)
         else:
             # items changed, but the list is the same.  Just refetch the
             # changed items.
@@ -1063,3 +1288,30 @@ class BackendItemTracker(signals.SignalEmitter):
                   [self.item_map[id_] for id_ in added_ids],
                   [self.item_map[id_] for id_ in changed_ids],
                   list(removed_ids))
+
+    def update_items(self, msg):
+        """Update our items using only the items in an ItemChanges message.
+
+        This is much faster than refetch_items() for big lists, but it only
+        works if query.could_update_incrementally() returns True.
+        """
+        ids_to_check = set(msg.added).union(msg.changed)
+        matching_ids = self.query.select_matching_ids(app.db.connection,
+                                                      ids_to_check)
+        removed_ids = self.item_ids.intersection(
+            ids_to_check.union(msg.removed)).difference(matching_ids)
+        added_ids = matching_ids.difference(self.item_ids)
+        added = []
+        changed = []
+        for item_info in item.fetch_item_infos(app.db.connection,
+                                               matching_ids):
+            self.item_map[item_info.id] = item_info
+            if item_info.id in added_ids:
+                added.append(item_info)
+            else:
+                changed.append(item_info)
+        for id_ in removed_ids:
+            del self.item_map[id_]
+        self.item_ids.difference_update(removed_ids)
+        self.item_ids.update(item_info.id for item_info in added)
+        self.emit('items-changed', added, changed, list(removed_ids))
@@ -0,0 +1,168 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.sqlcache -- Reuse SQL statements that select rows by id
+
+sqlite3 keeps a cache of compiled statements for each connection, keyed by
+the SQL text.  Statements that have the ids inlined (for example "WHERE id IN
+(1, 5, 7)") almost never hit that cache and need to be compiled every time.
+
+This module builds SQL that uses bound parameters for the ids instead.  The id
+lists are split up into chunks with a small set of fixed sizes, padding the
+last chunk by repeating an id.  This means that the same handful of SQL
+strings get used over and over, so sqlite3 can reuse the compiled statements.
+
+SQLTemplateCache stores the SQL strings, so that we don't have to rebuild them
+each time.  It also keeps hit/miss counts to see how well it's doing.
+"""
+
+import string
+
+# Sizes that we chunk id lists into.  25 matches
+# ItemTracker.FETCH_ROW_CHUNK_SIZE.  The last one must be less than 999,
+# which is the maximum number of variables that SQLite accepts.
+ID_CHUNK_SIZES = (1, 5, 25, 100, 300, 900)
+
+# Number of compiled statements that sqlite3 should cache per connection.
+# The default is 100, which is easy to overflow with one statement for each
+# chunk size.
+CACHED_STATEMENTS = 200
+
+class SQLTemplateCache(object):
+    """Stores SQL strings for reuse.
+
+    Keys are normally a (table, columns, chunk_size) tuple, but any hashable
+    value will do.
+
+    :attribute hits: number of times get() found a cached statement
+    :attribute misses: number of times get() had to build a statement
+    """
+    def __init__(self):
+        self._templates = {}
+        self.reset_stats()
+
+    def get(self, key, builder, *args):
+        """Get a SQL string
+
+        :param key: key for the SQL string
+        :param builder: function to build the SQL string if it's not cached.
+        :param args: arguments to pass to builder
+        """
+        try:
+            sql = self._templates[key]
+        except KeyError:
+            sql = self._templates[key] = builder(*args)
+            self.misses += 1
+        else:
+            self.hits += 1
+        return sql
+
+    def clear(self):
+        self._templates = {}
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Get a dict that describes how well we are doing."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._templates),
+        }
+
+# SQLTemplateCache shared by the backend and frontend code
+template_cache = SQLTemplateCache()
+
+def chunk_size_for(count):
+    """Get the chunk size to use for a list of count ids."""
+    for size in ID_CHUNK_SIZES:
+        if count <= size:
+            return size
+    return ID_CHUNK_SIZES[-1]
+
+def id_chunks(id_list):
+    """Split a list of ids into chunks for bound parameters.
+
+    Each chunk has one of the sizes from ID_CHUNK_SIZES.  If there aren't
+    enough ids to fill up a chunk, we repeat the last id.  This is harmless
+    for "id IN (...)" clauses.
+
+    :returns: iterator that yields (chunk_size, id_tuple) tuples
+    """
+    id_list = list(id_list)
+    max_size = ID_CHUNK_SIZES[-1]
+    for start in xrange(0, len(id_list), max_size):
+        chunk = id_list[start:start+max_size]
+        size = chunk_size_for(len(chunk))
+        if len(chunk) < size:
+            chunk.extend([chunk[-1]] * (size - len(chunk)))
+        yield size, tuple(chunk)
+
+def placeholders(count):
+    """Get a string with count comma separated "?" characters."""
+    return ', '.join('?' for i in xrange(count))
+
+def statements_for_ids(key, builder, id_list, template_values=None):
+    """Get SQL statements and bound values for a list of ids.
+
+    :param key: key for template_cache.  We add the chunk size to it.
+    :param builder: function that inputs a placeholder string like "?, ?, ?"
+                    and returns the SQL to run.  The ids get bound to those
+                    placeholders.
+    :param id_list: ids to bind
+    :param template_values: If given, treat the SQL as a string.Template and
+                            substitute these values in.  This is useful for
+                            things like temporary table names, which would
+                            fill up the cache if they were part of the key.
+    :returns: iterator that yields (sql, id_tuple) tuples
+    """
+    for size, chunk in id_chunks(id_list):
+        sql = template_cache.get(key + (size,), _build_for_chunk, builder,
+                                 size)
+        if template_values is not None:
+            sql = string.Template(sql).substitute(template_values)
+        yield sql, chunk
+
+def execute_for_ids(connection, key, builder, id_list, template_values=None):
+    """Execute a statement for each chunk of a list of ids.
+
+    See statements_for_ids() for a description of the arguments.
+
+    :param connection: sqlite3.Connection (or something with the same
+                       execute() method) to use
+    :returns: iterator that yields the result rows for all chunks
+    """
+    for sql, chunk in statements_for_ids(key, builder, id_list,
+                                         template_values):
+        for row in connection.execute(sql, chunk):
+            yield row
+
+def _build_for_chunk(builder, size):
+    return builder(placeholders(size))
@@ -35,6 +35,7 @@ import threading
 from miro import app
 from miro import signals
 from miro import threadcheck
+from miro import util
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -204,12 +205,23 @@ class View(object):
                           self.db_info)
 
 class ViewTrackerManager(object):
+    """Keeps track of ViewTrackers and updates them when objects change.
+
+    Normally, ViewTrackers are updated as soon as an object changes.  Between
+    start_batch() and finish_batch() calls, the changed objects are collected
+    instead, and each tracker gets checked once for the whole batch.
+    """
     def __init__(self, db):
         self.db = db
         # maps table_name to trackers
         self.table_to_tracker = {}
         # maps joined tables to trackers
         self.joined_table_to_tracker = {}
+        self.batch_depth = 0
+        # maps table_name to (ids, objects) tuples.  ids lists the changed
+        # object ids in the order they were changed, objects maps those ids
+        # to the objects.
+        self.pending_changes = {}
 
     def trackers_for_table(self, table_name):
         try:
@@ -221,13 +233,63 @@ class ViewTrackerManager(object):
     def trackers_for_ddb_class(self, klass):
         return self.trackers_for_table(self.db.table_name(klass))
 
+    def start_batch(self):
+        """Start collecting changed objects rather than checking them.
+
+        Calls to start_batch() can be nested, the changes get processed
+        when the outermost batch is finished.
+        """
+        self.batch_depth += 1
+
+    def finish_batch(self):
+        """Check all objects changed since start_batch() was called."""
+        if self.batch_depth <= 0:
+            raise ValueError("finish_batch() called without start_batch()")
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            pending_changes = self.pending_changes
+            self.pending_changes = {}
+            for table_name, (ids, objects) in pending_changes.items():
+                self._check_objects_for_table(table_name,
+                                              [objects[id_] for id_ in ids])
+
     def update_view_trackers(self, obj, can_change_views=True):
         """Update view trackers based on an object change."""
 
+        if can_change_views and self.batch_depth > 0:
+            table_name = self.db.table_name(obj.__class__)
+            try:
+                ids, objects = self.pending_changes[table_name]
+            except KeyError:
+                ids, objects = self.pending_changes[table_name] = ([], {})
+            if obj.id not in objects:
+                ids.append(obj.id)
+            objects[obj.id] = obj
+            return
+
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj, can_change_views)
 
+    def update_view_trackers_for_objects(self, objects):
+        """Update view trackers based on a group of changed objects.
+
+        Each tracker gets checked once for the objects in its table.
+        """
+        objects_by_table = {}
+        for obj in objects:
+            table_name = self.db.table_name(obj.__class__)
+            objects_by_table.setdefault(table_name, []).append(obj)
+        for table_name, table_objects in objects_by_table.items():
+            self._check_objects_for_table(table_name, table_objects)
+
+    def _check_objects_for_table(self, table_name, objects):
+        # copy the set, since signal handlers may link/unlink trackers
+        for tracker in list(self.trackers_for_table(table_name)):
+            tracker.check_objects(objects)
+
     def bulk_update_view_trackers(self, table_name):
+        # check_all_objects() will handle any changes that we've saved up
+        self.pending_changes.pop(table_name, None)
         for tracker in self.trackers_for_table(table_name):
             tracker.check_all_objects()
 
@@ -254,6 +316,8 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        # maps DDBObject classes to predicates from compile_where_predicate()
+        self._predicates = {}
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -271,15 +335,54 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
-    def _obj_in_view(self, obj):
-        """Check if a single object is in our view."""
-        where = '%s.id = ?' % (self.table_name,)
-        if self.where:
-            where += ' AND (%s)' % (self.where,)
+    def _get_predicate(self, klass):
+        """Get a python predicate equivalent to our WHERE clause.
 
-        values = (obj.id,) + self.values
-        return self.db_info.db.query_count(self.table_name, where, values,
-                self.joins) > 0
+        :returns: predicate function or None if we need to use SQL to check
+        """
+        try:
+            return self._predicates[klass]
+        except KeyError:
+            if self.joins:
+                predicate = None
+            else:
+                predicate = self.db_info.db.compile_where_predicate(klass,
+                        self.where, self.values)
+            self._predicates[klass] = predicate
+            return predicate
+
+    def _can_use_predicate(self, obj):
+        # We can only trust the python values if they match what's in the
+        # database.  Objects with unsaved changes and objects that have been
+        # removed need to be checked with SQL.
+        return (not obj.changed_attributes and
+                self.db_info.db.id_alive(obj.id, obj.__class__))
+
+    def _objects_in_view(self, objects):
+        """Check which of a list of objects are in our view.
+
+        :returns: set of ids for the objects that are in our view.
+        """
+        in_view = set()
+        to_query = []
+        for obj in objects:
+            predicate = self._get_predicate(obj.__class__)
+            if predicate is not None and self._can_use_predicate(obj):
+                if predicate(obj):
+                    in_view.add(obj.id)
+            else:
+                to_query.append(obj.id)
+        # we can only feed sqlite so many variables at once, so query the ids
+        # in chunks
+        for id_list_chunk in util.split_values_for_sqlite(to_query):
+            where = '%s.id IN (%s)' % (self.table_name,
+                    ', '.join('?' for i in xrange(len(id_list_chunk))))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            values = tuple(id_list_chunk) + self.values
+            in_view.update(self.db_info.db.query_ids(self.table_name, where,
+                values, joins=self.joins))
+        return in_view
 
     def _view_object_ids(self):
         """Get all object ids in our view."""
@@ -305,7 +408,7 @@ class ViewTracker(signals.SignalEmitter):
 
     def check_object(self, obj):
         before = (obj.id in self.current_ids)
-        now = self._obj_in_view(obj)
+        now = (obj.id in self._objects_in_view([obj]))
         if before and not now:
             self.current_ids.remove(obj.id)
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
@@ -315,6 +418,34 @@ class ViewTracker(signals.SignalEmitter):
         elif before and now:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def check_objects(self, objects):
+        """Check a group of changed objects at once.
+
+        This works like calling check_object() for each object, but only
+        needs a single query (or none if our WHERE clause can be evaluated in
+        python).
+        """
+        if not objects:
+            return
+        in_view = self._objects_in_view(objects)
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = (obj.id in in_view)
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif before and now:
+                changed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+        self._emit_for_objects('removed', removed)
+        self._emit_for_objects('added', added)
+        self._emit_for_objects('changed', changed)
+
     def _emit_for_objects(self, signal, objects):
         if self.bulk_mode:
             self.emit('bulk-' + signal, objects)
@@ -370,6 +501,9 @@ class BulkSQLManager(object):
                 self.last_call)
         self.active = True
         self.last_call = "".join(traceback.format_stack())
+        # save up signal_change() calls while we are active and check the
+        # changed objects all at once in finish()
+        self.view_tracker_manager.start_batch()
 
     def finish(self):
         if not self.active:
@@ -380,6 +514,7 @@ class BulkSQLManager(object):
             # Ensure that this flag always get set back to False even in the
             # face of any exception thrown from commit() method.
             self.active = False
+            self.view_tracker_manager.finish_batch()
 
         # Force a commit of our current transaction.
         #
@@ -437,12 +572,12 @@ class BulkSQLManager(object):
             self._update_view_trackers_by_table(to_insert, to_remove)
 
     def _update_view_trackers_by_object(self, changed_objs):
-        """Update view trackers by checking each changed object.
+        """Update view trackers by checking the changed objects.
 
         This method is the fastest when there are not a lot of changed objects
         """
-        for obj in changed_objs:
-            self.view_tracker_manager.update_view_trackers(obj)
+        self.view_tracker_manager.update_view_trackers_for_objects(
+            changed_objs)
 
     def _update_view_trackers_by_table(self, to_insert, to_remove):
         """Update view trackers by checking each table
@@ -491,7 +626,13 @@ class BulkSQLManager(object):
         removes_for_table.append(obj)
 
 class AttributeUpdateTracker(object):
-    """Used by DDBObject to track changes to attributes."""
+    """Used by DDBObject to track changes to attributes.
+
+    AttributeUpdateTracker also handles attributes that were restored lazily.
+    LiveStorage can skip converting expensive columns when it restores an
+    object, storing the raw database values in the _lazy_columns dict
+    instead.  We convert those values the first time they're accessed.
+    """
 
     def __init__(self, name):
         self.name = name
@@ -503,7 +644,7 @@ class AttributeUpdateTracker(object):
         try:
             return instance.__dict__[self.name]
         except KeyError:
-            raise AttributeError(self.name)
+            return self._load_lazy_value(instance)
         except AttributeError:
             if instance is None:
                 raise AttributeError(
@@ -511,8 +652,26 @@ class AttributeUpdateTracker(object):
             else:
                 raise
 
+    def _load_lazy_value(self, instance):
+        try:
+            lazy_columns = instance.__dict__['_lazy_columns']
+            db_value = lazy_columns[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+        value = instance.db_info.db.convert_lazy_column(instance, self.name,
+                                                        db_value)
+        instance.__dict__[self.name] = value
+        del lazy_columns[self.name]
+        return value
+
     def __set__(self, instance, value):
-        if instance.__dict__.get(self.name, "BOGUS VALUE FOO") != value:
+        lazy_columns = instance.__dict__.get('_lazy_columns')
+        if lazy_columns and self.name in lazy_columns:
+            # don't bother converting the old value, just assume that it
+            # changed.
+            del lazy_columns[self.name]
+            instance.changed_attributes.add(self.name)
+        elif instance.__dict__.get(self.name, "BOGUS VALUE FOO") != value:
             instance.changed_attributes.add(self.name)
         instance.__dict__[self.name] = value
 
@@ -680,6 +839,10 @@ class DDBObject(signals.SignalEmitter):
 
         :param dct: dict of new values for our database attributes
         """
+        lazy_columns = self.__dict__.get('_lazy_columns')
+        if lazy_columns:
+            for name in dct:
+                lazy_columns.pop(name, None)
         self.__dict__.update(dct)
         self.changed_attributes.update(dct.keys())
 
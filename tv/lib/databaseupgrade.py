@@ -53,6 +53,7 @@ from miro import schema
 from miro import util
 import types
 from miro import app
+from miro.data import feedcounts
 from miro import dbupgradeprogress
 from miro import prefs
 
@@ -175,7 +176,7 @@ def get_next_id(cursor):
     max_id = 0
     for table in get_object_tables(cursor):
         # skip tables that don't store DDBObjects
-        if table.startswith('item_fts'):
+        if table.startswith('item_fts') or table == 'feed_item_count':
             continue 
         try:
             cursor.execute("SELECT MAX(id) from %s" % table)
@@ -4417,3 +4418,69 @@ def upgrade201(cursor):
             where_values.append((feed_id,))
     cursor.executemany("UPDATE feed SET expire_timedelta=NULL "
                        "WHERE id=?", where_values)
+
+def upgrade202(cursor):
+    """Add the content_digest columns to the RSS feed impl tables."""
+    cursor.execute("ALTER TABLE rss_feed_impl ADD COLUMN content_digest text")
+    for table in ('saved_search_feed_impl', 'search_feed_impl'):
+        cursor.execute("ALTER TABLE %s ADD COLUMN content_digest pythonrepr" %
+                       table)
+        cursor.execute("UPDATE %s SET content_digest='{}'" % table)
+
+def upgrade203(cursor):
+    """Add a case-insensitive index for item filenames."""
+    cursor.execute("CREATE INDEX item_filename_nocase "
+                   "ON item (filename COLLATE NOCASE)")
+
+def upgrade204(cursor):
+    """Add the thumbnail_path column to the item table."""
+    # importing from miro is bad, but we need to find the files the same way
+    # Item.calc_thumbnail_path() does, otherwise the column won't match what
+    # the backend would have calculated.
+    from miro import fileutil
+    from miro.plat import resources
+    from miro.download_utils import get_file_url_path
+    from miro.plat.utils import (PlatformFilenameType, filename_to_unicode,
+                                 unicode_to_filename)
+    def _unicode_to_filename(value):
+        # reverses filename_to_unicode(), see upgrade195()
+        if value is not None and PlatformFilenameType != unicode:
+            return value.encode('utf-8')
+        else:
+            return value
+
+    def _icon_cache_path(url, filename):
+        # matches IconCache.get_filename()
+        if url and url.startswith(u"file://"):
+            return get_file_url_path(url)
+        elif url and url.startswith(u"/"):
+            return unicode_to_filename(url)
+        else:
+            return _unicode_to_filename(filename)
+
+    cursor.execute("ALTER TABLE item ADD COLUMN thumbnail_path TEXT")
+    cursor.execute("SELECT item.id, item.cover_art, icon_cache.url, "
+                   "icon_cache.filename, item.screenshot "
+                   "FROM item "
+                   "LEFT JOIN icon_cache ON icon_cache.id = item.icon_cache_id "
+                   "WHERE item.cover_art IS NOT NULL OR "
+                   "icon_cache.filename IS NOT NULL OR "
+                   "item.screenshot IS NOT NULL")
+    values = []
+    for row in cursor.fetchall():
+        (item_id, cover_art, icon_url, icon_filename, screenshot) = row
+        candidates = [_unicode_to_filename(cover_art)]
+        if icon_filename:
+            candidates.append(_icon_cache_path(icon_url, icon_filename))
+        candidates.append(_unicode_to_filename(screenshot))
+        for path in candidates:
+            if path:
+                path = resources.path(fileutil.expand_filename(path))
+                if fileutil.exists(path):
+                    values.append((filename_to_unicode(path), item_id))
+                    break
+    cursor.executemany("UPDATE item SET thumbnail_path=? WHERE id=?", values)
+
+def upgrade205(cursor):
+    """Add the feed_item_count table and the triggers that maintain it."""
+    feedcounts.setup_feed_counts(cursor)
@@ -110,14 +110,24 @@ class RemoveHTTPAuthCommand(Command):
         httpauth.remove_by_url_and_realm(*self.args)
 
 class BatchUpdateDownloadStatus(Command):
+    """Send status updates to the backend.
+
+    Args are (statuses, cmd_done, deltas).  statuses is a list of full status
+    dicts, deltas is a list of dicts containing dlid and values that have
+    changed since the last status sent for that download.
+    """
     spammy = True
     def action(self):
         from miro.downloader import RemoteDownloader
         from miro.messages import DownloaderSyncCommandComplete
 
-        cmd_done = self.args[1]
-        fresh = all(RemoteDownloader.update_status(status, cmd_done=cmd_done)
-                    for status in self.args[0])
+        statuses, cmd_done = self.args[0], self.args[1]
+        if len(self.args) > 2:
+            deltas = self.args[2]
+        else:
+            deltas = []
+        fresh = RemoteDownloader.update_status_batch(statuses, deltas,
+                                                     cmd_done=cmd_done)
         if cmd_done and fresh:
             DownloaderSyncCommandComplete().send_to_frontend()
 
@@ -185,6 +195,7 @@ class DownloaderBatchCommand(Command):
     RESTORE = 4
 
     def action(self):
+        from miro import httpclient
         from miro.dl_daemon import download
         mark_reply = True
         for dlid, (cmd, args) in self.args[0].iteritems():
@@ -204,7 +215,9 @@ class DownloaderBatchCommand(Command):
                 channel_name = args['channel_name']
                 url = args['url']
                 content_type = args['content_type']
-                download.start_download(url, dlid, content_type, channel_name)
+                priority = args.get('priority', httpclient.PRIORITY_NORMAL)
+                download.start_download(url, dlid, content_type, channel_name,
+                                        priority)
             elif cmd == self.RESTORE:
                 # Restoring a downloader doesn't actually change any state
                 # so don't reply.
@@ -219,6 +232,11 @@ class DownloaderBatchCommand(Command):
         if mark_reply:
             download.DOWNLOAD_UPDATER.set_cmds_done()
  
+class SetStatusUpdateIntervalCommand(Command):
+    def action(self):
+        from miro.dl_daemon import download
+        download.DOWNLOAD_UPDATER.set_interval(self.args[0])
+
 class MigrateDownloadCommand(Command):
     def action(self):
         from miro.dl_daemon import download
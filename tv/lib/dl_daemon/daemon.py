@@ -254,6 +254,12 @@ class ControllerDaemon(Daemon):
             prefs.UPSTREAM_LIMIT_IN_KBS,
             prefs.LIMIT_DOWNSTREAM_BT,
             prefs.DOWNSTREAM_BT_LIMIT_IN_KBS,
+            prefs.LIMIT_DOWNSTREAM_HTTP,
+            prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS,
+            prefs.HTTP_HOST_LIMIT_IN_KBS,
+            prefs.HTTP_CONNECTIONS_PER_HOST,
+            prefs.HTTP_SEGMENTED_DOWNLOADS,
+            prefs.HTTP_DOWNLOAD_SEGMENTS,
             prefs.BT_MIN_PORT,
             prefs.BT_MAX_PORT,
             prefs.USE_UPNP,
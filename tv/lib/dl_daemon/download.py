@@ -55,6 +55,7 @@ from miro import prefs
 
 from miro.dl_daemon import command
 from miro.dl_daemon import daemon
+from miro.dl_daemon import segmented
 from miro.util import (
     check_f, check_u, stringify, MAX_TORRENT_SIZE, returns_filename,
     info_hash_from_magnet, is_magnet_uri)
@@ -69,7 +70,8 @@ _downloads = {}
 
 _lock = RLock()
 
-def create_downloader(url, content_type, dlid, magnet=None):
+def create_downloader(url, content_type, dlid, magnet=None,
+                      priority=httpclient.PRIORITY_NORMAL):
     """Creates a downloader based on the content_type.
     """
     check_u(url)
@@ -79,7 +81,8 @@ def create_downloader(url, content_type, dlid, magnet=None):
     elif content_type ==  u'application/x-magnet':
         return BTDownloader(None, dlid, magnet=url)
     else:
-        return HTTPDownloader(url, dlid, expected_content_type=content_type)
+        return HTTPDownloader(url, dlid, expected_content_type=content_type,
+                              priority=priority)
 
 def pause_download(dlid):
     """Pauses a download by download id.
@@ -102,9 +105,11 @@ def info_hash_to_long(info_hash):
     """
     return long(str(info_hash), 16)
 
-def start_download(url, dlid, content_type, channel_name):
+def start_download(url, dlid, content_type, channel_name,
+                   priority=httpclient.PRIORITY_NORMAL):
     try:
         download = _downloads[dlid]
+        download.set_priority(priority)
         download.start()
     except KeyError:
         # There is no download with this id.  This is a new download.
@@ -112,7 +117,7 @@ def start_download(url, dlid, content_type, channel_name):
         check_u(content_type)
         if channel_name:
             check_f(channel_name)
-        dl = create_downloader(url, content_type, dlid)
+        dl = create_downloader(url, content_type, dlid, priority=priority)
         dl.channel_name = channel_name
         _downloads[dlid] = dl
 
@@ -181,6 +186,7 @@ def startup():
     logging.info("Starting downloaders")
     DOWNLOAD_UPDATER.start_updates()
     TORRENT_SESSION.startup()
+    HTTP_LIMITS.startup()
 
 def shutdown():
     logging.info("Shutting down downloaders...")
@@ -188,6 +194,7 @@ def shutdown():
         _downloads[dlid].shutdown()
     logging.info("Shutting down torrent session...")
     TORRENT_SESSION.shutdown()
+    HTTP_LIMITS.shutdown()
     # Flush the status updates.
     logging.info('flushing status updates...')
     DOWNLOAD_UPDATER.flush_update()
@@ -392,18 +399,72 @@ class TorrentSession(object):
 
 TORRENT_SESSION = TorrentSession()
 
+class HTTPLimits(object):
+    """Keeps the httpclient bandwidth limits in sync with the config."""
+
+    LIMIT_PREFS = (
+        prefs.LIMIT_DOWNSTREAM_HTTP.key,
+        prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS.key,
+        prefs.HTTP_HOST_LIMIT_IN_KBS.key,
+        prefs.HTTP_CONNECTIONS_PER_HOST.key,
+    )
+
+    def __init__(self):
+        self.callback_handle = None
+
+    def startup(self):
+        self.set_limits()
+        self.callback_handle = app.downloader_config_watcher.connect(
+            'changed', self.on_config_changed)
+
+    def shutdown(self):
+        if self.callback_handle is not None:
+            app.downloader_config_watcher.disconnect(self.callback_handle)
+            self.callback_handle = None
+
+    def set_limits(self):
+        rate = None
+        if app.config.get(prefs.LIMIT_DOWNSTREAM_HTTP):
+            rate = app.config.get(prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS) * 1024
+        host_rate = app.config.get(prefs.HTTP_HOST_LIMIT_IN_KBS) * 1024
+        max_per_host = app.config.get(prefs.HTTP_CONNECTIONS_PER_HOST)
+        httpclient.curl_manager.set_limits(rate, host_rate, max_per_host)
+
+    def on_config_changed(self, obj, key, value):
+        if key in self.LIMIT_PREFS:
+            self.set_limits()
+
+HTTP_LIMITS = HTTPLimits()
+
+def compact_status(status):
+    """Round the constantly changing numbers in a status dict.
+
+    Rates and ETAs are floats that change on pretty much every update.  We
+    only display them as whole numbers, so rounding them makes the status
+    smaller and means that tiny changes don't need to be sent at all.
+    """
+    for key in ('rate', 'upload_rate', 'eta'):
+        value = status.get(key)
+        if value is not None:
+            status[key] = int(value)
+    return status
+
 class DownloadStatusUpdater(object):
     """Handles updating status for all in progress downloaders.
 
     On OS X and gtk if the user is on the downloads page and has a
     bunch of downloads going, this can be a fairly CPU intensive task.
-    DownloadStatusUpdaters mitigate this in 2 ways.
+    DownloadStatusUpdaters mitigate this in 3 ways.
 
     1. DownloadStatusUpdater objects batch all status updates into one
        big update which takes much less CPU.
 
-    2. The update don't happen fairly infrequently (currently every 5
-       seconds).
+    2. The update don't happen fairly infrequently (every second when
+       the user can see download progress, every 5 seconds otherwise).
+
+    3. Periodic updates only contain the values that have changed since
+       the last update we sent for a downloader.  Replies to commands and
+       the first update for a downloader contain the full status.
 
     Because updates happen infrequently, DownloadStatusUpdaters should
     only be used for progress updates, not events like downloads
@@ -417,10 +478,23 @@ class DownloadStatusUpdater(object):
     def __init__(self):
         self.to_update = set()
         self.cmds_done = False
+        self.interval = self.UPDATE_CLIENT_INTERVAL
+        self.timeout = None
+        # maps dlids to (downloader, last status sent) tuples
+        self.last_sent = {}
 
     def start_updates(self):
-        eventloop.add_timeout(self.UPDATE_CLIENT_INTERVAL, self.do_update,
-                "Download status update")
+        self.timeout = eventloop.add_timeout(self.interval, self.do_update,
+                                             "Download status update")
+
+    def set_interval(self, interval):
+        """Change how often we send periodic updates."""
+        old_interval = self.interval
+        self.interval = interval
+        if interval < old_interval and self.timeout is not None:
+            # don't wait for the old, longer, timeout to fire
+            self.timeout.cancel()
+            self.start_updates()
 
     def flush_update(self):
         self.do_update(periodic=False)
@@ -429,19 +503,66 @@ class DownloadStatusUpdater(object):
         try:
             TORRENT_SESSION.update_torrents()
             statuses = []
+            deltas = []
             for downloader in self.to_update:
-                statuses.append(downloader.get_status())
+                status, full = self.make_status(downloader, self.cmds_done)
+                if full:
+                    statuses.append(status)
+                elif status is not None:
+                    deltas.append(status)
             self.to_update = set()
-            if statuses or self.cmds_done:
+            self.forget_removed_downloaders()
+            if statuses or deltas or self.cmds_done:
                 command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
                                                   statuses,
-                                                  self.cmds_done).send()
+                                                  self.cmds_done,
+                                                  deltas).send()
                 self.cmds_done = False
         finally:
             if periodic:
-                eventloop.add_timeout(self.UPDATE_CLIENT_INTERVAL,
-                                      self.do_update,
-                                      "Download status update")
+                self.start_updates()
+
+    def make_status(self, downloader, full=False):
+        """Calculate the status to send for a downloader.
+
+        :param full: force sending the full status
+        :returns: (status, full) tuple.  If full is False, status only
+            contains dlid and the values that have changed.  status is None
+            if nothing has changed.
+        """
+        status = compact_status(downloader.get_status())
+        dlid = status['dlid']
+        last = self.last_sent.get(dlid)
+        if last is None or last[0] is not downloader:
+            full = True
+        if full:
+            last_status = status.copy()
+            # metainfo is only in the status when it has changed and it's
+            # big, so don't hold on to it
+            last_status.pop('metainfo', None)
+            self.last_sent[dlid] = (downloader, last_status)
+            return status, True
+        last_status = last[1]
+        delta = dict((key, value) for key, value in status.iteritems()
+                     if key not in last_status or last_status[key] != value)
+        if not delta:
+            return None, False
+        last_status.update(delta)
+        last_status.pop('metainfo', None)
+        delta['dlid'] = dlid
+        return delta, False
+
+    def forget_removed_downloaders(self):
+        if len(self.last_sent) > len(_downloads):
+            for dlid in self.last_sent.keys():
+                if dlid not in _downloads:
+                    del self.last_sent[dlid]
+
+    def send_now(self, downloader):
+        """Send the full status for a downloader immediately."""
+        status, full = self.make_status(downloader, True)
+        command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON, [status],
+                                          False).send()
 
     def set_cmds_done(self):
         self.cmds_done = True
@@ -464,6 +585,9 @@ RETRY_TIMES = (
     )
 
 class BGDownloader(object):
+    # priority of our transfers, see httpclient.PRIORITY_HIGH, etc.
+    priority = httpclient.PRIORITY_NORMAL
+
     def __init__(self, url, dlid):
         self.dlid = dlid
         self.url = url
@@ -500,12 +624,18 @@ class BGDownloader(object):
             'retry_time': self.retry_time,
             'retry_count': self.retry_count}
 
+    def set_priority(self, priority):
+        """Change the priority of our transfers.
+
+        This takes effect the next time we start a transfer.
+        """
+        self.priority = priority
+
     def update_client(self, now=False):
         if not now:
             DOWNLOAD_UPDATER.queue_update(self)
         else:
-            command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                              [self.get_status()]).send()
+            DOWNLOAD_UPDATER.send_now(self)
 
     def pick_initial_filename(self, suffix=".part", torrent=False,
                               is_directory=False, exists=False):
@@ -724,12 +854,16 @@ class BGDownloader(object):
 
 class HTTPDownloader(BGDownloader):
     CHECK_STATS_TIMEOUT = 1.0
+    # set to True if the server didn't handle segmented downloads
+    segments_failed = False
 
     def __init__(self, url=None, dlid=None, restore=None,
-                 expected_content_type=None):
+                 expected_content_type=None,
+                 priority=httpclient.PRIORITY_NORMAL):
         self.retry_dc = None
         self.channel_name = None
         self.expected_content_type = expected_content_type
+        self.priority = priority
         if restore is not None:
             self.__dict__.update(restore)
             self.restartOnError = True
@@ -737,6 +871,7 @@ class HTTPDownloader(BGDownloader):
             BGDownloader.__init__(self, url, dlid)
             self.restartOnError = False
         self.client = None
+        self.probe_client = None
         self.rate = None
         if self.state == u'downloading':
             self.start_download()
@@ -755,6 +890,9 @@ class HTTPDownloader(BGDownloader):
         if self.retry_dc:
             self.retry_dc.cancel()
             self.retry_dc = None
+        if self._should_use_segments(resume):
+            self._start_segment_probe(resume)
+            return
         if resume:
             resume = self._resume_sanity_check()
 
@@ -763,9 +901,63 @@ class HTTPDownloader(BGDownloader):
         self.client = httpclient.grab_url(
             self.url, self.on_download_finished, self.on_download_error,
             header_callback=self.on_headers, write_file=self.filename,
-            resume=resume)
+            resume=resume, priority=self.priority)
+        self.update_stats()
+
+    def _should_use_segments(self, resume):
+        if self.segments_failed:
+            return False
+        if segmented.has_state(self.filename):
+            # The data for a segmented download isn't contiguous, so we
+            # can't resume it with a single connection.
+            if resume:
+                return True
+            segmented.remove_state(self.filename)
+        elif resume and self.current_size > 0:
+            # don't switch a single connection download to segments
+            return False
+        return app.config.get(prefs.HTTP_SEGMENTED_DOWNLOADS)
+
+    def _start_segment_probe(self, resume):
+        """Check if the server supports range requests."""
+        logging.debug("probing for segmented download: %s", self.url)
+        def callback(info):
+            self.on_segment_probe(info, resume)
+        self.probe_client = httpclient.grab_headers(self.url, callback,
+                                                    self.on_segment_probe_error)
+
+    def on_segment_probe(self, info, resume):
+        self.probe_client = None
+        if self.state != u'downloading':
+            return
+        if not segmented.supports_segments(info):
+            logging.debug("not using segments for %s", self.url)
+            self.segments_failed = True
+            if segmented.has_state(self.filename):
+                segmented.remove_state(self.filename)
+                self.start_new_download()
+            else:
+                self.start_download(resume)
+            return
+        self.on_headers(info)
+        if self.state != u'downloading':
+            # on_headers() found a problem
+            return
+        state = None
+        if resume:
+            state = segmented.load_state(self.filename)
+        self.client = segmented.SegmentedClient(
+            info['redirected-url'], self.filename, info,
+            app.config.get(prefs.HTTP_DOWNLOAD_SEGMENTS),
+            self.on_download_finished, self.on_download_error,
+            priority=self.priority, state=state)
+        self.client.start()
         self.update_stats()
 
+    def on_segment_probe_error(self, error):
+        self.probe_client = None
+        self.on_download_error(error)
+
     def _resume_sanity_check(self):
         """Do sanity checks to test if we should try HTTP Resume.
 
@@ -799,6 +991,9 @@ class HTTPDownloader(BGDownloader):
         self.client = None
 
     def cancel_request(self, remove_file=False):
+        if self.probe_client is not None:
+            self.probe_client.cancel()
+            self.probe_client = None
         if self.client is not None:
             self.client.cancel(remove_file=remove_file)
             self.destroy_client()
@@ -815,6 +1010,7 @@ class HTTPDownloader(BGDownloader):
                 fileutil.remove(self.filename)
             except OSError:
                 pass
+        segmented.remove_state(self.filename)
         self.current_size = 0
         self.total_size = None
 
@@ -852,7 +1048,13 @@ class HTTPDownloader(BGDownloader):
                 ext_content_type)
 
     def on_download_error(self, error):
-        if isinstance(error, httpclient.ResumeFailed):
+        if isinstance(error, segmented.RangeRequestsFailed):
+            logging.info("segmented download failed, using a single "
+                         "connection: %s", self.url)
+            self.destroy_client()
+            self.segments_failed = True
+            self.start_new_download()
+        elif isinstance(error, httpclient.ResumeFailed):
             # try starting from scratch
             self.current_size = 0
             self.total_size = None
@@ -934,6 +1136,7 @@ class HTTPDownloader(BGDownloader):
             # Cancel the request, don't keep around partially
             # downloaded data
             self.cancel_request(remove_file=True)
+            segmented.remove_state(self.filename)
         self.current_size = 0
         self.state = u"stopped"
         self.update_client()
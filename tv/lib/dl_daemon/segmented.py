@@ -0,0 +1,355 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.dl_daemon.segmented -- Download a file with parallel range requests.
+
+SegmentedClient splits a download into a few byte ranges and fetches them at
+the same time.  Each range is a separate libcurl transfer that writes
+directly to its part of the download file.  For big files on high-latency
+servers, this gets much closer to filling the pipe than a single connection.
+
+Progress is stored in a state file next to the download file, so a paused or
+interrupted download can pick up where its segments left off.
+"""
+
+import json
+import logging
+import os
+
+from miro.gtcache import gettext as _
+from miro import download_utils
+from miro import eventloop
+from miro import fileutil
+from miro import httpclient
+
+# don't split downloads into segments smaller than this
+MIN_SEGMENT_SIZE = 2 ** 20
+# how often to save the state file while downloading
+SAVE_STATE_INTERVAL = 5.0
+STATE_FILE_SUFFIX = '.segments'
+
+class RangeRequestsFailed(httpclient.HTTPError):
+    """The server didn't handle our range requests correctly."""
+    def __init__(self, host):
+        httpclient.HTTPError.__init__(self,
+                _('%(host)s doesn\'t support segmented downloads',
+                  {"host": host}))
+
+def supports_segments(info):
+    """Check the headers from a HEAD request to see if we can use segments.
+    """
+    if info.get('accept-ranges', '').lower() != 'bytes':
+        return False
+    total_size = info.get('content-length')
+    return total_size is not None and total_size >= 2 * MIN_SEGMENT_SIZE
+
+def state_path(filename):
+    return filename + STATE_FILE_SUFFIX
+
+def has_state(filename):
+    return os.path.exists(state_path(filename))
+
+def load_state(filename):
+    """Load the saved state for a segmented download.
+
+    :returns: state dict, or None if there's no valid state file
+    """
+    path = state_path(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        f = fileutil.open_file(path, 'rb')
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        state['segments'] = [Segment(int(start), int(end), int(done))
+                             for start, end, done in state['segments']]
+        state['total_size'] = int(state['total_size'])
+    except (IOError, ValueError, KeyError, TypeError), e:
+        logging.warn("Error loading segment state from %r: %s", path, e)
+        return None
+    return state
+
+def save_state(filename, state):
+    path = state_path(filename)
+    data = state.copy()
+    data['segments'] = [(segment.start, segment.end, segment.current_done())
+                        for segment in state['segments']]
+    try:
+        f = fileutil.open_file(path, 'wb')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+    except IOError, e:
+        logging.warn("Error saving segment state to %r: %s", path, e)
+
+def remove_state(filename):
+    try:
+        fileutil.remove(state_path(filename))
+    except OSError:
+        pass
+
+class Segment(object):
+    """A byte range of a download.
+
+    start and end are file positions (end is inclusive).  done is the number
+    of bytes at the start of the range that we've already written.
+    """
+    def __init__(self, start, end, done=0):
+        self.start = start
+        self.end = end
+        self.done = done
+        self.client = None
+
+    def length(self):
+        return self.end - self.start + 1
+
+    def is_finished(self):
+        return self.done >= self.length()
+
+    def current_done(self):
+        """Calculate done, including the data from the current transfer."""
+        done = self.done
+        if self.client is not None:
+            stats = self.client.get_stats()
+            # only count data from successful responses, that's the only
+            # data that gets written
+            if stats.status_code == 206:
+                done += stats.downloaded
+        return min(done, self.length())
+
+    def current_rate(self):
+        if self.client is None:
+            return 0
+        return self.client.get_stats().download_rate
+
+def make_segments(total_size, count):
+    """Split a download into count segments.
+
+    We will use less segments than count to keep them at least
+    MIN_SEGMENT_SIZE bytes.
+    """
+    count = max(1, min(count, total_size // MIN_SEGMENT_SIZE))
+    size = total_size // count
+    segments = []
+    for i in xrange(count):
+        start = i * size
+        if i == count - 1:
+            end = total_size - 1
+        else:
+            end = start + size - 1
+        segments.append(Segment(start, end))
+    return segments
+
+class SegmentedClient(object):
+    """Downloads a file by fetching several ranges in parallel.
+
+    SegmentedClient has the same interface as httpclient.HTTPClient, so
+    HTTPDownloader can use either one once the transfer is started.
+
+    If the server responds to a range request with anything but the bytes
+    that we asked for, the errback gets a RangeRequestsFailed error.  The
+    caller should then start over using a single connection.
+    """
+
+    def __init__(self, url, filename, info, segment_count, callback,
+                 errback, priority=httpclient.PRIORITY_NORMAL, state=None):
+        """Create a SegmentedClient.
+
+        :param url: URL to download.  This should be the redirected URL
+            from probing the server.
+        :param filename: file to write to
+        :param info: the callback info from a HEAD request for url
+        :param segment_count: number of segments to use for a new download
+        :param callback: function to call when the download finishes
+        :param errback: function to call when the download fails
+        :param priority: priority for our transfers
+        :param state: state returned by load_state() to resume from
+        """
+        self.url = url
+        self.filename = filename
+        self.info = info
+        self.host = download_utils.parse_url(url)[1]
+        self.callback = callback
+        self.errback = errback
+        self.priority = priority
+        self.state = {
+            'total_size': info['content-length'],
+            'etag': info.get('etag'),
+            'last-modified': info.get('last-modified'),
+        }
+        if state is not None and self._state_matches(state):
+            self.state['segments'] = state['segments']
+            self.preallocate = False
+        else:
+            self.state['segments'] = make_segments(self.state['total_size'],
+                                                   segment_count)
+            self.preallocate = True
+        self.segments = self.state['segments']
+        self.initial_size = sum(segment.done for segment in self.segments)
+        self.canceled = False
+        self.save_dc = None
+
+    def _state_matches(self, state):
+        for key in ('total_size', 'etag', 'last-modified'):
+            if state.get(key) != self.state[key]:
+                return False
+        return True
+
+    def start(self):
+        if self.preallocate:
+            try:
+                self._preallocate_file()
+            except IOError:
+                self._call_errback(httpclient.WriteError(self.filename))
+                return
+        for segment in self.segments:
+            if not segment.is_finished():
+                self._start_segment(segment)
+        save_state(self.filename, self.state)
+        self._schedule_save()
+        self._check_finished()
+
+    def _preallocate_file(self):
+        # truncate() creates a sparse file on most filesystems, so this is
+        # fast even for big downloads
+        f = fileutil.open_file(self.filename, 'wb')
+        try:
+            f.truncate(self.state['total_size'])
+        finally:
+            f.close()
+
+    def _start_segment(self, segment):
+        def callback(info):
+            self._on_segment_finished(segment)
+        def errback(error):
+            self._on_segment_error(segment, error)
+        byte_range = (segment.start + segment.done, segment.end)
+        segment.client = httpclient.grab_url(self.url, callback, errback,
+                                             write_file=self.filename,
+                                             priority=self.priority,
+                                             byte_range=byte_range)
+
+    def _on_segment_finished(self, segment):
+        if self.canceled:
+            return
+        expected = segment.length() - segment.done
+        received = segment.client.get_stats().downloaded
+        segment.client = None
+        if received != expected:
+            logging.warn("segmented download: got %s bytes, expected %s "
+                         "(%s)", received, expected, self.url)
+            self._fail(RangeRequestsFailed(self.host))
+            return
+        segment.done = segment.length()
+        self._check_finished()
+
+    def _on_segment_error(self, segment, error):
+        if self.canceled:
+            return
+        segment.done = segment.current_done()
+        segment.client = None
+        if isinstance(error, (httpclient.UnexpectedStatusCode,
+                              httpclient.ResumeFailed)):
+            # the server doesn't like our range requests
+            error = RangeRequestsFailed(self.host)
+        self._fail(error)
+
+    def _fail(self, error):
+        self.cancel()
+        if isinstance(error, RangeRequestsFailed):
+            remove_state(self.filename)
+        self._call_errback(error)
+
+    def _check_finished(self):
+        for segment in self.segments:
+            if not segment.is_finished():
+                return
+        self.canceled = True
+        self._cancel_save()
+        remove_state(self.filename)
+        eventloop.add_idle(self.callback, 'segmented download callback',
+                           args=(self.info.copy(),))
+
+    def _call_errback(self, error):
+        eventloop.add_idle(self.errback, 'segmented download errback',
+                           args=(error,))
+
+    def _schedule_save(self):
+        self.save_dc = eventloop.add_timeout(SAVE_STATE_INTERVAL,
+                                             self._save_timeout,
+                                             'save segmented download state')
+
+    def _cancel_save(self):
+        if self.save_dc is not None:
+            self.save_dc.cancel()
+            self.save_dc = None
+
+    def _save_timeout(self):
+        self.save_dc = None
+        if not self.canceled:
+            save_state(self.filename, self.state)
+            self._schedule_save()
+
+    def cancel(self, remove_file=False):
+        if self.canceled:
+            return
+        self.canceled = True
+        self._cancel_save()
+        for segment in self.segments:
+            if segment.client is not None:
+                segment.done = segment.current_done()
+                segment.client.cancel(remove_file=remove_file)
+                segment.client = None
+        if remove_file:
+            remove_state(self.filename)
+            try:
+                fileutil.remove(self.filename)
+            except OSError:
+                pass
+        else:
+            save_state(self.filename, self.state)
+
+    def get_stats(self):
+        """Get the combined stats for all segments.
+
+        :returns: a TransferStats object
+        """
+        stats = httpclient.TransferStats()
+        done = sum(segment.current_done() for segment in self.segments)
+        stats.status_code = 206
+        stats.initial_size = self.initial_size
+        stats.downloaded = done - self.initial_size
+        stats.download_total = self.state['total_size'] - self.initial_size
+        stats.download_rate = sum(segment.current_rate()
+                                  for segment in self.segments)
+        stats.priority = self.priority
+        return stats
@@ -74,10 +74,15 @@ class DownloadStateManager(object):
     RESTORE = command.DownloaderBatchCommand.RESTORE
 
     UPDATE_INTERVAL = 1
+    # how often the downloader sends status updates when the user can see
+    # download progress, and when they can't
+    STATUS_INTERVAL_DISPLAYED = 1
+    STATUS_INTERVAL_HIDDEN = 5
 
     def __init__(self):
         self.total_up_rate = 0
         self.total_down_rate = 0
+        self.status_interval = self.STATUS_INTERVAL_DISPLAYED
         # a hash of download ids that the server knows about.
         self.downloads = {}
         self.daemon_starter = None
@@ -118,6 +123,25 @@ class DownloadStateManager(object):
                               self.send_updates,
                               "Send Download Command Updates")
 
+    def set_progress_displayed(self, displayed):
+        """Tell the downloader whether the user can see download progress.
+
+        We use this to pick how often the downloader sends status updates.
+        """
+        if displayed:
+            interval = self.STATUS_INTERVAL_DISPLAYED
+        else:
+            interval = self.STATUS_INTERVAL_HIDDEN
+        if interval != self.status_interval:
+            self.status_interval = interval
+            if self.daemon_started():
+                self.send_status_interval()
+
+    def send_status_interval(self):
+        c = command.SetStatusUpdateIntervalCommand(RemoteDownloader.dldaemon,
+                                                   self.status_interval)
+        c.send()
+
     def get_download(self, dlid):
         try:
             return self.downloads[dlid]
@@ -195,6 +219,8 @@ class DownloadStateManager(object):
         self.daemon_starter.startup()
         # Now that the daemon has started, we can process updates.
         self.send_initial_updates()
+        if self.status_interval != self.STATUS_INTERVAL_DISPLAYED:
+            self.send_status_interval()
         self.start_updates()
     
     def shutdown_downloader(self, callback=None):
@@ -280,6 +306,9 @@ class RemoteDownloader(DDBObject):
             check_u(content_type)
         self.orig_url = self.url = url
         self.item_list = []
+        # item_list gets filled in after we start downloading, so remember
+        # this for calc_priority()
+        self.auto_downloaded = item.get_auto_downloaded()
         self.child_deleted = False
         self.main_item_id = None
         self.dlid = generate_dlid()
@@ -312,6 +341,7 @@ class RemoteDownloader(DDBObject):
         self.last_update = time.time()
         self.delete_files = True
         self.item_list = []
+        self.auto_downloaded = False
         if self.dlid == 'noid':
             # this won't happen nowadays, but it can for old databases
             self.dlid = generate_dlid()
@@ -322,11 +352,18 @@ class RemoteDownloader(DDBObject):
             default = self.status_attribute_defaults.get(attr_name)
             setattr(self, attr_name, default)
 
-    def update_status_attributes(self, status_dict):
-        """Reset the attributes that track downloading info."""
+    def update_status_attributes(self, status_dict, partial=False):
+        """Reset the attributes that track downloading info.
+
+        :param partial: if True, status_dict only contains values that have
+            changed.  Otherwise attributes missing from status_dict are reset
+            to their defaults.
+        """
         for attr_name in self.status_attributes:
             if attr_name in status_dict:
                 value = status_dict[attr_name]
+            elif partial:
+                continue
             else:
                 value = self.status_attribute_defaults.get(attr_name)
             # only set attributes if something's changed.  This makes our
@@ -343,6 +380,7 @@ class RemoteDownloader(DDBObject):
         status['channel_name'] = self.channel_name
         status['dlid'] = self.dlid
         status['url'] = self.url
+        status['priority'] = self.calc_priority()
         return status
 
     @classmethod
@@ -443,94 +481,151 @@ class RemoteDownloader(DDBObject):
 
     @classmethod
     def update_status(cls, data, cmd_done=False):
+        cls._prepare_status_data(data)
+        self = get_downloader_by_dlid(dlid=data['dlid'])
+        if self is not None:
+            return self.apply_status(data, cmd_done)
+        return True
+
+    @classmethod
+    def update_status_batch(cls, statuses, deltas, cmd_done=False):
+        """Update status for a batch of downloaders.
+
+        This is what we use for the status updates that the downloader sends
+        every second.  We fetch all the downloaders with one query and check
+        the view trackers once for the whole batch.
+
+        :param statuses: list of full status dicts
+        :param deltas: list of status dicts that only contain changed values
+        :returns: False if any of the updates were stale
+        """
+        updates = ([(data, False) for data in statuses] +
+                   [(data, True) for data in deltas])
+        for data, partial in updates:
+            cls._prepare_status_data(data)
+        downloaders = cls._downloaders_for_dlids(
+            [data['dlid'] for data, partial in updates])
+        fresh = True
+        view_tracker_manager = app.db_info.view_tracker_manager
+        view_tracker_manager.start_batch()
+        try:
+            for data, partial in updates:
+                downloader = downloaders.get(data['dlid'])
+                if downloader is None or not downloader.id_exists():
+                    continue
+                if not downloader.apply_status(data, cmd_done, partial):
+                    fresh = False
+        finally:
+            view_tracker_manager.finish_batch()
+        return fresh
+
+    @classmethod
+    def _downloaders_for_dlids(cls, dlids):
+        downloaders = {}
+        for chunk in util.split_values_for_sqlite(list(set(dlids))):
+            placeholders = ', '.join('?' for i in xrange(len(chunk)))
+            view = cls.make_view('dlid IN (%s)' % placeholders, chunk)
+            for downloader in view:
+                downloaders[downloader.dlid] = downloader
+        return downloaders
+
+    @staticmethod
+    def _prepare_status_data(data):
         for field in data:
             if field not in ['filename', 'short_filename', 'metainfo']:
                 data[field] = unicodify(data[field])
 
-        self = get_downloader_by_dlid(dlid=data['dlid'])
         # FIXME: how do we get all of the possible bit torrent
         # activity strings into gettext? --NN
         if data.has_key('activity') and data['activity']:
             data['activity'] = _(data['activity'])
 
-        if self is not None:
-            now = time.time()
-            last_update = self.last_update
-            state = self.get_state()
+    def apply_status(self, data, cmd_done=False, partial=False):
+        """Update our status attributes from a downloader status dict.
+
+        :param partial: data only contains the values that have changed
+        :returns: False if the update was stale and we ignored it
+        """
+        now = time.time()
+        last_update = self.last_update
+        state = self.get_state()
+        if partial:
+            new_state = data.get('state', state)
+        else:
             new_state = data.get('state', u'downloading')
 
-            # If this item was marked as pending update, then any update
-            # which comes in now which does not have cmd_done set is void.
-            if not cmd_done and self.status_updates_frozen:
-                logging.debug('self = %s, '
-                              'saved state = %s '
-                              'downloader state = %s.  '
-                              'Discard.',
+        # If this item was marked as pending update, then any update
+        # which comes in now which does not have cmd_done set is void.
+        if not cmd_done and self.status_updates_frozen:
+            logging.debug('self = %s, '
+                          'saved state = %s '
+                          'downloader state = %s.  '
+                          'Discard.',
+                          self, state, new_state)
+            # treat as stale
+            return False
+
+        # If the state is one which we set and was meant to be passed
+        # through to the downloader (valid_states), and the downloader
+        # replied with something that was a response to a previous
+        # download command, and state was also a part of valid_states,
+        # but the saved state and the new state do not match
+        # then it means the message is stale.
+        #
+        # Have a think about why this is true: when you set a state,
+        # which is authoritative, to the downloader you expect it
+        # to reply with that same state.  If they do not match then it
+        # means the message is stale.
+        #
+        # The exception to this rule is if the downloader replies with
+        # an error state, or if downloading has transitioned to finished
+        # state.
+        #
+        # This also does not apply to any state which we set on the
+        # downloader via a restore command.  A restore command before
+        # a pause/resume/cancel will work as intended, and no special
+        # trickery is required.  A restore command which happens after
+        # a pause/resume/cancel is void, so no work is required.
+        #
+        # I hope this makes sense and is clear!
+        valid_states = (u'downloading', u'paused', u'stopped',
+                        u'uploading-paused', u'finished')
+        if (cmd_done and
+          state in valid_states and new_state in valid_states and
+          state != new_state):
+            if not (state == u'downloading' and new_state == u'finished'):
+                logging.debug('self = %s STALE.  '
+                              'Saved state %s, got state %s.  Discarding.',
                               self, state, new_state)
-                # treat as stale
                 return False
 
-            # If the state is one which we set and was meant to be passed
-            # through to the downloader (valid_states), and the downloader
-            # replied with something that was a response to a previous
-            # download command, and state was also a part of valid_states,
-            # but the saved state and the new state do not match
-            # then it means the message is stale.
-            #
-            # Have a think about why this is true: when you set a state,
-            # which is authoritative, to the downloader you expect it
-            # to reply with that same state.  If they do not match then it
-            # means the message is stale.
-            #
-            # The exception to this rule is if the downloader replies with
-            # an error state, or if downloading has transitioned to finished
-            # state.
-            #
-            # This also does not apply to any state which we set on the
-            # downloader via a restore command.  A restore command before
-            # a pause/resume/cancel will work as intended, and no special
-            # trickery is required.  A restore command which happens after
-            # a pause/resume/cancel is void, so no work is required.
-            #
-            # I hope this makes sense and is clear!
-            valid_states = (u'downloading', u'paused', u'stopped',
-                            u'uploading-paused', u'finished')
-            if (cmd_done and
-              state in valid_states and new_state in valid_states and
-              state != new_state):
-                if not (state == u'downloading' and new_state == u'finished'):
-                    logging.debug('self = %s STALE.  '
-                                  'Saved state %s, got state %s.  Discarding.',
-                                  self, state, new_state)
-                    return False
-
-            # We are updating!  Reset the status_updates_frozen flag.
-            self.status_updates_frozen = False
-
-            # We have something to update: update the last updated timestamp.
-            self.last_update = now
-
-            was_finished = self.is_finished()
-            old_filename = self.get_filename()
+        # We are updating!  Reset the status_updates_frozen flag.
+        self.status_updates_frozen = False
 
-            self.before_changing_rates()
-            self.update_status_attributes(data)
-            self.after_changing_rates()
+        # We have something to update: update the last updated timestamp.
+        self.last_update = now
 
-            # Store the time the download finished
-            finished = self.is_finished() and not was_finished
-            name_changed = self.get_filename() != old_filename
-            file_migrated = (self.is_finished() and name_changed)
+        was_finished = self.is_finished()
+        old_filename = self.get_filename()
 
-            if ((self.get_state() == u'uploading'
-                 and not self.manualUpload
-                 and (app.config.get(prefs.LIMIT_UPLOAD_RATIO)
-                      and self.get_upload_ratio() > app.config.get(prefs.UPLOAD_RATIO)))):
-                self.stop_upload()
+        self.before_changing_rates()
+        self.update_status_attributes(data, partial)
+        self.after_changing_rates()
 
-            self.signal_change()
+        # Store the time the download finished
+        finished = self.is_finished() and not was_finished
+        name_changed = self.get_filename() != old_filename
+        file_migrated = (self.is_finished() and name_changed)
+
+        if ((self.get_state() == u'uploading'
+             and not self.manualUpload
+             and (app.config.get(prefs.LIMIT_UPLOAD_RATIO)
+                  and self.get_upload_ratio() > app.config.get(prefs.UPLOAD_RATIO)))):
+            self.stop_upload()
 
-            self.update_item_list(finished, file_migrated, old_filename)
+        self.signal_change()
+
+        self.update_item_list(finished, file_migrated, old_filename)
         return True
 
     def update_item_list(self, finished, file_migrated, old_filename):
@@ -565,6 +660,22 @@ class RemoteDownloader(DDBObject):
         else:
             return None
 
+    def calc_priority(self):
+        """Calculate the priority for our HTTP transfer.
+
+        Auto-downloads get a lower priority than downloads the user
+        started.
+        """
+        if self.item_list:
+            auto_downloaded = all(item.get_auto_downloaded()
+                                  for item in self.item_list)
+        else:
+            auto_downloaded = self.auto_downloaded
+        if auto_downloaded:
+            return httpclient.PRIORITY_LOW
+        else:
+            return httpclient.PRIORITY_NORMAL
+
     def run_downloader(self):
         """This is the actual download thread.
         """
@@ -587,7 +698,8 @@ class RemoteDownloader(DDBObject):
             self.url = url
             logging.debug("downloading url %s", self.url)
             args = dict(url=self.url, content_type=self.content_type,
-                        channel_name=self.channel_name)
+                        channel_name=self.channel_name,
+                        priority=self.calc_priority())
             app.download_state_manager.add_download(self.dlid, self)
             app.download_state_manager.queue(self.dlid,
                                              app.download_state_manager.RESUME,
@@ -674,7 +786,8 @@ class RemoteDownloader(DDBObject):
         elif self.get_state() in (u'stopped', u'paused', u'offline'):
             if app.download_state_manager.get_download(self.dlid):
                 args = dict(url=self.url, content_type=self.content_type,
-                            channel_name=self.channel_name)
+                            channel_name=self.channel_name,
+                            priority=self.calc_priority())
                 app.download_state_manager.queue(
                     self.dlid,
                     app.download_state_manager.RESUME,
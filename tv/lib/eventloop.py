@@ -35,8 +35,10 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import collections
 import errno
 import heapq
+import itertools
 import logging
 import Queue
 import select
@@ -54,13 +56,135 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+class SampleStats(object):
+    """Tracks a series of samples (callback times, queue sizes, etc).
+
+    We keep the count, total and max for all samples, but only remember the
+    last SAMPLE_COUNT samples for calculating percentiles.
+    """
+    SAMPLE_COUNT = 1000
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.recent = collections.deque(maxlen=self.SAMPLE_COUNT)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, percent):
+        """Get a percentile of the recent samples.
+
+        :param percent: percentile to calculate, from 0 to 100
+        :returns: the sample value or None if we don't have any samples
+        """
+        if not self.recent:
+            return None
+        samples = sorted(self.recent)
+        index = int(round((len(samples) - 1) * percent / 100.0))
+        return samples[index]
+
+class EventLoopProfiler(object):
+    """Records how long event loop callbacks take.
+
+    Profiling is off by default, since it adds some overhead to each
+    callback.  Call enable() to start profiling and report() to get a
+    summary of what the event loop is spending its time on.
+
+    :attribute callbacks: maps (kind, name) tuples to SampleStats for the
+    time spent in those callbacks.  kind is "idle", "urgent", "timeout" or
+    "socket".
+    :attribute idle_queue_depth: SampleStats for the size of the idle queue
+    at the start of each loop iteration
+    :attribute loop_latency: SampleStats for how long it takes to process
+    the events for each loop iteration
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.callbacks = {}
+        self.idle_queue_depth = SampleStats()
+        self.loop_latency = SampleStats()
+
+    def record_callback(self, kind, name, seconds):
+        key = (kind, name)
+        try:
+            stats = self.callbacks[key]
+        except KeyError:
+            stats = self.callbacks[key] = SampleStats()
+        stats.add(seconds)
+
+    def report(self, limit=None):
+        """Get a summary of the profile data.
+
+        :param limit: only include the callbacks with the highest total time
+        :returns: list of lines of text
+        """
+        def format_time(seconds):
+            if seconds is None:
+                return '-'
+            return '%.1fms' % (seconds * 1000)
+        latency = self.loop_latency
+        lines = []
+        lines.append('loop iterations: %s (p50: %s p95: %s p99: %s '
+                     'max: %s)' % (latency.count,
+                                   format_time(latency.percentile(50)),
+                                   format_time(latency.percentile(95)),
+                                   format_time(latency.percentile(99)),
+                                   format_time(latency.max)))
+        if self.idle_queue_depth.count:
+            mean_depth = (float(self.idle_queue_depth.total) /
+                          self.idle_queue_depth.count)
+        else:
+            mean_depth = 0
+        lines.append('idle queue depth: mean: %.1f p95: %s max: %s' %
+                     (mean_depth, self.idle_queue_depth.percentile(95),
+                      self.idle_queue_depth.max))
+        callbacks = sorted(self.callbacks.items(),
+                           key=lambda item: item[1].total,
+                           reverse=True)
+        if limit is not None:
+            callbacks = callbacks[:limit]
+        lines.append('%-8s %8s %9s %9s %9s %9s  %s' % ('kind', 'count', 'p50',
+                                                        'p95', 'p99', 'total',
+                                                        'name'))
+        for (kind, name), stats in callbacks:
+            lines.append('%-8s %8d %9s %9s %9s %9s  %s' % (
+                kind, stats.count,
+                format_time(stats.percentile(50)),
+                format_time(stats.percentile(95)),
+                format_time(stats.percentile(99)),
+                format_time(stats.total), name))
+        return lines
+
+    def log_report(self, limit=None):
+        logging.info("Event loop profile:\n%s",
+                     '\n'.join(self.report(limit)))
+
+profiler = EventLoopProfiler()
+
 class DelayedCall(object):
-    def __init__(self, function, name, args, kwargs):
+    def __init__(self, function, name, args, kwargs, kind='idle'):
         self.function = function
         self.name = name
         self.args = args
         self.kwargs = kwargs
+        self.kind = kind
         self.canceled = False
+        # Scheduler that we're waiting in, if any
+        self.scheduler = None
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -70,6 +194,8 @@ class DelayedCall(object):
         self.function = self.args = self.kwargs = None
 
     def cancel(self):
+        if not self.canceled and self.scheduler is not None:
+            self.scheduler.call_canceled()
         self.canceled = True
         self._unlink()
 
@@ -94,12 +220,33 @@ class DelayedCall(object):
                 logging.timing("%s cumulative is too slow (%.3f secs)",
                                self.name, total)
                 cumulative[self.name] = 0
+            if profiler.enabled:
+                profiler.record_callback(self.kind, self.name, end - start)
         self._unlink()
         return success
 
 class Scheduler(object):
+    """Keeps track of timeouts.
+
+    Timeouts are stored in a heap.  Canceling a timeout just marks it as
+    canceled, which is O(1).  Canceled timeouts get thrown away once they
+    reach the top of the heap, or when they make up most of the heap, in
+    which case we rebuild it with only the live timeouts.
+
+    add_timeout() and DelayedCall.cancel() can be called from any thread,
+    so access to the heap is protected by a lock.
+    """
+    # Rebuild the heap when at least this many of its entries are canceled
+    # and they make up over half of it.
+    COMPACT_MIN_CANCELED = 64
+
     def __init__(self):
         self.heap = []
+        self.lock = threading.Lock()
+        # used to break ties for timeouts scheduled for the same time, so
+        # they run in the order they were added.
+        self.counter = itertools.count()
+        self.canceled_count = 0
 
     def add_timeout(self, delay, function, name, args=None, kwargs=None):
         if args is None:
@@ -107,25 +254,109 @@ class Scheduler(object):
         if kwargs is None:
             kwargs = {}
         scheduled_time = clock() + delay
-        dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
-        heapq.heappush(self.heap, (scheduled_time, dc))
+        dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs,
+                         'timeout')
+        dc.scheduler = self
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.heap,
+                           (scheduled_time, self.counter.next(), dc))
+        finally:
+            self.lock.release()
+        return dc
+
+    def call_canceled(self):
+        """Called by DelayedCall.cancel() for our timeouts."""
+        self.lock.acquire()
+        try:
+            self.canceled_count += 1
+            if (self.canceled_count >= self.COMPACT_MIN_CANCELED and
+                    self.canceled_count * 2 > len(self.heap)):
+                self._compact()
+        finally:
+            self.lock.release()
+
+    def _compact(self):
+        """Remove all canceled timeouts from the heap.
+
+        Call this with self.lock acquired.
+        """
+        self.heap = [entry for entry in self.heap if not entry[2].canceled]
+        heapq.heapify(self.heap)
+        self.canceled_count = 0
+
+    def _pop(self):
+        """Pop the top of the heap.
+
+        Call this with self.lock acquired.
+        """
+        dc = heapq.heappop(self.heap)[2]
+        dc.scheduler = None
         return dc
 
+    def _discard_canceled(self):
+        """Throw away canceled timeouts at the top of the heap.
+
+        Call this with self.lock acquired.
+        """
+        while self.heap and self.heap[0][2].canceled:
+            self._pop()
+            self.canceled_count -= 1
+
     def next_timeout(self):
-        if len(self.heap) == 0:
-            return None
-        else:
-            return max(0, self.heap[0][0] - clock())
+        self.lock.acquire()
+        try:
+            self._discard_canceled()
+            if len(self.heap) == 0:
+                return None
+            else:
+                return max(0, self.heap[0][0] - clock())
+        finally:
+            self.lock.release()
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        self.lock.acquire()
+        try:
+            self._discard_canceled()
+            return len(self.heap) > 0 and self.heap[0][0] < clock()
+        finally:
+            self.lock.release()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
+        self.lock.acquire()
+        try:
+            self._discard_canceled()
+            dc = self._pop()
+        finally:
+            self.lock.release()
         return dc.dispatch()
 
+    def pop_due_timeouts(self):
+        """Remove all timeouts that are due and return them.
+
+        This lets the event loop handle all timeouts that fall due in the
+        same iteration while only checking the time and acquiring our lock
+        once.
+
+        :returns: list of DelayedCalls in the order they should run
+        """
+        due = []
+        self.lock.acquire()
+        try:
+            now = clock()
+            while self.heap and self.heap[0][0] < now:
+                if self.heap[0][2].canceled:
+                    self.canceled_count -= 1
+                    self._pop()
+                else:
+                    due.append(self._pop())
+        finally:
+            self.lock.release()
+        return due
+
 class CallQueue(object):
-    def __init__(self):
+    def __init__(self, kind='idle'):
+        self.kind = kind
         self.queue = Queue.Queue()
         self.quit_flag = False
         self.queue_size_warning_count = 0
@@ -135,7 +366,8 @@ class CallQueue(object):
             args = ()
         if kwargs is None:
             kwargs = {}
-        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs,
+                         self.kind)
         self.queue.put(dc)
 
         # Check if our queue size is too big and log a warning if so.  Only do
@@ -165,60 +397,320 @@ class CallQueue(object):
             self.process_next_idle()
 
 
+class ThreadPoolTaskStats(object):
+    """Stats for ThreadPool tasks with the same name.
+
+    :attribute queue_wait: SampleStats for the time between
+    call_in_thread() and when the task started running
+    :attribute run_time: SampleStats for the time it took to run the task
+    """
+    def __init__(self):
+        self.queue_wait = SampleStats()
+        self.run_time = SampleStats()
+
+# maps task names to ThreadPoolTaskStats objects.  Task names should say
+# what kind of task it is, not which host, file, etc. it's for, otherwise
+# this grows without bound.
+thread_pool_stats = {}
+
+# Priorities for call_in_thread_with_priority().  Lower values run first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    Each task has a priority.  Tasks with lower priority values run first.
+    To keep slow, low-priority tasks from starving the others, each priority
+    can only use some of the threads, see RESERVED_THREADS.
+
+    The pool starts with min_threads threads.  If there are tasks waiting and
+    no threads to run them, we add threads up to max_threads.  Threads that
+    are idle for IDLE_TIMEOUT seconds exit, until we're back to min_threads.
+    Idle threads block without a timeout; a timeout in the event loop picks
+    which ones should exit and wakes them up.
     """
     THREADS = 4
-
-    def __init__(self, event_loop):
+    MAX_THREADS = 12
+    # Number of threads that can only be used by higher priority tasks.  For
+    # example, PRIORITY_LOW tasks can't run unless there are at least 2 free
+    # threads, which leaves room for PRIORITY_NORMAL and PRIORITY_HIGH tasks.
+    RESERVED_THREADS = {
+        PRIORITY_HIGH: 0,
+        PRIORITY_NORMAL: 1,
+        PRIORITY_LOW: 2,
+    }
+    IDLE_TIMEOUT = 30.0
+
+    def __init__(self, event_loop, min_threads=None, max_threads=None):
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
+        self.condition = threading.Condition()
+        # map priorities to a deque of tasks waiting to be run
+        self.queues = dict((priority, collections.deque())
+                           for priority in self.RESERVED_THREADS)
         self.threads = []
+        self.busy_count = 0
+        # maps idle threads to the time they started waiting
+        self.idle_since = {}
+        # idle threads that retire_idle_threads() picked to exit
+        self.retiring = set()
+        # DelayedCall for retire_idle_threads()
+        self.retire_check = None
+        self.running = False
+        # generation gets incremented each time close_threads() is called.
+        # Threads from an older generation exit once they are done.
+        self.generation = 0
+        self.thread_counter = itertools.count()
+        if min_threads is None:
+            min_threads = self.THREADS
+        if max_threads is None:
+            max_threads = self.MAX_THREADS
+        self.set_size(min_threads, max_threads)
+
+    def set_size(self, min_threads, max_threads):
+        """Change how many threads we use."""
+        if min_threads < 1 or max_threads < min_threads:
+            raise ValueError("invalid sizes: %s, %s" % (min_threads,
+                                                        max_threads))
+        self.condition.acquire()
+        try:
+            self.min_threads = min_threads
+            self.max_threads = max_threads
+            if self.running:
+                self._start_threads()
+            # wake up idle threads so that they can exit if there are too
+            # many of them
+            self.condition.notifyAll()
+            self._schedule_retire_check()
+        finally:
+            self.condition.release()
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
-                                 target=thread_body,
-                                 args=[self.thread_loop])
-            t.setDaemon(True)
-            t.start()
-            self.threads.append(t)
-
-    def thread_loop(self):
+        self.condition.acquire()
+        try:
+            self.running = True
+            self._start_threads()
+        finally:
+            self.condition.release()
+
+    def _start_threads(self):
+        """Start threads as needed
+
+        We make sure we have min_threads threads.  If there are tasks that
+        can't run because all the threads are busy, we start new threads for
+        them (up to max_threads).
+
+        Call this with self.condition acquired.
+        """
+        while len(self.threads) < self.min_threads:
+            self._start_thread()
+        while (len(self.threads) < self.max_threads and
+               self._runnable_count() > len(self.threads) - self.busy_count):
+            self._start_thread()
+
+    def _start_thread(self):
+        t = threading.Thread(name='ThreadPool - %d' %
+                             self.thread_counter.next(),
+                             target=thread_body,
+                             args=[self.thread_loop, self.generation])
+        t.setDaemon(True)
+        self.threads.append(t)
+        t.start()
+
+    def _runnable_count(self):
+        """Count how many waiting tasks we could run if we had the threads.
+        """
+        count = 0
+        for priority, queue in self.queues.items():
+            if queue and self._can_run(priority):
+                count += len(queue)
+        return count
+
+    def _can_run(self, priority):
+        free_threads = self.max_threads - self.busy_count
+        return free_threads > self.RESERVED_THREADS[priority]
+
+    def _next_task(self):
+        """Get the next task to run.
+
+        Call this with self.condition acquired.
+        :returns: task tuple or None if we shouldn't run any tasks now
+        """
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            # When we are shutting down, run the remaining tasks without
+            # worrying about the reserved threads.
+            if queue and (not self.running or self._can_run(priority)):
+                return queue.popleft()
+        return None
+
+    def has_pending_tasks(self):
+        self.condition.acquire()
+        try:
+            return any(self.queues.values())
+        finally:
+            self.condition.release()
+
+    def thread_loop(self, generation):
         while True:
-            next_item = self.queue.get()
-            if next_item == "QUIT":
+            task = self._wait_for_task(generation)
+            if task is None:
                 break
-            else:
-                callback, errback, func, name, args, kwargs, = next_item
+            self._run_task(task)
+
+    def _wait_for_task(self, generation):
+        """Wait for a task to run in a worker thread.
+
+        :returns: task tuple or None if the thread should exit
+        """
+        self.condition.acquire()
+        try:
+            while True:
+                if generation != self.generation and self.running:
+                    # init_threads() was called again after close_threads(),
+                    # leave the work for the new threads
+                    return self._remove_current_thread()
+                current_thread = threading.currentThread()
+                task = self._next_task()
+                if task is not None:
+                    self.idle_since.pop(current_thread, None)
+                    self.retiring.discard(current_thread)
+                    self.busy_count += 1
+                    return task
+                if (not self.running or
+                    len(self.threads) > self.max_threads or
+                    current_thread in self.retiring):
+                    return self._remove_current_thread()
+                self.idle_since.setdefault(current_thread, clock())
+                self._schedule_retire_check()
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def _remove_current_thread(self):
+        current_thread = threading.currentThread()
+        self.idle_since.pop(current_thread, None)
+        self.retiring.discard(current_thread)
+        try:
+            self.threads.remove(current_thread)
+        except ValueError:
+            # close_threads() already removed us
+            pass
+        return None
+
+    def _schedule_retire_check(self):
+        """Schedule retire_idle_threads() if we have extra idle threads.
+
+        Call this with self.condition acquired.
+        """
+        if (self.retire_check is None and self.running and self.idle_since
+            and len(self.threads) - len(self.retiring) > self.min_threads):
+            self.retire_check = self.event_loop.scheduler.add_timeout(
+                self.IDLE_TIMEOUT, self.retire_idle_threads,
+                'Retire idle threads')
+            self.event_loop.wakeup()
+
+    def retire_idle_threads(self):
+        """Make threads that have been idle for IDLE_TIMEOUT seconds exit.
+
+        We keep at least min_threads threads around.
+        """
+        self.condition.acquire()
+        try:
+            if self.retire_check is not None:
+                # we may have been called before the timeout fired
+                self.retire_check.cancel()
+                self.retire_check = None
+            now = clock()
+            extra_threads = (len(self.threads) - len(self.retiring) -
+                             self.min_threads)
+            idle_threads = sorted(self.idle_since.items(),
+                                  key=lambda item: item[1])
+            for thread, idle_start in idle_threads:
+                if extra_threads <= 0:
+                    break
+                if (thread not in self.retiring and
+                    now - idle_start >= self.IDLE_TIMEOUT):
+                    self.retiring.add(thread)
+                    extra_threads -= 1
+            if self.retiring:
+                self.condition.notifyAll()
+            self._schedule_retire_check()
+        finally:
+            self.condition.release()
+
+    def _run_task(self, task):
+        callback, errback, func, name, args, kwargs, queue_time = task
+        start = clock()
+        try:
+            result = func(*args, **kwargs)
+        except KeyboardInterrupt:
+            raise
+        except Exception, exc:
+            logging.debug(">>> thread_loop: %s %s %s %s\n%s",
+                          func, name, args, kwargs,
+                          "".join(traceback.format_exc()))
+            func = errback
+            args = (exc,)
+            callback_name = 'Thread Pool Errback (%s)' % name
+        else:
+            func = callback
+            args = (result,)
+            callback_name = 'Thread Pool Callback (%s)' % name
+        end = clock()
+        self.condition.acquire()
+        try:
+            self.busy_count -= 1
             try:
-                result = func(*args, **kwargs)
-            except KeyboardInterrupt:
-                raise
-            except Exception, exc:
-                logging.debug(">>> thread_loop: %s %s %s %s\n%s",
-                              func, name, args, kwargs,
-                              "".join(traceback.format_exc()))
-                func = errback
-                name = 'Thread Pool Errback (%s)' % name
-                args = (exc,)
-            else:
-                func = callback
-                name = 'Thread Pool Callback (%s)' % name
-                args = (result,)
-            if not self.event_loop.quit_flag:
-                self.event_loop.idle_queue.add_idle(func, name, args=args)
-                self.event_loop.wakeup()
+                stats = thread_pool_stats[name]
+            except KeyError:
+                stats = thread_pool_stats[name] = ThreadPoolTaskStats()
+            stats.queue_wait.add(start - queue_time)
+            stats.run_time.add(end - start)
+            # a task finishing may let tasks from other priorities run
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        if not self.event_loop.quit_flag:
+            self.event_loop.idle_queue.add_idle(func, callback_name,
+                                                args=args)
+            self.event_loop.wakeup()
 
     def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+        self.queue_call_with_priority(PRIORITY_NORMAL, callback, errback,
+                                      function, name, *args, **kwargs)
+
+    def queue_call_with_priority(self, priority, callback, errback, function,
+                                 name, *args, **kwargs):
+        self.condition.acquire()
+        try:
+            self.queues[priority].append((callback, errback, function, name,
+                                          args, kwargs, clock()))
+            if self.running:
+                self._start_threads()
+            self.condition.notify()
+        finally:
+            self.condition.release()
 
     def close_threads(self):
-        for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.generation += 1
+            threads = self.threads
+            self.threads = []
+            self.idle_since.clear()
+            self.retiring.clear()
+            if self.retire_check is not None:
+                self.retire_check.cancel()
+                self.retire_check = None
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
         # Why is there a timeout on the join() here, what's wrong?  On
         # shutdown, the system waits for the eventloop to finish using 
         # eventloop.join() but eventloop calls close_threads() which wait
@@ -226,12 +718,11 @@ class ThreadPool(object):
         # in a blocking operation which is exactly the point of having them
         # so eventloop.join() in turn blocks.  So if it doesn't clean up
         # in time let the daemon flag in the Thread() do its job.  See #16584.
-        for t in self.threads:
+        for t in threads:
             try:
                 t.join(0.5)
             except StandardError:
                 pass
-        self.threads = []
 
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
@@ -287,7 +778,7 @@ class EventLoop(SimpleEventLoop):
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
         self.idle_queue = CallQueue()
-        self.urgent_queue = CallQueue()
+        self.urgent_queue = CallQueue('urgent')
         self.threadpool = ThreadPool(self)
         self.read_callbacks = {}
         self.write_callbacks = {}
@@ -317,11 +808,26 @@ class EventLoop(SimpleEventLoop):
         self.threadpool.queue_call(callback, errback, function, name,
                                   *args, **kwargs)
 
+    def call_in_thread_with_priority(self, priority, callback, errback,
+                                     function, name, *args, **kwargs):
+        self.threadpool.queue_call_with_priority(priority, callback, errback,
+                                                 function, name, *args,
+                                                 **kwargs)
+
     def run_idle_next_loop(self, function, name, args=None, kwargs=None):
         """Add an idle callback to be called on the next event loop."""
         self.idles_for_next_loop.append((function, name, args, kwargs))
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
+        if profiler.enabled:
+            profiler.idle_queue_depth.add(self.idle_queue.queue.qsize())
+            start = clock()
+            self._process_events(read_fds_ready, write_fds_ready)
+            profiler.loop_latency.add(clock() - start)
+        else:
+            self._process_events(read_fds_ready, write_fds_ready)
+
+    def _process_events(self, read_fds_ready, write_fds_ready):
         self._process_urgent_events()
         if self.quit_flag:
             return
@@ -376,8 +882,8 @@ class EventLoop(SimpleEventLoop):
                                                self.read_callbacks,
                                                self.removed_read_callbacks):
             yield callback
-        while self.scheduler.has_pending_timeout():
-            yield self.scheduler.process_next_timeout
+        for dc in self.scheduler.pop_due_timeouts():
+            yield dc.dispatch
         while self.idle_queue.has_pending_idle():
             yield self.idle_queue.process_next_idle
 
@@ -394,7 +900,14 @@ class EventLoop(SimpleEventLoop):
                     continue
                 when = "While talking to the network"
                 def callback_event():
-                    success = trapcall.trap_call(when, function)
+                    if profiler.enabled:
+                        start = clock()
+                        success = trapcall.trap_call(when, function)
+                        profiler.record_callback('socket',
+                                                 _callback_name(function),
+                                                 clock() - start)
+                    else:
+                        success = trapcall.trap_call(when, function)
                     if not success:
                         del map_[fd]
                     return success
@@ -405,6 +918,13 @@ class EventLoop(SimpleEventLoop):
         self.idle_queue.quit_flag = True
         self.urgent_queue.quit_flag = True
 
+def _callback_name(function):
+    """Get a name to use for a socket callback in the profiler."""
+    try:
+        return '%s.%s' % (function.im_class.__name__, function.__name__)
+    except AttributeError:
+        return getattr(function, '__name__', repr(function))
+
 _eventloop = EventLoop()
 
 def add_read_callback(sock, callback):
@@ -476,6 +996,9 @@ def add_urgent_call(function, name, args=None, kwargs=None):
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
     """Schedule a function to be called in a separate thread.
 
+    name should be the same for all calls of the same kind, we keep
+    thread_pool_stats for each name.
+
     .. Warning::
 
        Do not put code that accesses the database or the UI here!
@@ -483,6 +1006,17 @@ def call_in_thread(callback, errback, function, name, *args, **kwargs):
     _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_thread_with_priority(priority, callback, errback, function, name,
+                                 *args, **kwargs):
+    """Like call_in_thread(), but with a priority for the task.
+
+    priority should be PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW.  Use
+    PRIORITY_HIGH for quick calls that the user is waiting on and
+    PRIORITY_LOW for slow background work.
+    """
+    _eventloop.call_in_thread_with_priority(
+        priority, callback, errback, function, name, *args, **kwargs)
+
 lt = None
 
 profile_file = None
@@ -534,6 +1068,9 @@ def thread_pool_quit():
 def thread_pool_init():
     _eventloop.threadpool.init_threads()
 
+def thread_pool_set_size(min_threads, max_threads):
+    _eventloop.threadpool.set_size(min_threads, max_threads)
+
 def as_idle(func):
     """Decorator to make a methods run as an idle function
 
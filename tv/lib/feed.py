@@ -32,6 +32,7 @@
 FIXME - talk about Feed architecture here
 """
 
+import hashlib
 import os
 import re
 import time
@@ -61,9 +62,11 @@ from miro import models
 from miro import prefs
 from miro.plat import resources
 from miro import downloader
+from miro.data import feedcounts
 from miro.util import (returns_unicode, returns_filename, unicodify, check_u,
                        check_f, quote_unicode_url, to_uni,
-                       is_url, stringify, is_magnet_uri)
+                       is_url, stringify, is_magnet_uri,
+                       split_values_for_sqlite)
 from miro import fileutil
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
 from miro.plat.filebundle import is_file_bundle
@@ -88,26 +91,23 @@ def default_feed_icon_path():
 
 class _RateLimiter(object):
     """Helper class used by create_items_for_parsed() to avoid hogging the
-    GIL.
+    event loop.
 
-    This class helps ensure that a potentially long-running operation doesn't
-    take more than a fixed-percentage of the CPU.  It's not really a great
-    solution, but it's the simplest way for 4.0.2
+    create_items_for_parsed() calls time_to_yield() after each entry.  Once
+    we've run for MAX_RUN_TIME, it returns True and we let other callbacks run
+    before continuing.
     """
+    MAX_RUN_TIME = 0.1
+
     def __init__(self):
-        self.last_time = time.time()
+        self.reset()
 
-    def check_for_sleep(self):
-        elapsed = self.last_time - time.time()
-        if elapsed < 0.1:
-            return # don't sleep until a decent of time has passed.
-        # We want to yield at least 10% of the CPU.  Sleep for 10% of the time
-        # we took since the last check
-        sleep_time = elapsed / 10.0
-        time.sleep(sleep_time)
-        # get ready for the next check() call
+    def reset(self):
         self.last_time = time.time()
 
+    def time_to_yield(self):
+        return time.time() - self.last_time >= self.MAX_RUN_TIME
+
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -224,6 +224,28 @@ def _on_config_change(obj, key, value):
                 pass
             feed.set_update_frequency(update_freq)
 
+# Counts how many feed updates ended at each stage.  Updates that end early
+# skip the work for the later stages.
+#   - not-modified: the server said nothing changed (HTTP 304)
+#   - unchanged-content: the content matched our digest from the last update,
+#     so we skipped running feedparser and checking the items
+#   - parsed: we ran feedparser and updated the items
+update_stage_counts = {
+    'not-modified': 0,
+    'unchanged-content': 0,
+    'parsed': 0,
+}
+
+def calc_content_digest(html):
+    """Calculate a digest for the content of a feed.
+
+    We use this to avoid re-parsing feeds that haven't changed from servers
+    that ignore the ETag and If-Modified-Since headers.
+    """
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    return unicode(hashlib.sha1(html).hexdigest())
+
 def run_feedparser(html, callback, errback):
     if _RUN_FEED_PARSER_INLINE:
         try:
@@ -315,6 +337,10 @@ class FeedImpl(DDBObject):
                              self.updateFreq,
                              self.title)
 
+    def schedule_initial_update(self):
+        """Schedule our first update after startup."""
+        self.schedule_update_events(INITIAL_FEED_UPDATE_DELAY)
+
     def cancel_update_events(self):
         if hasattr(self, 'scheduler') and self.scheduler is not None:
             self.scheduler.cancel()
@@ -554,17 +580,15 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             self.loading = True
             eventloop.add_idle(lambda: self.generate_feed(True), "generate_feed")
         else:
-            self.schedule_update_events(INITIAL_FEED_UPDATE_DELAY)
+            self.actualFeed.schedule_initial_update()
 
     def clean_old_items(self):
         if self.actualFeed:
             return self.actualFeed.clean_old_items()
 
     def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
+        if '_item_counts' in self.__dict__:
+            del self.__dict__['_item_counts']
 
     def recalc_counts(self):
         self.invalidate_counts()
@@ -572,50 +596,48 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if self.in_folder():
             self.get_folder().signal_change(needs_save=False)
 
+    def _get_item_counts(self):
+        # The feed_item_count table is kept up to date by SQLite triggers, so
+        # this is a single row lookup rather than a COUNT(*) query for each
+        # number.
+        try:
+            return self._item_counts
+        except AttributeError:
+            self._item_counts = feedcounts.get_feed_counts(app.db, self.id)
+            return self._item_counts
+
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return self._get_item_counts()['downloaded']
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return self._get_item_counts()['downloading']
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return self._get_item_counts()['unwatched']
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        counts = self._get_item_counts()
+        # subtract the items in auto_pending_items
+        if not self.autoDownloadable:
+            auto_pending = 0
+        elif self.getEverything:
+            auto_pending = counts['not_downloaded']
+        else:
+            auto_pending = counts['eligible']
+        return counts['new_items'] - auto_pending
 
     def mark_as_viewed(self):
         """Sets the last time the feed was viewed to now
         """
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
+        self.invalidate_counts()
         for item in list(self.available_items):
             item.unset_new()
         if self.in_folder():
@@ -676,9 +698,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.calc_thumbnail_path()
         self.signal_change()
         for item in self.items:
-            if not item.icon_cache or not (item.icon_cache.is_valid() or
-                    item.screenshot or
-                    item.is_container_item):
+            if item.thumbnail_path is None and not item.is_container_item:
                 item.signal_change(needs_save=False)
 
     def get_id(self):
@@ -1139,6 +1159,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if isinstance(self.actualFeed, DirectoryWatchFeedImpl):
             move_items_to = None
         self.cancel_update_events()
+        feedupdate.forget_feed(self)
         if self.download is not None:
             self.download.cancel()
             self.download = None
@@ -1201,7 +1222,15 @@ class ThrottledUpdateFeedImpl(FeedImpl):
         else:
             if self.updateFreq > 0:
                 feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                        self.update, periodic=True)
+
+    def schedule_initial_update(self):
+        # spread the startup updates over our update interval, rather than
+        # updating every feed at once.
+        feedupdate.cancel_update(self.ufeed)
+        feedupdate.schedule_update(INITIAL_FEED_UPDATE_DELAY, self.ufeed,
+                                   self.update,
+                                   spread=max(self.updateFreq, 0))
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
@@ -1229,15 +1258,50 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     def remember_old_items(self):
         self.old_items = set(self.items)
 
-    def create_items_for_parsed(self, parsed):
-        """Update the feed using parsed XML passed in"""
+    def create_items_for_parsed(self, parsed, callback=None):
+        """Update the feed using parsed XML passed in
+
+        For big feeds this can take a while.  When it does, we stop to let
+        other events run and continue in an idle callback.
+
+        :param callback: function to call when we're done.  It's passed the
+        number of seconds spent creating items, not counting the time spent
+        waiting between steps.  It will be called before we return if we
+        could handle everything at once.  It won't be called if the feed is
+        removed before we finish.
+        """
+        self._create_items_step(self._create_items_for_parsed(parsed),
+                                callback, 0.0)
+
+    def _create_items_step(self, iterator, callback, work_time):
+        if not self.ufeed.id_exists():
+            return
+        # Each step gets its own bulk_sql_manager session, since other code
+        # runs in between steps.
+        start = clock()
         app.bulk_sql_manager.start()
         try:
-            self._create_items_for_parsed(parsed)
+            try:
+                iterator.next()
+            except StopIteration:
+                finished = True
+            else:
+                finished = False
         finally:
             app.bulk_sql_manager.finish()
+        work_time += clock() - start
+        if not finished:
+            eventloop.add_idle(self._create_items_step,
+                               "create items for %s" % self.url,
+                               args=(iterator, callback, work_time))
+        elif callback is not None:
+            callback(work_time)
 
     def _create_items_for_parsed(self, parsed):
+        """Generator that does the work for create_items_for_parsed().
+
+        It yields when it's time to let other events run.
+        """
         rate_limiter = _RateLimiter()
         channel_title = None
         try:
@@ -1269,25 +1333,33 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
 
         items_byid = {}
         items_byURLTitle = {}
-        items_nokey = []
+        # Items without an rss id need to be compared against each entry.
+        # Index them by the enclosure values that the comparison checks, so
+        # that we only need to compare against a few of them.
+        items_nokey = {}
         for item in self.items:
-            rate_limiter.check_for_sleep()
-            try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
+            rss_id = item.get_rss_id()
+            if rss_id is not None:
+                items_byid[rss_id] = item
+            else:
+                key = FeedParserValues.item_enclosure_key(item)
+                items_nokey.setdefault(key, []).append(item)
             by_url_title_key = (item.url, item.entry_title)
             if by_url_title_key != (None, None):
                 items_byURLTitle[by_url_title_key] = item
         for entry in parsed.entries:
-            rate_limiter.check_for_sleep()
+            if rate_limiter.time_to_yield():
+                yield
+                rate_limiter.reset()
+                # items may have been removed while we were waiting, they
+                # get skipped by the id_exists() checks below.
             entry = self.add_scraped_thumbnail(entry)
             fp_values = FeedParserValues(entry)
             new = True
             if fp_values.data['rss_id'] is not None:
                 id_ = fp_values.data['rss_id']
-                if items_byid.has_key(id_):
-                    item = items_byid[id_]
+                item = items_byid.get(id_)
+                if item is not None and item.id_exists():
                     if not fp_values.compare_to_item(item):
                         item.update_from_feed_parser_values(fp_values)
                     new = False
@@ -1296,24 +1368,22 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                 by_url_title_key = (fp_values.data['url'],
                         fp_values.data['entry_title'])
                 if by_url_title_key != (None, None):
-                    if items_byURLTitle.has_key(by_url_title_key):
-                        item = items_byURLTitle[by_url_title_key]
+                    item = items_byURLTitle.get(by_url_title_key)
+                    if item is not None and item.id_exists():
                         if not fp_values.compare_to_item(item):
                             item.update_from_feed_parser_values(fp_values)
                         new = False
                         self.old_items.discard(item)
             if new:
-                for item in items_nokey:
-                    if fp_values.compare_to_item(item):
-                        new = False
-                    else:
-                        try:
-                            if fp_values.compare_to_item_enclosures(item):
-                                item.update_from_feed_parser_values(fp_values)
-                                new = False
-                                self.old_items.discard(item)
-                        except StandardError:
-                            pass
+                # Updating an item doesn't change its enclosure key, so the
+                # index stays valid.
+                for item in items_nokey.get(fp_values.enclosure_key(), ()):
+                    if not item.id_exists():
+                        continue
+                    if not fp_values.compare_to_item(item):
+                        item.update_from_feed_parser_values(fp_values)
+                        self.old_items.discard(item)
+                    new = False
             if new and fp_values.first_video_enclosure is not None:
                 self._handle_new_entry(entry, fp_values, channel_title)
 
@@ -1398,6 +1468,8 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.initialHTML = initialHTML
         self.etag = etag
         self.modified = modified
+        self.content_digest = None
+        self.new_content_digest = None
         self.download = None
 
     @returns_unicode
@@ -1436,22 +1508,26 @@ class RSSFeedImpl(RSSFeedImplBase):
             logging.warn("Empty feed, not updating: %s", self.url)
             self.feedparser_finished()
             return
-        start = clock()
         self.parsed = parsed
         self.remember_old_items()
-        self.create_items_for_parsed(parsed)
+        self.create_items_for_parsed(parsed, self._items_created)
 
+    def _items_created(self, work_time):
         try:
             updateFreq = self.parsed["feed"]["ttl"]
         except KeyError:
             updateFreq = 0
         self.set_update_frequency(updateFreq)
 
+        # only remember the digest once the items are all updated, otherwise
+        # we might skip content that we haven't finished with.
+        self.content_digest = self.new_content_digest
+        self.new_content_digest = None
+        update_stage_counts['parsed'] += 1
         self.feedparser_finished()
-        end = clock()
-        if end - start > 1.0:
+        if work_time > 1.0:
             logging.timing("feed update for: %s too slow (%.3f secs)",
-                           self.url, end - start)
+                           self.url, work_time)
 
     def call_feedparser(self, html):
         self.ufeed.confirm_db_thread()
@@ -1472,6 +1548,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         if hasattr(self, 'initialHTML') and self.initialHTML is not None:
             html = self.initialHTML
             self.initialHTML = None
+            self.new_content_digest = calc_content_digest(html)
             self.call_feedparser(html)
         else:
             try:
@@ -1502,9 +1579,8 @@ class RSSFeedImpl(RSSFeedImplBase):
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
-            self.schedule_update_events(-1)
-            self.updating = False
-            self.ufeed.signal_change()
+            update_stage_counts['not-modified'] += 1
+            self._finish_unchanged_update()
             return
         html = info['body']
         if info.has_key('charset'):
@@ -1520,8 +1596,26 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
+        self.new_content_digest = calc_content_digest(html)
+        # We need self.parsed to be set for get_link() and friends, so we
+        # always parse the feed once after startup.
+        if (self.new_content_digest == self.content_digest and
+                hasattr(self, 'parsed')):
+            logging.debug("RSSFeedImpl: _update_callback: "
+                          "content unchanged (%s)", self.ufeed)
+            update_stage_counts['unchanged-content'] += 1
+            self.new_content_digest = None
+            self._finish_unchanged_update()
+            return
+        feedupdate.update_changed(self.ufeed)
         self.call_feedparser(html)
 
+    def _finish_unchanged_update(self):
+        feedupdate.update_unchanged(self.ufeed)
+        self.schedule_update_events(-1)
+        self.updating = False
+        self.ufeed.signal_change()
+
     @returns_unicode
     def get_license(self):
         """Returns the URL of the license associated with the feed
@@ -1542,10 +1636,12 @@ class RSSFeedImpl(RSSFeedImplBase):
         """
         FeedImpl.setup_restored(self)
         self.download = None
+        self.new_content_digest = None
 
     def clean_old_items(self):
         self.modified = None
         self.etag = None
+        self.content_digest = None
         self.update()
 
 class RSSMultiFeedBase(RSSFeedImplBase):
@@ -1553,7 +1649,10 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         RSSFeedImplBase.setup_new(self, url, ufeed, title)
         self.etag = {}
         self.modified = {}
+        self.content_digest = {}
+        self.new_content_digest = {}
         self.download_dc = {}
+        self.parsed_queue = []
         self.updating = 0
         self._urls = None
 
@@ -1562,6 +1661,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         """
         RSSFeedImplBase.setup_restored(self)
         self.download_dc = {}
+        self.new_content_digest = {}
+        self.parsed_queue = []
         self.updating = 0
         self._urls = None
 
@@ -1608,13 +1709,35 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         self.ufeed.confirm_db_thread()
         if not self.ufeed.id_exists() or url not in self.download_dc:
             return
-        start = clock()
-        self.create_items_for_parsed(parsed)
-        self.feedparser_finished(url)
-        end = clock()
-        if end - start > 1.0:
-            logging.timing("feed update for: %s too slow (%.3f secs)",
-                           self.url, end - start)
+        # Handle one URL at a time.  create_items_for_parsed() indexes our
+        # items when it starts, so if two URLs were handled at once, the
+        # same entry could turn into an item for each of them.
+        self.parsed_queue.append((parsed, url))
+        if len(self.parsed_queue) == 1:
+            self._create_items_for_next_url()
+
+    def _create_items_for_next_url(self):
+        queued = self.parsed_queue[0]
+        parsed, url = queued
+        self.create_items_for_parsed(
+            parsed, lambda work_time: self._items_created(queued, work_time))
+
+    def _items_created(self, queued, work_time):
+        if not self.parsed_queue or self.parsed_queue[0] is not queued:
+            # _cancel_all_downloads() was called while we were working
+            return
+        del self.parsed_queue[0]
+        parsed, url = queued
+        if url in self.download_dc:
+            if url in self.new_content_digest:
+                self.content_digest[url] = self.new_content_digest.pop(url)
+            update_stage_counts['parsed'] += 1
+            self.feedparser_finished(url)
+            if work_time > 1.0:
+                logging.timing("feed update for: %s (%s) too slow "
+                               "(%.3f secs)", self.url, url, work_time)
+        if self.parsed_queue:
+            self._create_items_for_next_url()
 
     def call_feedparser(self, html, url):
         self.ufeed.confirm_db_thread()
@@ -1657,10 +1780,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         if info.get('status') == 304:
             logging.debug("RSSMultiFeedBase: _update_callback: "
                           "status 304 (%s)", self.ufeed)
-            self.schedule_update_events(-1)
-            self.updating -= 1
-            self.check_update_finished()
-            self.ufeed.signal_change()
+            update_stage_counts['not-modified'] += 1
+            self._finish_unchanged_update()
             return
         html = info['body']
         if info.has_key('charset'):
@@ -1679,8 +1800,22 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             self.modified[url] = unicodify(info['last-modified'])
         else:
             self.modified[url] = None
+        digest = calc_content_digest(html)
+        if digest == self.content_digest.get(url):
+            logging.debug("RSSMultiFeedBase: _update_callback: "
+                          "content unchanged (%s)", self.ufeed)
+            update_stage_counts['unchanged-content'] += 1
+            self._finish_unchanged_update()
+            return
+        self.new_content_digest[url] = digest
         self.call_feedparser(html, url)
 
+    def _finish_unchanged_update(self):
+        self.schedule_update_events(-1)
+        self.updating -= 1
+        self.check_update_finished()
+        self.ufeed.signal_change()
+
     def on_remove(self):
         self._cancel_all_downloads()
 
@@ -1688,11 +1823,13 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         for dc in self.download_dc.values():
             dc.cancel()
         self.download_dc = {}
+        self.parsed_queue = []
         self.updating = 0
 
     def clean_old_items(self):
         self.modified = {}
         self.etag = {}
+        self.content_digest = {}
         self.update()
 
 class SavedSearchFeedImpl(RSSMultiFeedBase):
@@ -2009,14 +2146,11 @@ class DirectoryScannerImplBase(FeedImpl):
     # how long to wait to update the feed after our directory watcher informs
     # us of new items
     DIRECTORY_WATCH_UPDATE_TIMEOUT = 1.0
-
-    def setup_new(self, *args, **kwargs):
-        FeedImpl.setup_new(self, *args, **kwargs)
-        self.pending_paths_to_add = []
-
-    def setup_restored(self):
-        FeedImpl.setup_restored(self)
-        self.pending_paths_to_add = []
+    # When scanning, we check for new files and add items in batches.  Each
+    # batch is finished when it has SCAN_BATCH_SIZE media files, or after
+    # SCAN_BATCH_TIME seconds.
+    SCAN_BATCH_SIZE = 250
+    SCAN_BATCH_TIME = 0.4
 
     def expire_items(self):
         """Directory Items shouldn't automatically expire
@@ -2114,19 +2248,20 @@ class DirectoryScannerImplBase(FeedImpl):
             if item.get_filename() in self._watcher_paths_deleted:
                 to_remove.append(item)
         # find added paths don't have an item
-        known_files = self.calc_known_files()
-        for x in self.items:
-            known_files.add_path(x.get_filename())
+        extra_known_files = self.calc_extra_known_files()
         to_add = []
         start = time.time()
-        for f in self._filter_paths(self._watcher_paths_added, known_files):
-            to_add.append(f)
+        for paths in self._new_path_batches(self._watcher_paths_added,
+                                            extra_known_files):
+            to_add.extend(paths)
             if time.time() - start > 0.4:
                 yield
                 if not self.id_exists():
                     return
                 start = time.time()
-        # commit changes
+        # commit changes.  A scan may have added some of the paths while we
+        # were yielding, so check them again.
+        to_add = self.filter_known_paths(to_add)
         with app.local_metadata_manager.bulk_add():
             app.bulk_sql_manager.start()
             try:
@@ -2141,19 +2276,64 @@ class DirectoryScannerImplBase(FeedImpl):
         self._watcher_paths_added = set()
         self._watcher_update_timeout = None
 
-    def calc_known_files(self):
-        # Calculate files known about by feeds other than the directory feed
-        # Using a select statement is good here because we don't want to
-        # construct all the Item objects if we don't need to.
-        known_files = fileutil.FileSet(row[0] for row in
-                models.Item.select(['filename'],
-                    'filename IS NOT NULL AND '
-                    '(feed_id is NULL or feed_id != ?)', (self.ufeed_id,)))
-        for path in self.pending_paths_to_add:
-            known_files.add_path(path)
+    def calc_extra_known_files(self):
+        """Calculate files that we shouldn't add, but don't have items.
+
+        Files that have items are checked using the database, see
+        filter_known_paths().  This handles the rest: anything that
+        _add_known_files() adds.  Batches of new paths get items right after
+        they're checked, without yielding in between, so the database check
+        also covers paths that are being added by another update.
+        """
+        known_files = fileutil.FileSet()
         self._add_known_files(known_files)
         return known_files
 
+    def filter_known_paths(self, paths):
+        """Remove paths that we already have items for.
+
+        Rather than loading every filename in the database, we check paths in
+        chunks using the item_filename_nocase index.  Like FileSet, the
+        comparison is case-insensitive.
+
+        :param paths: list of paths to check
+        :returns: list of paths that don't have items
+        """
+        filenames = [filename_to_unicode(p) for p in paths]
+        known = set()
+        for chunk in split_values_for_sqlite(filenames):
+            placeholders = ', '.join('?' for i in xrange(len(chunk)))
+            rows = models.Item.select(['filename'],
+                                      'filename COLLATE NOCASE IN (%s)' %
+                                      placeholders, chunk, convert=False)
+            known.update(row[0].lower() for row in rows)
+        rv = []
+        for path, filename in zip(paths, filenames):
+            key = filename.lower()
+            if key not in known:
+                # also filter out paths that differ only by case
+                known.add(key)
+                rv.append(path)
+        return rv
+
+    def _calc_shadowed_filenames(self, items):
+        """Find filenames for our items that other feeds also have items for.
+
+        :returns: set of lowercased unicode filenames
+        """
+        filenames = [filename_to_unicode(i.get_filename()) for i in items
+                     if i.get_filename() is not None]
+        shadowed = set()
+        for chunk in split_values_for_sqlite(filenames):
+            placeholders = ', '.join('?' for i in xrange(len(chunk)))
+            rows = models.Item.select(['filename'],
+                                      'filename COLLATE NOCASE IN (%s) AND '
+                                      '(feed_id IS NULL OR feed_id != ?)' %
+                                      placeholders,
+                                      chunk + [self.ufeed_id], convert=False)
+            shadowed.update(row[0].lower() for row in rows)
+        return shadowed
+
     # Subclass may override this to implement asynchronous preparation
     # if it is long-running
     def schedule_update(self):
@@ -2183,9 +2363,10 @@ class DirectoryScannerImplBase(FeedImpl):
 
         self._before_update()
 
-        known_files = self.calc_known_files()
+        extra_known_files = self.calc_extra_known_files()
         my_files = set()
         my_items = list(self.items)
+        shadowed_filenames = self._calc_shadowed_filenames(my_items)
         # pause after doing prep work
         yield
         if should_halt_early():
@@ -2201,7 +2382,8 @@ class DirectoryScannerImplBase(FeedImpl):
             filename = item.get_filename()
             if (filename is None or
                 not fileutil.isfile(filename) or
-                known_files.contains_path(filename)):
+                filename_to_unicode(filename).lower() in shadowed_filenames or
+                extra_known_files.contains_path(filename)):
                 to_remove.append(item)
             if filename not in my_files:
                 my_files.add(filename)
@@ -2224,85 +2406,69 @@ class DirectoryScannerImplBase(FeedImpl):
                     item.remove()
         finally:
             app.bulk_sql_manager.finish()
-
-        # now that we've checked for items that need to be removed, we
-        # add our items to known_files so that they don't get added
-        # multiple times to this feed.
-        for path in my_files:
-            known_files.add_path(path)
+        # we don't need these anymore, and they can be large for big
+        # directories
+        del my_items, my_files, shadowed_filenames, to_remove
 
         # adds any files we don't know about
         # files on the filesystem
         scan_dir = self._scan_dir()
         if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
-            all_files = []
-            start = time.time()
-            for f in fileutil.miro_allfiles(scan_dir):
-                all_files.append(f)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
-            start = time.time()
-            to_add = []
-            for path in self._filter_paths(all_files, known_files):
-                to_add.append(path)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
-
-            # Keep track of the paths we will add in case we get directory
-            # watcher updates.  In that case, we want these paths to be in
-            # known_files.  It's very important that the next line come before
-            # the first yield statement to avoid a race condition.
-            self.pending_paths_to_add = to_add
-            path_iter = iter(to_add)
-            finished = False
-            yield # yield after doing prep work
-            if should_halt_early():
-                return
-            with app.local_metadata_manager.bulk_add():
-                while not finished:
-                    finished = self._add_batch_of_videos(path_iter, 0.1)
-                    yield # yield after each batch
-                    if should_halt_early():
-                        return
+            path_iter = fileutil.miro_allfiles(scan_dir)
+            for paths in self._new_path_batches(path_iter, extra_known_files):
+                if paths:
+                    # Use a bulk_add() context for each batch, so that
+                    # metadata processing starts as soon as the batch is
+                    # added rather than after the entire scan.
+                    with app.local_metadata_manager.bulk_add():
+                        self._add_batch_of_videos(paths)
+                yield # yield after each batch
+                if should_halt_early():
+                    return
         self._after_update()
         self.updating = False
-        self.pending_paths_to_add = []
         self.schedule_update_events(-1)
 
-    def _add_batch_of_videos(self, path_iter, max_time):
-        """Make a bunch of filenames, but don't take too long.
-
-        We consume paths from path_iter until it's finished, or max_time
-        elapses.
-
-        :returns: if path_iter is finished
+    def _new_path_batches(self, paths, extra_known_files):
+        """Find paths that we should create items for.
+
+        This is the scanning half of the update pipeline.  Paths are pulled
+        from the paths iterator one at a time, so that we never have the
+        entire directory listing in memory.  Media files are queued up
+        and then checked against the database with filter_known_paths()
+        once we have SCAN_BATCH_SIZE of them, or after we've been scanning
+        for a while.
+
+        :param paths: iterable of paths to check
+        :param extra_known_files: FileSet of paths to skip, from
+            calc_extra_known_files()
+        :returns: generator that yields lists of paths to add.  Lists may be
+            empty if we haven't found anything new in a while, callers should
+            use that as a chance to yield to the event loop.
         """
+        batch = []
         start = time.time()
+        for path in paths:
+            if (filetypes.is_media_filename(filename_to_unicode(path)) and
+                not extra_known_files.contains_path(path)):
+                batch.append(path)
+            if (len(batch) >= self.SCAN_BATCH_SIZE or
+                time.time() - start > self.SCAN_BATCH_TIME):
+                yield self.filter_known_paths(batch)
+                batch = []
+                start = time.time()
+        if batch:
+            yield self.filter_known_paths(batch)
+
+    def _add_batch_of_videos(self, paths):
+        """Create FileItems for a batch of paths."""
         app.bulk_sql_manager.start()
         try:
-            for path in path_iter:
+            for path in paths:
                 self._make_child(path)
-                if time.time() - start > max_time:
-                    return False
-            return True
         finally:
             app.bulk_sql_manager.finish()
 
-    def _filter_paths(self, paths, known_files):
-        """Filter out filenames that we shouldn't add.
-
-        This method removes items from paths if they are in known_files or
-        they are not media files
-        """
-        return (p for p in paths if not known_files.contains_path(p) and
-              filetypes.is_media_filename(filename_to_unicode(p)))
-
 class DirectoryWatchFeedImpl(DirectoryScannerImplBase):
     def setup_new(self, ufeed, directory):
         # calculate url and title arguments to FeedImpl's constructor
@@ -2439,6 +2605,7 @@ class SearchFeedImpl(RSSMultiFeedBase):
         self.query = u''
         self.etag = {}
         self.modified = {}
+        self.content_digest = {}
         self.ufeed.icon_cache.reset()
         self.thumbURL = None
         self.ufeed.icon_cache.request_update(is_vital=True)
@@ -2506,6 +2673,9 @@ class SearchFeedImpl(RSSMultiFeedBase):
         # the dtv:search feed should never automatically update.
         return
 
+    def schedule_initial_update(self):
+        return
+
 class SearchDownloadsFeedImpl(FeedImpl):
     def setup_new(self, ufeed):
         FeedImpl.setup_new(self, url=u'dtv:searchDownloads', ufeed=ufeed,
@@ -2687,6 +2857,20 @@ def expire_items():
     finally:
         eventloop.add_timeout(300, expire_items, "Expire Items")
 
+def reconcile_counts():
+    """Fix any feed item counts that the database triggers got wrong."""
+    try:
+        for feed_id in feedcounts.reconcile_feed_counts(app.db):
+            logging.warn("reconcile_counts: fixed item counts for feed %s",
+                         feed_id)
+            try:
+                Feed.get_by_id(feed_id).recalc_counts()
+            except ObjectNotFoundError:
+                pass
+    finally:
+        eventloop.add_timeout(3600, reconcile_counts,
+                              "Reconcile Feed Counts")
+
 def lookup_feed(url, search_term=None):
     try:
         return Feed.get_by_url_and_search(url, search_term)
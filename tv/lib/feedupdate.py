@@ -31,24 +31,89 @@
 
 Our basic strategy is to limit the number of feeds that are
 simultaniously updating at any given time.  Right now the limit is set
-to 3.
+to 3, and at most 2 feeds from the same host can update at once.
+
+Other things we do to avoid updating lots of feeds at once:
+
+  - At startup, spread each feed's first update over its update interval.
+    Otherwise they would all update at once and keep doing that every
+    interval.
+  - Add some random jitter to the periodic update times, so that feeds
+    that end up in step drift apart.
+  - Feeds that keep returning the same content get updated less often.
+
+When there are more feeds ready to update than we can run, the feed that
+the user is looking at goes first, followed by feeds that auto-download.
 """
 
-import collections
+import heapq
+import itertools
+import random
+import urlparse
 
 from miro import eventloop
+from miro.clock import clock
 
 MAX_UPDATES = 3
+MAX_UPDATES_PER_HOST = 2
+# Periodic update delays get randomly adjusted by up to this fraction
+JITTER = 0.1
+# After this many updates in a row with unchanged content, we double the
+# update interval.  After twice that many, we quadruple it, etc.
+UNCHANGED_BACKOFF_STEP = 3
+MAX_BACKOFF_FACTOR = 4
+
+PRIORITY_DISPLAYED = 0
+PRIORITY_AUTODOWNLOAD = 1
+PRIORITY_NORMAL = 2
+
+def _spread_fraction(feed):
+    """Get a number in [0, 1) to offset feed's first update by.
+
+    Multiplying by the golden ratio spreads consecutive feed ids evenly.
+    """
+    return (feed.id * 0.6180339887498949) % 1.0
+
+def _calc_host(feed):
+    try:
+        return urlparse.urlparse(feed.get_url())[1].lower()
+    except (AttributeError, TypeError, ValueError):
+        return ''
 
 class FeedUpdateQueue(object):
     def __init__(self):
-        self.update_queue = collections.deque()
+        # heap of [priority, counter, feed, update_callback, due_time]
+        # lists.  update_queue_entries maps feed ids to their entry.  Entries
+        # that aren't in that dict have been removed.
+        self.update_queue = []
+        self.update_queue_entries = {}
+        self.counter = itertools.count()
         self.timeouts = {}
         self.callback_handles = {}
         self.currently_updating = set()
+        self.host_counts = {}
+        # maps ids of updating feeds to their host
+        self.updating_hosts = {}
+        self.displayed_feed_ids = set()
+        self.unchanged_counts = {}
+        # how long feeds wait in the queue after their update is due
+        self.update_lag = eventloop.SampleStats()
 
-    def schedule_update(self, delay, feed, update_callback):
+    def calc_delay(self, delay, feed, periodic, spread=0):
+        if periodic:
+            streak = self.unchanged_counts.get(feed.id, 0)
+            delay *= min(2 ** (streak // UNCHANGED_BACKOFF_STEP),
+                         MAX_BACKOFF_FACTOR)
+            delay *= random.uniform(1 - JITTER, 1 + JITTER)
+        if spread > 0:
+            delay += spread * _spread_fraction(feed)
+        return delay
+
+    def schedule_update(self, delay, feed, update_callback, periodic=False,
+                        spread=0):
         name = "Feed update (%s)" % feed.get_title()
+        self.cancel_update(feed)
+        delay = self.calc_delay(delay, feed, periodic, spread)
         self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
                 name, args=(feed, update_callback))
 
@@ -60,31 +125,114 @@ class FeedUpdateQueue(object):
         else:
             timeout.cancel()
 
+    def forget_feed(self, feed):
+        self.cancel_update(feed)
+        # run_update_queue() skips heap entries that aren't in
+        # update_queue_entries, so we don't need to touch the heap.
+        self.update_queue_entries.pop(feed.id, None)
+        self.displayed_feed_ids.discard(feed.id)
+        self.unchanged_counts.pop(feed.id, None)
+
+    def calc_priority(self, feed):
+        if feed.id in self.displayed_feed_ids:
+            return PRIORITY_DISPLAYED
+        try:
+            if feed.is_autodownloadable():
+                return PRIORITY_AUTODOWNLOAD
+        except AttributeError:
+            pass
+        return PRIORITY_NORMAL
+
     def do_update(self, feed, update_callback):
         del self.timeouts[feed.id]
-        self.update_queue.append((feed, update_callback))
+        self._enqueue(feed, update_callback, clock())
         self.run_update_queue()
 
+    def _enqueue(self, feed, update_callback, due_time):
+        entry = [self.calc_priority(feed), self.counter.next(), feed,
+                 update_callback, due_time]
+        self.update_queue_entries[feed.id] = entry
+        heapq.heappush(self.update_queue, entry)
+
+    def set_feed_displayed(self, feed_id, displayed):
+        if displayed:
+            self.displayed_feed_ids.add(feed_id)
+        else:
+            self.displayed_feed_ids.discard(feed_id)
+        # move the feed to its new place in the queue
+        entry = self.update_queue_entries.pop(feed_id, None)
+        if entry is not None:
+            priority, count, feed, update_callback, due_time = entry
+            self._enqueue(feed, update_callback, due_time)
+
+    def update_unchanged(self, feed):
+        self.unchanged_counts[feed.id] = \
+                self.unchanged_counts.get(feed.id, 0) + 1
+
+    def update_changed(self, feed):
+        self.unchanged_counts.pop(feed.id, None)
+
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
         self.currently_updating.remove(feed)
+        host = self.updating_hosts.pop(feed.id)
+        self.host_counts[host] -= 1
+        if self.host_counts[host] == 0:
+            del self.host_counts[host]
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
 
+    def _host_full(self, host):
+        return (host != '' and
+                self.host_counts.get(host, 0) >= MAX_UPDATES_PER_HOST)
+
     def run_update_queue(self):
+        # entries that we can't run yet because their host is busy
+        skipped = []
         while (len(self.update_queue) > 0 and 
                len(self.currently_updating) < MAX_UPDATES):
-            feed, update_callback = self.update_queue.popleft()
+            entry = heapq.heappop(self.update_queue)
+            priority, count, feed, update_callback, due_time = entry
+            if self.update_queue_entries.get(feed.id) is not entry:
+                # entry was replaced by set_feed_displayed()
+                continue
             if feed in self.currently_updating:
+                del self.update_queue_entries[feed.id]
                 continue
+            host = _calc_host(feed)
+            if self._host_full(host):
+                skipped.append(entry)
+                continue
+            del self.update_queue_entries[feed.id]
+            self.update_lag.add(clock() - due_time)
             handle = feed.connect('update-finished', self.update_finished)
             handle2 = feed.connect('removed', self.update_finished)
             self.callback_handles[feed.id] = (handle, handle2)
             self.currently_updating.add(feed)
+            self.host_counts[host] = self.host_counts.get(host, 0) + 1
+            self.updating_hosts[feed.id] = host
             update_callback()
+        for entry in skipped:
+            heapq.heappush(self.update_queue, entry)
+
+    def stats(self):
+        """Get some stats on the feed updates.
+
+        :returns: dict with the number of feeds waiting for their update
+            time, waiting in the queue and updating, plus the median, 95th
+            percentile and max time that feeds wait in the queue.
+        """
+        return {
+            'scheduled': len(self.timeouts),
+            'queued': len(self.update_queue_entries),
+            'updating': len(self.currently_updating),
+            'lag_p50': self.update_lag.percentile(50),
+            'lag_p95': self.update_lag.percentile(95),
+            'lag_max': self.update_lag.max,
+        }
 
 global_update_queue = FeedUpdateQueue()
 
@@ -92,8 +240,40 @@ def cancel_update(feed):
     """Cancel any pending updates for feed."""
     global_update_queue.cancel_update(feed)
 
-def schedule_update(delay, feed, update_callback):
+def forget_feed(feed):
+    """Drop everything we know about feed.  Call this when it's removed."""
+    global_update_queue.forget_feed(feed)
+
+def schedule_update(delay, feed, update_callback, periodic=False,
+                    spread=0):
     """Schedules a feed to be updated sometime around delay seconds in
     the future.
+
+    :param periodic: True if this is a regular update, rather than one we
+        want to happen at a specific time.  We'll space out periodic updates
+        for feeds that haven't been changing.
+    :param spread: add a per-feed offset of up to this many seconds to the
+        delay, so that feeds scheduled at the same time don't all update at
+        once.
+    """
+    global_update_queue.schedule_update(delay, feed, update_callback,
+                                        periodic, spread)
+
+def set_feed_displayed(feed_id, displayed):
+    """Tell us if the user is looking at a feed.
+
+    Displayed feeds get updated before others.
     """
-    global_update_queue.schedule_update(delay, feed, update_callback)
+    global_update_queue.set_feed_displayed(feed_id, displayed)
+
+def update_unchanged(feed):
+    """Tell us that a feed update didn't find any new content."""
+    global_update_queue.update_unchanged(feed)
+
+def update_changed(feed):
+    """Tell us that a feed update found new content."""
+    global_update_queue.update_changed(feed)
+
+def get_stats():
+    """Get stats about the feed update queue, see FeedUpdateQueue.stats()."""
+    return global_update_queue.stats()
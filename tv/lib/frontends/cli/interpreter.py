@@ -415,6 +415,24 @@ class MiroInterpreter(cmd.Cmd):
         return self.handle_item_complete(text, self._get_item_view(),
                 lambda i: i.is_downloaded())
 
+    @run_in_event_loop
+    def do_profile(self, line):
+        """profile [on|off|reset] -- Event loop profiler."""
+        if line == 'on':
+            eventloop.profiler.reset()
+            eventloop.profiler.enable()
+        elif line == 'off':
+            eventloop.profiler.disable()
+        elif line == 'reset':
+            eventloop.profiler.reset()
+        elif line:
+            print 'usage: profile [on|off|reset]'
+        else:
+            if not eventloop.profiler.enabled:
+                print 'profiler is off, use "profile on" to start it'
+            for line in eventloop.profiler.report(limit=30):
+                print line
+
     @run_in_event_loop
     def do_testdialog(self, line):
         """testdialog -- Tests the cli dialog system."""
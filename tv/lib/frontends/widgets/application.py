@@ -59,6 +59,7 @@ from miro import filetypes
 from miro.gtcache import gettext as _
 from miro.gtcache import ngettext
 from miro.frontends.widgets import dialogs
+from miro.frontends.widgets import imagepool
 from miro.frontends.widgets import infoupdater
 from miro.frontends.widgets import newsearchfeed
 from miro.frontends.widgets import newfeed
@@ -152,6 +153,8 @@ class Application:
         initializes the ui, and displays the :class:`MiroWindow`.
         """
         data.init()
+        imagepool.init_thumbnail_loader(os.path.join(
+            app.config.get(prefs.SUPPORT_DIRECTORY), 'thumbnail-cache'))
         # Send a couple messages to the backend, when we get responses,
         # WidgetsMessageHandler() will call build_window()
         messages.TrackGuides().send_to_backend()
@@ -1234,6 +1237,7 @@ class Application:
         width = self.get_left_width()
         if width:
             app.widget_state.set_tabs_width(width)
+        imagepool.shutdown_thumbnail_loader()
         app.controller.shutdown()
         self.quit_ui()
 
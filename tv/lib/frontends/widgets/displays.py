@@ -436,6 +436,8 @@ class ItemListDisplayMixin(object):
 
     def on_activate(self, is_push):
         app.item_list_controller_manager.controller_displayed(self.controller)
+        # item lists show progress for downloading items
+        messages.SetDownloadProgressDisplayed(True).send_to_backend()
         if not is_push:
             # Focus the item list when we pop the video display from being on
             # top of us.
@@ -448,6 +450,7 @@ class ItemListDisplayMixin(object):
     def on_deactivate(self):
         app.item_list_controller_manager.controller_no_longer_displayed(
                 self.controller)
+        messages.SetDownloadProgressDisplayed(False).send_to_backend()
 
     def cleanup(self):
         self.controller.cleanup()
@@ -488,11 +491,13 @@ class FeedDisplay(ItemListDisplay):
 
     def cleanup(self):
         ItemListDisplay.cleanup(self)
+        messages.SetFeedDisplayed(self.feed_id, False).send_to_backend()
         if widgetutil.feed_exists(self.feed_id):
             messages.MarkFeedSeen(self.feed_id).send_to_backend()
 
     def make_controller(self, tab):
         self.feed_id = tab.id
+        messages.SetFeedDisplayed(self.feed_id, True).send_to_backend()
         return feedcontroller.FeedController(tab.id, tab.is_folder,
                                              tab.is_directory_feed)
 
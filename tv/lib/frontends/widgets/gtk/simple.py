@@ -50,6 +50,10 @@ class Image(object):
         self.width = self.pixbuf.get_width()
         self.height = self.pixbuf.get_height()
 
+    def save(self, path):
+        """Save the image to path as a PNG file."""
+        self.pixbuf.save(path, 'png')
+
     def resize(self, width, height):
         width = int(round(width))
         height = int(round(height))
@@ -33,18 +33,36 @@ filenames.
 imagepool handles creating Image and ImageSurface objects for image
 filenames.  It caches Image/ImageSurface objecsts so to avoid re-creating
 them.
+
+It can also load thumbnails in the background, see get_surface_async().
 """
 
 import logging
+import os
+import threading
 import traceback
+from hashlib import sha1
 
 from miro import util
 from miro.plat import resources
 from miro.plat.frontends.widgets import widgetset
+from miro.plat.frontends.widgets.threads import call_on_ui_thread
 
 broken_image = widgetset.Image(resources.path('images/broken-image.gif'))
 
 CACHE_SIZE = 2000 # number of objects to keep in memory
+# Total size of the pixel data to keep in memory for each cache.  Images vary
+# from small icons to full size cover art, so this is what actually bounds our
+# memory use.
+CACHE_BYTES = 64 * 1024 * 1024
+# number of threads to load thumbnails with
+THUMBNAIL_THREADS = 2
+# Max number of thumbnail requests waiting for a thread.  When we go over
+# this, we drop the oldest requests.  Those are for rows that the user has
+# scrolled past.
+MAX_PENDING_THUMBNAILS = 64
+# number of resized thumbnails to keep in the disk cache
+THUMBNAIL_DISK_CACHE_FILES = 20000
 
 def resize_image(image, dest_width, dest_height, upsize_threshold=1.5):
     # handle corner case of empty dest
@@ -85,6 +103,14 @@ def resize_one_dimension(image, width_scale, height_scale,
     # okay, give up on scaling and just return the image
     return image
 
+def pixel_data_size(image):
+    """Estimate how much memory an Image or ImageSurface uses.
+
+    We assume 4 bytes per pixel, which is what the 32-bit formats our
+    platforms use take.
+    """
+    return int(image.width) * int(image.height) * 4
+
 class ImagePool(util.Cache):
     def create_new_value(self, (path, size), invalidator=None):
         try:
@@ -97,13 +123,22 @@ class ImagePool(util.Cache):
             image = resize_image(image, *size)
         return image
 
+    def value_size(self, image):
+        if image is broken_image:
+            # shared by all broken images, so it's never freed
+            return 0
+        return pixel_data_size(image)
+
 class ImageSurfacePool(util.Cache):
     def create_new_value(self, (path, size), invalidator=None):
         image = _imagepool.get((path, size), invalidator=invalidator)
         return widgetset.ImageSurface(image)
 
-_imagepool = ImagePool(CACHE_SIZE)
-_image_surface_pool = ImageSurfacePool(CACHE_SIZE)
+    def value_size(self, surface):
+        return pixel_data_size(surface)
+
+_imagepool = ImagePool(CACHE_SIZE, CACHE_BYTES)
+_image_surface_pool = ImageSurfacePool(CACHE_SIZE, CACHE_BYTES)
 
 def get(path, size=None, invalidator=None):
     """Returns an Image for path.
@@ -157,3 +192,326 @@ def clear_cache_for_path(path):
                 invalid.add(key)
         for key in invalid:
             pool.remove(key)
+
+def _failed_load_invalidator(path):
+    """Make an invalidator for an image that we couldn't load.
+
+    The invalidator from util.mtime_invalidator() is always true for missing
+    files, so the broken image would get thrown away and loaded again every
+    time the row was drawn.  Instead, keep it until the file's mtime changes,
+    which includes the file being created.
+    """
+    def get_mtime():
+        try:
+            return os.stat(path).st_mtime
+        except EnvironmentError:
+            return None
+    mtime = get_mtime()
+    return lambda key: get_mtime() != mtime
+
+class _ThumbnailRequest(object):
+    def __init__(self, path, size, invalidator):
+        self.path = path
+        self.size = size
+        self.invalidator = invalidator
+        self.callbacks = set()
+        self.image = None
+
+class ThumbnailLoader(object):
+    """Load and resize thumbnails using a pool of threads.
+
+    Requests are handled newest first, since those are for the rows that are
+    currently on screen.  Finished images are handed back to the UI thread
+    in batches, so each callback is called at most once per batch.
+
+    Resized images are also stored in cache_dir, keyed by the path, mtime and
+    size of the image.  This way we don't need to decode full size images
+    again after a restart.
+
+    :attribute cancelled: number of requests that we dropped
+    :attribute disk_hits: number of images that we loaded from cache_dir
+    :attribute disk_misses: number of images that we had to resize
+    """
+    def __init__(self, cache_dir, ui_scheduler=call_on_ui_thread,
+                 thread_count=THUMBNAIL_THREADS):
+        """Create a ThumbnailLoader
+
+        :param cache_dir: directory to store resized images in
+        :param ui_scheduler: function to schedule a callback on the UI thread
+        :param thread_count: number of threads to start
+        """
+        self.cache_dir = cache_dir
+        self.ui_scheduler = ui_scheduler
+        self.condition = threading.Condition()
+        # maps (path, size) keys to requests, the oldest request first
+        self.pending = util.OrderedDict()
+        self.in_progress = {}
+        self.finished = []
+        self.delivery_scheduled = False
+        self.quitting = False
+        self.cancelled = self.disk_hits = self.disk_misses = 0
+        self.threads = []
+        for i in xrange(thread_count):
+            # the first thread also cleans up the disk cache
+            thread = threading.Thread(target=self._thread_loop,
+                                      args=(i == 0,),
+                                      name='Thumbnail Loader %d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def request(self, path, size, callback, invalidator=None):
+        """Request that an image gets loaded.
+
+        When the image is ready, it will be put into the image pool and
+        callback will be called on the UI thread with no arguments.
+        """
+        key = (path, size)
+        self.condition.acquire()
+        try:
+            if key in self.in_progress:
+                self.in_progress[key].callbacks.add(callback)
+                return
+            request = self.pending.pop(key, None)
+            if request is None:
+                request = _ThumbnailRequest(path, size, invalidator)
+            request.callbacks.add(callback)
+            # (re)add the request to the newest end
+            self.pending[key] = request
+            while len(self.pending) > MAX_PENDING_THUMBNAILS:
+                self.pending.popitem(last=False)
+                self.cancelled += 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def cancel(self, callback):
+        """Cancel all pending requests that were made with callback."""
+        self.condition.acquire()
+        try:
+            for key, request in self.pending.items():
+                request.callbacks.discard(callback)
+                if not request.callbacks:
+                    del self.pending[key]
+                    self.cancelled += 1
+            for request in self.in_progress.values():
+                request.callbacks.discard(callback)
+        finally:
+            self.condition.release()
+
+    def shutdown(self):
+        self.condition.acquire()
+        try:
+            self.quitting = True
+            self.pending.clear()
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        for thread in self.threads:
+            thread.join()
+
+    def deliver_finished(self):
+        """Put finished images in the image pool and call their callbacks.
+
+        This runs on the UI thread.
+        """
+        self.condition.acquire()
+        try:
+            finished = self.finished
+            self.finished = []
+            self.delivery_scheduled = False
+        finally:
+            self.condition.release()
+        callbacks = set()
+        for request in finished:
+            _imagepool.set((request.path, request.size), request.image,
+                           invalidator=request.invalidator)
+            callbacks.update(request.callbacks)
+        for callback in callbacks:
+            callback()
+
+    def _thread_loop(self, prune_disk_cache):
+        if prune_disk_cache:
+            self._prune_disk_cache()
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.pending and not self.quitting:
+                    self.condition.wait()
+                if self.quitting:
+                    return
+                key, request = self.pending.popitem()
+                self.in_progress[key] = request
+            finally:
+                self.condition.release()
+            try:
+                request.image = self.load_image(request.path, request.size)
+            except StandardError:
+                logging.warn("error loading image %s:\n%s", request.path,
+                             traceback.format_exc())
+                request.image = broken_image
+                request.invalidator = _failed_load_invalidator(request.path)
+            self.condition.acquire()
+            try:
+                del self.in_progress[key]
+                self.finished.append(request)
+                schedule_delivery = not self.delivery_scheduled
+                self.delivery_scheduled = True
+            finally:
+                self.condition.release()
+            if schedule_delivery:
+                self.ui_scheduler(self.deliver_finished)
+
+    def disk_cache_path(self, path, size):
+        """Get the path to store a resized image at.
+
+        :returns: a path inside cache_dir, or None if the image doesn't exist
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except EnvironmentError:
+            return None
+        key = repr((path, mtime, size))
+        return os.path.join(self.cache_dir, sha1(key).hexdigest() + '.png')
+
+    def load_image(self, path, size):
+        """Load an image, using the disk cache if we can.
+
+        This runs on our threads.
+        """
+        if size is None:
+            return widgetset.Image(path)
+        cache_path = self.disk_cache_path(path, size)
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                image = widgetset.Image(cache_path)
+            except StandardError:
+                logging.warn("error loading cached thumbnail %s", cache_path)
+            else:
+                self._count_disk_lookup(hit=True)
+                return image
+        self._count_disk_lookup(hit=False)
+        image = resize_image(widgetset.Image(path), *size)
+        if cache_path is not None and image is not broken_image:
+            self._save_to_disk_cache(image, cache_path)
+        return image
+
+    def _count_disk_lookup(self, hit):
+        self.condition.acquire()
+        try:
+            if hit:
+                self.disk_hits += 1
+            else:
+                self.disk_misses += 1
+        finally:
+            self.condition.release()
+
+    def _save_to_disk_cache(self, image, cache_path):
+        temp_path = '%s.%s.tmp' % (cache_path, threading.currentThread().name)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            image.save(temp_path)
+            os.rename(temp_path, cache_path)
+        except (StandardError, EnvironmentError):
+            logging.warn("error saving thumbnail %s:\n%s", cache_path,
+                         traceback.format_exc())
+            try:
+                os.remove(temp_path)
+            except EnvironmentError:
+                pass
+
+    def _prune_disk_cache(self):
+        """Remove the oldest thumbnails if we have too many of them."""
+        try:
+            names = os.listdir(self.cache_dir)
+        except EnvironmentError:
+            return
+        if len(names) <= THUMBNAIL_DISK_CACHE_FILES:
+            return
+        files = []
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                files.append((os.stat(path).st_mtime, path))
+            except EnvironmentError:
+                pass
+        files.sort()
+        for mtime, path in files[:len(files) - THUMBNAIL_DISK_CACHE_FILES]:
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'cancelled': self.cancelled,
+            'disk_hits': self.disk_hits,
+            'disk_misses': self.disk_misses,
+        }
+
+_thumbnail_loader = None
+
+def init_thumbnail_loader(cache_dir):
+    """Start loading thumbnails for get_surface_async() in the background.
+
+    Until this is called, get_surface_async() loads images synchronously.
+
+    :param cache_dir: directory to store resized thumbnails in
+    """
+    global _thumbnail_loader
+    if _thumbnail_loader is None:
+        _thumbnail_loader = ThumbnailLoader(cache_dir)
+
+def shutdown_thumbnail_loader():
+    global _thumbnail_loader
+    if _thumbnail_loader is not None:
+        _thumbnail_loader.shutdown()
+        _thumbnail_loader = None
+
+def get_surface_async(path, size, callback, invalidator=None):
+    """Get an ImageSurface for path without loading it on the UI thread.
+
+    If the image isn't loaded yet, we start loading it in the background
+    and return None.  callback will be called with no arguments once the
+    image is ready, then get_surface_async() will return it.
+
+    :param callback: function to call once the image is loaded.  Pass the
+    same callback to cancel_async_requests() to cancel the requests.
+    """
+    key = (path, size)
+    if _thumbnail_loader is None:
+        return _image_surface_pool.get(key, invalidator=invalidator)
+    surface = _image_surface_pool.get_cached(key)
+    if surface is not None:
+        return surface
+    image = _imagepool.get_cached(key)
+    if image is None:
+        _thumbnail_loader.request(path, size, callback, invalidator)
+        return None
+    # Make the surface ourselves rather than using _image_surface_pool.get(),
+    # which would look the key up in both pools again.  The surface is valid
+    # for as long as the image that we made it from.
+    surface = widgetset.ImageSurface(image)
+    _image_surface_pool.set(key, surface,
+                            invalidator=_imagepool.invalidators[key])
+    return surface
+
+def cancel_async_requests(callback):
+    """Cancel pending get_surface_async() requests made with callback."""
+    if _thumbnail_loader is not None:
+        _thumbnail_loader.cancel(callback)
+
+def get_stats():
+    """Get the hit, miss and eviction counts for our caches.
+
+    :returns: dict mapping cache names to util.Cache.stats() dicts
+    """
+    stats = {
+        'images': _imagepool.stats(),
+        'surfaces': _image_surface_pool.stats(),
+    }
+    if _thumbnail_loader is not None:
+        stats['thumbnails'] = _thumbnail_loader.stats()
+    return stats
@@ -37,6 +37,7 @@ in the interface.
 """
 
 import collections
+import itertools
 
 from miro import app
 from miro import prefs
@@ -61,8 +62,11 @@ class ItemList(itemtrack.ItemTracker):
             - set_sort changes the sort
     """
 
-    # sentinel used to represent a group_info that hasn't been calculated
-    NOT_CALCULATED = object()
+    # When we need to load rows to calculate a group, load this many at once.
+    # Groups can span thousands of rows (for example an album view where
+    # mutagen hasn't run yet), so we use bigger chunks than
+    # FETCH_ROW_CHUNK_SIZE.
+    GROUP_FETCH_CHUNK_SIZE = 300
 
     def __init__(self, tab_type, tab_id, sort=None, group_func=None,
                  filters=None, search_text=None):
@@ -119,8 +123,41 @@ class ItemList(itemtrack.ItemTracker):
 
     def _uncache_row_data(self, id_list):
         itemtrack.ItemTracker._uncache_row_data(self, id_list)
-        # items have changed, so we need to reset all group info
-        self._reset_group_info()
+        # items have changed, so forget their group keys and the groups that
+        # they were part of
+        for id_ in id_list:
+            self.group_keys.pop(id_, None)
+            self._forget_group_run(id_)
+
+    def _load_rows(self, rows_to_load):
+        itemtrack.ItemTracker._load_rows(self, rows_to_load)
+        # calculate the group keys while we have the rows at hand
+        if self.group_func is not None:
+            for index in rows_to_load:
+                id_ = self.id_list[index]
+                self.group_keys[id_] = self.group_func(self.row_data[id_])
+
+    def on_item_changes(self, message):
+        if self.group_func is not None:
+            # Groups next to a changed or removed item may grow, shrink or
+            # merge.  Forget them now, while the rows still have their old
+            # positions.
+            self._forget_group_runs_near(
+                self.id_to_index[id_]
+                for id_ in itertools.chain(message.changed, message.removed)
+                if id_ in self.id_to_index)
+        itemtrack.ItemTracker.on_item_changes(self, message)
+
+    def _try_incremental_update(self, message):
+        if not itemtrack.ItemTracker._try_incremental_update(self, message):
+            return False
+        if self.group_func is not None:
+            # Same as above, but for the positions where items were inserted
+            self._forget_group_runs_near(
+                self.id_to_index[id_]
+                for id_ in itertools.chain(message.added, message.changed)
+                if id_ in self.id_to_index)
+        return True
 
     def _make_base_query(self, tab_type, tab_id):
         if self.is_for_device():
@@ -301,9 +338,11 @@ class ItemList(itemtrack.ItemTracker):
         """
         if self.group_func is None:
             raise ValueError("no grouping set")
-        if self.group_info[row] is ItemList.NOT_CALCULATED:
-            self._calc_group_info(row)
-        return self.group_info[row]
+        run = self.group_runs.get(self.id_list[row])
+        if run is None:
+            run = self._calc_group_run(row)
+        start = self.id_to_index[run[0]]
+        return (row - start, len(run), self.get_row(start))
 
     def get_group_top(self, item_id):
         """Get the first info for an item's group.
@@ -332,33 +371,62 @@ class ItemList(itemtrack.ItemTracker):
         self._reset_group_info()
 
     def _reset_group_info(self):
-        self.group_info = [ItemList.NOT_CALCULATED] * len(self)
-
-    def _calc_group_info(self, row):
-        # FIXME: for normal item lists, this is fairly fast, but it is slow in
-        # a specific case:
-        #
-        # When the group function returns the same value for many items and
-        # those items need to be loaded.  This actually can happen pretty
-        # easily when you add a bunch of music files to miro, and we haven't
-        # run mutagen on them yet.  In that case, when you first switch to the
-        # music tab, basically all items will be in the same group.
-        key = self.group_func(self.get_row(row))
+        # group_keys maps item ids to the value group_func returned for them.
+        # group_runs maps item ids to the run of adjacent ids that make up
+        # their group.  All ids in a run share the same list, so we can find
+        # an item's position and the group size without calling group_func.
+        # Both are keyed by id rather than row, so they stay valid when
+        # on_item_changes() inserts or removes rows elsewhere in the list.
+        self.group_keys = {}
+        self.group_runs = {}
+
+    def _forget_group_run(self, id_):
+        run = self.group_runs.get(id_)
+        if run is not None:
+            for member_id in run:
+                del self.group_runs[member_id]
+
+    def _forget_group_runs_near(self, rows):
+        """Forget the groups for a set of rows and the rows next to them."""
+        for row in rows:
+            for i in xrange(max(row - 1, 0), min(row + 2, len(self))):
+                self._forget_group_run(self.id_list[i])
+
+    def _group_key(self, row, step):
+        id_ = self.id_list[row]
+        try:
+            return self.group_keys[id_]
+        except KeyError:
+            pass
+        if self._row_loaded(row):
+            key = self.group_keys[id_] = self.group_func(self.row_data[id_])
+            return key
+        # Load the rows that we will probably walk through next.
+        # _load_rows() calculates their keys for us.
+        if step > 0:
+            rows = xrange(row, min(row + self.GROUP_FETCH_CHUNK_SIZE,
+                                   len(self)))
+        else:
+            rows = xrange(row, max(row - self.GROUP_FETCH_CHUNK_SIZE, -1), -1)
+        self._load_rows([i for i in rows if not self._row_loaded(i)])
+        return self.group_keys[id_]
+
+    def _calc_group_run(self, row):
+        key = self._group_key(row, 1)
         if key is None:
             # if group_func returns None, then put this item in a group by
             # itself.
-            self.group_info[row] = (0, 1, self.get_row(row))
-            return
-        start = end = row
-        while (start > 0 and
-               self.group_func(self.get_row(start-1)) == key):
-            start -= 1
-        while (end < len(self) - 1 and
-               self.group_func(self.get_row(end+1)) == key):
-            end += 1
-        total = end - start + 1
-        for row in xrange(start, end+1):
-            self.group_info[row] = (row-start, total, self.get_row(start))
+            run = [self.id_list[row]]
+        else:
+            start = end = row
+            while start > 0 and self._group_key(start-1, -1) == key:
+                start -= 1
+            while end < len(self) - 1 and self._group_key(end+1, 1) == key:
+                end += 1
+            run = self.id_list[start:end+1]
+        for id_ in run:
+            self.group_runs[id_] = run
+        return run
 
 class ItemTrackerUpdater(object):
     """Keep a list of ItemTrackers and call on_item_changes when needed.
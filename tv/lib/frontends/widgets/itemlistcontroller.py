@@ -50,6 +50,7 @@ from miro import prefs
 from miro import subscription
 from miro.gtcache import gettext as _
 from miro.frontends.widgets import dialogs
+from miro.frontends.widgets import imagepool
 from miro.frontends.widgets import itemcontextmenu
 from miro.frontends.widgets import itemlist
 from miro.frontends.widgets import itemlistwidgets
@@ -450,6 +451,8 @@ class ItemListController(object):
                 'throbber-drawn', self.on_throbber_drawn)
         self.standard_item_view.renderer.signals.connect_weak(
                 'item-retrying', self.on_item_retrying)
+        self.standard_item_view.renderer.signals.connect_weak(
+                'thumbnail-loaded', self.on_thumbnail_loaded)
 
     def set_view(self, _widget, view):
         if view == self.selected_view:
@@ -777,6 +780,9 @@ class ItemListController(object):
     def on_item_retrying(self, signaler, item_info):
         self.retry_time_manager.start(item_info)
 
+    def on_thumbnail_loaded(self, signaler):
+        self.standard_item_view.queue_redraw()
+
     def on_key_press(self, view, key, mods):
         if key == keyboard.DELETE or key == keyboard.BKSPACE:
             return self.handle_delete()
@@ -995,6 +1001,8 @@ class ItemListController(object):
         self.disconnect_from_config_signals()
         for item_view in self.all_item_views():
             item_view.unset_model()
+        imagepool.cancel_async_requests(
+            self.standard_item_view.renderer.on_thumbnail_loaded)
         app.item_list_pool.release(self.item_list)
         self.item_list = None
 
@@ -183,11 +183,14 @@ class ItemRendererSignals(signals.SignalEmitter):
         throbber-drawn (obj, item_info) -- a progress throbber was drawn
         item-retrying (obj, item_info) -- a download will be retried, and we
         need to update the time
+        thumbnail-loaded (obj) -- thumbnails that we drew a placeholder for
+        have been loaded, and we need to redraw
     """
     def __init__(self):
         signals.SignalEmitter.__init__(self,
                                        'throbber-drawn',
                                        'item-retrying',
+                                       'thumbnail-loaded',
                                       )
 
 _cached_images = {} # caches ImageSurface for get_image()
@@ -220,7 +223,8 @@ class ItemRenderer(widgetset.ItemListRenderer):
     def __init__(self, display_channel=True, is_podcast=False,
                  wide_image=False):
         widgetset.ItemListRenderer.__init__(self)
-        self.canvas = ItemRendererCanvas(wide_image)
+        self.canvas = ItemRendererCanvas(wide_image,
+                                         self.on_thumbnail_loaded)
         self.signals = ItemRendererSignals()
         self.display_channel = display_channel
         self.is_podcast = is_podcast
@@ -229,6 +233,9 @@ class ItemRenderer(widgetset.ItemListRenderer):
     def get_size(self, style, layout_manager):
         return self.MIN_WIDTH, self.HEIGHT
 
+    def on_thumbnail_loaded(self):
+        self.signals.emit('thumbnail-loaded')
+
     def hotspot_test(self, style, layout_manager, x, y, width, height):
         layout = self.layout_all(layout_manager, width, height, False, None)
         hotspot_info = layout.find_hotspot(x, y)
@@ -529,11 +536,14 @@ class ItemRendererCanvas(object):
     for the cell
     """
 
-    def __init__(self, wide_image):
+    def __init__(self, wide_image, thumbnail_loaded_callback=None):
         """Create a new ItemRendererDrawer
 
         :param wide_image: should we draw our image with a wide aspect ratio?
+        :param thumbnail_loaded_callback: if given, load thumbnails in the
+        background and call this once they are ready to be drawn.
         """
+        self.thumbnail_loaded_callback = thumbnail_loaded_callback
         if wide_image:
             self.image_width = IMAGE_WIDTH_WIDE
         else:
@@ -1085,9 +1095,19 @@ class ItemRendererCanvas(object):
         context.fill()
 
     def draw_thumbnail(self, context, x, y, width, height):
-        icon = imagepool.get_surface(self.thumbnail, (width, height),
-                                     invalidator=util.mtime_invalidator(
-                self.thumbnail))
+        invalidator = util.mtime_invalidator(self.thumbnail)
+        if self.thumbnail_loaded_callback is None:
+            icon = imagepool.get_surface(self.thumbnail, (width, height),
+                                         invalidator=invalidator)
+        else:
+            icon = imagepool.get_surface_async(self.thumbnail,
+                                               (width, height),
+                                               self.thumbnail_loaded_callback,
+                                               invalidator=invalidator)
+            if icon is None:
+                # The thumbnail is still loading.  Leave the thumbnail
+                # background that we already drew as a placeholder.
+                return
         icon_x = x + (width - icon.width) // 2
         icon_y = y + (height - icon.height) // 2
         # if our thumbnail is far enough to the left, we need to set a clip
@@ -54,6 +54,7 @@ from miro import net
 from miro import prefs
 from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.gtcache import gettext as _
 from miro.xhtmltools import url_encode_dict, multipart_encode
 from miro.plat import utils
@@ -67,6 +68,14 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# shortest time we will wait before checking if throttled transfers can
+# resume
+MIN_THROTTLE_TIMEOUT = 0.01
+
+# Transfer priorities.  Lower values go first.
+PRIORITY_HIGH = 0    # feed updates and other small, interactive requests
+PRIORITY_NORMAL = 1  # downloads started by the user
+PRIORITY_LOW = 2     # auto-downloads
 
 _logged_noproxy_error = False
 
@@ -209,7 +218,7 @@ class TransferOptions(object):
 
     def __init__(self, url, etag=None, modified=None, resume=False,
             post_vars=None, post_files=None, write_file=None,
-                 extra_headers=None):
+                 extra_headers=None, priority=PRIORITY_HIGH, byte_range=None):
         self.url = url
         self.etag = etag
         self.modified = modified
@@ -218,6 +227,8 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        self.priority = priority
+        self.byte_range = byte_range
         self.requires_cookies = False
         self.head_request = False
         self.invalid_url = False
@@ -355,6 +366,7 @@ class CurlTransfer(object):
         self.last_url = None
 
         self.stats = TransferStats()
+        self.stats.priority = options.priority
         self._lookup_auth()
         self.lock = threading.Lock()
 
@@ -371,6 +383,7 @@ class CurlTransfer(object):
         self.status_code = None
         self.trying_head_request = False
         self.saw_head_success = False
+        self.throttled = False
 
     def _send_new_request(self):
         self._reset_transfer_data()
@@ -473,7 +486,13 @@ class CurlTransfer(object):
         if self.options._cancel_on_body_data:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func_abort)
         elif self.options.write_file is not None:
-            if not self.saw_head_success:
+            if self.options.byte_range is not None:
+                # range requests are used for segmented downloads.  The
+                # caller has already checked that the server supports them,
+                # so skip the HEAD request.
+                self._open_file()
+                self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
+            elif not self.saw_head_success:
                 # try a HEAD request first to see if the request will work.
                 # It avoids the issue of RESUME_FROM being applied to the 
                 # error response.
@@ -542,6 +561,9 @@ class CurlTransfer(object):
             curl_manager.remove_transfer(self)
 
     def _open_file(self):
+        if self.options.byte_range is not None:
+            self._open_file_for_range()
+            return
         if self.options.resume:
             mode = 'ab'
             try:
@@ -559,6 +581,19 @@ class CurlTransfer(object):
         except IOError:
             raise WriteError(self.options.write_file)
 
+    def _open_file_for_range(self):
+        start, end = self.options.byte_range
+        self.handle.setopt(pycurl.RANGE, '%d-%d' % (start, end))
+        try:
+            # The file is shared with the transfers for the other ranges.
+            # Don't buffer writes, so that everything we've received is in
+            # the file if the download gets interrupted.
+            self._filehandle = fileutil.open_file(self.options.write_file,
+                                                  'r+b', 0)
+            self._filehandle.seek(start)
+        except IOError:
+            raise WriteError(self.options.write_file)
+
     def should_debug_request(self):
         # return True here to debug HTTP requests in the log file
         return False
@@ -644,6 +679,8 @@ class CurlTransfer(object):
                     args=(self._make_callback_info(),))
 
     def check_response_code(self, code):
+        if self.options.byte_range is not None:
+            return code == 206
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
@@ -834,6 +871,8 @@ class CurlTransfer(object):
         stats.upload_rate = int(getinfo(pycurl.SPEED_UPLOAD))
         stats.status_code = self.status_code
         stats.initial_size = self.resume_from
+        stats.priority = self.options.priority
+        stats.throttled = self.throttled
 
         return stats
 
@@ -852,6 +891,25 @@ class CurlTransfer(object):
         finally:
             self.lock.release()
 
+    def mark_queued(self):
+        """Called when the transfer has to wait before it can start."""
+        stats = TransferStats()
+        stats.priority = self.options.priority
+        stats.queued = True
+        self.lock.acquire()
+        try:
+            self.stats = stats
+        finally:
+            self.lock.release()
+
+    def set_throttled(self, throttled):
+        """Pause/unpause receiving data to stay inside bandwidth limits."""
+        if throttled:
+            self.handle.pause(pycurl.PAUSE_RECV)
+        else:
+            self.handle.pause(pycurl.PAUSE_CONT)
+        self.throttled = throttled
+
 class TransferStats(object):
     """Holds data about a lib curl transfer.
 
@@ -864,6 +922,13 @@ class TransferStats(object):
         download_rate -- download rate in bytes/second
         upload_rate -- upload rate in bytes/second
         initial_size -- bytes that we starting downloading from
+        priority -- priority of the transfer (one of the PRIORITY_* values)
+        throttled -- is the transfer paused to stay inside bandwidth limits?
+        queued -- is the transfer waiting for other transfers to the same
+            host to finish?
+
+    For the totals returned by LibCURLManager.get_stats(), throttled and
+    queued are the number of transfers in that state and priority is None.
     """
     def __init__(self):
         self.downloaded = self.download_total = 0
@@ -871,6 +936,245 @@ class TransferStats(object):
         self.download_rate = self.upload_rate = 0
         self.initial_size = 0
         self.status_code = None
+        self.priority = None
+        self.throttled = False
+        self.queued = False
+
+class TokenBucket(object):
+    """Token bucket used to limit bandwidth.
+
+    Each token is a byte.  The bucket refills at rate bytes/second, up to
+    capacity.  Received data takes tokens out of the bucket.  We don't
+    control how much data libcurl hands us at once, so the bucket can go
+    into debt.
+    """
+    def __init__(self, rate, capacity=None, time_func=clock):
+        self.rate = rate
+        if capacity is None:
+            # allow a 1 second burst
+            capacity = rate
+        self.capacity = capacity
+        self.time_func = time_func
+        self.tokens = capacity
+        self.last_fill = time_func()
+
+    def fill(self):
+        now = self.time_func()
+        elapsed = max(now - self.last_fill, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last_fill = now
+
+    def available(self):
+        self.fill()
+        return self.tokens
+
+    def consume(self, amount):
+        self.fill()
+        self.tokens -= amount
+
+    def time_until(self, amount):
+        """Calculate how long until the bucket contains amount tokens."""
+        self.fill()
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / float(self.rate)
+
+class BandwidthScheduler(object):
+    """Decides when CurlTransfers run and how fast they go.
+
+    This class handles 2 things:
+
+      - Per-host concurrency: if a host already has max_per_host transfers
+        running, new transfers for it wait until one finishes.  Waiting
+        transfers start in priority order.
+      - Rate limiting: received data is charged to a global token bucket
+        and a per-host token bucket.  When a bucket goes into debt, the
+        transfers using it are paused until it refills.
+
+    PRIORITY_HIGH transfers never wait and never get paused, but the data
+    they receive still counts against the limits.  Paused PRIORITY_LOW
+    transfers only resume once the buckets are half full, so
+    PRIORITY_NORMAL transfers get the bandwidth first.  After waiting for
+    AGING_TIME, they resume at the PRIORITY_NORMAL level, so a steady
+    stream of PRIORITY_NORMAL data can't starve them.  No transfer stays
+    paused for longer than MAX_PAUSE_TIME.
+
+    All methods should be called from the libcurl thread.
+    """
+
+    # how full the buckets need to be to resume a paused transfer
+    RESUME_LEVELS = {
+        PRIORITY_HIGH: 0.0,
+        PRIORITY_NORMAL: 0.25,
+        PRIORITY_LOW: 0.5,
+    }
+    # how long a paused transfer waits before it resumes at the
+    # PRIORITY_NORMAL level
+    AGING_TIME = 5.0
+    # longest time we keep a transfer paused.  libcurl counts paused time
+    # against LOW_SPEED_TIME (see CurlTransfer._init_handle()), so we need
+    # to let some data through before it aborts the transfer.
+    MAX_PAUSE_TIME = net.SOCKET_READ_TIMEOUT / 2.0
+
+    def __init__(self, time_func=clock):
+        self.time_func = time_func
+        self.global_bucket = None
+        self.host_rate = None
+        self.max_per_host = None
+        self.host_buckets = {}
+        # maps hosts to the set of running transfers for them
+        self.running = {}
+        self.waiting = []
+        # maps throttled transfers to the time we paused them
+        self.throttled = {}
+        # maps running transfers to the bytes we've charged them for
+        self.bytes_seen = {}
+
+    def set_limits(self, rate=None, host_rate=None, max_per_host=None):
+        """Change the limits.
+
+        :param rate: global download limit in bytes/second
+        :param host_rate: download limit for each host in bytes/second
+        :param max_per_host: max number of transfers to run for each host
+
+        None or 0 means no limit.
+        """
+        if rate:
+            self.global_bucket = TokenBucket(rate, time_func=self.time_func)
+        else:
+            self.global_bucket = None
+        self.host_rate = host_rate or None
+        self.host_buckets = {}
+        self.max_per_host = max_per_host or None
+
+    def add(self, transfer):
+        """Add a new transfer.
+
+        :returns: True if the transfer can start now.  If not, it will be
+            returned from pop_startable() later.
+        """
+        if self._can_start(transfer):
+            self._set_running(transfer)
+            return True
+        self.waiting.append(transfer)
+        return False
+
+    def remove(self, transfer):
+        """Remove a transfer that finished or was canceled."""
+        host = transfer.options.host
+        running = self.running.get(host)
+        if running is not None and transfer in running:
+            running.remove(transfer)
+            if not running:
+                del self.running[host]
+        elif transfer in self.waiting:
+            self.waiting.remove(transfer)
+        self.throttled.pop(transfer, None)
+        self.bytes_seen.pop(transfer, None)
+
+    def pop_startable(self):
+        """Get the waiting transfers that can start now.
+
+        Transfers are returned in priority order.
+        """
+        started = []
+        for transfer in sorted(self.waiting,
+                               key=lambda t: t.options.priority):
+            if self._can_start(transfer):
+                self.waiting.remove(transfer)
+                self._set_running(transfer)
+                started.append(transfer)
+        return started
+
+    def _can_start(self, transfer):
+        if (self.max_per_host is None or
+                transfer.options.priority == PRIORITY_HIGH):
+            return True
+        running = self.running.get(transfer.options.host, ())
+        return len(running) < self.max_per_host
+
+    def _set_running(self, transfer):
+        self.running.setdefault(transfer.options.host, set()).add(transfer)
+        self.bytes_seen[transfer] = 0
+
+    def buckets_for(self, transfer):
+        buckets = []
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+        if self.host_rate is not None:
+            host = transfer.options.host
+            try:
+                bucket = self.host_buckets[host]
+            except KeyError:
+                bucket = self.host_buckets[host] = TokenBucket(
+                    self.host_rate, time_func=self.time_func)
+            buckets.append(bucket)
+        return buckets
+
+    def charge(self, transfer, downloaded):
+        """Charge a transfer for the data it's received.
+
+        :param downloaded: total bytes downloaded by the transfer's current
+            request
+        """
+        last = self.bytes_seen.get(transfer, 0)
+        if downloaded < last:
+            # the transfer started a new request (after a HEAD request, an
+            # auth challenge, etc).
+            last = 0
+        self.bytes_seen[transfer] = downloaded
+        if downloaded > last:
+            for bucket in self.buckets_for(transfer):
+                bucket.consume(downloaded - last)
+
+    def update_throttling(self):
+        """Pause/resume transfers based on how full the buckets are."""
+        for transfers in self.running.values():
+            for transfer in transfers:
+                if transfer.options.priority == PRIORITY_HIGH:
+                    continue
+                if transfer in self.throttled:
+                    if self._can_resume(transfer):
+                        del self.throttled[transfer]
+                        transfer.set_throttled(False)
+                elif self._should_pause(transfer):
+                    self.throttled[transfer] = self.time_func()
+                    transfer.set_throttled(True)
+
+    def _should_pause(self, transfer):
+        for bucket in self.buckets_for(transfer):
+            if bucket.available() < 0:
+                return True
+        return False
+
+    def _resume_wait(self, transfer):
+        paused_time = self.time_func() - self.throttled[transfer]
+        level = self.RESUME_LEVELS[transfer.options.priority]
+        aged_level = min(level, self.RESUME_LEVELS[PRIORITY_NORMAL])
+        if paused_time >= self.AGING_TIME:
+            level = aged_level
+        wait = 0
+        for bucket in self.buckets_for(transfer):
+            wait = max(wait, bucket.time_until(bucket.capacity * level))
+        if level > aged_level:
+            # check again once the transfer ages
+            wait = min(wait, self.AGING_TIME - paused_time)
+        return max(min(wait, self.MAX_PAUSE_TIME - paused_time), 0)
+
+    def _can_resume(self, transfer):
+        return self._resume_wait(transfer) == 0
+
+    def calc_timeout(self):
+        """Calculate when we should check on the throttled transfers.
+
+        :returns: seconds to wait or None if no transfers are throttled
+        """
+        timeout = None
+        for transfer in self.throttled:
+            wait = self._resume_wait(transfer)
+            if timeout is None or wait < timeout:
+                timeout = wait
+        return timeout
 
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
@@ -880,6 +1184,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Enforces bandwidth limits using a BandwidthScheduler
     """
 
     def __init__(self):
@@ -888,7 +1193,11 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
+        self.limits_to_set = Queue.Queue()
         self.after_perform_callbacks = []
+        self.scheduler = BandwidthScheduler()
+        self.stats = TransferStats()
+        self.stats_lock = threading.Lock()
 
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
@@ -916,6 +1225,26 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         self.transfers_to_remove.put((transfer, remove_file))
         self.wakeup()
 
+    def set_limits(self, rate=None, host_rate=None, max_per_host=None):
+        """Change the bandwidth limits.
+
+        This can be called from any thread.  See
+        BandwidthScheduler.set_limits() for the arguments.
+        """
+        self.limits_to_set.put((rate, host_rate, max_per_host))
+        self.wakeup()
+
+    def get_stats(self):
+        """Get the totals for all transfers.
+
+        :returns: a TransferStats object
+        """
+        self.stats_lock.acquire()
+        try:
+            return self.stats
+        finally:
+            self.stats_lock.release()
+
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
@@ -927,9 +1256,14 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         if timeout < 0:
             # libcurl documentation says this means to wait "not too long"
             # Let's try 2 seconds
-            return 2.0
+            timeout = 2.0
         else:
-            return timeout / 1000.0
+            timeout = timeout / 1000.0
+        throttle_timeout = self.scheduler.calc_timeout()
+        if throttle_timeout is not None:
+            timeout = min(timeout,
+                          max(throttle_timeout, MIN_THROTTLE_TIMEOUT))
+        return timeout
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
@@ -941,26 +1275,48 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             self.after_perform_callbacks = []
             if rv != pycurl.E_CALL_MULTI_PERFORM:
                 break
+        self.scheduler.update_throttling()
         self.process_queues()
         self.check_finished()
+        self.start_waiting_transfers()
 
     def update_stats(self):
+        totals = TransferStats()
+        totals.uploaded = 0
+        totals.queued = len(self.scheduler.waiting)
         for transfer in self.transfer_map.values():
             transfer.update_stats()
+            stats = transfer.stats
+            self.scheduler.charge(transfer, stats.downloaded)
+            totals.downloaded += stats.downloaded
+            totals.uploaded += stats.uploaded
+            totals.download_rate += stats.download_rate
+            totals.upload_rate += stats.upload_rate
+            if stats.throttled:
+                totals.throttled += 1
+        self.stats_lock.acquire()
+        try:
+            self.stats = totals
+        finally:
+            self.stats_lock.release()
 
     def process_queues(self):
         while True:
             try:
-                transfer = self.transfers_to_add.get_nowait()
+                limits = self.limits_to_set.get_nowait()
             except Queue.Empty:
                 break
+            self.scheduler.set_limits(*limits)
+
+        while True:
             try:
-                transfer.build_handle()
-            except NetworkError, e:
-                transfer.call_errback(e)
-                continue
-            self.transfer_map[transfer.handle] = transfer
-            self.multi.add_handle(transfer.handle)
+                transfer = self.transfers_to_add.get_nowait()
+            except Queue.Empty:
+                break
+            if self.scheduler.add(transfer):
+                self.start_transfer(transfer)
+            else:
+                transfer.mark_queued()
 
         while True:
             try:
@@ -968,12 +1324,31 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             transfer.on_cancel(remove_file)
+            self.scheduler.remove(transfer)
             try:
                 del self.transfer_map[transfer.handle]
             except KeyError:
                 continue
             self.multi.remove_handle(transfer.handle)
 
+    def start_transfer(self, transfer):
+        try:
+            transfer.build_handle()
+        except NetworkError, e:
+            self.scheduler.remove(transfer)
+            transfer.call_errback(e)
+            return
+        self.transfer_map[transfer.handle] = transfer
+        self.multi.add_handle(transfer.handle)
+
+    def start_waiting_transfers(self):
+        while True:
+            transfers = self.scheduler.pop_startable()
+            if not transfers:
+                break
+            for transfer in transfers:
+                self.start_transfer(transfer)
+
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
@@ -990,6 +1365,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
         self.multi.remove_handle(handle)
+        self.scheduler.remove(transfer)
         return transfer
 
 class HTTPClient(object):
@@ -1024,7 +1400,8 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None, extra_headers=None):
+        post_files=None, extra_headers=None, priority=PRIORITY_HIGH,
+        byte_range=None):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -1046,6 +1423,11 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
     :param extra_headers: an option dictionary of extra headers to send
+    :param priority: transfer priority (one of the PRIORITY_* values).  This
+        controls who goes first when we hit the bandwidth limits.
+    :param byte_range: (start, end) tuple.  If given along with write_file,
+        only request those bytes (end is inclusive) and write them at the
+        same position in write_file, which must already exist.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
@@ -1069,7 +1451,8 @@ def grab_url(url, callback, errback, header_callback=None,
         return _grab_file_url(url, callback, errback, default_mime_type)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
-                post_files, write_file, extra_headers)
+                post_files, write_file, extra_headers, priority,
+                byte_range)
         transfer = CurlTransfer(options, callback, errback, header_callback,
                 content_check_callback)
         transfer.start()
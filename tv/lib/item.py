@@ -132,16 +132,32 @@ class FeedParserValues(object):
                 return False
         return True
 
+    # attributes that compare_to_item_enclosures() checks
+    enclosure_keys = (
+        'url', 'enclosure_size', 'enclosure_type',
+        'enclosure_format'
+        )
+
     def compare_to_item_enclosures(self, item):
-        compare_keys = (
-            'url', 'enclosure_size', 'enclosure_type',
-            'enclosure_format'
-            )
-        for key in compare_keys:
+        for key in self.enclosure_keys:
             if getattr(item, key) != self.data[key]:
                 return False
         return True
 
+    def enclosure_key(self):
+        """Get a hashable key for our enclosure.
+
+        If compare_to_item_enclosures() or compare_to_item() returns True for
+        an item, then item_enclosure_key() will return the same key for that
+        item.  This can be used to build an index of items to compare against.
+        """
+        return tuple(self.data[key] for key in self.enclosure_keys)
+
+    @classmethod
+    def item_enclosure_key(cls, item):
+        """Get the key that enclosure_key() would return for an item."""
+        return tuple(getattr(item, key) for key in cls.enclosure_keys)
+
     def _calc_title(self):
         if hasattr(self.entry, "title"):
             # The title attribute shouldn't use entities, but some in
@@ -524,6 +540,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.size = self.enclosure_size
         # Initalize FileItem attributes to None
         self.short_filename = self.offset_path = None
+        self.calc_thumbnail_path()
 
         # link_number is a hack to make sure that scraped items at the
         # top of a page show up before scraped items at the bottom of
@@ -557,8 +574,16 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         if ('torrent_title' in self.changed_attributes or
             'metadata_title' in self.changed_attributes):
             self.calc_title()
+        if ('cover_art' in self.changed_attributes or
+            'screenshot' in self.changed_attributes):
+            self.calc_thumbnail_path()
         ItemBase.signal_change(self, needs_save, can_change_views)
 
+    def icon_changed(self):
+        """Called by our IconCache when its file changes."""
+        self.calc_thumbnail_path()
+        self.signal_change()
+
     def playlists_changed(self, added=False):
         """Called when the item gets added/removed from playlists."""
         Item.change_tracker.playlists_changed = True
@@ -1085,6 +1110,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         else:
             metadata = app.local_metadata_manager.get_metadata(filename)
         self.update_from_metadata(metadata)
+        self.calc_thumbnail_path()
         Item._path_count_tracker.add_item(self)
 
     def file_moved(self, new_filename):
@@ -1312,6 +1338,8 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.file_type = self.watched_time = self.last_watched = None
         self.duration = None
         self.is_container_item = None
+        # the MetadataManager deletes our screenshot along with the file
+        self.screenshot = None
         self.signal_change()
 
     def has_downloader(self):
@@ -1622,20 +1650,8 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         to signal the right set of items.
         """
         self.confirm_db_thread()
-        if self.cover_art:
-            path = self.cover_art
-            path = resources.path(fileutil.expand_filename(path))
-            if fileutil.exists(path):
-                return path
-        if self.icon_cache is not None and self.icon_cache.is_valid():
-            # is_valid() verifies that the path exists
-            path = self.icon_cache.get_filename()
-            return resources.path(fileutil.expand_filename(path))
-        if self.screenshot:
-            path = self.screenshot
-            path = resources.path(fileutil.expand_filename(path))
-            if fileutil.exists(path):
-                return path
+        if self.thumbnail_path is not None:
+            return self.thumbnail_path
         if self.is_container_item:
             return resources.path("images/thumb-default-folder.png")
         else:
@@ -1649,6 +1665,28 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
             else:
                 return resources.path("images/thumb-default-video.png")
 
+    def calc_thumbnail_path(self):
+        """Calculate the thumbnail_path column.
+
+        thumbnail_path stores the first of our cover art, icon cache and
+        screenshot files that exists, or None if none of them do.  We call
+        this whenever one of those files is created or removed, so that
+        get_thumbnail() and ItemInfo.thumbnail don't need to check the
+        filesystem.
+        """
+        self.confirm_db_thread()
+        candidates = [self.cover_art]
+        if self.icon_cache is not None and self.icon_cache.filename:
+            candidates.append(self.icon_cache.get_filename())
+        candidates.append(self.screenshot)
+        for path in candidates:
+            if path:
+                path = resources.path(fileutil.expand_filename(path))
+                if fileutil.exists(path):
+                    self.thumbnail_path = path
+                    return
+        self.thumbnail_path = None
+
     def is_downloaded_torrent(self):
         return (self.is_container_item and self.has_downloader() and
                 self.downloader.is_finished())
@@ -2118,6 +2156,11 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
                 not self._allow_nonexistent_paths):
             self.expire()
             return True
+        if (self.thumbnail_path is not None and
+                not fileutil.exists(self.thumbnail_path)):
+            # our thumbnail was deleted outside of miro
+            self.calc_thumbnail_path()
+            self.signal_change()
         return False
 
     def _get_downloader(self):
@@ -2303,6 +2346,8 @@ class FileItem(Item):
         self.feed_id = models.Feed.get_manual_feed().id
         self.deleted = True
         self._calc_parent_title()
+        # remove_file() deleted our screenshot
+        self.screenshot = None
         self.signal_change()
 
     def make_undeleted(self):
@@ -41,6 +41,7 @@ import urlparse
 # XXX merged into http.server in Python 3.
 import BaseHTTPServer
 import SocketServer
+import Queue
 import threading
 import httplib
 import gzip
@@ -56,14 +57,15 @@ MAX_SESSION = 2147483647
 import mdns
 from const import *
 from subr import (encode_response, decode_response, split_url_path, atoi,
-                  atol, StreamObj, ChunkedStreamObj, find_daap_tag,
-                  find_daap_listitems)
+                  atol, StreamObj, ChunkedStreamObj, EncodedListing,
+                  find_daap_tag, find_daap_listitems)
 
 # Configurable options (or do via command line).
 DEFAULT_PORT = 3689
 DAAP_TIMEOUT = 1800    # timeout (in seconds)
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
+DAAP_POOL_SIZE = 0     # Worker threads, 0 means one thread per connection.
 
 # !!! No user servicable parts below. !!!
 
@@ -100,6 +102,44 @@ DEFAULT_DAAP_PLAYLIST_META = ('dmap.itemid,dmap.itemname,dmap.persistentid,' +
                               'dmap.parentcontainerid,dmap.persistentid,' + 
                               'com.apple.itunes.is-podcast-playlist')
 
+class EncodedItemCache(object):
+    # Cache of encoded listing items, keyed by item id.  Each entry holds the
+    # item revision it was encoded for and a dict mapping meta strings to the
+    # encoded mlit bytes.  An item with a new revision has changed, so its
+    # entry is thrown away.
+    #
+    # This gets used from several server threads without a lock.  Single dict
+    # operations are atomic and the worst a race can do is encode an item
+    # twice, so that's fine.
+    def __init__(self):
+        self.entries = dict()
+
+    def get(self, item_id, revision, meta, meta_codes, itemprop):
+        entry = self.entries.get(item_id)
+        if entry is None or entry[0] != revision:
+            entry = (revision, dict())
+            self.entries[item_id] = entry
+        data = entry[1].get(meta)
+        if data is None:
+            data = self.encode(itemprop, meta_codes)
+            entry[1][meta] = data
+        return data
+
+    def encode(self, itemprop, meta_codes):
+        # NB: mikd must be the first guy in the listing.
+        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
+        # it doesn't work!
+        # item kind - seems OK to hardcode this.
+        item = [('mikd', DAAP_ITEMKIND_AUDIO)]
+        for m, code in meta_codes:
+            value = itemprop.get(m)
+            if value is not None:
+                item.append((code, value))
+        return str(encode_response([('mlit', item)]))
+
+    def discard(self, item_id):
+        self.entries.pop(item_id, None)
+
 class SessionObject(object):
     # Container object for a daap session.  Basically a heartbeat timeout
     # timer object and a generation counter so we can impose some ordering
@@ -113,6 +153,9 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     # a new port.
     # allow_reuse_address = True    # setsockopt(... SO_REUSEADDR, 1)
     daemon_threads = True
+    # The default listen() backlog of 5 drops connections when several
+    # clients connect at once and they have to wait for a SYN retry.
+    request_queue_size = 64
 
     def __init__(self, server_address, RequestHandlerClass,
                  bind_and_activate=True):
@@ -123,6 +166,7 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
+        self.item_cache = EncodedItemCache()
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
@@ -202,6 +246,59 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
             except KeyError:
                 pass
 
+class ThreadPoolMixIn:
+    # Like SocketServer.ThreadingMixIn, but connections are handled by a
+    # fixed pool of worker threads instead of a new thread each.  Once all
+    # the workers are busy new connections wait in the queue until one
+    # finishes.  Note that a worker is tied up for the whole life of a
+    # keep-alive connection, including /update requests that block waiting
+    # for changes, so the pool should be bigger than the number of
+    # connections clients keep open.
+    pool_size = 32
+
+    def start_pool(self):
+        self.request_queue = Queue.Queue()
+        self.workers = []
+        for i in xrange(self.pool_size):
+            t = threading.Thread(target=self.process_request_worker,
+                                 name='DAAP worker %d' % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def process_request_worker(self):
+        while True:
+            request, client_address = self.request_queue.get()
+            if request is None:
+                break
+            try:
+                self.finish_request(request, client_address)
+                self.shutdown_request(request)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.request_queue.put((request, client_address))
+
+    def stop_pool(self):
+        for t in self.workers:
+            self.request_queue.put((None, None))
+        self.workers = []
+
+class DaapThreadPoolTCPServer(ThreadPoolMixIn, DaapTCPServer):
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, pool_size=None):
+        DaapTCPServer.__init__(self, server_address, RequestHandlerClass,
+                               bind_and_activate)
+        if pool_size:
+            self.pool_size = pool_size
+        self.start_pool()
+
+    def server_close(self):
+        DaapTCPServer.server_close(self)
+        self.stop_pool()
+
 class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     server_version = 'daap.py' + ' ' + VERSION
@@ -247,11 +344,16 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            if isinstance(blob, ChunkedStreamObj) and blob.can_sendfile():
+                # Zero-copy: let the kernel move the file data to the socket.
+                self.wfile.flush()
+                blob.sendfile(self.connection)
+            else:
+                for chunk in blob:
+                    self.wfile.write(chunk)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
-        except IOError:
+        except (IOError, OSError):
             session = getattr(self, 'session', 0)
             if session:
                 self.server.del_session(session)
@@ -545,39 +647,35 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         backend_id = playlist_id
         if backend_id == 2:
             backend_id = None
-        items = self.server.backend.get_items(playlist_id=backend_id)
-        itemlist = []
-        deleted = []
         try:
             meta = query['meta']
         except KeyError:
             meta = DEFAULT_DAAP_META
         revision, delta = self.get_revision(query) 
-        meta_list = [m.strip() for m in meta.split(',')]
-        # NB: mikd must be the first guy in the listing.
-        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
-        # it doesn't work!
-        for k in items.keys():
-            itemprop = items[k]
+        # The backend keeps its items ordered by revision, so for a delta
+        # request we only get back the items that changed.
+        items = self.server.backend.get_items(playlist_id=backend_id,
+                                              since_revision=delta)
+        meta_codes = []
+        for m in meta.split(','):
+            m = m.strip()
+            try:
+                meta_codes.append((m, dmap_consts_rmap[m]))
+            except KeyError:
+                continue
+        # Key the cache on the meta names we actually send
+        meta = ','.join(m for m, code in meta_codes)
+        item_cache = self.server.item_cache
+        itemlist = []
+        deleted = []
+        for k, itemprop in items.iteritems():
             if itemprop['revision'] <= delta:
                 continue
             if itemprop['valid']:
-                item = []
-                for m in meta_list:
-                    if m in itemprop.keys():
-                        try:
-                            code = dmap_consts_rmap[m]
-                        except KeyError:
-                            continue
-                        if itemprop[m] is not None:
-                            attribute = (code, itemprop[m])
-                            item.append(attribute)
-                itemlist.append(('mlit', [       # Listing item
-                                      # item kind - seems OK to hardcode this.
-                                          ('mikd', DAAP_ITEMKIND_AUDIO),
-                                         ] + item
-                           )) 
+                itemlist.append(item_cache.get(k, itemprop['revision'], meta,
+                                               meta_codes, itemprop))
             else:
+                item_cache.discard(k)
                 deleted.append(('miid', k))
 
         tag = 'apso' if playlist_id else 'adbs'
@@ -589,7 +687,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                         ('muty', update),    # Update type
                         ('mtco', nfiles),    # Specified total count
                         ('mrco', nfiles),    # Returned count
-                        ('mlcl', itemlist)
+                        ('mlcl', EncodedListing(itemlist))
                   ]
         if deleted:
             content.append(('mudl', deleted))    # Itemlist deleted
@@ -795,12 +893,17 @@ def runloop(daapserver):
     daapserver.serve_forever()
 
 def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
-                     max_conn=DAAP_MAXCONN, robust=True):
+                     max_conn=DAAP_MAXCONN, robust=True,
+                     pool_size=DAAP_POOL_SIZE):
     handler = DaapHttpRequestHandler
     failed = False
     while True:
         try:
-            httpd = DaapTCPServer(('', port), handler)
+            if pool_size:
+                httpd = DaapThreadPoolTCPServer(('', port), handler,
+                                                pool_size=pool_size)
+            else:
+                httpd = DaapTCPServer(('', port), handler)
             break
         except socket.error, e:
             if robust and not port == 0:
@@ -28,9 +28,13 @@
 
 # subr.py
 
+import errno
 import os
+import select
+import socket
 import stat
 import struct
+import sys
 import urllib
 import gzip
 
@@ -56,30 +60,83 @@ fmts = {
     DMAP_TYPE_VERSION: ('I', 4),
 }
 
+def _find_sendfile():
+    """
+       _find_sendfile() -> sendfile(out_fd, in_fd, offset, count) -> sent
+
+       os.sendfile() only exists in Python 3.3 and later, so on Linux we call
+       the libc function through ctypes.  Returns None if sendfile() isn't
+       available.
+    """
+    try:
+        return os.sendfile
+    except AttributeError:
+        pass
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        c_sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = c_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+sendfile = _find_sendfile()
+
 class StreamObj(object):
     """
        Data object for encoding HTTP responses.  Use once then dispose.
+
+       data can be a string or a list of strings.  A list is written out
+       in blocks of at most DEFAULT_CHUNK_SIZE bytes, so big listings never
+       need to be joined into one string.
     """
+    DEFAULT_CHUNK_SIZE = 128 * 1024
+
     def __init__(self, data, content_encoding=None):
+        if isinstance(data, str):
+            data = [data]
+        self.chunks = data
         self.content_encoding = content_encoding
         if content_encoding == 'gzip':
             gzdata = StringIO()
             f = gzip.GzipFile(fileobj=gzdata, mode='wb')
-            f.write(data)
+            for block in self:
+                f.write(block)
             f.close()
-            self.data = gzdata.getvalue()
-        else:
-            self.data = data
+            self.chunks = [gzdata.getvalue()]
+        self.size = sum(len(chunk) for chunk in self.chunks)
 
     def __str__(self):
-        return self.data
+        return ''.join(self.chunks)
 
-    # Treat this as one big block of data.
     def __iter__(self):
-        yield self.data
+        pending = []
+        pending_size = 0
+        for chunk in self.chunks:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= self.DEFAULT_CHUNK_SIZE:
+                yield ''.join(pending)
+                pending = []
+                pending_size = 0
+        if pending:
+            yield ''.join(pending)
 
     def __len__(self):
-        return len(self.data)
+        return self.size
 
     def get_headers(self):
         headers = []
@@ -90,6 +147,18 @@ class StreamObj(object):
     def get_rangetext(self):
         return ''
 
+class EncodedListing(object):
+    """
+       A list container value whose contents are already encoded.
+
+       encode_response() sends the chunks as-is instead of encoding a list
+       of (code, value) pairs.  Use this to send listing items that have been
+       encoded once and cached.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.size = sum(len(chunk) for chunk in chunks)
+
 class ChunkedStreamObj(object):
     """
        Streaming object.  Use once and then you must dispose.
@@ -153,6 +222,53 @@ class ChunkedStreamObj(object):
     def __len__(self):
         return self.streamsize
 
+    def can_sendfile(self):
+        """
+           can_sendfile() -> bool
+
+           True if the stream can be sent with sendfile() instead of being
+           read into Python.
+        """
+        if sendfile is None:
+            return False
+        try:
+            mode = os.fstat(self.file_obj.fileno()).st_mode
+        except (AttributeError, OSError):
+            return False
+        return stat.S_ISREG(mode)
+
+    def sendfile(self, sock):
+        """
+           sendfile(sock) -> None
+
+           Send the stream to sock with sendfile().  The kernel copies the
+           data straight from the file to the socket.  Like iterating, this
+           consumes the object.
+        """
+        in_fd = self.file_obj.fileno()
+        out_fd = sock.fileno()
+        offset = self.file_obj.tell()
+        timeout = sock.gettimeout()
+        while self.unread > 0:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, self.unread)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    raise
+                # Socket has a timeout, so it's non-blocking underneath.
+                r, w, x = select.select([], [out_fd], [], timeout)
+                if not w:
+                    raise socket.timeout('timed out')
+                continue
+            # Maybe file got truncated
+            if sent == 0:
+                break
+            offset += sent
+            self.unread -= sent
+        self.file_obj.seek(offset, os.SEEK_SET)
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -285,41 +401,15 @@ def encode_response(reply, content_encoding=None):
        to send over the wire.
 
        DMAP_TYPE_LIST should have a value of list containing other response
-       codes.
+       codes, or an EncodedListing.
 
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        chunks = []
+        _encode_chunks(reply, chunks)
+        blob = StreamObj(chunks, content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
@@ -327,6 +417,48 @@ def encode_response(reply, content_encoding=None):
         blob = ChunkedStreamObj(file_obj, hint, start, end)
     return blob
 
+def _encode_chunks(reply, chunks):
+    """
+       _encode_chunks(reply, chunks) -> size
+
+       Append the encoded reply to chunks, return the number of bytes added.
+    """
+    total = 0
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        fmt, size = fmts[typ]
+        if typ == DMAP_TYPE_LIST:
+            # list container - we don't know the size until the contents
+            # are encoded, so leave a slot for the header and fill it in
+            # afterwards.
+            header_index = len(chunks)
+            chunks.append('')
+            if isinstance(value, EncodedListing):
+                chunks.extend(value.chunks)
+                size = value.size
+            else:
+                size = _encode_chunks(value, chunks)
+            chunks[header_index] = struct.pack('!4sI', code, size)
+            total += 8 + size
+            continue
+        if typ == DMAP_TYPE_STRING:
+            fmt = str(len(value)) + fmt
+            size = len(value)
+            # This ensures we always get a string type even if we are lame
+            # and passed a unicode in.
+            value = str(buffer(value))
+        # code (4 bytes), length (4 bytes), data (variable), network byte
+        # order
+        fmt = '!4sI' + fmt
+        try:
+            data = struct.pack(fmt, code, size, value)
+        except struct.error:
+            # This pack did not work.  Let's ignore it
+            continue
+        chunks.append(data)
+        total += len(data)
+    return total
+
 def split_url_path(urlpath):
     """
        split_url_path(urlpath) -> path, dict
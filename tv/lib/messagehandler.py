@@ -43,6 +43,7 @@ from miro import conversions
 from miro import downloader
 from miro import eventloop
 from miro import feed
+from miro import feedupdate
 from miro import guide
 from miro import fileutil
 from miro import commandline
@@ -546,6 +547,12 @@ class BackendMessageHandler(messages.MessageHandler):
     def handle_stop_tracking_share(self, message):
         app.sharing_tracker.stop_tracking_share(message.share_id)
 
+    def handle_set_feed_displayed(self, message):
+        feedupdate.set_feed_displayed(message.id, message.displayed)
+
+    def handle_set_download_progress_displayed(self, message):
+        app.download_state_manager.set_progress_displayed(message.displayed)
+
     def handle_mark_feed_seen(self, message):
         try:
             try:
@@ -1606,6 +1613,16 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         time.sleep(message.n)
         logging.debug('handle_clog_backend: Backend out of snooze.  Yawn!')
 
+    def handle_set_event_loop_profiling(self, message):
+        if message.enabled:
+            eventloop.profiler.reset()
+            eventloop.profiler.enable()
+        else:
+            eventloop.profiler.disable()
+
+    def handle_dump_event_loop_profile(self, message):
+        eventloop.profiler.log_report()
+
     def handle_force_feedparser_processing(self, message):
         # For all our RSS feeds, force an update
         for f in feed.Feed.make_view():
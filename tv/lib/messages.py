@@ -301,6 +301,21 @@ class UpdateFeedFolder(BackendMessage):
     def __init__(self, id_):
         self.id = id_
 
+class SetFeedDisplayed(BackendMessage):
+    """Tell the backend when the user starts or stops looking at a feed.
+    """
+    def __init__(self, id_, displayed):
+        self.id = id_
+        self.displayed = displayed
+
+class SetDownloadProgressDisplayed(BackendMessage):
+    """Tell the backend if the user can see download progress.
+
+    This controls how often the downloader sends status updates.
+    """
+    def __init__(self, displayed):
+        self.displayed = displayed
+
 class MarkFeedSeen(BackendMessage):
     """Mark a feed as seen.
     """
@@ -875,6 +890,20 @@ class ClogBackend(BackendMessage):
     def __init__(self, n=0):
         self.n = n
 
+class SetEventLoopProfiling(BackendMessage):
+    """Dev message: turn the event loop profiler on or off.
+
+    Turning the profiler on clears out any data from before.
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+class DumpEventLoopProfile(BackendMessage):
+    """Dev message: write a summary of the event loop profiler data to the
+    log.
+    """
+    pass
+
 class ForceFeedparserProcessing(BackendMessage):
     """Force the backend to do a bunch of feedparser updates
     """
@@ -1121,6 +1121,11 @@ class MetadataManagerBase(signals.SignalEmitter):
             5, self.echonest_cover_art_dir)
         self.pending_mutagen_tasks = []
         self.bulk_add_count = 0
+        # MetadataCache to check before running mutagen/movie-data
+        self.metadata_cache = app.metadata_cache
+        # maps (source_name, path) -> MetadataCache.stat_key() for tasks
+        # that we sent after a cache miss
+        self._cache_stat_keys = {}
         self.metadata_processors = [
             self.mutagen_processor,
             self.moviedata_processor,
@@ -1297,6 +1302,10 @@ class MetadataManagerBase(signals.SignalEmitter):
     def _cancel_processing_paths(self, paths):
         paths = [self._translate_path(p) for p in paths]
         workerprocess.cancel_tasks_for_files(paths)
+        if self._cache_stat_keys:
+            for path in paths:
+                for source_name in (u'mutagen', u'movie-data'):
+                    self._cache_stat_keys.pop((source_name, path), None)
         for processor in self.metadata_processors:
             processor.remove_tasks_for_paths(paths)
 
@@ -1637,6 +1646,8 @@ class MetadataManagerBase(signals.SignalEmitter):
         """Run mutagen on a path."""
         self.check_image_directories()
         path = self._translate_path(path)
+        if self._check_metadata_cache(self.mutagen_processor, path):
+            return
         task = workerprocess.MutagenTask(path, self.cover_art_dir)
         if not self.in_bulk_add():
             self.mutagen_processor.add_task(task)
@@ -1647,6 +1658,8 @@ class MetadataManagerBase(signals.SignalEmitter):
         """Run the movie data program on a path."""
         self.check_image_directories()
         path = self._translate_path(path)
+        if self._check_metadata_cache(self.moviedata_processor, path):
+            return
         task = workerprocess.MovieDataProgramTask(path, self.screenshot_dir)
         self.moviedata_processor.add_task(task)
 
@@ -1674,12 +1687,49 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.echonest_processor.add_path(self._translate_path(path),
                                          metadata_fetcher)
 
+    def _check_metadata_cache(self, processor, path):
+        """Try to use a cached result instead of running a processor.
+
+        If the metadata cache has a result for the file, we handle it like
+        the processor had just finished.  Otherwise we remember the file's
+        size and mtime so that we can store the result when the task
+        completes.
+
+        :param processor: _TaskProcessor we want to run
+        :param path: translated path to the file
+        :returns: True if we found a cached result
+        """
+        if self.metadata_cache is None:
+            return False
+        stat_key, result = self.metadata_cache.lookup_path(
+            path, processor.source_name)
+        if stat_key is None:
+            return False
+        if result is None:
+            key = (processor.source_name, path)
+            self._cache_stat_keys[key] = stat_key
+            return False
+        logging.debug("%s result cached: %r", processor.source_name, path)
+        result['source_path'] = path
+        self._on_task_complete(processor, path, result)
+        return True
+
     def _on_task_complete(self, processor, path, result):
+        stat_key = self._cache_stat_keys.pop(
+            (processor.source_name, path), None)
+        if stat_key is not None:
+            # The processor just read the file, so the data we need for the
+            # fingerprint should be in the OS cache.
+            fingerprint = self.metadata_cache.fingerprint(path)
+            if fingerprint is not None and fingerprint[:2] == stat_key:
+                self.metadata_cache.store(fingerprint,
+                                          processor.source_name, result)
         path = self._untranslate_path(path)
         self.metadata_finished.append((processor, path, result))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
 
     def _on_task_error(self, processor, path, error):
+        self._cache_stat_keys.pop((processor.source_name, path), None)
         path = self._untranslate_path(path)
         self.metadata_errors.append((processor, path, error))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
@@ -1719,6 +1769,8 @@ class MetadataManagerBase(signals.SignalEmitter):
                 logging.warn("Error adding new metadata: %s. new_metadata\n%s",
                              e, new_metadata_debug_string)
                 raise
+        if self.metadata_cache is not None:
+            self.metadata_cache.commit()
         self._send_progress_updates()
 
     def _process_metadata_finished(self):
@@ -0,0 +1,283 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.metadatacache -- Cache metadata extraction results by file content.
+
+MetadataCache stores the results of running mutagen and the movie data
+program so that we don't have to run them again for a file that we've already
+seen.  Results are keyed by the file's size, mtime and a hash of the start and
+end of the file, rather than the path.  This means re-importing a library or
+re-attaching a device can skip the extractors for files that haven't changed,
+even if they live at a different path now.
+
+The cache lives in its own sqlite database, separate from the main miro
+database.  It's just a cache, so if anything goes wrong we drop it and start
+over.
+"""
+
+import cPickle
+import logging
+import os
+from hashlib import sha1
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from miro import fileutil
+
+# keys in the result dicts that point to files we created.  If those files
+# are gone, the cached result is no longer valid.
+IMAGE_KEYS = ('cover_art', 'screenshot')
+
+class MetadataCache(object):
+    """Cache for metadata extractor results.
+
+    Attributes:
+
+    hits -- number of lookups that found a cached result
+    misses -- number of lookups that didn't
+    bytes_saved -- total size of the files that we didn't need to process
+    """
+
+    # how much data to hash from the start and end of each file
+    HASH_BLOCK_SIZE = 16 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = self.misses = self.bytes_saved = 0
+        self.connection = None
+        self._open()
+
+    def _open(self):
+        try:
+            self.connection = sqlite3.connect(self.path)
+            self._create_table()
+        except sqlite3.DatabaseError, e:
+            logging.warn("MetadataCache: error opening %s (%s).  "
+                         "Starting over", self.path, e)
+            self._reset()
+
+    def _create_table(self):
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata_cache "
+                                "(size INTEGER, mtime INTEGER, "
+                                "content_hash TEXT, source TEXT, "
+                                "result BLOB, "
+                                "PRIMARY KEY (size, mtime, content_hash, "
+                                "source))")
+        self.connection.commit()
+
+    def _reset(self):
+        if self.connection is not None:
+            self.connection.close()
+        try:
+            os.remove(self.path)
+        except EnvironmentError:
+            pass
+        self.connection = sqlite3.connect(self.path)
+        self._create_table()
+
+    def close(self):
+        if self.connection is not None:
+            self.commit()
+            self.connection.close()
+            self.connection = None
+
+    def commit(self):
+        """Commit results that have been stored since the last commit.
+
+        store() doesn't commit by itself, since doing that for every file in
+        a big import would be slow.
+        """
+        try:
+            self.connection.commit()
+        except sqlite3.DatabaseError, e:
+            logging.warn("MetadataCache: error committing (%s)", e)
+
+    def stat_key(self, path):
+        """Get the (size, mtime) part of a file's cache key.
+
+        This only needs a stat() call, so it's much cheaper than
+        fingerprint().
+
+        :returns: (size, mtime) tuple or None if we can't stat the file.
+        """
+        try:
+            stat_info = os.stat(path)
+        except EnvironmentError:
+            return None
+        return (stat_info.st_size, int(stat_info.st_mtime))
+
+    def fingerprint(self, path):
+        """Calculate the cache key for a file.
+
+        This reads from the start and end of the file, use stat_key() to
+        check if a file could be in the cache first.
+
+        :returns: (size, mtime, content_hash) tuple or None if we can't read
+            the file.
+        """
+        try:
+            stat_info = os.stat(path)
+            f = open(path, 'rb')
+        except EnvironmentError:
+            return None
+        try:
+            size = stat_info.st_size
+            hasher = sha1(f.read(self.HASH_BLOCK_SIZE))
+            if size > self.HASH_BLOCK_SIZE * 2:
+                f.seek(-self.HASH_BLOCK_SIZE, os.SEEK_END)
+                hasher.update(f.read(self.HASH_BLOCK_SIZE))
+        except EnvironmentError:
+            return None
+        finally:
+            f.close()
+        return (size, int(stat_info.st_mtime), unicode(hasher.hexdigest()))
+
+    def lookup_path(self, path, source):
+        """Get a cached result for a file.
+
+        We only read the file to calculate its fingerprint if we have a
+        result for a file with the same size and mtime.
+
+        :param path: path to the file
+        :param source: name of the metadata source (u'mutagen', etc)
+        :returns: (stat_key, result) tuple.  stat_key is the value from
+            stat_key() or None if we can't read the file.  result is the
+            result dict or None if we don't have a usable result.
+        """
+        stat_key = self.stat_key(path)
+        if stat_key is None:
+            return None, None
+        if not self._has_results_for(stat_key, source):
+            self.misses += 1
+            return stat_key, None
+        fingerprint = self.fingerprint(path)
+        if fingerprint is None:
+            return None, None
+        return fingerprint[:2], self.lookup(fingerprint, source)
+
+    def _has_results_for(self, stat_key, source):
+        try:
+            cursor = self.connection.execute(
+                "SELECT 1 FROM metadata_cache "
+                "WHERE size=? AND mtime=? AND source=? LIMIT 1",
+                stat_key + (source,))
+            return cursor.fetchone() is not None
+        except sqlite3.DatabaseError, e:
+            logging.warn("MetadataCache: error looking up result (%s)", e)
+            return False
+
+    def lookup(self, fingerprint, source):
+        """Get a cached result.
+
+        :param fingerprint: value returned by fingerprint()
+        :param source: name of the metadata source (u'mutagen', etc)
+        :returns: result dict or None if we don't have a usable result
+        """
+        try:
+            cursor = self.connection.execute(
+                "SELECT result FROM metadata_cache "
+                "WHERE size=? AND mtime=? AND content_hash=? AND source=?",
+                fingerprint + (source,))
+            row = cursor.fetchone()
+        except sqlite3.DatabaseError, e:
+            logging.warn("MetadataCache: error looking up result (%s)", e)
+            row = None
+        if row is not None:
+            result = self._load_result(row[0])
+            if result is not None and self._images_exist(result):
+                self.hits += 1
+                self.bytes_saved += fingerprint[0]
+                return result
+            self.remove(fingerprint, source)
+        self.misses += 1
+        return None
+
+    def _load_result(self, data):
+        try:
+            return cPickle.loads(str(data))
+        except StandardError:
+            logging.warn("MetadataCache: error unpickling result",
+                         exc_info=True)
+            return None
+
+    def _images_exist(self, result):
+        for key in IMAGE_KEYS:
+            if key in result and not fileutil.exists(result[key]):
+                return False
+        return True
+
+    def store(self, fingerprint, source, result):
+        """Store a result from a metadata extractor."""
+        result = result.copy()
+        # created_cover_art is only true for the first file that we extracted
+        # the cover art for, don't copy it over to the cached result.
+        # source_path depends on where the file was when we processed it.
+        result.pop('created_cover_art', None)
+        result.pop('source_path', None)
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata_cache "
+                "(size, mtime, content_hash, source, result) "
+                "VALUES (?, ?, ?, ?, ?)",
+                fingerprint + (source, sqlite3.Binary(data)))
+        except sqlite3.DatabaseError, e:
+            logging.warn("MetadataCache: error storing result (%s)", e)
+
+    def remove(self, fingerprint, source):
+        try:
+            self.connection.execute(
+                "DELETE FROM metadata_cache "
+                "WHERE size=? AND mtime=? AND content_hash=? AND source=?",
+                fingerprint + (source,))
+        except sqlite3.DatabaseError, e:
+            logging.warn("MetadataCache: error removing result (%s)", e)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        """Get a dict of cache statistics."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+            'bytes_saved': self.bytes_saved,
+        }
+
+    def log_stats(self):
+        logging.info("MetadataCache: %d hits, %d misses (%.1f%%), "
+                     "%d bytes not processed", self.hits, self.misses,
+                     self.hit_rate() * 100, self.bytes_saved)
@@ -328,10 +328,9 @@ class AsyncSocket(object):
             eventloop.remove_write_callback(self.socket)
             trap_call(self, errback, ConnectionTimeout(host))
             self.connectionErrback = None
-        eventloop.call_in_thread(onAddressLookup, handleGetAddrInfoException,
-                                 socket.getaddrinfo,
-                                 "getAddrInfo - %s:%s" % (host, port),
-                                 host, port)
+        eventloop.call_in_thread_with_priority(eventloop.PRIORITY_HIGH,
+                onAddressLookup, handleGetAddrInfoException,
+                socket.getaddrinfo, "getAddrInfo", host, port)
 
     def accept_connection(self, family, host, port, callback, errback):
         def finishAccept():
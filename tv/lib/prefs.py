@@ -81,6 +81,14 @@ LIMIT_DOWNSTREAM_BT         = Pref(key='limitDownstreamBT',     default=False, p
 DOWNSTREAM_BT_LIMIT_IN_KBS  = Pref(key='downstreamBTLimitInKBS', default=200,   platformSpecific=False)
 LIMIT_CONNECTIONS_BT        = Pref(key='limitConnectionsBT',     default=False, platformSpecific=False)
 CONNECTION_LIMIT_BT_NUM     = Pref(key='connectionLimitBTNum', default=100,   platformSpecific=False)
+LIMIT_DOWNSTREAM_HTTP       = Pref(key='limitDownstreamHTTP',   default=False, platformSpecific=False)
+DOWNSTREAM_HTTP_LIMIT_IN_KBS = Pref(key='downstreamHTTPLimitInKBS', default=200, platformSpecific=False)
+# per-host limits for HTTP downloads, 0 means no limit
+HTTP_HOST_LIMIT_IN_KBS      = Pref(key='httpHostLimitInKBS',    default=0,     platformSpecific=False)
+HTTP_CONNECTIONS_PER_HOST   = Pref(key='httpConnectionsPerHost', default=4,    platformSpecific=False)
+# download big HTTP files using several connections at once
+HTTP_SEGMENTED_DOWNLOADS    = Pref(key='httpSegmentedDownloads', default=False, platformSpecific=False)
+HTTP_DOWNLOAD_SEGMENTS      = Pref(key='httpDownloadSegments',  default=4,     platformSpecific=False)
 PRESERVE_DISK_SPACE         = Pref(key='preserveDiskSpace',     default=True,  platformSpecific=False)
 PRESERVE_X_GB_FREE          = Pref(key='preserveXGBFree',       default=0.2,   platformSpecific=False)
 EXPIRE_AFTER_X_DAYS         = Pref(key='expireAfterXDays',      default=6,     platformSpecific=False,
@@ -126,6 +134,10 @@ SHARE_WARN_ON_QUIT          = Pref(key='ShareWarnOnQuit',       default=True, pl
 SHARE_VIDEO                 = Pref(key='ShareVideo',            default=True, platformSpecific=False)
 SHARE_AUDIO                 = Pref(key='ShareAudio',            default=True, platformSpecific=False)
 SHARE_FEED                  = Pref(key='ShareFeed',             default=True, platformSpecific=False)
+# Worker threads for the sharing server.  0 means a thread per connection.
+SHARE_SERVER_THREADS        = Pref(key='ShareServerThreads',    default=0, platformSpecific=False)
+# Size of the transcoded segment cache in MB.  0 turns the cache off.
+SHARE_TRANSCODE_CACHE_SIZE  = Pref(key='ShareTranscodeCacheSize', default=500, platformSpecific=False)
 # the musicTabClicked key was used before miro 5.0.  It's been changed because
 # we want to pop up the dialog for users who ran 4.0.x and let them know about
 # internet lookups
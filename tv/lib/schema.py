@@ -483,6 +483,7 @@ class ItemSchema(MultiClassObjectSchema):
         ('kind', SchemaString(noneOk=True)),
         ('net_lookup_enabled', SchemaBool()),
         ('metadata_title', SchemaString(noneOk=True)),
+        ('thumbnail_path', SchemaFilename(noneOk=True)),
     ]
 
     indexes = (
@@ -493,6 +494,7 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_feed_downloader', ('feed_id', 'downloader_id',)),
             ('item_file_type', ('file_type',)),
             ('item_filename', ('filename',)),
+            ('item_filename_nocase', ('filename COLLATE NOCASE',)),
     )
 
 class DeviceItemSchema(ObjectSchema):
@@ -653,6 +655,7 @@ class RSSFeedImplSchema(FeedImplSchema):
         ('initialHTML', SchemaBinary(noneOk=True)),
         ('etag', SchemaString(noneOk=True)),
         ('modified', SchemaString(noneOk=True)),
+        ('content_digest', SchemaString(noneOk=True)),
     ]
 
 class SavedSearchFeedImplSchema(FeedImplSchema):
@@ -661,6 +664,7 @@ class SavedSearchFeedImplSchema(FeedImplSchema):
     fields = FeedImplSchema.fields + [
         ('etag', SchemaDict(SchemaString(),SchemaString(noneOk=True))),
         ('modified', SchemaDict(SchemaString(),SchemaString(noneOk=True))),
+        ('content_digest', SchemaDict(SchemaString(),SchemaString())),
     ]
 
     @staticmethod
@@ -671,6 +675,10 @@ class SavedSearchFeedImplSchema(FeedImplSchema):
     def handle_malformed_modified(row):
         return {}
 
+    @staticmethod
+    def handle_malformed_content_digest(row):
+        return {}
+
 class ScraperFeedImplSchema(FeedImplSchema):
     klass = ScraperFeedImpl
     table_name = 'scraper_feed_impl'
@@ -998,7 +1006,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 201
+VERSION = 205
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
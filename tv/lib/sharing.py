@@ -294,10 +294,11 @@ class SharingTracker(object):
                 raise IOError('test connect failed')
             client.disconnect()
 
-        eventloop.call_in_thread(success,
-                                 failure,
-                                 testconnect,
-                                 'DAAP test connect')
+        eventloop.call_in_thread_with_priority(eventloop.PRIORITY_HIGH,
+                                               success,
+                                               failure,
+                                               testconnect,
+                                               'DAAP test connect')
 
     def mdns_callback_backend(self, added, fullname, host, port):
         # SAFE: the shared name should be unique.  (Or else you could not
@@ -1065,6 +1066,10 @@ class _SharedDataSet(object):
         self.revision = 1
         # map DAAP ids to dicts of item data
         self.daap_items = dict()
+        # map DAAP ids to the revision they were last updated in.  Items are
+        # kept in revision order, so the items that changed after a revision
+        # can be found without looking at all the others.
+        self.item_revisions = util.OrderedDict()
         # map DAAP ids to dicts of playlist data
         self.daap_playlists = dict()
         # map DAAP playlist ids to sets of items in that playlist
@@ -1178,7 +1183,7 @@ class _SharedDataSet(object):
             for item_info in added + changed:
                 self.make_daap_item(item_info)
             for item_id in removed:
-                self.daap_items[item_id] = self._deleted_item(item_id)
+                self._store_item(item_id, self._deleted_item(item_id))
             self.condition.notify_all()
 
     def on_playlist_added(self, tracker, playlist_or_feed):
@@ -1282,7 +1287,17 @@ class _SharedDataSet(object):
             if isinstance(value, unicode):
                 daap_item[key] = value.encode('utf-8')
         # store the data
-        self.daap_items[item_info.id] = daap_item
+        self._store_item(item_info.id, daap_item)
+
+    def _store_item(self, item_id, daap_item):
+        """Store a new or changed item dict.
+
+        This moves the item to the end of item_revisions so that it stays
+        in revision order.
+        """
+        self.daap_items[item_id] = daap_item
+        self.item_revisions.pop(item_id, None)
+        self.item_revisions[item_id] = daap_item['revision']
 
     # XXX TEMPORARY: should this item be podcast?  We won't need this when
     # the item type's metadata is completely accurate and won't lie to us.
@@ -1412,8 +1427,15 @@ class _SharedDataSet(object):
         with self.lock:
             return self.daap_items[item_id]
 
-    def get_items(self, playlist_id):
+    def get_items(self, playlist_id, since_revision=0):
         with self.lock:
+            if since_revision:
+                item_ids = self._item_ids_changed_since(since_revision)
+                if playlist_id is not None:
+                    playlist_items = self.playlist_item_map[playlist_id]
+                    item_ids = [id_ for id_ in item_ids
+                                if id_ in playlist_items]
+                return dict((id_, self.daap_items[id_]) for id_ in item_ids)
             if playlist_id is None:
                 return self.daap_items.copy()
             else:
@@ -1425,6 +1447,19 @@ class _SharedDataSet(object):
                         logging.warn("Error looking up DAAP item: %s", id_)
                 return items_dict
 
+    def _item_ids_changed_since(self, revision):
+        """Get the ids of items updated after revision.
+
+        This walks item_revisions backwards, so it only touches the items
+        that changed.
+        """
+        item_ids = []
+        for id_ in reversed(self.item_revisions):
+            if self.item_revisions[id_] <= revision:
+                break
+            item_ids.append(id_)
+        return item_ids
+
     def get_playlists(self):
         with self.lock:
             return self.daap_playlists.copy()
@@ -1457,11 +1492,22 @@ class SharingManagerBackend(object):
     type = u'sharing-backend'
     id = u'sharing-backend'
 
+    # How many segments ahead of the one being played we try to have
+    # transcoded.
+    PREFETCH_SEGMENTS = transcode.TranscodeObject.buffer_high_watermark
+    # How long to wait for another session to transcode a segment we want
+    SEGMENT_WAIT_TIMEOUT = transcode.TranscodeObject.segment_duration
+
     def __init__(self):
         self.data_set = _SharedDataSet()
         self.transcode_lock = threading.Lock()
         self.transcode = dict()
         self.in_shutdown = False
+        cache_dir = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                                 'transcode-cache')
+        cache_size = app.config.get(prefs.SHARE_TRANSCODE_CACHE_SIZE)
+        self.segment_cache = transcode.SegmentCache(cache_dir,
+                                                    cache_size * 1024 * 1024)
 
     # Reserved for future use: you can register new sharing protocols here.
     def register_protos(self, proto):
@@ -1497,7 +1543,6 @@ class SharingManagerBackend(object):
         # FIXME: the above docstring could realy use some more details.
 
         file_obj = None
-        no_file = (None, None)
         # Get a copy of the item and use that.  If the item gets deleted in a
         # different thread while we're running the code below, then we'll deal
         # with it later on.
@@ -1506,56 +1551,9 @@ class SharingManagerBackend(object):
         if ext in ('ts', 'm3u8'):
             # If we are requesting a playlist, this basically means that
             # transcode is required.
-            old_transcode_obj = None
-            need_create = False
-            with self.transcode_lock:
-                if self.in_shutdown:
-                    return no_file
-                try:
-                    transcode_obj = self.transcode[session]
-                    if transcode_obj.itemid != itemid:
-                        need_create = True
-                        old_transcode_obj = transcode_obj
-                    else:
-                        # This request has already been satisfied by a more
-                        # recent request.  Bye ...
-                        if generation < transcode_obj.generation:
-                            logging.debug('item %s transcode out of order',
-                                          itemid)
-                            return no_file
-                        if chunk is not None and transcode_obj.isseek(chunk):
-                            need_create = True
-                            old_transcode_obj = transcode_obj
-                except KeyError:
-                    need_create = True
-                if need_create:
-                    yes, info = transcode.needs_transcode(path)
-                    transcode_obj = transcode.TranscodeObject(
-                                                          path,
-                                                          itemid,
-                                                          generation,
-                                                          chunk,
-                                                          info,
-                                                          request_path_func)
-                self.transcode[session] = transcode_obj
-
-            # If there was an old object, shut it down.  Do it outside the
-            # loop so that we don't hold onto the transcode lock for excessive
-            # time
-            if old_transcode_obj:
-                old_transcode_obj.shutdown()
-            if need_create:
-                transcode_obj.transcode()
-
-            if ext == 'm3u8':
-                file_obj = transcode_obj.get_playlist()
-                file_obj.seek(offset, os.SEEK_SET)
-            elif ext == 'ts':
-                file_obj = transcode_obj.get_chunk()
-            else:
-                # Should this be a ValueError instead?  But returning -1
-                # will make the caller return 404.
-                logging.warning('error: transcode should be one of ts or m3u8')
+            file_obj = self.get_transcode_file(path, itemid, generation, ext,
+                                               session, request_path_func,
+                                               offset, chunk)
         elif ext == 'coverart':
             try:
                 cover_art = daapitem['cover_art']
@@ -1579,6 +1577,140 @@ class SharingManagerBackend(object):
                     file_obj.close()
         return file_obj, os.path.basename(path)
 
+    def get_transcode_file(self, path, itemid, generation, ext, session,
+                           request_path_func, offset, chunk):
+        """Get the m3u8 playlist or a ts segment for a transcoded item.
+
+        Segments are served from the segment cache if they're there,
+        otherwise from this session's transcode.  Either way, we make sure
+        something is transcoding the next few segments that aren't cached.
+
+        :returns: file object, or None if there's nothing to send
+        """
+        with self.transcode_lock:
+            if self.in_shutdown:
+                return None
+            transcode_obj = self.transcode.get(session)
+            if (transcode_obj is not None and
+                    transcode_obj.itemid == itemid and
+                    generation < transcode_obj.generation):
+                # This request has already been satisfied by a more
+                # recent request.  Bye ...
+                logging.debug('item %s transcode out of order', itemid)
+                return None
+        media_info = self.segment_cache.get_media_info(path)
+        media_key = self.segment_cache.media_key(
+            path, transcode.get_transcode_profile(media_info))
+        def prefetch(chunk, shared=True):
+            return self.prefetch_segments(session, path, itemid, generation,
+                                          media_info, media_key,
+                                          request_path_func, chunk, shared)
+        if ext == 'm3u8':
+            prefetch(0)
+            file_obj = transcode.make_temp_file(transcode.build_playlist(
+                media_info, itemid, request_path_func))
+            file_obj.seek(offset, os.SEEK_SET)
+            return file_obj
+        elif ext != 'ts':
+            # Should this be a ValueError instead?  But returning -1
+            # will make the caller return 404.
+            logging.warning('error: transcode should be one of ts or m3u8')
+            return None
+
+        if chunk is None:
+            if transcode_obj is not None and transcode_obj.itemid == itemid:
+                chunk = transcode_obj.current_chunk
+            else:
+                chunk = 0
+        key = media_key + (chunk,)
+        file_obj = self.segment_cache.get(key)
+        if file_obj is None:
+            transcode_obj = prefetch(chunk)
+            if transcode_obj is not None and transcode_obj.covers(chunk):
+                return transcode_obj.get_chunk(chunk)
+            # Another session is transcoding this segment
+            file_obj = self.segment_cache.wait_for(key,
+                                                   self.SEGMENT_WAIT_TIMEOUT)
+        if file_obj is None:
+            logging.debug('timed out waiting for segment %s of %s', chunk,
+                          path)
+            transcode_obj = prefetch(chunk, shared=False)
+            if transcode_obj is not None and transcode_obj.covers(chunk):
+                return transcode_obj.get_chunk(chunk)
+            return self.segment_cache.get(key)
+        prefetch(chunk + 1)
+        return file_obj
+
+    def prefetch_segments(self, session, path, itemid, generation,
+                          media_info, media_key, request_path_func, chunk,
+                          shared=True):
+        """Make sure the segments starting at chunk are being transcoded.
+
+        We look for the first segment within PREFETCH_SEGMENTS of chunk that
+        isn't cached.  If this session's transcode will get to it soon we
+        leave it alone.  So we do if shared is True and another session's
+        transcode will.  Otherwise we replace this session's transcode with
+        one that starts at that segment.
+
+        :returns: this session's TranscodeObject, or None
+        """
+        nchunks, trailer = transcode.get_chunk_count(media_info)
+        start = None
+        for index in xrange(chunk, min(chunk + self.PREFETCH_SEGMENTS,
+                                       nchunks)):
+            if not self.segment_cache.contains(media_key + (index,)):
+                start = index
+                break
+        shared = shared and self.segment_cache.enabled()
+        old_transcode_obj = new_transcode_obj = None
+        with self.transcode_lock:
+            if self.in_shutdown:
+                return None
+            transcode_obj = self.transcode.get(session)
+            if transcode_obj is not None and transcode_obj.itemid != itemid:
+                old_transcode_obj = transcode_obj
+                transcode_obj = None
+                del self.transcode[session]
+            if start is None:
+                # Everything we want is already cached
+                pass
+            elif transcode_obj is not None and transcode_obj.covers(start):
+                transcode_obj.discard_before(chunk)
+            elif shared and self._other_transcode_covers(session, media_key,
+                                                         start):
+                pass
+            else:
+                if transcode_obj is not None:
+                    old_transcode_obj = transcode_obj
+                new_transcode_obj = transcode.TranscodeObject(
+                                                      path,
+                                                      itemid,
+                                                      generation,
+                                                      start,
+                                                      media_info,
+                                                      request_path_func,
+                                                      self.segment_cache)
+                self.transcode[session] = new_transcode_obj
+                transcode_obj = new_transcode_obj
+
+        # If there was an old object, shut it down.  Do it outside the
+        # loop so that we don't hold onto the transcode lock for excessive
+        # time
+        if old_transcode_obj:
+            old_transcode_obj.shutdown()
+        if new_transcode_obj:
+            new_transcode_obj.transcode()
+        return transcode_obj
+
+    def _other_transcode_covers(self, session, media_key, chunk):
+        for other_session, transcode_obj in self.transcode.items():
+            if (other_session != session and
+                    transcode_obj.cache_key == media_key and
+                    not transcode_obj.throttled() and
+                    transcode_obj.covers(chunk)):
+                return True
+        return False
+
     def get_playlists(self):
         """Get the current list of playlists
 
@@ -1595,7 +1727,7 @@ class SharingManagerBackend(object):
         """
         return self.data_set.get_playlists()
 
-    def get_items(self, playlist_id=None):
+    def get_items(self, playlist_id=None, since_revision=0):
         """Get the current list of items
 
         This should return a dict mapping DAAP item ids to dicts of item data.
@@ -1608,8 +1740,10 @@ class SharingManagerBackend(object):
 
         :param playlist_id: playlist to fetch items from, or None to fetch all
         items.
+        :param since_revision: if non-zero, only return items updated after
+        this revision.
         """
-        return self.data_set.get_items(playlist_id)
+        return self.data_set.get_items(playlist_id, since_revision)
 
     def finished_callback(self, session):
         # Like shutdown but only shuts down one of the sessions.  No need to
@@ -1630,6 +1764,8 @@ class SharingManagerBackend(object):
             self.in_shutdown = True
             for key in self.transcode.keys():
                 self.transcode[key].shutdown()
+        logging.info('transcode segment cache: %s',
+                     self.segment_cache.get_stats())
 
 class SharingManager(object):
     """SharingManager is the sharing server.  It publishes Miro media items
@@ -1864,6 +2000,7 @@ class SharingManager(object):
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
                             del self.thread
+                            self.server.server_close()
                             del self.server
                             self.reload_done_event.set()
                             return
@@ -1908,8 +2045,10 @@ class SharingManager(object):
             return
 
         name = app.config.get(prefs.SHARE_NAME).encode('utf-8')
+        pool_size = app.config.get(prefs.SHARE_SERVER_THREADS)
         self.server = libdaap.make_daap_server(self.backend, debug=True,
-                                               name=name)
+                                               name=name,
+                                               pool_size=pool_size)
         if not self.server:
             self.sharing = False
             return
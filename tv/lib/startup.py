@@ -71,6 +71,7 @@ from miro import feed
 from miro import folder
 from miro import messages
 from miro import messagehandler
+from miro import metadatacache
 from miro import models
 from miro import playlist
 from miro import prefs
@@ -249,7 +250,7 @@ def startup_for_frontend(obj, thread):
     item.setup_deleted_checker()
     logging.info("Restoring database...")
     start = time.time()
-    app.db = storedatabase.LiveStorage()
+    app.db = storedatabase.LiveStorage(lazy_restore=True)
     try:
         app.db.upgrade_database()
     except databaseupgrade.DatabaseTooNewError:
@@ -296,10 +297,16 @@ def startup_for_frontend(obj, thread):
     app.sharing_manager = sharing.SharingManager()
     app.download_state_manager = downloader.DownloadStateManager()
     item.setup_change_tracker()
+    setup_metadata_cache()
     item.setup_metadata_manager()
 
     _startup_checker.run_checks()
 
+def setup_metadata_cache():
+    path = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                        'metadata_cache.sqlite')
+    app.metadata_cache = metadatacache.MetadataCache(path)
+
 def fix_database_inconsistencies():
     item.fix_non_container_parents()
     item.move_orphaned_items()
@@ -515,6 +522,7 @@ def on_frontend_started():
     eventloop.add_timeout(60, item.update_incomplete_metadata,
             "update metadata data")
     eventloop.add_timeout(90, clear_icon_cache_orphans, "clear orphans")
+    eventloop.add_timeout(120, feed.reconcile_counts, "reconcile feed counts")
 
 def setup_global_feeds():
     setup_global_feed(u'dtv:manualFeed', initiallyAutoDownloadable=False)
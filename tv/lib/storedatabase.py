@@ -55,6 +55,7 @@ import datetime
 import traceback
 import time
 import os
+import re
 import sys
 from cStringIO import StringIO
 
@@ -76,8 +77,10 @@ from miro import schema
 from miro import signals
 from miro import prefs
 from miro import util
+from miro.data import feedcounts
 from miro.data import fulltextsearch
 from miro.data import item
+from miro.data import sqlcache
 from miro.gtcache import gettext as _
 from miro.plat.utils import PlatformFilenameType, filename_to_unicode
 
@@ -108,6 +111,120 @@ _sqlite_type_map = {
         schema.SchemaStringSet: 'text',
 }
 
+# SchemaItem subclasses where comparing the python value stored in a
+# DDBObject gives the same result as comparing the value stored in SQLite.
+# These are the only columns that compile_where_predicate() will handle.
+_predicate_comparable_types = (
+        schema.SchemaBool,
+        schema.SchemaFloat,
+        schema.SchemaInt,
+        schema.SchemaString,
+        schema.SchemaURL,
+)
+
+# Subset of _predicate_comparable_types that can be used as a boolean
+# expression on their own (for example "WHERE NOT expired")
+_predicate_truth_types = (
+        schema.SchemaBool,
+        schema.SchemaFloat,
+        schema.SchemaInt,
+)
+
+_predicate_and_re = re.compile(r'\s+AND\s+', re.IGNORECASE)
+_predicate_term_re = re.compile(r"""
+    ^(?P<not>NOT\s+)?
+    (?:(?P<table>\w+)\.)?(?P<column>\w+)
+    (?:\s*(?P<op>=|==|!=|<>)\s*\?
+      |\s+(?P<null_check>IS\s+NOT\s+NULL|IS\s+NULL))?$
+    """, re.IGNORECASE | re.VERBOSE)
+
+def compile_where_predicate(obj_schema, where, values):
+    """Try to convert a SQL WHERE clause to a python predicate.
+
+    This lets ViewTrackers check if an object is in their view without going
+    to the database.  Only a very simple subset of SQL is supported: terms
+    joined with AND, where each term is one of "column=?", "column<>?",
+    "column IS NULL", "column IS NOT NULL", "column" or "NOT column".
+
+    :param obj_schema: ObjectSchema for the table that the where clause
+                       selects from
+    :param where: WHERE clause, or None
+    :param values: tuple of values for the "?" placeholders in where
+    :returns: function that inputs a DDBObject and returns True if it matches
+              where, or None if where can't be converted.
+    """
+    if where is None:
+        return lambda obj: True
+    schema_items = dict(obj_schema.fields)
+    checks = []
+    values = list(values)
+    for term in _predicate_and_re.split(where.strip()):
+        m = _predicate_term_re.match(term.strip())
+        if m is None:
+            return None
+        table, column = m.group('table'), m.group('column')
+        if table is not None and table != obj_schema.table_name:
+            return None
+        schema_item = schema_items.get(column)
+        if not isinstance(schema_item, _predicate_comparable_types):
+            return None
+        op, null_check = m.group('op'), m.group('null_check')
+        if m.group('not') and (op or null_check):
+            # NOT binds looser than the comparison, don't try to handle it
+            return None
+        if op is not None:
+            if not values:
+                return None
+            checks.append(_make_compare_check(column, op, values.pop(0)))
+        elif null_check is not None:
+            is_null = (null_check.split()[1].upper() == 'NULL')
+            checks.append(_make_null_check(column, is_null))
+        elif isinstance(schema_item, _predicate_truth_types):
+            checks.append(_make_truth_check(column, not m.group('not')))
+        else:
+            return None
+    if values:
+        # more values than placeholders that we understood
+        return None
+    def predicate(obj):
+        for check in checks:
+            if not check(obj):
+                return False
+        return True
+    return predicate
+
+def _make_compare_check(column, op, value):
+    # comparisons with NULL are never true in SQL
+    if op in ('=', '=='):
+        def check(obj):
+            obj_value = getattr(obj, column)
+            return (value is not None and obj_value is not None and
+                    obj_value == value)
+    else:
+        def check(obj):
+            obj_value = getattr(obj, column)
+            return (value is not None and obj_value is not None and
+                    obj_value != value)
+    return check
+
+def _make_null_check(column, is_null):
+    def check(obj):
+        return (getattr(obj, column) is None) == is_null
+    return check
+
+def _make_truth_check(column, truth):
+    def check(obj):
+        obj_value = getattr(obj, column)
+        return obj_value is not None and bool(obj_value) == truth
+    return check
+
+# SchemaItem subclasses that are expensive to convert from SQL.  In lazy
+# restore mode, we wait until they're used before converting them.
+_lazy_restore_types = (
+        schema.SchemaBinary,
+        schema.SchemaReprContainer,
+)
+
 VERSION_KEY = "Democracy Version"
 
 class DatabaseObjectCache(object):
@@ -388,7 +505,7 @@ class LiveStorage(signals.SignalEmitter):
     """
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
-                 start_in_temp_mode=False):
+                 start_in_temp_mode=False, lazy_restore=False):
         """Create a LiveStorage for a database
 
         :param path: path to the database (or ":memory:")
@@ -402,6 +519,9 @@ class LiveStorage(signals.SignalEmitter):
         :param start_in_temp_mode: True if this database should start in
                                    temporary mode (running in memory, but
                                    checking if it can write to the disk)
+        :param lazy_restore: Wait until expensive columns (pythonrepr and
+                             blob columns) are accessed before converting
+                             them when restoring objects.
         """
         signals.SignalEmitter.__init__(self)
         self.create_signal("transaction-finished")
@@ -439,6 +559,9 @@ class LiveStorage(signals.SignalEmitter):
         self._schema_version = schema_version
         self._schema_map = {}
         self._schema_column_map = {}
+        # maps schemas to the set of columns that we restore lazily
+        self._lazy_columns = {}
+        self.lazy_restore = lazy_restore
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
@@ -452,6 +575,9 @@ class LiveStorage(signals.SignalEmitter):
                     klass.track_attribute_changes(field_name)
             for name, schema_item in oschema.fields:
                 self._schema_column_map[oschema, name] = schema_item
+            self._lazy_columns[oschema] = set(
+                name for name, schema_item in oschema.fields
+                if isinstance(schema_item, _lazy_restore_types))
         self._converter = SQLiteConverter()
 
         self.open_connection(start_in_temp_mode=start_in_temp_mode)
@@ -473,7 +599,8 @@ class LiveStorage(signals.SignalEmitter):
             try:
                 self.connection = sqlite3.connect(path,
                         isolation_level=None,
-                        detect_types=sqlite3.PARSE_DECLTYPES)
+                        detect_types=sqlite3.PARSE_DECLTYPES,
+                        cached_statements=sqlcache.CACHED_STATEMENTS)
             except sqlite3.DatabaseError, e:
                 logging.warn("Error opening sqlite database: %s", e)
                 action = self.error_handler.handle_open_error()
@@ -528,7 +655,9 @@ class LiveStorage(signals.SignalEmitter):
         """
         self.connection = sqlite3.connect(':memory:',
                                           isolation_level=None,
-                                          detect_types=sqlite3.PARSE_DECLTYPES)
+                                          detect_types=sqlite3.PARSE_DECLTYPES,
+                                          cached_statements=
+                                          sqlcache.CACHED_STATEMENTS)
         self.temp_mode = True
         eventloop.add_timeout(300,
                               self._try_save_temp_to_disk,
@@ -935,9 +1064,13 @@ class LiveStorage(signals.SignalEmitter):
         obj_schema = self._schema_map[obj.__class__]
         setters = []
         values = []
+        lazy_columns = obj.__dict__.get('_lazy_columns', ())
         for name, schema_item in obj_schema.fields:
-            if (isinstance(schema_item, schema.SchemaSimpleItem) and
+            if ((isinstance(schema_item, schema.SchemaSimpleItem) or
+                    name in lazy_columns) and
                     name not in obj.changed_attributes):
+                # Skip unchanged simple values and lazy values that haven't
+                # been converted yet (we know that they can't have changed).
                 continue
             setters.append('%s=?' % name)
             value = getattr(obj, name)
@@ -950,8 +1083,10 @@ class LiveStorage(signals.SignalEmitter):
                 schema_item, value))
         obj.reset_changed_attributes()
         if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
+            sql = sqlcache.template_cache.get(
+                ('update_obj', obj_schema.table_name, tuple(setters)),
+                self._update_sql, obj_schema.table_name, setters)
+            values.append(obj.id)
             self.execute(sql, values, is_update=True)
             if (self.cursor.rowcount != 1 and not
                     self._quitting_from_operational_error):
@@ -963,6 +1098,9 @@ class LiveStorage(signals.SignalEmitter):
                             "(id: %s, count: %s)" %
                             (obj.id, self.cursor.rowcount))
 
+    def _update_sql(self, table_name, setters):
+        return "UPDATE %s SET %s WHERE id=?" % (table_name, ', '.join(setters))
+
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
 
@@ -1033,6 +1171,13 @@ class LiveStorage(signals.SignalEmitter):
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
+    def compile_where_predicate(self, klass, where, values):
+        """Convert a WHERE clause to a python predicate for klass.
+
+        See compile_where_predicate() for details.
+        """
+        return compile_where_predicate(self._schema_map[klass], where, values)
+
     def _get_query_bottom(self, table_name, where, joins, order_by, limit):
         sql = StringIO()
         sql.write("FROM %s\n" % table_name)
@@ -1094,25 +1239,19 @@ class LiveStorage(signals.SignalEmitter):
         restored_data = {}
         columns_to_update = []
         values_to_update = []
+        if self.lazy_restore:
+            lazy_columns = self._lazy_columns[schema]
+            restored_data['_lazy_columns'] = {}
+        else:
+            lazy_columns = ()
         for (name, schema_item), value in \
                 itertools.izip(schema.fields, db_row):
-            try:
-                value = self._converter.from_sql(schema, name, schema_item,
-                        value)
-            except StandardError:
-                logging.exception('self._converter.from_sql failed.')
-                handler = self._converter.get_malformed_data_handler(schema,
-                        name, schema_item, value)
-                if handler is None:
-                    if util.chatter:
-                        logging.warn("error converting %s (%r)", name, value)
-                    raise
-                try:
-                    value = handler(value)
-                except StandardError:
-                    if util.chatter:
-                        logging.warn("error converting %s (%r)", name, value)
-                    raise
+            if name in lazy_columns and value is not None:
+                restored_data['_lazy_columns'][name] = value
+                continue
+            value, malformed = self._convert_from_sql(schema, name,
+                                                      schema_item, value)
+            if malformed:
                 columns_to_update.append(name)
                 values_to_update.append(self._converter.to_sql(schema, name,
                     schema_item, value))
@@ -1120,13 +1259,58 @@ class LiveStorage(signals.SignalEmitter):
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
-            setters = ['%s=?' % c for c in columns_to_update]
-            sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
-                    ', '.join(setters), restored_data['id'])
-            self.execute(sql, values_to_update)
+            self._update_malformed_columns(schema, restored_data['id'],
+                                           columns_to_update,
+                                           values_to_update)
         klass = schema.get_ddb_class(restored_data)
         return klass(restored_data=restored_data, db_info=db_info)
 
+    def _convert_from_sql(self, schema, name, schema_item, value):
+        """Convert a value restored from the database.
+
+        :returns: (value, malformed) tuple.  malformed is True if the value
+                  stored in the database was malformed and we used a
+                  malformed data handler to get the value.
+        """
+        try:
+            return (self._converter.from_sql(schema, name, schema_item,
+                                             value), False)
+        except StandardError:
+            logging.exception('self._converter.from_sql failed.')
+            handler = self._converter.get_malformed_data_handler(schema,
+                    name, schema_item, value)
+            if handler is None:
+                if util.chatter:
+                    logging.warn("error converting %s (%r)", name, value)
+                raise
+            try:
+                return (handler(value), True)
+            except StandardError:
+                if util.chatter:
+                    logging.warn("error converting %s (%r)", name, value)
+                raise
+
+    def _update_malformed_columns(self, schema, id_, columns, values):
+        setters = ['%s=?' % c for c in columns]
+        sql = self._update_sql(schema.table_name, setters)
+        self.execute(sql, list(values) + [id_])
+
+    def convert_lazy_column(self, obj, name, value):
+        """Convert a column value that was restored lazily.
+
+        This gets called by AttributeUpdateTracker the first time a lazy
+        attribute is accessed.
+        """
+        schema = self._schema_map[obj.__class__]
+        schema_item = self._schema_column_map[schema, name]
+        value, malformed = self._convert_from_sql(schema, name, schema_item,
+                                                  value)
+        if malformed:
+            self._update_malformed_columns(schema, obj.id, [name],
+                    [self._converter.to_sql(schema, name, schema_item,
+                                            value)])
+        return value
+
     def persistent_object_count(self):
         return len(self._object_map)
 
@@ -1359,10 +1543,14 @@ class LiveStorage(signals.SignalEmitter):
         self._create_variables_table()
         self.set_version()
         self.setup_fulltext_search()
+        self.setup_feed_counts()
 
     def setup_fulltext_search(self):
         fulltextsearch.setup_fulltext_search(self.connection)
 
+    def setup_feed_counts(self):
+        feedcounts.setup_feed_counts(self.connection)
+
     def _get_size_info(self):
         """Get info about the database size
 
@@ -1472,6 +1660,10 @@ class DeviceLiveStorage(LiveStorage):
     def setup_fulltext_search(self):
         fulltextsearch.setup_fulltext_search(self.connection, 'device_item')
 
+    def setup_feed_counts(self):
+        # devices don't have feeds
+        pass
+
     def show_upgrade_progress(self):
         return False
 
@@ -1500,6 +1692,10 @@ class SharingLiveStorage(LiveStorage):
                                              path_column='video_path',
                                              has_entry_description=False)
 
+    def setup_feed_counts(self):
+        # shares don't have feeds
+        pass
+
 class SQLiteConverter(object):
     def __init__(self):
         self._to_sql_converters = {
@@ -40,6 +40,7 @@ with the command line and env from plat.utils.miro_helper_program_info().
 
 import ctypes
 import cPickle as pickle
+import cStringIO
 import logging
 import os
 import struct
@@ -73,7 +74,12 @@ def _on_windows():
 #
 # We spawn a child process and communicate to it by sending messages through
 # it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# followed by a pickled object.  We use the highest pickle protocol, since
+# it's both faster and more compact than the default.
+#
+# To cut down on the per-message overhead, multiple messages can be sent in
+# a single frame by pickling them as a list.  Messages themselves are never
+# lists, so the reader can tell the two apart.
 #
 # The communication goes like this:
 #
@@ -263,54 +269,103 @@ class LoadError(StandardError):
 
 SIZEOF_LONG = struct.calcsize("Q")
 
-def _read_bytes_from_pipe(pipe, length):
-    """Read size bytes from a pipe.
+try:
+    _memoryview = memoryview
+except NameError:
+    # Python 2.6.  We can't readinto() the middle of our buffer without
+    # memoryview, so _PipeReader copies the data in instead.
+    _memoryview = None
 
-    This is different from just calling read() because read can return partial
-    data.
+class _PipeReader(object):
+    """Reads objects from one side of a pipe.
 
-    This method call read() until either:
-      a) read() returns no data, meaning the pipe is closed
-      b) we've read length bytes
+    We read the pickle data into a buffer that gets reused for each message
+    and unpickle directly from it, rather than creating a new string for
+    every message.
     """
-    data = []
-    while length > 0:
-        d = pipe.read(length)
-        if d == '':
-            break
-        length -= len(d)
-        data.append(d)
-    return ''.join(data)
+    INITIAL_BUFFER_SIZE = 64 * 1024
+    # If a big message makes our buffer grow past this, we go back to a
+    # smaller buffer afterwards.
+    MAX_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self._set_buffer(bytearray(self.INITIAL_BUFFER_SIZE))
+        self.supports_readinto = (hasattr(pipe, 'readinto') and
+                                  _memoryview is not None)
+
+    def _set_buffer(self, buf):
+        self.buf = buf
+        if _memoryview is not None:
+            self.view = _memoryview(buf)
+
+    def _read_into_buffer(self, length):
+        """Read bytes into the start of our buffer.
+
+        This is different from just calling read() because read can return
+        partial data.  We keep reading until either:
+          a) the pipe is closed
+          b) we've read length bytes
+
+        :returns: number of bytes read
+        """
+        if length > len(self.buf):
+            self._set_buffer(bytearray(max(length, len(self.buf) * 2)))
+        pos = 0
+        while pos < length:
+            if self.supports_readinto:
+                count = self.pipe.readinto(self.view[pos:length])
+            else:
+                data = self.pipe.read(length - pos)
+                count = len(data)
+                self.buf[pos:pos+count] = data
+            if not count:
+                break
+            pos += count
+        return pos
 
-def _load_obj(pipe):
-    """Load an object from one side of a pipe.
+    def load_obj(self):
+        """Load an object from the pipe.
 
-    _load_obj blocks until the all the data has been sent.
+        load_obj blocks until the all the data has been sent.
 
-    :raises IOError: low-level error while reading from the pipe
-    :raises LoadError: data read was corrupted
+        :raises IOError: low-level error while reading from the pipe
+        :raises LoadError: data read was corrupted
 
-    :returns: Python object send from the other side
+        :returns: Python object send from the other side
+        """
+        read_size = self._read_into_buffer(SIZEOF_LONG)
+        if read_size < SIZEOF_LONG:
+            raise LoadError("EOF reached while reading size field "
+                    "(read %s bytes)" % read_size)
+        size = struct.unpack_from("Q", self.buf)[0]
+        read_size = self._read_into_buffer(size)
+        if read_size < size:
+            raise LoadError("EOF reached while reading pickle data "
+                    "(read %s bytes)" % read_size)
+        try:
+            try:
+                data = buffer(self.buf, 0, size)
+                return pickle.load(cStringIO.StringIO(data))
+            finally:
+                if len(self.buf) > self.MAX_BUFFER_SIZE:
+                    self._set_buffer(bytearray(self.INITIAL_BUFFER_SIZE))
+        except (pickle.PickleError, EOFError):
+            raise LoadError("Pickle data corrupt")
+        except ImportError:
+            raise LoadError("Pickle data references unimportable module")
+        except StandardError, e:
+            # log this exception for easier debugging.
+            send_subprocess_error_for_exception()
+            raise LoadError("Unknown error in pickle.loads: %s" % e)
+
+def _load_obj(pipe):
+    """Load an object from one side of a pipe.
+
+    See _PipeReader.load_obj() for details.  Use _read_from_pipe() for
+    reading a stream of messages.
     """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
-        raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("Q", size_data)[0]
-    pickle_data = _read_bytes_from_pipe(pipe, size)
-    if len(pickle_data) < size:
-        raise LoadError("EOF reached while reading pickle data "
-                "(read %s bytes)" % len(pickle_data))
-    try:
-        return pickle.loads(pickle_data)
-    except pickle.PickleError:
-        raise LoadError("Pickle data corrupt")
-    except ImportError:
-        raise LoadError("Pickle data references unimportable module")
-    except StandardError, e:
-        # log this exception for easier debugging.
-        send_subprocess_error_for_exception()
-        raise LoadError("Unknown error in pickle.loads: %s" % e)
+    return _PipeReader(pipe).load_obj()
 
 def _dump_obj(obj, pipe):
     """Dump an object to the other side of the pipe.
@@ -319,7 +374,7 @@ def _dump_obj(obj, pipe):
     :raises pickle.PickleError: obj could not be pickled
     """
 
-    pickle_data = pickle.dumps(obj)
+    pickle_data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
     size_data = struct.pack("Q", len(pickle_data))
     # NOTE: We do a blocking write here.  This should be fine, since on both
     # sides we have a thread dedicated to just reading from the pipe and
@@ -327,10 +382,22 @@ def _dump_obj(obj, pipe):
     # process on the other side has gone really haywire and the reader thread
     # is hung.  I (BDK) can't really see a way for this to realistically
     # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
+    #
+    # Write everything in one call, since our pipes are unbuffered.
+    pipe.write(size_data + pickle_data)
     pipe.flush()
 
+def _dump_objs(objs, pipe):
+    """Dump a list of objects to the other side of the pipe in one frame.
+
+    :raises IOError: low-level error while writing to the pipe
+    :raises pickle.PickleError: objs could not be pickled
+    """
+    if len(objs) == 1:
+        _dump_obj(objs[0], pipe)
+    else:
+        _dump_obj(list(objs), pipe)
+
 class SubprocessManager(object):
     """Manages a running subprocess
 
@@ -346,7 +413,8 @@ class SubprocessManager(object):
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, then it's up
+        to the caller to send messages with send_message().
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -358,7 +426,8 @@ class SubprocessManager(object):
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
@@ -527,6 +596,21 @@ class SubprocessManager(object):
         except pickle.PickleError:
             logging.warn("Error pickling message in send_message() (%s)", msg)
 
+    def send_messages(self, messages):
+        """Send a list of messages to our subprocess in a single frame."""
+
+        if not self.is_running:
+            raise ValueError("subprocess not running")
+        try:
+            _dump_objs(messages, self.process.stdin)
+        except IOError:
+            logging.warn("Broken pipe in send_messages()")
+        except pickle.PickleError:
+            logging.warn("Error pickling messages in send_messages(), "
+                         "sending them one at a time")
+            for msg in messages:
+                self.send_message(msg)
+
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
@@ -567,11 +651,17 @@ def _read_from_pipe(pipe):
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
     """
+    reader = _PipeReader(pipe)
     while True:
-        msg = _load_obj(pipe)
-        if msg is None:
-            return # other side wants to quit
-        yield msg
+        obj = reader.load_obj()
+        if isinstance(obj, list):
+            messages = obj
+        else:
+            messages = (obj,)
+        for msg in messages:
+            if msg is None:
+                return # other side wants to quit
+            yield msg
 
 class SubprocessResponderThread(threading.Thread):
     """Thread that implements our run loop to handle subprocess output.
@@ -744,18 +834,52 @@ class PipeMessageProxy(object):
     This is used in the subprocess to send messages back to the main process
     over it's stdout pipe
 
-    It's safe for multiple threads in the subprocess to use this at once
+    It's safe for multiple threads in the subprocess to use this at once.
+    If a thread sends a message while another thread is writing, the message
+    gets added to a list and the writing thread sends it along with any
+    other waiting messages in a single frame.
     """
     def __init__(self, fileobj):
         self.fileobj = fileobj
         self.lock = threading.Lock()
+        self.pending = []
+        self.writing = False
 
     def handle(self, msg):
+        with self.lock:
+            self.pending.append(msg)
+            if self.writing:
+                # the thread that's writing will send our message
+                return
+            self.writing = True
+        # NOTE: we don't handle IOError here because what can we do about
+        # that?  Just let it propagate up to the top and which should cause
+        # us to shutdown.
         try:
+            while True:
+                with self.lock:
+                    messages = self.pending
+                    self.pending = []
+                    if not messages:
+                        self.writing = False
+                        return
+                self._write_messages(messages)
+        except:
             with self.lock:
-                _dump_obj(msg, self.fileobj)
+                self.writing = False
+            raise
+
+    def _write_messages(self, messages):
+        try:
+            _dump_objs(messages, self.fileobj)
         except pickle.PickleError:
-            send_subprocess_error_for_exception()
-        # NOTE: we don't handle IOError here because what can we do about
-        # that?  Just let it propagate up to the top and which should cause us
-        # to shutdown.
+            if len(messages) == 1:
+                send_subprocess_error_for_exception()
+                return
+            # send the messages one at a time so that only the bad ones get
+            # dropped.
+            for msg in messages:
+                try:
+                    _dump_obj(msg, self.fileobj)
+                except pickle.PickleError:
+                    send_subprocess_error_for_exception()
@@ -159,6 +159,74 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+    def test_batch(self):
+        vt_manager = app.db_info.view_tracker_manager
+        vt_manager.start_batch()
+        self.feed2.set_title(u"booya")
+        self.feed.revert_title()
+        self.feed2.set_title(u"booya2")
+        # changes shouldn't be checked until the batch is finished
+        self.assertEquals(self.add_callbacks, [])
+        self.assertEquals(self.remove_callbacks, [])
+        vt_manager.finish_batch()
+        self.assertEquals(self.add_callbacks, [self.feed2])
+        self.assertEquals(self.remove_callbacks, [self.feed])
+        self.assertEquals(self.change_callbacks, [])
+
+    def test_check_objects(self):
+        self.setup_view(feed.Feed.make_view("userTitle=?", (u'booya',)))
+        self.feed2.userTitle = u'booya'
+        self.feed.userTitle = None
+        # Feed.signal_change() doesn't take can_change_views, call the
+        # DDBObject version directly
+        database.DDBObject.signal_change(self.feed2, can_change_views=False)
+        database.DDBObject.signal_change(self.feed, can_change_views=False)
+        self.tracker.check_objects([self.feed, self.feed2])
+        self.assertEquals(self.add_callbacks, [self.feed2])
+        self.assertEquals(self.remove_callbacks, [self.feed])
+
+class WherePredicateTest(DatabaseTestCase):
+    def check_predicate(self, where, values, obj, correct_result):
+        predicate = app.db.compile_where_predicate(obj.__class__, where,
+                values)
+        self.assertNotEquals(predicate, None)
+        self.assertEquals(predicate(obj), correct_result)
+        # the SQL version should agree with us
+        view = obj.__class__.make_view(where, values)
+        self.assertEquals(obj.id in view.id_list(), correct_result)
+
+    def test_compare(self):
+        self.feed.set_title(u'booya')
+        self.check_predicate("userTitle=?", (u'booya',), self.feed, True)
+        self.check_predicate("feed.userTitle = ?", (u'foo',), self.feed,
+                False)
+        self.check_predicate("userTitle<>?", (u'foo',), self.feed, True)
+        self.check_predicate("userTitle=?", (None,), self.feed, False)
+
+    def test_null(self):
+        self.check_predicate("userTitle IS NULL", (), self.feed, True)
+        self.check_predicate("userTitle IS NOT NULL", (), self.feed, False)
+
+    def test_and(self):
+        self.feed.set_title(u'booya')
+        self.check_predicate("userTitle=? AND NOT errorState AND visible",
+                (u'booya',), self.feed, True)
+        self.check_predicate("userTitle=? AND errorState", (u'booya',),
+                self.feed, False)
+
+    def test_unsupported(self):
+        for where in ("userTitle LIKE 'booya%'",
+                "userTitle=? OR userTitle IS NULL",
+                "(userTitle=?)",
+                "item.title=?",
+                "thumbnail_path=?",
+                "userTitle"):
+            self.assertEquals(app.db.compile_where_predicate(feed.Feed,
+                where, (u'booya',)), None)
+        # placeholder count mismatch
+        self.assertEquals(app.db.compile_where_predicate(feed.Feed,
+            "userTitle=?", ()), None)
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
@@ -3,9 +3,11 @@ import os
 from miro import app
 from miro import downloader
 from miro import eventloop
+from miro import httpclient
 from miro import models
 from miro import prefs
 from miro.dl_daemon import command
+from miro.dl_daemon import download
 from miro.plat import resources
 from miro.test import testobjects
 from miro.test.framework import MiroTestCase
@@ -54,7 +56,7 @@ class DownloaderTest(MiroTestCase):
         self.mock_try_scraping_url.reset_mock()
         callback(self.url)
 
-    def run_daemon_commands(self):
+    def run_daemon_commands(self, priority=httpclient.PRIORITY_NORMAL):
         app.download_state_manager.send_updates()
         self.assertEquals(self.mock_send.call_count, 1)
         cmd = self.mock_send.call_args[0][0]
@@ -64,6 +66,7 @@ class DownloaderTest(MiroTestCase):
         self.assertEquals(arg[self.dlid][0],
                           command.DownloaderBatchCommand.RESUME)
         self.assertEquals(arg[self.dlid][1]['url'], self.url)
+        self.assertEquals(arg[self.dlid][1]['priority'], priority)
 
     def update_status(self, download_progress, elapsed_time):
         # define some arbitrary constants
@@ -133,6 +136,33 @@ class DownloaderTest(MiroTestCase):
         self.item.expire()
         self.assertEquals(self.feed.downloaded_items.count(), 0)
 
+    def test_auto_download_priority(self):
+        self.item.download(autodl=True)
+        self.dlid = self.item.downloader.dlid
+        self.run_content_type_check()
+        self.run_flash_scrape()
+        self.run_daemon_commands(httpclient.PRIORITY_LOW)
+        # the priority also gets sent when we restore the downloader
+        status = self.item.downloader.get_status_for_downloader()
+        self.assertEquals(status['priority'], httpclient.PRIORITY_LOW)
+
+    def test_status_delta(self):
+        self.start_download()
+        self.update_status(0.3, 10)
+        # send a status that only contains the values that changed
+        command.BatchUpdateDownloadStatus(None, [], False, [{
+            'dlid': self.dlid,
+            'current_size': 60000,
+            'rate': 3000,
+        }]).action()
+        self.check_download_in_progress()
+        self.assertEquals(self.item.downloader.get_current_size(), 60000)
+        self.assertEquals(self.item.downloader.rate, 3000)
+        # values missing from the delta should be left alone
+        self.assertEquals(self.item.downloader.get_total_size(), 100000)
+        self.assertEquals(self.item.downloader.get_filename(),
+                          self.downloading_path)
+
     ## def test_resume(self):
     ##     # FIXME - implement this
     ##     pass
@@ -140,3 +170,56 @@ class DownloaderTest(MiroTestCase):
     ## def test_resume_fail(self):
     ##     # FIXME - implement this
     ##     pass
+
+class FakeBGDownloader(object):
+    def __init__(self, dlid):
+        self.status = {
+            'dlid': dlid,
+            'state': u'downloading',
+            'current_size': 0,
+            'rate': 10.4,
+            'eta': 99.9,
+            'metainfo': 'big blob of torrent data',
+        }
+
+    def get_status(self):
+        status = self.status.copy()
+        # like BTDownloader, only send metainfo once
+        self.status.pop('metainfo', None)
+        return status
+
+class DownloadStatusUpdaterTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.updater = download.DownloadStatusUpdater()
+        self.downloader = FakeBGDownloader(u'dlid-1')
+
+    def test_first_status_is_full(self):
+        status, full = self.updater.make_status(self.downloader)
+        self.assert_(full)
+        self.assertEquals(status['state'], u'downloading')
+        self.assertEquals(status['metainfo'], 'big blob of torrent data')
+        # rates and eta get rounded
+        self.assertEquals(status['rate'], 10)
+        self.assertEquals(status['eta'], 99)
+
+    def test_delta(self):
+        self.updater.make_status(self.downloader)
+        self.downloader.status['current_size'] = 1000
+        self.downloader.status['rate'] = 10.9
+        status, full = self.updater.make_status(self.downloader)
+        self.assert_(not full)
+        self.assertEquals(status, {'dlid': u'dlid-1', 'current_size': 1000})
+        # nothing changed, nothing to send
+        self.assertEquals(self.updater.make_status(self.downloader),
+                          (None, False))
+
+    def test_forced_full(self):
+        self.updater.make_status(self.downloader)
+        status, full = self.updater.make_status(self.downloader, True)
+        self.assert_(full)
+        self.assertEquals(status['state'], u'downloading')
+        # a new downloader object for the same dlid also gets a full status
+        status, full = self.updater.make_status(
+            FakeBGDownloader(u'dlid-1'))
+        self.assert_(full)
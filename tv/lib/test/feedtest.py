@@ -1,13 +1,20 @@
 import os
+import shutil
 import unittest
 from time import sleep
 
 from miro import app
+from miro import database
 from miro import prefs
 from miro import dialogs
+from miro import feed
 from miro import feedparserutil
 from miro.item import Item
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
+from miro.data import feedcounts
+from miro.downloader import RemoteDownloader
+from miro.plat import resources
+from miro.test import testobjects
 
 from miro.test.framework import MiroTestCase, EventLoopTest
 
@@ -377,6 +384,100 @@ support participatory culture and build a fairer music industry.</description>
         self.assertEquals(Item.make_view().count(), 4)
         self.check_guids(3, 4, 5, 6)
 
+class CreateItemsTest(FeedTestCase):
+    # Test create_items_for_parsed()
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.old_max_run_time = feed._RateLimiter.MAX_RUN_TIME
+
+    def tearDown(self):
+        feed._RateLimiter.MAX_RUN_TIME = self.old_max_run_time
+        FeedTestCase.tearDown(self)
+
+    def write_feed(self, titles):
+        # write a feed without guids
+        items = []
+        for i, title in enumerate(titles):
+            items.append("""\
+<item>
+ <title>%s</title>
+ <enclosure url="http://example.com/%s.mpg" length="%s" />
+</item>
+""" % (title, i, 1000 + i))
+        self.write_file("""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Test Feed</title>
+      <link>http://example.com/</link>
+      %s
+   </channel>
+</rss>""" % '\n'.join(items))
+
+    def check_titles(self, titles):
+        self.assertSameSet([i.get_title() for i in Item.make_view()], titles)
+
+    def test_items_without_rss_id(self):
+        self.write_feed([u'one', u'two', u'three'])
+        self.feed = self.make_feed()
+        self.check_titles([u'one', u'two', u'three'])
+        # the titles changed, but the enclosures are the same.  We should
+        # update the old items rather than make new ones.
+        self.write_feed([u'one', u'new two', u'new three'])
+        self.update_feed(self.feed)
+        self.check_titles([u'one', u'new two', u'new three'])
+
+    def test_unchanged_content(self):
+        self.write_feed([u'one', u'two'])
+        self.feed = self.make_feed()
+        counts = feed.update_stage_counts.copy()
+        # the feed didn't change, we should skip parsing it
+        self.update_feed(self.feed)
+        self.assertEquals(feed.update_stage_counts['unchanged-content'],
+                          counts['unchanged-content'] + 1)
+        self.assertEquals(feed.update_stage_counts['parsed'],
+                          counts['parsed'])
+        self.assertEquals(self.feed.actualFeed.updating, False)
+        # the feed changed, we should parse it
+        self.write_feed([u'one', u'two', u'three'])
+        self.update_feed(self.feed)
+        self.assertEquals(feed.update_stage_counts['parsed'],
+                          counts['parsed'] + 1)
+        self.check_titles([u'one', u'two', u'three'])
+        # clean_old_items() should always parse the feed
+        self.feed.actualFeed.clean_old_items()
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        self.assertEquals(feed.update_stage_counts['parsed'],
+                          counts['parsed'] + 2)
+
+    def test_yield_to_event_loop(self):
+        # force create_items_for_parsed() to yield after each entry
+        feed._RateLimiter.MAX_RUN_TIME = 0
+        self.write_feed([u'one', u'two', u'three'])
+        self.feed = self.make_feed()
+        self.runPendingIdles()
+        self.check_titles([u'one', u'two', u'three'])
+        self.assertEquals(self.feed.actualFeed.updating, False)
+
+    def test_multiple_urls_with_same_entries(self):
+        # force create_items_for_parsed() to yield after each entry, then
+        # give a multi-URL feed two URLs with the same entries.  Each entry
+        # should only become one item.
+        feed._RateLimiter.MAX_RUN_TIME = 0
+        self.write_feed([u'one', u'two', u'three'])
+        other_filename = self.make_temp_path()
+        shutil.copyfile(self.filename, other_filename)
+        self.feed = Feed(u'dtv:search')
+        self.feed.actualFeed._urls = [self.url,
+                                      u'file://%s' % other_filename]
+        self.update_feed(self.feed)
+        self.runPendingIdles()
+        titles = [i.get_title() for i in Item.make_view()]
+        self.assertEquals(sorted(titles), [u'one', u'three', u'two'])
+        self.assertEquals(self.feed.actualFeed.parsed_queue, [])
+        self.assertEquals(self.feed.actualFeed.updating, 0)
+
 class FeedParserAttributesTestCase(FeedTestCase):
     """Test that we save/restore attributes from feedparser correctly.
 
@@ -461,5 +562,145 @@ by-nd/1.0</creativeCommons:license>
         self.save_then_restore_db()
         self.assertEquals(self.item.get_rss_id(), None)
 
+class FeedCountsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        # make_deleted() moves items to the manual feed
+        self.manual_feed = testobjects.make_manual_feed()
+        self.feed, self.items = testobjects.make_feed_with_items(5)
+        self.file_feed, self.file_items = testobjects.make_feed_with_items(
+            3, file_items=True)
+
+    def update_downloader_status(self, item, state):
+        path = self.make_temp_path('.mkv')
+        status = {
+            'dlid': item.downloader.dlid,
+            'url': item.url,
+            'state': state,
+            'current_size': 1000,
+            'total_size': 1000,
+            'upload_size': 0,
+            'start_time': 1000,
+            'end_time': 1050,
+            'eta': None,
+            'rate': None,
+            'filename': path,
+            'short_filename': os.path.basename(path),
+            'reason_failed': None,
+            'short_reason_failed': None,
+            'type': None,
+            'retry_time': None,
+            'retry_count': None,
+        }
+        RemoteDownloader.update_status(status, cmd_done=True)
+
+    def check_counts(self, feed):
+        # the counts from the feed_item_count table should match what we get
+        # from running COUNT() queries.
+        feed.invalidate_counts()
+        self.assertEquals(feed.num_downloaded(),
+                          feed.downloaded_items.count())
+        self.assertEquals(feed.num_downloading(),
+                          feed.downloading_items.count())
+        self.assertEquals(feed.num_unwatched(), feed.unwatched_items.count())
+        self.assertEquals(feed.num_available(),
+                          feed.available_items.count() -
+                          feed.auto_pending_items.count())
+
+    def check_all_counts(self):
+        for feed in Feed.make_view():
+            self.check_counts(feed)
+
+    def test_counts(self):
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_downloaded(), 0)
+        self.assertEquals(self.feed.num_available(), 5)
+        self.assertEquals(self.file_feed.num_downloaded(), 3)
+        # change some items
+        self.items[0].unset_new()
+        self.items[1].remove()
+        self.file_items[0].make_deleted()
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_available(), 3)
+        # changing the auto-download mode changes the available count
+        for mode in (u'all', u'new', u'off'):
+            self.feed.set_auto_download_mode(mode)
+            self.check_counts(self.feed)
+
+    def test_counts_for_new_feed(self):
+        feed = testobjects.make_feed()
+        self.assertEquals(feed.num_downloaded(), 0)
+        self.assertEquals(feed.num_available(), 0)
+
+    def test_reconcile(self):
+        self.assertEquals(feedcounts.reconcile_feed_counts(app.db), [])
+        app.db.cursor.execute("UPDATE feed_item_count SET downloaded=100 "
+                              "WHERE feed_id=?", (self.feed.id,))
+        self.assertEquals(feedcounts.reconcile_feed_counts(app.db),
+                          [self.feed.id])
+        self.check_all_counts()
+
+    def test_download_finished(self):
+        item = self.items[0]
+        item.download()
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_downloading(), 1)
+        self.assertEquals(self.feed.num_downloaded(), 0)
+        self.update_downloader_status(item, u'finished')
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_downloading(), 0)
+        self.assertEquals(self.feed.num_downloaded(), 1)
+
+    def test_main_item_changed(self):
+        # items in different feeds share a downloader when they have the
+        # same URL.  Only the main item counts as downloading.
+        item = self.items[0]
+        other_feed = testobjects.make_feed()
+        other_item = testobjects.make_item(other_feed, u'other',
+                                           url=item.url)
+        item.download()
+        other_item.download()
+        self.assert_(other_item.downloader is item.downloader)
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_downloading(), 1)
+        self.assertEquals(other_feed.num_downloading(), 0)
+        # removing the main item makes other_item the main item
+        item.remove()
+        self.assertEquals(other_item.downloader.main_item_id, other_item.id)
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_downloading(), 0)
+        self.assertEquals(other_feed.num_downloading(), 1)
+
+    def test_downloader_removed(self):
+        # expire() stops the downloader before removing it
+        item = self.items[0]
+        item.download()
+        self.update_downloader_status(item, u'finished')
+        downloader = item.downloader
+        item.expire()
+        self.assertRaises(database.ObjectNotFoundError,
+                          RemoteDownloader.get_by_id, downloader.id)
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_downloaded(), 0)
+        # the counts should also be right if a finished downloader gets
+        # deleted from the DB without being stopped first
+        item = self.items[1]
+        item.download()
+        self.update_downloader_status(item, u'finished')
+        self.assertEquals(self.feed.num_downloaded(), 1)
+        database.DDBObject.remove(item.downloader)
+        self.check_all_counts()
+        self.assertEquals(self.feed.num_downloaded(), 0)
+
+    def test_upgrade(self):
+        # upgrade205 should fill in feed_item_count for an existing database
+        old_db_path = self.make_temp_path('.db')
+        shutil.copy(resources.path("testdata/olddatabase.v79"), old_db_path)
+        self.reload_database(old_db_path)
+        app.db.cursor.execute("SELECT COUNT(*) FROM feed_item_count")
+        self.assert_(app.db.cursor.fetchone()[0] > 0)
+        self.assertEquals(feedcounts.reconcile_feed_counts(app.db), [])
+        self.check_all_counts()
+
 if __name__ == "__main__":
     unittest.main()
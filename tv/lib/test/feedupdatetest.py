@@ -0,0 +1,129 @@
+from miro import feedupdate
+from miro import signals
+from miro.test.framework import EventLoopTest
+
+class FakeFeed(signals.SignalEmitter):
+    def __init__(self, id_, url, autodownload=False):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id_
+        self.url = url
+        self.autodownload = autodownload
+
+    def get_url(self):
+        return self.url
+
+    def get_title(self):
+        return u'feed-%s' % self.id
+
+    def is_autodownloadable(self):
+        return self.autodownload
+
+class FeedUpdateQueueTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.updated = []
+
+    def make_feed(self, id_, host, autodownload=False):
+        return FakeFeed(id_, u'http://%s/feed-%s.rss' % (host, id_),
+                        autodownload)
+
+    def schedule(self, feed):
+        self.queue.schedule_update(0, feed,
+                                   lambda: self.updated.append(feed))
+
+    def finish(self, feed):
+        feed.emit('update-finished')
+        self.runPendingIdles()
+
+    def test_global_limit(self):
+        feeds = [self.make_feed(i, 'host%s.com' % i) for i in range(5)]
+        for feed in feeds:
+            self.schedule(feed)
+        self.run_pending_timeouts()
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES])
+        self.assertEquals(self.queue.stats()['queued'], 2)
+        self.finish(feeds[0])
+        self.assertEquals(self.updated, feeds[:4])
+
+    def test_host_limit(self):
+        feeds = [self.make_feed(i, 'example.com') for i in range(3)]
+        other_feed = self.make_feed(3, 'example.org')
+        for feed in feeds + [other_feed]:
+            self.schedule(feed)
+        self.run_pending_timeouts()
+        # the third example.com feed has to wait, even though we could run
+        # another update.
+        self.assertEquals(self.updated, feeds[:2] + [other_feed])
+        self.finish(feeds[1])
+        self.assertEquals(self.updated, feeds[:2] + [other_feed, feeds[2]])
+
+    def test_priority(self):
+        busy_feeds = [self.make_feed(i, 'busy%s.com' % i) for i in range(3)]
+        normal = self.make_feed(3, 'normal.com')
+        autodownload = self.make_feed(4, 'autodownload.com', True)
+        displayed = self.make_feed(5, 'displayed.com')
+        for feed in busy_feeds + [normal, autodownload, displayed]:
+            self.schedule(feed)
+        self.run_pending_timeouts()
+        self.assertEquals(self.updated, busy_feeds)
+        # the user starts looking at the feed while it's waiting
+        self.queue.set_feed_displayed(displayed.id, True)
+        for feed in busy_feeds:
+            self.finish(feed)
+        self.assertEquals(self.updated[3:], [displayed, autodownload, normal])
+        stats = self.queue.stats()
+        self.assertEquals(stats['queued'], 0)
+        self.assertEquals(self.queue.update_lag.count, 6)
+
+    def test_backoff(self):
+        feed = self.make_feed(0, 'example.com')
+        def calc_delay():
+            return self.queue.calc_delay(1000, feed, periodic=True)
+        for i in range(feedupdate.UNCHANGED_BACKOFF_STEP):
+            self.assert_(900 <= calc_delay() <= 1100)
+            self.queue.update_unchanged(feed)
+        self.assert_(1800 <= calc_delay() <= 2200)
+        for i in range(feedupdate.UNCHANGED_BACKOFF_STEP * 10):
+            self.queue.update_unchanged(feed)
+        self.assert_(calc_delay() <= 1100 * feedupdate.MAX_BACKOFF_FACTOR)
+        # explicit delays don't get backed off or jittered
+        self.assertEquals(self.queue.calc_delay(10, feed, periodic=False), 10)
+        self.queue.update_changed(feed)
+        self.assert_(900 <= calc_delay() <= 1100)
+
+    def test_spread(self):
+        feeds = [self.make_feed(i, 'example.com') for i in range(100)]
+        delays = [self.queue.calc_delay(5, feed, periodic=False, spread=1000)
+                  for feed in feeds]
+        for delay in delays:
+            self.assert_(5 <= delay < 1005)
+        # the same feed always gets the same offset
+        self.assertEquals(delays[0], self.queue.calc_delay(
+            5, feeds[0], periodic=False, spread=1000))
+        # the first updates should be spread over the whole interval, check
+        # that each tenth of it gets some of them.
+        buckets = set(int((delay - 5) // 100) for delay in delays)
+        self.assertEquals(buckets, set(range(10)))
+
+    def test_forget_feed(self):
+        busy_feeds = [self.make_feed(i, 'busy%s.com' % i) for i in range(3)]
+        waiting = self.make_feed(3, 'waiting.com')
+        scheduled = self.make_feed(4, 'scheduled.com')
+        for feed in busy_feeds + [waiting]:
+            self.schedule(feed)
+        self.run_pending_timeouts()
+        self.queue.schedule_update(1000, scheduled,
+                                   lambda: self.updated.append(scheduled))
+        for feed in (waiting, scheduled):
+            self.queue.set_feed_displayed(feed.id, True)
+            self.queue.update_unchanged(feed)
+            self.queue.forget_feed(feed)
+        self.assertEquals(self.queue.displayed_feed_ids, set())
+        self.assertEquals(self.queue.unchanged_counts, {})
+        stats = self.queue.stats()
+        self.assertEquals(stats['queued'], 0)
+        self.assertEquals(stats['scheduled'], 0)
+        # the forgotten feed shouldn't update once there's room
+        self.finish(busy_feeds[0])
+        self.assertEquals(self.updated, busy_feeds)
@@ -361,7 +361,7 @@ class MiroTestCase(unittest.TestCase):
         # shutdown workerprocess if we started it for some reason.
         workerprocess.shutdown()
         workerprocess._subprocess_manager = \
-                workerprocess.WorkerSubprocessManager()
+                workerprocess.WorkerProcessPool()
         workerprocess._miro_task_queue.reset()
         self.reset_log_filter()
         signals.system.disconnect_all()
@@ -486,9 +486,9 @@ class MiroTestCase(unittest.TestCase):
     def make_temp_dir_path(self):
         return tempfile.mkdtemp(dir=self.tempdir)
 
-    def start_http_server(self):
+    def start_http_server(self, threaded=False):
         self.stop_http_server()
-        self.httpserver = testhttpserver.HTTPServer()
+        self.httpserver = testhttpserver.HTTPServer(threaded)
         self.httpserver.start()
 
     def last_http_info(self, info_name):
@@ -710,7 +710,7 @@ class EventLoopTest(MiroTestCase):
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        while eventloop._eventloop.threadpool.has_pending_tasks():
             sleep(0.05)
         eventloop._eventloop.threadpool.close_threads()
 
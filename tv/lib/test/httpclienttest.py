@@ -14,7 +14,8 @@ from miro import httpclient
 from miro import signals
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                 uses_httpclient)
 
 from miro.gtcache import gettext as _
 
@@ -1092,3 +1093,160 @@ class LimitProtocolTest(HTTPClientTestBase):
         self.check_errback_called()
         self.assert_(isinstance(self.grab_url_error,
                                 httpclient.InvalidRedirect))
+
+class FakeTransfer(object):
+    def __init__(self, host, priority):
+        self.options = httpclient.TransferOptions(
+            'http://%s/video.mp4' % host, priority=priority)
+        self.throttled = False
+
+    def set_throttled(self, throttled):
+        self.throttled = throttled
+
+class BandwidthSchedulerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.time = 100.0
+        self.scheduler = httpclient.BandwidthScheduler(
+            time_func=lambda: self.time)
+
+    def test_max_per_host(self):
+        self.scheduler.set_limits(max_per_host=1)
+        first = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        low = FakeTransfer('a.com', httpclient.PRIORITY_LOW)
+        normal = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        other_host = FakeTransfer('b.com', httpclient.PRIORITY_LOW)
+        feed = FakeTransfer('a.com', httpclient.PRIORITY_HIGH)
+        self.assert_(self.scheduler.add(first))
+        self.assert_(not self.scheduler.add(low))
+        self.assert_(not self.scheduler.add(normal))
+        self.assert_(self.scheduler.add(other_host))
+        # high priority transfers never wait
+        self.assert_(self.scheduler.add(feed))
+        self.scheduler.remove(feed)
+        self.assertEquals(self.scheduler.pop_startable(), [])
+        # when a slot opens up, the highest priority transfer gets it
+        self.scheduler.remove(first)
+        self.assertEquals(self.scheduler.pop_startable(), [normal])
+        self.scheduler.remove(normal)
+        self.assertEquals(self.scheduler.pop_startable(), [low])
+
+    def test_remove_waiting(self):
+        self.scheduler.set_limits(max_per_host=1)
+        first = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        second = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        self.scheduler.add(first)
+        self.scheduler.add(second)
+        self.scheduler.remove(second)
+        self.scheduler.remove(first)
+        self.assertEquals(self.scheduler.pop_startable(), [])
+
+    def test_throttle(self):
+        self.scheduler.set_limits(rate=1000)
+        normal = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        low = FakeTransfer('b.com', httpclient.PRIORITY_LOW)
+        feed = FakeTransfer('c.com', httpclient.PRIORITY_HIGH)
+        for transfer in (normal, low, feed):
+            self.scheduler.add(transfer)
+        self.scheduler.charge(normal, 800)
+        self.scheduler.update_throttling()
+        self.assert_(not normal.throttled)
+        self.assertEquals(self.scheduler.calc_timeout(), None)
+        # go over the limit
+        self.scheduler.charge(feed, 700)
+        self.scheduler.update_throttling()
+        self.assert_(normal.throttled)
+        self.assert_(low.throttled)
+        # high priority transfers are never throttled
+        self.assert_(not feed.throttled)
+        # we're 500 bytes in debt, normal priority transfers resume after
+        # we get back to 250 tokens.
+        self.assertAlmostEquals(self.scheduler.calc_timeout(), 0.75)
+        self.time += 0.75
+        self.scheduler.update_throttling()
+        self.assert_(not normal.throttled)
+        self.assert_(low.throttled)
+        # low priority transfers resume after we get back to 500 tokens
+        self.time += 0.25
+        self.scheduler.update_throttling()
+        self.assert_(not low.throttled)
+
+    def test_low_priority_aging(self):
+        self.scheduler.set_limits(rate=1000)
+        normal = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        low = FakeTransfer('b.com', httpclient.PRIORITY_LOW)
+        for transfer in (normal, low):
+            self.scheduler.add(transfer)
+        downloaded = 0
+        start_time = self.time
+        # keep the normal priority transfer using all the bandwidth.  The
+        # buckets never get back to half full, but the low priority
+        # transfer should still resume once it's aged.
+        while low.throttled or self.time == start_time:
+            if not normal.throttled:
+                downloaded += 1500
+                self.scheduler.charge(normal, downloaded)
+                self.scheduler.update_throttling()
+                self.assert_(normal.throttled)
+                self.assert_(low.throttled)
+            self.assert_(self.time - start_time <
+                         self.scheduler.AGING_TIME + 1.0)
+            self.time += self.scheduler.calc_timeout()
+            self.scheduler.update_throttling()
+        self.assert_(self.time - start_time >= self.scheduler.AGING_TIME)
+
+    def test_max_pause_time(self):
+        self.scheduler.set_limits(rate=1)
+        transfer = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        self.scheduler.add(transfer)
+        self.scheduler.charge(transfer, 100000)
+        self.scheduler.update_throttling()
+        self.assert_(transfer.throttled)
+        # the buckets won't refill for a long time, but we shouldn't pause
+        # the transfer long enough for libcurl's low speed check to abort it
+        self.assertEquals(self.scheduler.calc_timeout(),
+                          self.scheduler.MAX_PAUSE_TIME)
+        self.time += self.scheduler.MAX_PAUSE_TIME
+        self.scheduler.update_throttling()
+        self.assert_(not transfer.throttled)
+        # once it gets more data, it gets paused again
+        self.scheduler.charge(transfer, 100001)
+        self.scheduler.update_throttling()
+        self.assert_(transfer.throttled)
+
+    def test_charge_new_request(self):
+        self.scheduler.set_limits(rate=1000)
+        transfer = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        self.scheduler.add(transfer)
+        self.scheduler.charge(transfer, 600)
+        self.scheduler.charge(transfer, 900)
+        self.assertEquals(self.scheduler.global_bucket.available(), 100)
+        # the transfer started a new request, so downloaded went down
+        self.scheduler.charge(transfer, 50)
+        self.assertEquals(self.scheduler.global_bucket.available(), 50)
+
+    def test_host_limits(self):
+        self.scheduler.set_limits(host_rate=1000)
+        a1 = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        a2 = FakeTransfer('a.com', httpclient.PRIORITY_NORMAL)
+        b = FakeTransfer('b.com', httpclient.PRIORITY_NORMAL)
+        for transfer in (a1, a2, b):
+            self.scheduler.add(transfer)
+        self.scheduler.charge(a1, 1500)
+        self.scheduler.charge(b, 500)
+        self.scheduler.update_throttling()
+        self.assert_(a1.throttled)
+        self.assert_(a2.throttled)
+        self.assert_(not b.throttled)
+
+    def test_remove_limits(self):
+        self.scheduler.set_limits(rate=1000)
+        transfer = FakeTransfer('a.com', httpclient.PRIORITY_LOW)
+        self.scheduler.add(transfer)
+        self.scheduler.charge(transfer, 5000)
+        self.scheduler.update_throttling()
+        self.assert_(transfer.throttled)
+        self.scheduler.set_limits()
+        self.assertEquals(self.scheduler.calc_timeout(), 0)
+        self.scheduler.update_throttling()
+        self.assert_(not transfer.throttled)
@@ -1,11 +1,16 @@
+import logging
 import os
+import time
 
+from miro import app
 from miro import download_utils
 from miro import httpclient
+from miro import prefs
 from miro.test.framework import (
     EventLoopTest, uses_httpclient, skip_for_platforms)
 from miro.plat import resources
 from miro.dl_daemon import download
+from miro.dl_daemon import segmented
 
 class TestingDownloader(download.HTTPDownloader):
     # update stats really often to make sure that we can do things like pause
@@ -165,3 +170,124 @@ class HTTPDownloaderTest(EventLoopTest):
         self.downloader2.statusCallback = status_callback
         self.runEventLoop()
         self.assert_(not self.restarted)
+
+class SegmentedDownloadTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        download.chatter = False
+        download.next_free_filename = lambda x: self.make_temp_path_fileobj()
+        download._downloads = {}
+        # segmented downloads need several connections at once
+        self.start_http_server(threaded=True)
+        self.httpserver.add_header('Accept-Ranges', 'bytes')
+        app.config.set(prefs.HTTP_SEGMENTED_DOWNLOADS, True)
+        app.config.set(prefs.HTTP_DOWNLOAD_SEGMENTS, 4)
+        # our test file is small, use small segments so that we get 4 of
+        # them
+        self.old_min_segment_size = segmented.MIN_SEGMENT_SIZE
+        segmented.MIN_SEGMENT_SIZE = 4096
+        self.download_url = unicode(
+                self.httpserver.build_url('screen-redirect'))
+        self.download_path = resources.path(
+                'testdata/httpserver/linux-screen.jpg')
+        self.event_loop_timeout = 5.0
+        self.download_size = 45572
+
+    def tearDown(self):
+        segmented.MIN_SEGMENT_SIZE = self.old_min_segment_size
+        EventLoopTest.tearDown(self)
+        download.next_free_filename = download_utils.next_free_filename
+        download.chatter = True
+
+    def stopOnFinished(self):
+        if self.downloader.state == "finished":
+            self.stopEventLoop(False)
+
+    def start_downloader(self):
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+
+    def check_download(self):
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(open(self.downloader.filename, 'rb').read(),
+                          open(self.download_path, 'rb').read())
+        self.assertEquals(self.downloader.current_size, self.download_size)
+        self.assert_(not segmented.has_state(self.downloader.filename))
+
+    def time_download(self):
+        start = time.time()
+        self.start_downloader()
+        self.runEventLoop()
+        self.check_download()
+        return time.time() - start
+
+    @uses_httpclient
+    def test_segmented_download(self):
+        self.start_downloader()
+        self.runEventLoop()
+        self.check_download()
+        self.assert_(not self.downloader.segments_failed)
+        self.assertEquals(self.last_http_info('method'), 'GET')
+        self.assert_('range' in self.last_http_info('headers'))
+
+    @uses_httpclient
+    def test_no_accept_ranges(self):
+        self.start_http_server(threaded=True)
+        self.download_url = unicode(
+                self.httpserver.build_url('screen-redirect'))
+        self.start_downloader()
+        self.runEventLoop()
+        self.check_download()
+        self.assert_(self.downloader.segments_failed)
+        self.assert_('range' not in self.last_http_info('headers'))
+
+    @uses_httpclient
+    def test_fallback(self):
+        # The server says it supports ranges, but sends the entire file
+        # instead.  We should fall back to using a single connection.
+        self.httpserver.disable_resume()
+        self.start_downloader()
+        self.runEventLoop()
+        self.check_download()
+        self.assert_(self.downloader.segments_failed)
+
+    @uses_httpclient
+    def test_pause_and_resume(self):
+        self.start_downloader()
+        def pause_on_data():
+            if (self.downloader.state == 'downloading' and
+                    self.downloader.current_size == 4 * 5000):
+                self.downloader.pause()
+                self.stopEventLoop(False)
+        self.downloader.statusCallback = pause_on_data
+        # each segment gets 5000 bytes, then the server stops sending
+        self.httpserver.pause_after(5000)
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'paused')
+        state = segmented.load_state(self.downloader.filename)
+        self.assertEquals(state['total_size'], self.download_size)
+        self.assertEquals([s.done for s in state['segments']], [5000] * 4)
+        self.httpserver.pause_after(-1)
+        self.downloader.statusCallback = self.stopOnFinished
+        self.add_timeout(0.1, self.downloader.start, 'restarter')
+        self.runEventLoop()
+        self.check_download()
+
+    @uses_httpclient
+    def test_throughput(self):
+        # limit each connection to 40KB/s.  A single connection should take
+        # over a second, while 4 segments should take about a quarter of
+        # that.
+        self.httpserver.set_rate_limit(40000)
+        app.config.set(prefs.HTTP_SEGMENTED_DOWNLOADS, False)
+        single_time = self.time_download()
+        app.config.set(prefs.HTTP_SEGMENTED_DOWNLOADS, True)
+        download._downloads = {}
+        segmented_time = self.time_download()
+        logging.info("segmented download throughput: %d B/s (single "
+                     "connection: %d B/s)",
+                     self.download_size / segmented_time,
+                     self.download_size / single_time)
+        self.assert_(segmented_time < single_time / 2,
+                     "segmented: %ss single: %ss" % (segmented_time,
+                                                     single_time))
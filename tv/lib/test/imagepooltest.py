@@ -0,0 +1,181 @@
+import os
+import time
+
+from miro import util
+from miro.frontends.widgets import imagepool
+from miro.test.framework import MiroTestCase
+
+class FakeImage(object):
+    """Stand-in for widgetset.Image that doesn't need a real image file."""
+    def __init__(self, path, width=400, height=300):
+        if not os.path.exists(path):
+            raise IOError("%s doesn't exist" % path)
+        self.path = path
+        self.width = width
+        self.height = height
+
+    def resize(self, width, height):
+        return FakeImage(self.path, width, height)
+
+    def crop_and_scale(self, src_x, src_y, src_width, src_height,
+                       dest_width, dest_height):
+        return FakeImage(self.path, dest_width, dest_height)
+
+    def save(self, path):
+        open(path, 'wb').write('fake image data')
+
+class FakeImageSurface(object):
+    def __init__(self, image):
+        self.image = image
+        self.width = image.width
+        self.height = image.height
+
+class ThumbnailLoaderTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.patch_function('miro.plat.frontends.widgets.widgetset.Image',
+                            FakeImage)
+        self.patch_function(
+            'miro.plat.frontends.widgets.widgetset.ImageSurface',
+            FakeImageSurface)
+        self.cache_dir = os.path.join(self.tempdir, 'thumbnail-cache')
+        self.scheduled = []
+        self.loaders = []
+        self.image_path = self.make_temp_path('.png')
+        self.callback_count = 0
+
+    def tearDown(self):
+        for loader in self.loaders:
+            loader.shutdown()
+        imagepool._thumbnail_loader = None
+        imagepool._imagepool.clear()
+        imagepool._image_surface_pool.clear()
+        MiroTestCase.tearDown(self)
+
+    def make_loader(self, thread_count=1):
+        loader = imagepool.ThumbnailLoader(self.cache_dir,
+                                           self.scheduled.append,
+                                           thread_count)
+        self.loaders.append(loader)
+        return loader
+
+    def callback(self):
+        self.callback_count += 1
+
+    def wait_for_delivery(self):
+        start = time.time()
+        while not self.scheduled:
+            if time.time() - start > 5.0:
+                raise AssertionError("ThumbnailLoader didn't finish")
+            time.sleep(0.01)
+        # empty the list in place, since our loaders append to it
+        scheduled = self.scheduled[:]
+        del self.scheduled[:]
+        for func in scheduled:
+            func()
+
+    def test_load(self):
+        loader = self.make_loader()
+        loader.request(self.image_path, (100, 50), self.callback)
+        loader.request(self.image_path, (100, 50), self.callback)
+        self.wait_for_delivery()
+        # the requests should be merged and our callback only called once
+        self.assertEquals(self.callback_count, 1)
+        image = imagepool._imagepool.get_cached((self.image_path, (100, 50)))
+        self.assertEquals((image.width, image.height), (100, 50))
+        self.assertEquals(loader.disk_misses, 1)
+
+    def test_disk_cache(self):
+        loader = self.make_loader()
+        loader.request(self.image_path, (100, 50), self.callback)
+        self.wait_for_delivery()
+        cache_path = loader.disk_cache_path(self.image_path, (100, 50))
+        self.assert_(os.path.exists(cache_path))
+        # a new loader (for example after a restart) should use the resized
+        # image from the disk cache
+        imagepool._imagepool.clear()
+        loader2 = self.make_loader()
+        loader2.request(self.image_path, (100, 50), self.callback)
+        self.wait_for_delivery()
+        self.assertEquals(loader2.disk_hits, 1)
+        image = imagepool._imagepool.get_cached((self.image_path, (100, 50)))
+        self.assertEquals(image.path, cache_path)
+        # changing the image should change the cache path
+        new_mtime = os.stat(self.image_path).st_mtime + 10
+        os.utime(self.image_path, (new_mtime, new_mtime))
+        self.assertNotEquals(loader.disk_cache_path(self.image_path,
+                                                    (100, 50)),
+                             cache_path)
+        # so should a different size
+        self.assertNotEquals(loader.disk_cache_path(self.image_path,
+                                                    (50, 50)),
+                             cache_path)
+
+    def test_cancel(self):
+        # use a loader without threads so that requests stay pending
+        loader = self.make_loader(thread_count=0)
+        def other_callback():
+            pass
+        loader.request(self.image_path, (100, 50), self.callback)
+        loader.request(self.image_path, (50, 50), self.callback)
+        loader.request(self.image_path, (50, 50), other_callback)
+        loader.cancel(self.callback)
+        # the request that other_callback also wanted should stay around
+        self.assertEquals(loader.pending.keys(), [(self.image_path, (50, 50))])
+        self.assertEquals(loader.cancelled, 1)
+
+    def test_drop_old_requests(self):
+        loader = self.make_loader(thread_count=0)
+        for i in xrange(imagepool.MAX_PENDING_THUMBNAILS + 10):
+            loader.request(self.image_path, (i + 1, i + 1), self.callback)
+        self.assertEquals(len(loader.pending),
+                          imagepool.MAX_PENDING_THUMBNAILS)
+        self.assertEquals(loader.cancelled, 10)
+        # the newest requests should be kept
+        self.assert_((self.image_path, (1, 1)) not in loader.pending)
+        self.assert_((self.image_path, (imagepool.MAX_PENDING_THUMBNAILS + 10,
+                                        imagepool.MAX_PENDING_THUMBNAILS + 10))
+                     in loader.pending)
+
+    def get_surface_async(self, path):
+        return imagepool.get_surface_async(
+            path, (100, 50), self.callback,
+            invalidator=util.mtime_invalidator(path))
+
+    def test_missing_file(self):
+        imagepool._thumbnail_loader = self.make_loader()
+        path = os.path.join(self.tempdir, 'missing.png')
+        with self.allow_warnings():
+            self.assertEquals(self.get_surface_async(path), None)
+            self.wait_for_delivery()
+        self.assertEquals(self.callback_count, 1)
+        # redrawing the row should use the broken image, rather than trying
+        # to load the file again
+        for i in xrange(20):
+            surface = self.get_surface_async(path)
+            self.assert_(surface.image is imagepool.broken_image)
+        self.assertEquals(imagepool._thumbnail_loader.pending.keys(), [])
+        self.assertEquals(self.scheduled, [])
+        self.assertEquals(self.callback_count, 1)
+        # once the file shows up, we should load it
+        open(path, 'wb').write('fake image data')
+        os.utime(path, (1000, 1000))
+        self.assertEquals(self.get_surface_async(path), None)
+        self.wait_for_delivery()
+        self.assertEquals(self.get_surface_async(path).image.path, path)
+
+    def test_stats(self):
+        imagepool._thumbnail_loader = self.make_loader()
+        imagepool._imagepool.reset_stats()
+        imagepool._image_surface_pool.reset_stats()
+        # each pool should count at most one lookup per call
+        self.assertEquals(self.get_surface_async(self.image_path), None)
+        self.wait_for_delivery()
+        self.get_surface_async(self.image_path)
+        self.get_surface_async(self.image_path)
+        image_stats = imagepool._imagepool.stats()
+        surface_stats = imagepool._image_surface_pool.stats()
+        self.assertEquals((image_stats['hits'], image_stats['misses']),
+                          (1, 1))
+        self.assertEquals((surface_stats['hits'], surface_stats['misses']),
+                          (1, 2))
@@ -219,6 +219,46 @@ class ItemListTest(MiroTestCase):
             group_info = self.item_list.get_group_info(i)
             self.assertEquals(group_info[2].title, u'new-title')
 
+    def test_grouping_incremental_changes(self):
+        # test that group info stays correct when on_item_changes() changes
+        # the items next to a group
+        self.item_list.set_sort(itemsort.TitleSort())
+        list_items = self.item_list.get_items()
+        group_keys = dict((info.id, i < 5) for i, info in enumerate(list_items))
+        def group_func(info):
+            return group_keys[info.id]
+        self.item_list.set_grouping(group_func)
+        self.check_group_info(group_func)
+
+        def send_changes(added=(), changed=(), removed=()):
+            app.db.finish_transaction()
+            msg = messages.ItemChanges(set(added), set(changed), set(removed),
+                                       set(['title']), False, False)
+            self.item_list.on_item_changes(msg)
+        # split the second group in 2
+        group_keys[list_items[7].id] = True
+        send_changes(changed=[list_items[7].id])
+        self.assertEquals(self.item_list.get_group_info(6), (1, 2,
+                                                             list_items[5]))
+        self.assertEquals(self.item_list.get_group_info(7), (0, 1,
+                                                             list_items[7]))
+        self.check_group_info(group_func)
+        # remove the item that split the group, the 2 halves should merge
+        for item in self.items:
+            if item.id == list_items[7].id:
+                item.remove()
+        send_changes(removed=[list_items[7].id])
+        self.assertEquals(self.item_list.get_group_info(6), (1, 4,
+                                                             list_items[5]))
+        self.check_group_info(group_func)
+        # add a new item to the end of the first group
+        new_item = testobjects.make_item(self.feed, u'item-4b')
+        group_keys[new_item.id] = True
+        send_changes(added=[new_item.id])
+        self.assertEquals(self.item_list.get_group_info(0), (0, 6,
+                                                             list_items[0]))
+        self.check_group_info(group_func)
+
     def test_grouping_returns_none(self):
         # If the grouping function returns None, then the item should never be
         # part of a group
@@ -427,6 +427,45 @@ class ItemMetadataTest(MiroTestCase):
                 self.assertEquals(item.metadata_title, None)
                 self.assertEquals(item.duration, None)
 
+class ItemThumbnailTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        self.item = testobjects.make_file_item(self.feed)
+        self.cover_art = self.make_image_file('.jpg')
+        self.screenshot = self.make_image_file('.png')
+
+    def make_image_file(self, ext):
+        path, fp = self.make_temp_path_fileobj(ext)
+        fp.write("fake image data")
+        fp.close()
+        return path
+
+    def send_metadata(self, **metadata):
+        on_new_metadata(mock.Mock(), {self.item.filename: metadata})
+
+    def test_thumbnail_path(self):
+        self.assertEquals(self.item.thumbnail_path, None)
+        self.send_metadata(screenshot=self.screenshot)
+        self.assertEquals(self.item.thumbnail_path, self.screenshot)
+        # cover art takes precedence over the screenshot
+        self.send_metadata(cover_art=self.cover_art)
+        self.assertEquals(self.item.thumbnail_path, self.cover_art)
+        self.assertEquals(self.item.get_thumbnail(), self.cover_art)
+
+    def test_make_deleted(self):
+        self.send_metadata(screenshot=self.screenshot)
+        self.item.make_deleted()
+        self.assertEquals(self.item.thumbnail_path, None)
+
+    def test_deleted_outside_miro(self):
+        self.send_metadata(cover_art=self.cover_art,
+                           screenshot=self.screenshot)
+        os.remove(self.cover_art)
+        self.assertEquals(self.item.thumbnail_path, self.cover_art)
+        self.item.check_deleted()
+        self.assertEquals(self.item.thumbnail_path, self.screenshot)
+
 class ItemSizeTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -40,6 +40,7 @@ from miro import models
 from miro import sharing
 from miro.data import item
 from miro.data import itemtrack
+from miro.data import sqlcache
 from miro.test import mock
 from miro.data import connectionpool
 from miro.test.framework import MiroTestCase, MatchAny
@@ -365,6 +366,40 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_list_change_after_message()
         self.check_tracker_items()
 
+    def test_incremental_update(self):
+        # test that list changes get handled without re-running the query
+        fetch_id_list = mock.Mock(side_effect=self.tracker._fetch_id_list)
+        self.tracker._fetch_id_list = fetch_id_list
+        # move an item to the end of the list
+        item1 = self.tracked_items[0]
+        item1.release_date += datetime.timedelta(days=400)
+        item1.signal_change()
+        # move items in and out of the list
+        item2 = self.tracked_items[1]
+        item2.feed_id = self.other_feed1.id
+        item2.signal_change()
+        item3 = self.other_items1[0]
+        item3.feed_id = self.tracked_feed.id
+        item3.signal_change()
+        # add/remove items
+        testobjects.make_item(self.tracked_feed, u'new-item')
+        self.tracked_items[2].remove()
+        self.check_list_change_after_message()
+        self.check_tracker_items()
+        self.assertEquals(fetch_id_list.call_count, 0)
+
+    def test_incremental_update_limit(self):
+        # test that we refetch the entire list if there are too many changes
+        self.tracker.INCREMENTAL_UPDATE_LIMIT = 1
+        fetch_id_list = mock.Mock(side_effect=self.tracker._fetch_id_list)
+        self.tracker._fetch_id_list = fetch_id_list
+        for obj in self.tracked_items[:2]:
+            obj.release_date += datetime.timedelta(days=400)
+            obj.signal_change()
+        self.check_list_change_after_message()
+        self.check_tracker_items()
+        self.assertEquals(fetch_id_list.call_count, 1)
+
     def test_item_changes_after_finished(self):
         # test item changes after we've finished fetching all rows
         while not self.tracker.idle_work_scheduled:
@@ -962,6 +997,34 @@ class ItemInfoAttributeTest(MiroTestCase):
                    "attributes: (%s)" % missing_attributes)
             raise AssertionError(msg)
 
+class SQLCacheTest(MiroTestCase):
+    def test_id_chunks(self):
+        self.assertEquals(list(sqlcache.id_chunks([1])), [(1, (1,))])
+        self.assertEquals(list(sqlcache.id_chunks([1, 2, 3])),
+                          [(5, (1, 2, 3, 3, 3))])
+        # big lists get split into multiple chunks
+        max_size = sqlcache.ID_CHUNK_SIZES[-1]
+        chunks = list(sqlcache.id_chunks(range(max_size + 2)))
+        self.assertEquals([size for size, ids in chunks], [max_size, 5])
+        self.assertEquals(chunks[0][1], tuple(range(max_size)))
+        self.assertEquals(chunks[1][1],
+                          (max_size, max_size+1, max_size+1, max_size+1,
+                           max_size+1))
+
+    def test_fetch_reuses_sql(self):
+        feed, items = testobjects.make_feed_with_items(10)
+        app.db.finish_transaction()
+        sqlcache.template_cache.clear()
+        sqlcache.template_cache.reset_stats()
+        ids = [i.id for i in items]
+        infos = app.db.fetch_item_infos(ids[:3])
+        self.assertSameSet([info.id for info in infos], ids[:3])
+        infos = app.db.fetch_item_infos(ids[3:6])
+        self.assertSameSet([info.id for info in infos], ids[3:6])
+        stats = sqlcache.template_cache.stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 1)
+
 class BackendItemTrackerTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
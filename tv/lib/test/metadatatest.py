@@ -25,6 +25,7 @@ from miro import prefs
 from miro import schema
 from miro import filetypes
 from miro import metadata
+from miro import metadatacache
 from miro import workerprocess
 from miro.plat import resources
 from miro.plat.utils import (PlatformFilenameType,
@@ -1321,6 +1322,148 @@ class MetadataManagerTest(MiroTestCase):
         correct_paths = paths[100:150] + new_paths
         self.assertSameSet(self.processor.mutagen_paths(), correct_paths)
 
+    def test_metadata_cache(self):
+        cache_path = os.path.join(self.tempdir, 'metadata_cache.sqlite')
+        cache = metadatacache.MetadataCache(cache_path)
+        self.metadata_manager.metadata_cache = cache
+        path = os.path.join(self.tempdir, 'foo.avi')
+        open(path, 'wb').write('FAKE VIDEO DATA')
+        self.check_add_file(path)
+        self.check_run_mutagen(path, 'video', 101, 'Foo')
+        self.check_run_movie_data(path, 'video', 100, False)
+        self.assertEquals(cache.misses, 2)
+        # Add a copy of the file.  We should use the cached results rather
+        # than running mutagen and movie data again.
+        path2 = os.path.join(self.tempdir, 'bar.avi')
+        shutil.copy2(path, path2)
+        self.net_lookup_enabled[path2] = self.net_lookup_enabled[path]
+        self.mutagen_data[path2] = self.mutagen_data[path]
+        self.movieprogram_data[path2] = self.movieprogram_data[path]
+        self.metadata_manager.add_file(path2)
+        self.check_metadata(path2)
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.processor.movie_data_paths(), [])
+        self.assertEquals(cache.hits, 2)
+        self.assertEquals(cache.bytes_saved, 2 * os.path.getsize(path))
+
+    def test_metadata_cache_changed_file(self):
+        cache_path = os.path.join(self.tempdir, 'metadata_cache.sqlite')
+        cache = metadatacache.MetadataCache(cache_path)
+        self.metadata_manager.metadata_cache = cache
+        path = os.path.join(self.tempdir, 'foo.avi')
+        open(path, 'wb').write('FAKE VIDEO DATA')
+        self.check_add_file(path)
+        self.check_run_mutagen(path, 'video', 101, 'Foo')
+        self.check_run_movie_data(path, 'video', 100, False)
+        # If the file contents are different, we should run the extractors
+        path2 = os.path.join(self.tempdir, 'bar.avi')
+        open(path2, 'wb').write('OTHER VIDEO DATA')
+        self.check_add_file(path2)
+        self.assertEquals(self.processor.mutagen_paths(), [path2])
+        self.assertEquals(cache.hits, 0)
+
+class MetadataCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_path = os.path.join(self.tempdir, 'metadata_cache.sqlite')
+        self.cache = metadatacache.MetadataCache(self.cache_path)
+        self.path = os.path.join(self.tempdir, 'foo.mp3')
+        self.write_file(self.path, 'a' * 100000)
+
+    def tearDown(self):
+        self.cache.close()
+        MiroTestCase.tearDown(self)
+
+    def write_file(self, path, data):
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+
+    def test_lookup(self):
+        fingerprint = self.cache.fingerprint(self.path)
+        self.assertEquals(self.cache.lookup(fingerprint, u'mutagen'), None)
+        result = {'title': u'Foo', 'source_path': self.path,
+                  'created_cover_art': True}
+        self.cache.store(fingerprint, u'mutagen', result)
+        self.assertEquals(self.cache.lookup(fingerprint, u'mutagen'),
+                          {'title': u'Foo'})
+        self.assertEquals(self.cache.lookup(fingerprint, u'movie-data'),
+                          None)
+        self.assertEquals(self.cache.stats(), {
+            'hits': 1,
+            'misses': 2,
+            'hit_rate': 1.0 / 3,
+            'bytes_saved': 100000,
+        })
+
+    def test_lookup_path(self):
+        fingerprint = self.cache.fingerprint(self.path)
+        self.cache.store(fingerprint, u'mutagen', {'title': u'Foo'})
+        self.assertEquals(self.cache.lookup_path(self.path, u'mutagen'),
+                          (fingerprint[:2], {'title': u'Foo'}))
+        # if there's no result for a file with the same size and mtime, we
+        # shouldn't read the file.
+        path2 = os.path.join(self.tempdir, 'bar.mp3')
+        self.write_file(path2, 'b' * 1000)
+        mock_fingerprint = mock.Mock()
+        self.cache.fingerprint = mock_fingerprint
+        self.assertEquals(self.cache.lookup_path(path2, u'mutagen'),
+                          (self.cache.stat_key(path2), None))
+        self.assertEquals(self.cache.lookup_path(self.path, u'movie-data'),
+                          (fingerprint[:2], None))
+        self.assertEquals(mock_fingerprint.call_count, 0)
+        self.assertEquals(self.cache.lookup_path('/non/existent/path',
+                                                 u'mutagen'),
+                          (None, None))
+        self.assertEquals(self.cache.hits, 1)
+        self.assertEquals(self.cache.misses, 2)
+
+    def test_fingerprint(self):
+        fingerprint = self.cache.fingerprint(self.path)
+        path2 = os.path.join(self.tempdir, 'bar.mp3')
+        shutil.copy2(self.path, path2)
+        self.assertEquals(self.cache.fingerprint(path2), fingerprint)
+        # changing the data at the end of the file should change the
+        # fingerprint
+        self.write_file(path2, 'a' * 99999 + 'b')
+        os.utime(path2, (os.stat(self.path).st_atime,
+                         os.stat(self.path).st_mtime))
+        self.assertNotEquals(self.cache.fingerprint(path2), fingerprint)
+        self.assertEquals(self.cache.fingerprint('/non/existent/path'),
+                          None)
+
+    def test_missing_image(self):
+        fingerprint = self.cache.fingerprint(self.path)
+        screenshot = os.path.join(self.tempdir, 'foo.png')
+        self.write_file(screenshot, 'FAKE IMAGE')
+        self.cache.store(fingerprint, u'movie-data',
+                         {'screenshot': screenshot})
+        self.assertNotEquals(self.cache.lookup(fingerprint, u'movie-data'),
+                             None)
+        # if the screenshot is deleted, the cached result is no good
+        os.remove(screenshot)
+        self.assertEquals(self.cache.lookup(fingerprint, u'movie-data'),
+                          None)
+
+    def test_persistence(self):
+        fingerprint = self.cache.fingerprint(self.path)
+        self.cache.store(fingerprint, u'mutagen', {'title': u'Foo'})
+        self.cache.commit()
+        self.cache.close()
+        self.cache = metadatacache.MetadataCache(self.cache_path)
+        self.assertEquals(self.cache.lookup(fingerprint, u'mutagen'),
+                          {'title': u'Foo'})
+
+    def test_corrupt_database(self):
+        self.cache.close()
+        self.write_file(self.cache_path, 'NOT A DATABASE' * 100)
+        with self.allow_warnings():
+            self.cache = metadatacache.MetadataCache(self.cache_path)
+        fingerprint = self.cache.fingerprint(self.path)
+        self.cache.store(fingerprint, u'mutagen', {'title': u'Foo'})
+        self.assertEquals(self.cache.lookup(fingerprint, u'mutagen'),
+                          {'title': u'Foo'})
+
 class EchonestNetErrorTest(EventLoopTest):
     # Test our pause/retry logic when we get HTTP errors from echonest
 
@@ -0,0 +1,1081 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""performancetest -- Benchmarks for performance sensitive code.
+
+These tests don't get run normally.  To run them, list them on the command
+line, for example::
+
+    ./run.sh --unittest performancetest
+"""
+
+import cPickle as pickle
+import heapq
+import httplib
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # resource isn't available on windows
+    resource = None
+
+from miro import app
+from miro import database
+from miro import downloader
+from miro import eventloop
+from miro import feed
+from miro import feedparserutil
+from miro import item
+from miro import libdaap
+from miro import messages
+from miro import schema
+from miro import sharing
+from miro import subprocessmanager
+from miro import workerprocess
+from miro.clock import clock
+from miro.data import itemtrack
+from miro.data import sqlcache
+from miro.data.item import ItemSource
+from miro.dl_daemon import command
+from miro.frontends.widgets import imagepool
+from miro.frontends.widgets import itemlist
+from miro.frontends.widgets import itemsort
+from miro.plat import resources
+from miro.plat.frontends.widgets import widgetset
+from miro.plat.utils import make_url_safe
+from miro.test.framework import EventLoopTest
+
+class PerformanceTestCase(EventLoopTest):
+    def time_function(self, func, *args, **kwargs):
+        """Call a function and return how long it took in seconds."""
+        start = time.time()
+        func(*args, **kwargs)
+        return time.time() - start
+
+    def report(self, name, seconds, **details):
+        """Print the results of a benchmark."""
+        details_str = ', '.join('%s=%s' % (k, v)
+                                for k, v in sorted(details.items()))
+        sys.stdout.write('\n%s: %.3f secs (%s)\n' % (name, seconds,
+                                                     details_str))
+
+class ViewTrackerPerformanceTest(PerformanceTestCase):
+    """Measure how long signal_change() takes with many view trackers."""
+
+    def setup_trackers(self, item_count, tracker_count):
+        self.feed = feed.Feed(u'http://example.com/feed.rss')
+        app.bulk_sql_manager.start()
+        try:
+            self.items = [
+                item.Item(item.FeedParserValues({'title': u'item-%s' % i}),
+                          feed_id=self.feed.id)
+                for i in xrange(item_count)
+            ]
+        finally:
+            app.bulk_sql_manager.finish()
+        self.trackers = []
+        for i in xrange(tracker_count):
+            # alternate between trackers that we can evaluate in python and
+            # ones that we need to use SQL for.
+            if i % 2:
+                view = item.Item.make_view('feed_id=? AND NOT keep',
+                                           (self.feed.id,))
+            else:
+                view = item.Item.make_view("feed.userTitle IS NULL",
+                        joins={'feed': 'feed.id=item.feed_id'})
+            self.trackers.append(view.make_tracker())
+
+    def change_items(self):
+        for obj in self.items:
+            obj.keep = not obj.keep
+            obj.signal_change()
+
+    def change_items_in_batch(self):
+        app.db_info.view_tracker_manager.start_batch()
+        try:
+            self.change_items()
+        finally:
+            app.db_info.view_tracker_manager.finish_batch()
+
+    def check_signal_change(self, item_count, tracker_count):
+        self.setup_trackers(item_count, tracker_count)
+        self.report('signal_change()', self.time_function(self.change_items),
+                    items=item_count, trackers=tracker_count)
+        self.report('signal_change() batched',
+                    self.time_function(self.change_items_in_batch),
+                    items=item_count, trackers=tracker_count)
+
+    def test_signal_change_few_trackers(self):
+        self.check_signal_change(1000, 5)
+
+    def test_signal_change_many_trackers(self):
+        self.check_signal_change(1000, 50)
+
+    def test_signal_change_many_items(self):
+        self.check_signal_change(5000, 20)
+
+class RestoreTestObject(database.DDBObject):
+    def setup_new(self, title, entry):
+        self.title = title
+        self.entry = entry
+        self.links = [entry['link']] * 5
+
+class RestoreTestObjectSchema(schema.ObjectSchema):
+    klass = RestoreTestObject
+    table_name = 'restore_test'
+    fields = [
+        ('id', schema.SchemaInt()),
+        ('title', schema.SchemaString()),
+        # simulates the feedparser data that we used to store for items
+        ('entry', schema.SchemaDict(schema.SchemaString(),
+                                    schema.SchemaReprContainer())),
+        ('links', schema.SchemaList(schema.SchemaURL())),
+    ]
+
+class RestorePerformanceTest(PerformanceTestCase):
+    """Measure how long it takes to restore objects at startup."""
+
+    OBJECT_COUNT = 50000
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        self.db_path = self.make_temp_path(extension=".db")
+        self.reload_database(self.db_path, schema_version=0,
+                             object_schemas=[RestoreTestObjectSchema])
+        app.bulk_sql_manager.start()
+        try:
+            for i in xrange(self.OBJECT_COUNT):
+                link = u'http://example.com/%s' % i
+                RestoreTestObject(u'object-%s' % i, {
+                    'title': u'object-%s' % i,
+                    'link': link,
+                    'summary': u'summary ' * 50,
+                    'enclosures': [{'url': link + u'.mp4',
+                                    'type': u'video/mp4',
+                                    'length': u'12345678'}],
+                    'updated_parsed': (2012, 3, 4, 5, 6, 7, 0, 64, 0),
+                })
+        finally:
+            app.bulk_sql_manager.finish()
+
+    def restore_all(self, lazy_restore):
+        self.reload_database(self.db_path, schema_version=0,
+                             object_schemas=[RestoreTestObjectSchema],
+                             lazy_restore=lazy_restore)
+        # access the title, like the tab list does at startup
+        for obj in RestoreTestObject.make_view():
+            obj.title
+
+    def maxrss(self):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def check_restore(self, lazy_restore):
+        maxrss_before = self.maxrss()
+        seconds = self.time_function(self.restore_all, lazy_restore)
+        self.report('restore', seconds, objects=self.OBJECT_COUNT,
+                    lazy=lazy_restore,
+                    maxrss_growth=self.maxrss() - maxrss_before)
+
+    def test_restore(self):
+        # Note: ru_maxrss only increases, so run the lazy restore first to
+        # get a fair memory comparison.
+        self.check_restore(True)
+        self.check_restore(False)
+
+class ItemFetchPerformanceTest(PerformanceTestCase):
+    """Measure the per-row cost of fetching ItemInfos."""
+
+    ITEM_COUNT = 20000
+    # matches ItemTracker.FETCH_ROW_CHUNK_SIZE
+    CHUNK_SIZE = 25
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        self.feed = feed.Feed(u'http://example.com/feed.rss')
+        app.bulk_sql_manager.start()
+        try:
+            self.item_ids = [
+                item.Item(item.FeedParserValues({'title': u'item-%s' % i}),
+                          feed_id=self.feed.id).id
+                for i in xrange(self.ITEM_COUNT)
+            ]
+        finally:
+            app.bulk_sql_manager.finish()
+
+    def fetch_in_chunks(self):
+        for start in xrange(0, len(self.item_ids), self.CHUNK_SIZE):
+            app.db.fetch_item_infos(
+                self.item_ids[start:start+self.CHUNK_SIZE])
+
+    def test_fetch_item_infos(self):
+        sqlcache.template_cache.reset_stats()
+        seconds = self.time_function(self.fetch_in_chunks)
+        self.report('fetch_item_infos()', seconds, items=self.ITEM_COUNT,
+                    usecs_per_row=int(seconds * 1000000 / self.ITEM_COUNT),
+                    **sqlcache.template_cache.stats())
+
+class ItemTrackerPerformanceTest(PerformanceTestCase):
+    """Measure how long ItemTracker takes to handle list changes for a big
+    "All Videos" view.
+    """
+
+    ITEM_COUNT = 100000
+    CHANGE_COUNT = 20
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        self.init_data_package()
+        self.feed = feed.Feed(u'http://example.com/feed.rss')
+        app.bulk_sql_manager.start()
+        try:
+            self.items = []
+            for i in xrange(self.ITEM_COUNT):
+                obj = item.Item(item.FeedParserValues({
+                    'entry_title': u'video-%s' % i,
+                    'url': u'http://example.com/%s.mkv' % i,
+                }), feed_id=self.feed.id)
+                obj.file_type = u'video'
+                self.items.append(obj)
+        finally:
+            app.bulk_sql_manager.finish()
+        app.db.finish_transaction()
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('file_type', '=', u'video')
+        query.add_condition('deleted', '=', False)
+        query.set_order_by(['title'], ['name'])
+        self.tracker = itemtrack.ItemTracker(lambda func: None, query,
+                                             ItemSource())
+
+    def tearDown(self):
+        self.tracker.destroy()
+        PerformanceTestCase.tearDown(self)
+
+    def change_title(self, index):
+        obj = self.items[index * 997 % len(self.items)]
+        obj.title = u'changed-%s' % index
+        obj.signal_change()
+        app.db.finish_transaction()
+        return messages.ItemChanges([], [obj.id], [], ['title'], False,
+                                    False)
+
+    def time_changes(self):
+        total = 0.0
+        for i in xrange(self.CHANGE_COUNT):
+            msg = self.change_title(i)
+            total += self.time_function(self.tracker.on_item_changes, msg)
+        return total / self.CHANGE_COUNT
+
+    def test_title_change(self):
+        self.report('ItemTracker.on_item_changes() incremental',
+                    self.time_changes(), items=self.ITEM_COUNT)
+        self.tracker.INCREMENTAL_UPDATE_LIMIT = 0
+        self.report('ItemTracker.on_item_changes() full refetch',
+                    self.time_changes(), items=self.ITEM_COUNT)
+
+class ItemListGroupingPerformanceTest(PerformanceTestCase):
+    """Measure get_group_info() for an album view of a big music library."""
+
+    TRACK_COUNT = 50000
+    CHANGE_COUNT = 20
+
+    def setup_library(self, album_count):
+        self.init_data_package()
+        self.feed = feed.Feed(u'dtv:manualFeed')
+        tracks_per_album = self.TRACK_COUNT // album_count
+        app.bulk_sql_manager.start()
+        try:
+            self.items = []
+            for i in xrange(self.TRACK_COUNT):
+                obj = item.Item(item.FeedParserValues({
+                    'entry_title': u'track-%s' % i,
+                    'url': u'http://example.com/%s.mp3' % i,
+                }), feed_id=self.feed.id)
+                obj.file_type = u'audio'
+                obj.album_artist = u'artist-%s' % (i // tracks_per_album)
+                obj.album = u'album-%s' % (i // tracks_per_album)
+                obj.track = i % tracks_per_album
+                self.items.append(obj)
+        finally:
+            app.bulk_sql_manager.finish()
+        app.db.finish_transaction()
+        self.item_list = itemlist.ItemList('feed', self.feed.id,
+                                           itemsort.MultiRowAlbum(True),
+                                           itemlist.album_grouping)
+
+    def get_all_group_info(self):
+        for row in xrange(len(self.item_list)):
+            self.item_list.get_group_info(row)
+
+    def change_track(self, index):
+        obj = self.items[index * 997 % len(self.items)]
+        obj.title = u'changed-%s' % index
+        obj.signal_change()
+        app.db.finish_transaction()
+        return messages.ItemChanges([], [obj.id], [], ['title'], False,
+                                    False)
+
+    def time_changes(self):
+        # After each change, ask for the group info of every row, like the
+        # table view does when it redraws.
+        total = 0.0
+        for i in xrange(self.CHANGE_COUNT):
+            msg = self.change_track(i)
+            total += self.time_function(self.item_list.on_item_changes, msg)
+            total += self.time_function(self.get_all_group_info)
+        return total / self.CHANGE_COUNT
+
+    def check_album_view(self, album_count):
+        self.setup_library(album_count)
+        try:
+            self.report('ItemList.get_group_info() all rows, cold',
+                        self.time_function(self.get_all_group_info),
+                        tracks=self.TRACK_COUNT, albums=album_count)
+            self.report('ItemList.get_group_info() all rows, warm',
+                        self.time_function(self.get_all_group_info),
+                        tracks=self.TRACK_COUNT, albums=album_count)
+            self.report('ItemList.on_item_changes() + get_group_info()',
+                        self.time_changes(), tracks=self.TRACK_COUNT,
+                        albums=album_count)
+        finally:
+            self.item_list.destroy()
+
+    def test_10_albums(self):
+        self.check_album_view(10)
+
+    def test_5000_albums(self):
+        self.check_album_view(5000)
+
+class FeedUpdatePerformanceTest(PerformanceTestCase):
+    """Measure how long create_items_for_parsed() takes for big feeds."""
+
+    def make_parsed(self, entry_count):
+        # Make a feed without guids, so that we have to check the entries
+        # against the items without rss ids.
+        entries = []
+        for i in xrange(entry_count):
+            entries.append('<item><title>entry-%s</title>'
+                           '<enclosure url="http://example.com/%s.mp4" '
+                           'length="%s" type="video/mp4" /></item>' %
+                           (i, i, 1000 + i))
+        return feedparserutil.parse("""<?xml version="1.0"?>
+<rss version="2.0">
+<channel>
+<title>Big Feed</title>
+<link>http://example.com/</link>
+%s
+</channel>
+</rss>""" % '\n'.join(entries))
+
+    def update(self, feed_impl, parsed):
+        finished = []
+        feed_impl.remember_old_items()
+        feed_impl.create_items_for_parsed(
+            parsed, lambda work_time: finished.append(True))
+        while not finished:
+            self.runPendingIdles()
+
+    def check_update(self, entry_count):
+        parsed = self.make_parsed(entry_count)
+        feed_impl = feed.Feed(u'http://example.com/%s.rss' %
+                              entry_count).actualFeed
+        self.report('create_items_for_parsed() new items',
+                    self.time_function(self.update, feed_impl, parsed),
+                    entries=entry_count)
+        self.report('create_items_for_parsed() existing items',
+                    self.time_function(self.update, feed_impl, parsed),
+                    entries=entry_count)
+
+    def test_small_feed(self):
+        self.check_update(100)
+
+    def test_medium_feed(self):
+        self.check_update(1000)
+
+    def test_big_feed(self):
+        self.check_update(10000)
+
+class DirectoryScanPerformanceTest(PerformanceTestCase):
+    """Measure how long it takes to scan a big watched folder."""
+
+    FILE_COUNT = 20000
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        self.dir = self.make_temp_dir_path()
+        for i in xrange(self.FILE_COUNT):
+            subdir = os.path.join(self.dir, 'album-%s' % (i // 100))
+            if not os.path.exists(subdir):
+                os.mkdir(subdir)
+            open(os.path.join(subdir, 'track-%s.mp3' % i), 'wb').close()
+        self.feed_impl = feed.Feed(u'dtv:directoryfeed:%s' %
+                                   make_url_safe(self.dir)).actualFeed
+
+    def maxrss(self):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def scan(self):
+        self.first_batch_time = None
+        real_add_batch = self.feed_impl._add_batch_of_videos
+        def add_batch(paths):
+            if self.first_batch_time is None:
+                self.first_batch_time = time.time()
+            real_add_batch(paths)
+        self.feed_impl._add_batch_of_videos = add_batch
+        start = time.time()
+        self.feed_impl.update()
+        while self.feed_impl.updating:
+            self.runPendingIdles()
+        del self.feed_impl._add_batch_of_videos
+        if self.first_batch_time is None:
+            return None
+        return self.first_batch_time - start
+
+    def test_scan(self):
+        maxrss_before = self.maxrss()
+        first_items = []
+        seconds = self.time_function(
+            lambda: first_items.append(self.scan()))
+        self.report('directory scan new files', seconds,
+                    files=self.FILE_COUNT, first_batch_secs=first_items[0],
+                    maxrss_growth=self.maxrss() - maxrss_before)
+        self.report('directory scan existing files',
+                    self.time_function(self.scan), files=self.FILE_COUNT)
+
+class ThumbnailScrollPerformanceTest(PerformanceTestCase):
+    """Measure frame times while scrolling through a list of thumbnails.
+
+    Each frame draws the thumbnails for the visible rows, then we scroll
+    SCROLL_ROWS rows.  We wait between frames, like the real UI would, so
+    that ThumbnailLoader gets time to work.
+    """
+
+    THUMBNAIL_COUNT = 10000
+    VISIBLE_ROWS = 8
+    SCROLL_ROWS = 8
+    FRAME_INTERVAL = 1.0 / 60
+    # thumbnail size that ItemRenderer uses
+    SIZE = (154, 105)
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        # Make a cover art sized image, then link it to get many paths
+        # without using lots of disk space.
+        source = os.path.join(self.tempdir, 'cover.png')
+        image = widgetset.Image(resources.path(
+            'images/album-view-default-video.png'))
+        image.resize(600, 600).save(source)
+        self.image_dir = self.make_temp_dir_path()
+        self.paths = []
+        for i in xrange(self.THUMBNAIL_COUNT):
+            path = os.path.join(self.image_dir, 'cover-%s.png' % i)
+            if hasattr(os, 'link'):
+                os.link(source, path)
+            else:
+                shutil.copy(source, path)
+            self.paths.append(path)
+        self.cache_dir = os.path.join(self.tempdir, 'thumbnail-cache')
+        self.scheduled = []
+
+    def tearDown(self):
+        imagepool.shutdown_thumbnail_loader()
+        PerformanceTestCase.tearDown(self)
+
+    def clear_memory_caches(self):
+        imagepool._imagepool.clear()
+        imagepool._image_surface_pool.clear()
+
+    def start_loader(self):
+        imagepool.shutdown_thumbnail_loader()
+        imagepool._thumbnail_loader = imagepool.ThumbnailLoader(
+            self.cache_dir, self.scheduled.append)
+
+    def callback(self):
+        self.redraws += 1
+
+    def draw_frame(self, first_row):
+        for path in self.paths[first_row:first_row+self.VISIBLE_ROWS]:
+            surface = imagepool.get_surface_async(path, self.SIZE,
+                                                  self.callback)
+            if surface is None:
+                self.placeholders += 1
+        # run the callbacks that ThumbnailLoader scheduled
+        scheduled, self.scheduled = self.scheduled, []
+        for func in scheduled:
+            func()
+
+    def scroll(self):
+        self.placeholders = self.redraws = 0
+        frame_times = []
+        for first_row in xrange(0, len(self.paths), self.SCROLL_ROWS):
+            frame_time = self.time_function(self.draw_frame, first_row)
+            frame_times.append(frame_time)
+            if frame_time < self.FRAME_INTERVAL:
+                time.sleep(self.FRAME_INTERVAL - frame_time)
+        return frame_times
+
+    def report_scroll(self, name):
+        frame_times = self.scroll()
+        frame_times.sort()
+        self.report(name, sum(frame_times) / len(frame_times),
+                    frames=len(frame_times),
+                    p95_ms=int(frame_times[len(frame_times) * 95 // 100] *
+                               1000),
+                    max_ms=int(frame_times[-1] * 1000),
+                    placeholders=self.placeholders, redraws=self.redraws,
+                    **imagepool.get_stats().get('thumbnails', {}))
+
+    def fill_disk_cache(self):
+        loader = imagepool._thumbnail_loader
+        for path in self.paths:
+            if not os.path.exists(loader.disk_cache_path(path, self.SIZE)):
+                loader.load_image(path, self.SIZE)
+
+    def test_scroll(self):
+        self.clear_memory_caches()
+        self.report_scroll('thumbnail scroll frame time, synchronous')
+        self.clear_memory_caches()
+        self.start_loader()
+        self.report_scroll('thumbnail scroll frame time, cold cache')
+        # simulate a restart: the resized thumbnails are on disk, but
+        # nothing is in memory.
+        self.fill_disk_cache()
+        self.clear_memory_caches()
+        self.start_loader()
+        self.report_scroll('thumbnail scroll frame time, warm disk cache')
+
+class DownloadStatusPerformanceTest(PerformanceTestCase):
+    """Measure backend CPU time spent on download status updates."""
+
+    TICKS = 10
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        self.patch_for_test('miro.dl_daemon.command.Command.send')
+        mock_scrape = self.patch_for_test(
+            'miro.flashscraper.try_scraping_url')
+        mock_scrape.side_effect = lambda url, callback: callback(url)
+        self.feed = feed.Feed(u'http://example.com/feed.rss')
+
+    def make_downloads(self, count):
+        self.dlids = []
+        app.bulk_sql_manager.start()
+        try:
+            for i in xrange(count):
+                url = u'http://example.com/%s.mp4' % i
+                item_ = item.Item(item.FeedParserValues({
+                    'title': u'item-%s' % i,
+                    'url': url,
+                }), feed_id=self.feed.id)
+                dl = downloader.RemoteDownloader(url, item_, u'video/mp4')
+                item_.set_downloader(dl)
+                self.dlids.append(dl.dlid)
+        finally:
+            app.bulk_sql_manager.finish()
+        for dl in downloader.RemoteDownloader.make_view():
+            dl.status_updates_frozen = False
+        self.statuses = dict((dlid, self.make_status(dlid))
+                             for dlid in self.dlids)
+
+    def make_status(self, dlid):
+        return {
+            'dlid': dlid,
+            'url': u'http://example.com/%s.mp4' % dlid,
+            'state': u'downloading',
+            'total_size': 100000000,
+            'current_size': 0,
+            'eta': 1000,
+            'rate': 100000,
+            'upload_size': 0,
+            'filename': '/tmp/%s.mp4' % dlid,
+            'start_time': 1000,
+            'end_time': None,
+            'short_filename': '%s.mp4' % dlid,
+            'reason_failed': u'No Error',
+            'short_reason_failed': u'No Error',
+            'type': u'HTTP',
+            'retry_time': None,
+            'retry_count': None,
+        }
+
+    def run_tick(self, use_deltas):
+        statuses = []
+        deltas = []
+        for dlid in self.dlids:
+            status = self.statuses[dlid]
+            status['current_size'] += 100000
+            status['eta'] -= 1
+            if use_deltas:
+                deltas.append({
+                    'dlid': dlid,
+                    'current_size': status['current_size'],
+                    'eta': status['eta'],
+                })
+            else:
+                statuses.append(status.copy())
+        if use_deltas:
+            command.BatchUpdateDownloadStatus(None, statuses, False,
+                                              deltas).action()
+        else:
+            # the old way: full statuses, applied one at a time
+            for status in statuses:
+                downloader.RemoteDownloader.update_status(status)
+        app.db.finish_transaction()
+        item.Item.change_tracker.send_changes()
+
+    def run_ticks(self, use_deltas):
+        for tick in xrange(self.TICKS):
+            self.run_tick(use_deltas)
+
+    def check_updates(self, count):
+        self.make_downloads(count)
+        for use_deltas in (False, True):
+            start = time.clock()
+            self.run_ticks(use_deltas)
+            cpu_time = time.clock() - start
+            # updates are sent once a second, so CPU time per tick is the
+            # fraction of a CPU that we use.
+            self.report('download status updates per tick',
+                        cpu_time / self.TICKS, downloads=count,
+                        deltas=use_deltas)
+
+    def test_50_downloads(self):
+        self.check_updates(50)
+
+    def test_300_downloads(self):
+        self.check_updates(300)
+
+    def test_1000_downloads(self):
+        self.check_updates(1000)
+
+class _ListingRequestHandler(libdaap.DaapHttpRequestHandler):
+    """DaapHttpRequestHandler that doesn't handle a real request."""
+    def __init__(self, server):
+        self.server = server
+
+class _ListingServer(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.item_cache = libdaap.EncodedItemCache()
+
+class DaapListingPerformanceTest(PerformanceTestCase):
+    """Measure full and delta DAAP item listings."""
+
+    CHANGED_ITEMS = 10
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        self.backend = sharing.SharingManagerBackend()
+        self.data_set = self.backend.data_set
+        self.handler = _ListingRequestHandler(_ListingServer(self.backend))
+
+    def store_item(self, item_id):
+        self.data_set._store_item(item_id, {
+            'dmap.itemid': item_id,
+            'dmap.itemname': 'Track %s' % item_id,
+            'dmap.containeritemid': item_id,
+            'daap.songtime': 215000,
+            'daap.songsize': 5000000,
+            'daap.songformat': 'mp3',
+            'daap.songalbumartist': 'Some Artist',
+            'com.apple.itunes.mediakind': libdaap.DAAP_MEDIAKIND_AUDIO,
+            'revision': self.data_set.revision,
+            'valid': True,
+        })
+
+    def send_listing(self, delta):
+        """Build a listing and encode it like do_send_reply() does.
+
+        :returns: number of bytes sent
+        """
+        query = {
+            'revision-number': str(self.data_set.revision),
+            'delta': str(delta),
+        }
+        rcode, reply, headers = self.handler.do_itemlist([], query)
+        byte_count = 0
+        for chunk in libdaap.encode_response(reply):
+            byte_count += len(chunk)
+        return byte_count
+
+    def check_listing(self, count):
+        for i in xrange(count):
+            self.store_item(i)
+        for cache in ('cold', 'warm'):
+            start = time.time()
+            byte_count = self.send_listing(0)
+            self.report('DAAP full listing (%s cache)' % cache,
+                        time.time() - start, items=count, bytes=byte_count)
+        old_revision = self.data_set.revision
+        self.data_set.revision += 1
+        for i in xrange(0, count, count // self.CHANGED_ITEMS):
+            self.store_item(i)
+        start = time.time()
+        byte_count = self.send_listing(old_revision)
+        self.report('DAAP delta listing', time.time() - start, items=count,
+                    changed=self.CHANGED_ITEMS, bytes=byte_count)
+
+    def test_10k_items(self):
+        self.check_listing(10000)
+
+    def test_100k_items(self):
+        self.check_listing(100000)
+
+class _StreamingBackend(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_file(self, itemid, generation, ext, session, request_path_func,
+                 offset=0, chunk=None):
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(offset, os.SEEK_SET)
+        return file_obj, os.path.basename(self.path)
+
+class DaapStreamingPerformanceTest(PerformanceTestCase):
+    """Measure throughput and CPU use for concurrent DAAP range requests."""
+
+    FILE_SIZE = 32 * 1024 * 1024
+    RANGE_SIZE = 8 * 1024 * 1024
+    READ_SIZE = 256 * 1024
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'stream.mp3')
+        block = os.urandom(1024 * 1024)
+        with open(self.path, 'wb') as f:
+            for i in xrange(self.FILE_SIZE // len(block)):
+                f.write(block)
+        self.backend = _StreamingBackend(self.path)
+
+    def cpu_time(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def stream_range(self, port, index, errors):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/login')
+            reply = libdaap.decode_response(conn.getresponse().read())
+            session = libdaap.find_daap_tag('mlid', reply)
+            start = (index * self.RANGE_SIZE // 2) % (self.FILE_SIZE -
+                                                       self.RANGE_SIZE)
+            end = start + self.RANGE_SIZE - 1
+            conn.request('GET',
+                         '/databases/1/items/1.mp3?session-id=%d' % session,
+                         headers={'Range': 'bytes=%d-%d' % (start, end)})
+            response = conn.getresponse()
+            byte_count = 0
+            while True:
+                data = response.read(self.READ_SIZE)
+                if not data:
+                    break
+                byte_count += len(data)
+            conn.close()
+            if byte_count != self.RANGE_SIZE:
+                errors.append('client %d got %d bytes' % (index, byte_count))
+        except Exception, e:
+            errors.append(e)
+
+    def run_clients(self, client_count, use_sendfile, pool_size):
+        server = libdaap.make_daap_server(self.backend, port=0,
+                                          max_conn=client_count,
+                                          pool_size=pool_size)
+        server_thread = threading.Thread(target=server.serve_forever,
+                                         args=(0.05,))
+        server_thread.start()
+        old_sendfile = libdaap.subr.sendfile
+        if not use_sendfile:
+            libdaap.subr.sendfile = None
+        try:
+            port = server.server_address[1]
+            errors = []
+            threads = [threading.Thread(target=self.stream_range,
+                                        args=(port, i, errors))
+                       for i in xrange(client_count)]
+            start_cpu = self.cpu_time()
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.time() - start
+            cpu_time = self.cpu_time() - start_cpu
+        finally:
+            libdaap.subr.sendfile = old_sendfile
+            server.shutdown()
+            server.server_close()
+            server_thread.join()
+        self.assertEquals(errors, [])
+        total_mb = client_count * self.RANGE_SIZE / (1024.0 * 1024.0)
+        self.report('DAAP range streaming', seconds, clients=client_count,
+                    sendfile=use_sendfile, pool_size=pool_size,
+                    mb_per_sec=int(total_mb / seconds),
+                    cpu_secs='%.2f' % cpu_time)
+
+    def check_clients(self, client_count):
+        if libdaap.subr.sendfile is not None:
+            self.run_clients(client_count, True, 0)
+        self.run_clients(client_count, False, 0)
+        if libdaap.subr.sendfile is not None:
+            self.run_clients(client_count, True, 8)
+
+    def test_1_client(self):
+        self.check_clients(1)
+
+    def test_8_clients(self):
+        self.check_clients(8)
+
+    def test_32_clients(self):
+        self.check_clients(32)
+
+class HeapScheduler(object):
+    """The old eventloop.Scheduler, which only throws away canceled timeouts
+    when they reach the top of the heap.
+    """
+    def __init__(self):
+        self.heap = []
+
+    def add_timeout(self, delay, function, name, args=None, kwargs=None):
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        scheduled_time = clock() + delay
+        dc = eventloop.DelayedCall(function, "timeout (%s)" % (name,), args,
+                                   kwargs)
+        heapq.heappush(self.heap, (scheduled_time, dc))
+        return dc
+
+    def has_pending_timeout(self):
+        return len(self.heap) > 0 and self.heap[0][0] < clock()
+
+    def process_next_timeout(self):
+        time, dc = heapq.heappop(self.heap)
+        return dc.dispatch()
+
+class SchedulerPerformanceTest(PerformanceTestCase):
+    """Compare eventloop.Scheduler with a plain heap of timeouts.
+
+    This simulates lots of feeds and DelayedFunctionCallers that schedule a
+    timeout, then cancel it and reschedule.
+    """
+    TIMEOUT_COUNT = 20000
+    # how many times each timeout gets rescheduled
+    RESCHEDULE_COUNT = 5
+
+    def callback(self):
+        pass
+
+    def add_and_cancel(self, scheduler):
+        calls = []
+        for i in xrange(self.TIMEOUT_COUNT):
+            calls.append(scheduler.add_timeout(i * 0.00001, self.callback,
+                                               'callback'))
+        for j in xrange(self.RESCHEDULE_COUNT):
+            for i in xrange(self.TIMEOUT_COUNT):
+                calls[i].cancel()
+                calls[i] = scheduler.add_timeout(i * 0.00001, self.callback,
+                                                 'callback')
+
+    def dispatch_all(self, scheduler):
+        if isinstance(scheduler, eventloop.Scheduler):
+            for dc in scheduler.pop_due_timeouts():
+                dc.dispatch()
+        else:
+            while scheduler.has_pending_timeout():
+                scheduler.process_next_timeout()
+
+    def check_scheduler(self, name, scheduler):
+        self.report('%s add/cancel' % name,
+                    self.time_function(self.add_and_cancel, scheduler),
+                    timeouts=self.TIMEOUT_COUNT,
+                    reschedules=self.RESCHEDULE_COUNT,
+                    heap_size=len(scheduler.heap))
+        # wait for all the timeouts to be due
+        time.sleep(self.TIMEOUT_COUNT * 0.00001)
+        self.report('%s dispatch' % name,
+                    self.time_function(self.dispatch_all, scheduler),
+                    timeouts=self.TIMEOUT_COUNT)
+        self.assertEquals(len(scheduler.heap), 0)
+
+    def test_scheduler(self):
+        self.check_scheduler('heap', HeapScheduler())
+        self.check_scheduler('Scheduler', eventloop.Scheduler())
+
+class WorkerProcessPerformanceTest(PerformanceTestCase):
+    """Measure how MutagenTask throughput scales with more worker processes.
+    """
+    FILE_COUNT = 2000
+
+    def setUp(self):
+        PerformanceTestCase.setUp(self)
+        # build a corpus of audio files by copying our test files
+        source_dir = resources.path("testdata/metadata")
+        source_paths = [os.path.join(source_dir, name)
+                        for name in ('mp3-0.mp3', 'mp3-1.mp3', 'mp3-2.mp3')]
+        corpus_dir = os.path.join(self.tempdir, 'corpus')
+        os.mkdir(corpus_dir)
+        self.cover_art_dir = os.path.join(self.tempdir, 'cover-art')
+        os.mkdir(self.cover_art_dir)
+        self.paths = []
+        for i in xrange(self.FILE_COUNT):
+            path = os.path.join(corpus_dir, 'track-%s.mp3' % i)
+            shutil.copyfile(source_paths[i % len(source_paths)], path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        workerprocess.shutdown()
+        PerformanceTestCase.tearDown(self)
+
+    def task_done(self, msg, result):
+        self.finished_count += 1
+        if self.finished_count == len(self.paths):
+            self.stopEventLoop(abnormal=False)
+
+    def run_tasks(self):
+        self.finished_count = 0
+        for path in self.paths:
+            workerprocess.send(workerprocess.MutagenTask(path,
+                                                         self.cover_art_dir),
+                               self.task_done, self.task_done)
+        self.runEventLoop(600)
+
+    def check_process_count(self, process_count):
+        workerprocess.startup(process_count=process_count)
+        try:
+            seconds = self.time_function(self.run_tasks)
+            throughput = ', '.join('%.1f' % s['tasks_per_second']
+                                   for s in workerprocess.get_stats())
+        finally:
+            workerprocess.shutdown()
+        self.report('MutagenTask', seconds, files=len(self.paths),
+                    processes=process_count,
+                    files_per_sec=int(len(self.paths) / seconds),
+                    per_process_tasks_per_sec='[%s]' % throughput)
+
+    def test_mutagen_task(self):
+        for process_count in (1, 2, 4, 8):
+            self.check_process_count(process_count)
+
+class _CountingPipe(object):
+    """Wraps a pipe and counts the bytes written to it."""
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.byte_count = 0
+
+    def write(self, data):
+        self.byte_count += len(data)
+        self.pipe.write(data)
+
+    def flush(self):
+        self.pipe.flush()
+
+def _dump_obj_protocol_0(obj, pipe):
+    """The old subprocessmanager._dump_obj()."""
+    pickle_data = pickle.dumps(obj)
+    pipe.write(struct.pack("Q", len(pickle_data)))
+    pipe.write(pickle_data)
+    pipe.flush()
+
+class SubprocessPipePerformanceTest(PerformanceTestCase):
+    """Measure messages per second and bytes per message for our subprocess
+    pipes.
+    """
+    MESSAGE_COUNT = 20000
+    BATCH_SIZE = 50
+
+    def make_messages(self):
+        messages = []
+        for i in xrange(self.MESSAGE_COUNT):
+            if i % 2:
+                messages.append(workerprocess.MutagenTask(
+                    u'/home/user/Music/track-%s.mp3' % i,
+                    u'/home/user/.miro/cover-art'))
+            else:
+                messages.append(workerprocess.TaskResult(i, {
+                    'file_type': u'audio',
+                    'duration': 215000,
+                    'title': u'Track %s' % i,
+                    'artist': u'Some Artist',
+                    'album': u'Some Album',
+                    'track': i % 12,
+                }))
+        return messages
+
+    def send_messages(self, write_func):
+        read_fd, write_fd = os.pipe()
+        read_pipe = os.fdopen(read_fd, 'rb', 0)
+        write_pipe = _CountingPipe(os.fdopen(write_fd, 'wb', 0))
+        received = []
+        def reader():
+            received.extend(subprocessmanager._read_from_pipe(read_pipe))
+        thread = threading.Thread(target=reader)
+        thread.start()
+        messages = self.make_messages()
+        start = time.time()
+        write_func(messages, write_pipe)
+        subprocessmanager._dump_obj(None, write_pipe)
+        thread.join()
+        seconds = time.time() - start
+        write_pipe.pipe.close()
+        read_pipe.close()
+        self.assertEquals(len(received), len(messages))
+        return seconds, write_pipe.byte_count
+
+    def check_write_func(self, name, write_func):
+        seconds, byte_count = self.send_messages(write_func)
+        self.report(name, seconds, messages=self.MESSAGE_COUNT,
+                    messages_per_sec=int(self.MESSAGE_COUNT / seconds),
+                    bytes_per_message=byte_count // self.MESSAGE_COUNT)
+
+    def write_protocol_0(self, messages, pipe):
+        for msg in messages:
+            _dump_obj_protocol_0(msg, pipe)
+
+    def write_single(self, messages, pipe):
+        for msg in messages:
+            subprocessmanager._dump_obj(msg, pipe)
+
+    def write_batched(self, messages, pipe):
+        for i in xrange(0, len(messages), self.BATCH_SIZE):
+            subprocessmanager._dump_objs(messages[i:i+self.BATCH_SIZE], pipe)
+
+    def test_pipe(self):
+        self.check_write_func('pipe protocol 0', self.write_protocol_0)
+        self.check_write_func('pipe highest protocol', self.write_single)
+        self.check_write_func('pipe highest protocol batched',
+                              self.write_batched)
@@ -43,6 +43,63 @@ class SchedulerTest(EventLoopTest):
         end_time = time()
         self.assertAlmostEqual(start_time + 0.2, end_time, places=1)
 
+    def test_cancel(self):
+        dc = eventloop.add_timeout(0.1, self.callback, "foo")
+        eventloop.add_timeout(0.2, self.callback, "foo", kwargs={'stop': 1})
+        dc.cancel()
+        self.runEventLoop()
+        self.assertEquals(len(self.got_args), 1)
+
+    def test_canceled_timeouts_skipped(self):
+        scheduler = eventloop.Scheduler()
+        dc = scheduler.add_timeout(0, self.callback, "foo")
+        scheduler.add_timeout(10, self.callback, "bar")
+        dc.cancel()
+        # the canceled timeout shouldn't make us wake up early
+        self.assert_(scheduler.next_timeout() > 9)
+        self.assert_(not scheduler.has_pending_timeout())
+        self.assertEquals(len(scheduler.heap), 1)
+        self.assertEquals(scheduler.canceled_count, 0)
+
+    def test_compact(self):
+        scheduler = eventloop.Scheduler()
+        calls = [scheduler.add_timeout(i, self.callback, "foo")
+                 for i in xrange(100)]
+        for dc in calls[1:scheduler.COMPACT_MIN_CANCELED]:
+            dc.cancel()
+        # not enough canceled calls to compact yet
+        self.assertEquals(len(scheduler.heap), 100)
+        for dc in calls[scheduler.COMPACT_MIN_CANCELED:]:
+            dc.cancel()
+        self.assert_(len(scheduler.heap) < 100)
+        for entry in scheduler.heap:
+            if entry[2] is calls[0]:
+                break
+        else:
+            raise AssertionError("live timeout removed")
+        # canceling a call twice shouldn't mess up our count
+        canceled_count = scheduler.canceled_count
+        calls[1].cancel()
+        self.assertEquals(scheduler.canceled_count, canceled_count)
+
+    def test_pop_due_timeouts(self):
+        scheduler = eventloop.Scheduler()
+        first = scheduler.add_timeout(0, self.callback, "foo")
+        canceled = scheduler.add_timeout(0, self.callback, "foo")
+        second = scheduler.add_timeout(0, self.callback, "foo")
+        later = scheduler.add_timeout(10, self.callback, "foo")
+        canceled.cancel()
+        sleep(0.01)
+        # timeouts for the same time should run in the order they were
+        # added
+        self.assertEquals(scheduler.pop_due_timeouts(), [first, second])
+        self.assertEquals(scheduler.pop_due_timeouts(), [])
+        self.assertEquals(len(scheduler.heap), 1)
+        # canceling a call that's already been popped shouldn't count
+        # towards compacting the heap
+        first.cancel()
+        self.assertEquals(scheduler.canceled_count, 0)
+
     def test_lots_of_threads(self):
         timeouts = [0, 0, 0.1, 0.2, 0.3]
         threadCount = 8
@@ -57,3 +114,142 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class ThreadPoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.pool = eventloop._eventloop.threadpool
+        self.pool.set_size(2, 6)
+        eventloop.thread_pool_stats.clear()
+        self.release_slow_tasks = threading.Event()
+        self.fast_results = []
+
+    def tearDown(self):
+        self.release_slow_tasks.set()
+        self.pool.close_threads()
+        self.pool.set_size(eventloop.ThreadPool.THREADS,
+                           eventloop.ThreadPool.MAX_THREADS)
+        EventLoopTest.tearDown(self)
+
+    def slow_task(self):
+        self.release_slow_tasks.wait(5)
+
+    def fast_task(self, index):
+        sleep(0.01)
+        return index
+
+    def fast_callback(self, index):
+        self.fast_results.append(index)
+        if len(self.fast_results) == 20:
+            self.release_slow_tasks.set()
+            eventloop.shutdown()
+
+    def errback(self, error):
+        raise AssertionError("task failed: %s" % error)
+
+    def queue_fast_tasks(self):
+        for i in range(10):
+            eventloop.call_in_thread_with_priority(eventloop.PRIORITY_HIGH,
+                self.fast_callback, self.errback, self.fast_task,
+                'fast task', i)
+        for i in range(10, 20):
+            eventloop.call_in_thread(self.fast_callback, self.errback,
+                                     self.fast_task, 'normal task', i)
+
+    def test_slow_tasks_dont_block_fast_ones(self):
+        # Fill the pool with slow tasks, then check that fast tasks still
+        # run without waiting for them.
+        for i in range(30):
+            eventloop.call_in_thread_with_priority(eventloop.PRIORITY_LOW,
+                lambda result: None, self.errback, self.slow_task,
+                'slow task')
+        eventloop.add_timeout(0.1, self.queue_fast_tasks, 'queue fast tasks')
+        self.runEventLoop()
+        self.assertEquals(sorted(self.fast_results), range(20))
+        # Without the reserved threads, the fast tasks would wait until the
+        # slow tasks were released.
+        fast_stats = eventloop.thread_pool_stats['fast task']
+        self.assertEquals(fast_stats.queue_wait.count, 10)
+        self.assert_(fast_stats.queue_wait.max < 0.5)
+        normal_stats = eventloop.thread_pool_stats['normal task']
+        self.assertEquals(normal_stats.run_time.count, 10)
+        self.assert_(normal_stats.queue_wait.max < 0.5)
+        self.assert_(len(self.pool.threads) <= 6)
+
+    def test_resize(self):
+        self.pool.IDLE_TIMEOUT = 0.1
+        self.pool.set_size(1, 4)
+        self.pool.init_threads()
+        self.assertEquals(len(self.pool.threads), 1)
+        for i in range(4):
+            self.pool.queue_call_with_priority(eventloop.PRIORITY_HIGH,
+                lambda result: None, self.errback, self.slow_task,
+                'slow task')
+        self.assertEquals(len(self.pool.threads), 4)
+        self.release_slow_tasks.set()
+        for i in range(20):
+            if self.pool.busy_count == 0:
+                break
+            sleep(0.1)
+        # idle threads block without a timeout, they don't exit until
+        # retire_idle_threads() runs from the event loop
+        sleep(0.2)
+        self.assertEquals(len(self.pool.threads), 4)
+        self.assert_(self.pool.retire_check is not None)
+        self.pool.retire_idle_threads()
+        # idle threads should exit until we're back to the minimum
+        for i in range(20):
+            if len(self.pool.threads) == 1:
+                break
+            sleep(0.1)
+        self.assertEquals(len(self.pool.threads), 1)
+        self.assertEquals(self.pool.retire_check, None)
+        stats = eventloop.thread_pool_stats['slow task']
+        self.assertEquals(stats.run_time.count, 4)
+
+class EventLoopProfilerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.profiler = eventloop.profiler
+        self.profiler.reset()
+
+    def tearDown(self):
+        self.profiler.disable()
+        self.profiler.reset()
+        EventLoopTest.tearDown(self)
+
+    def test_percentile(self):
+        stats = eventloop.SampleStats()
+        self.assertEquals(stats.percentile(50), None)
+        for i in range(101):
+            stats.add(i)
+        self.assertEquals(stats.count, 101)
+        self.assertEquals(stats.total, 5050)
+        self.assertEquals(stats.max, 100)
+        self.assertEquals(stats.percentile(50), 50)
+        self.assertEquals(stats.percentile(95), 95)
+        self.assertEquals(stats.percentile(99), 99)
+
+    def test_disabled_by_default(self):
+        eventloop.add_idle(lambda: None, "foo")
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stop")
+        self.runEventLoop()
+        self.assertEquals(self.profiler.callbacks, {})
+        self.assertEquals(self.profiler.loop_latency.count, 0)
+
+    def test_record_callbacks(self):
+        self.profiler.enable()
+        for i in range(3):
+            eventloop.add_idle(lambda: None, "foo")
+        eventloop.add_urgent_call(lambda: None, "bar")
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stop")
+        self.runEventLoop()
+        callbacks = self.profiler.callbacks
+        self.assertEquals(callbacks['idle', 'idle (foo)'].count, 3)
+        self.assertEquals(callbacks['urgent', 'idle (bar)'].count, 1)
+        self.assertEquals(callbacks['timeout', 'timeout (stop)'].count, 1)
+        self.assert_(self.profiler.loop_latency.count > 0)
+        self.assert_(self.profiler.idle_queue_depth.max >= 3)
+        # make sure report() doesn't choke on the data
+        report = self.profiler.report()
+        self.assert_('idle (foo)' in '\n'.join(report))
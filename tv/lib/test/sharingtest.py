@@ -28,16 +28,23 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro import sharing
+import gzip
+import httplib
 import os
+import threading
+import time
+from StringIO import StringIO
 
 import sqlite3
 
 from miro import app
+from miro import libdaap
 from miro import messages
 from miro import messagehandler
 from miro import models
 from miro import prefs
 from miro import startup
+from miro import transcode
 from miro.data import mappings
 from miro.test import mock
 from miro.test import testobjects
@@ -489,6 +496,31 @@ class SharingServerTest(EventLoopTest):
         self.check_daap_list(self.backend.get_items(), new_item_list)
         self.check_daap_item_deleted(self.backend.get_items(), removed)
 
+    def test_items_changed_since(self):
+        self.setup_sharing_manager_backend()
+        initial_revision = self.backend.data_set.revision
+        added = self.video_items[0]
+        added.set_user_metadata({'file_type': u'audio'})
+        added.signal_change()
+        changed = self.audio_items[0]
+        changed.set_user_metadata({'title': u'New title'})
+        changed.signal_change()
+        removed = self.audio_items[-1]
+        removed.remove()
+        self.send_changes_from_trackers()
+        # only the items that changed should be returned
+        changes = self.backend.get_items(since_revision=initial_revision)
+        self.assertSameSet(changes.keys(), [added.id, changed.id, removed.id])
+        self.check_daap_list(changes, [added, changed])
+        self.check_daap_item_deleted(changes, removed)
+        # test filtering by playlist
+        changes = self.backend.get_items(self.audio_playlist.id,
+                                         since_revision=initial_revision)
+        self.check_daap_list(changes, [changed])
+        # test no changes
+        self.assertEquals(self.backend.get_items(
+            since_revision=self.backend.data_set.revision), {})
+
     def test_feed_changes(self):
         self.setup_sharing_manager_backend()
         initial_revision = self.backend.data_set.revision
@@ -621,3 +653,345 @@ class SharingServerTest(EventLoopTest):
     # FIXME: implement this
     # def test_get_file(self):
         # pass
+
+class FakeDaapRequestHandler(libdaap.DaapHttpRequestHandler):
+    """DaapHttpRequestHandler that doesn't handle a real request."""
+    def __init__(self, server):
+        self.server = server
+
+class DaapItemListTest(MiroTestCase):
+    """Test the item listings that libdaap sends."""
+    META = 'dmap.itemid,dmap.itemname,daap.songtime'
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.items = {}
+        self.server = mock.Mock()
+        self.server.backend.get_items.side_effect = self.get_items
+        self.server.item_cache = libdaap.EncodedItemCache()
+        self.handler = FakeDaapRequestHandler(self.server)
+
+    def get_items(self, playlist_id=None, since_revision=0):
+        return dict((k, v) for k, v in self.items.items()
+                    if v['revision'] > since_revision)
+
+    def set_item(self, item_id, name, revision, valid=True):
+        self.items[item_id] = {
+            'dmap.itemid': item_id,
+            'dmap.itemname': name,
+            'daap.songtime': None,
+            'revision': revision,
+            'valid': valid,
+        }
+
+    def list_items(self, delta=0):
+        """Get an item listing
+
+        :returns: (items, deleted) tuple.  items maps item ids to a list of
+        (code, value) tuples.  deleted is a list of deleted item ids.
+        """
+        query = {
+            'meta': self.META,
+            'revision-number': '10',
+            'delta': str(delta),
+        }
+        rcode, reply, headers = self.handler.do_itemlist([], query)
+        self.assertEquals(rcode, libdaap.DAAP_OK)
+        data = str(libdaap.encode_response(reply))
+        decoded = libdaap.decode_response(data)
+        listing = libdaap.find_daap_tag('mlcl', decoded) or []
+        items = dict((dict(item)['miid'], item)
+                     for item in libdaap.find_daap_listitems(listing))
+        deleted = libdaap.find_daap_tag('mudl', decoded) or []
+        return items, libdaap.find_daap_listitems(deleted)
+
+    def test_full_listing(self):
+        self.set_item(1, 'one', 1)
+        self.set_item(2, 'two', 2)
+        items, deleted = self.list_items()
+        # mikd must come first, then the meta in the order requested.  None
+        # values shouldn't be sent.
+        self.assertEquals(items, {
+            1: [('mikd', libdaap.DAAP_ITEMKIND_AUDIO), ('miid', 1),
+                ('minm', 'one')],
+            2: [('mikd', libdaap.DAAP_ITEMKIND_AUDIO), ('miid', 2),
+                ('minm', 'two')],
+        })
+        self.assertEquals(deleted, [])
+
+    def test_delta_listing(self):
+        self.set_item(1, 'one', 1)
+        self.set_item(2, 'two', 1)
+        self.list_items()
+        self.set_item(2, 'new two', 2)
+        self.set_item(3, 'three', 2)
+        items, deleted = self.list_items(delta=1)
+        self.assertSameSet(items.keys(), [2, 3])
+        # The cached data for item 2 should have been thrown away
+        self.assertEquals(dict(items[2])['minm'], 'new two')
+        # the full listing should have the new data too
+        items, deleted = self.list_items()
+        self.assertEquals(dict(items[1])['minm'], 'one')
+        self.assertEquals(dict(items[2])['minm'], 'new two')
+
+    def test_deleted(self):
+        self.set_item(1, 'one', 1)
+        self.set_item(2, 'two', 1)
+        self.list_items()
+        self.set_item(2, 'two', 2, valid=False)
+        items, deleted = self.list_items(delta=1)
+        self.assertEquals(items, {})
+        self.assertEquals(deleted, [2])
+        self.assertEquals(self.server.item_cache.entries.keys(), [1])
+
+    def test_gzip(self):
+        self.set_item(1, 'one', 1)
+        rcode, reply, headers = self.handler.do_itemlist([], {})
+        plain = str(libdaap.encode_response(reply))
+        blob = libdaap.encode_response(reply, content_encoding='gzip')
+        data = ''.join(blob)
+        self.assertEquals(len(blob), len(data))
+        gzip_file = gzip.GzipFile(fileobj=StringIO(data))
+        self.assertEquals(gzip_file.read(), plain)
+
+class DaapStreamTest(MiroTestCase):
+    """Test streaming files from the DAAP server."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.data = ''.join(chr(i % 256) for i in xrange(300000))
+        self.path = os.path.join(self.tempdir, 'test.mp3')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.backend = mock.Mock()
+        self.backend.get_file.side_effect = self.get_file
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        MiroTestCase.tearDown(self)
+
+    def get_file(self, itemid, generation, ext, session, request_path_func,
+                 offset=0, chunk=None):
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(offset, os.SEEK_SET)
+        return file_obj, os.path.basename(self.path)
+
+    def start_server(self, pool_size=0):
+        self.server = libdaap.make_daap_server(self.backend, port=0,
+                                               pool_size=pool_size)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def fetch(self, range_header=None):
+        port = self.server.server_address[1]
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        try:
+            conn.request('GET', '/login')
+            reply = libdaap.decode_response(conn.getresponse().read())
+            session = libdaap.find_daap_tag('mlid', reply)
+            headers = {}
+            if range_header:
+                headers['Range'] = range_header
+            conn.request('GET', '/databases/1/items/1.mp3?session-id=%d' %
+                         session, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def check_stream(self):
+        status, body = self.fetch()
+        self.assertEquals(status, 200)
+        self.assertEquals(body, self.data)
+        status, body = self.fetch('bytes=1000-')
+        self.assertEquals(status, 206)
+        self.assertEquals(body, self.data[1000:])
+        status, body = self.fetch('bytes=1000-1999')
+        self.assertEquals(status, 206)
+        self.assertEquals(body, self.data[1000:2000])
+
+    def test_stream(self):
+        self.start_server()
+        self.check_stream()
+
+    def test_stream_without_sendfile(self):
+        self.patch_function('miro.libdaap.subr.ChunkedStreamObj.can_sendfile',
+                            lambda self: False)
+        self.start_server()
+        self.check_stream()
+
+    def test_thread_pool(self):
+        self.start_server(pool_size=2)
+        self.check_stream()
+
+class SegmentCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.cache = transcode.SegmentCache(self.cache_dir, 250)
+        self.path = os.path.join(self.tempdir, 'movie.avi')
+        open(self.path, 'wb').write('movie data')
+
+    def key(self, index):
+        return self.cache.media_key(self.path, 'profile') + (index,)
+
+    def add_segment(self, index, size=100):
+        self.cache.add(self.key(index), StringIO(str(index) * size))
+
+    def test_get(self):
+        self.assertEquals(self.cache.get(self.key(0)), None)
+        self.add_segment(0)
+        self.assertEquals(self.cache.get(self.key(0)).read(), '0' * 100)
+        stats = self.cache.get_stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hit_rate'], 0.5)
+        self.assertEquals(stats['bytes'], 100)
+
+    def test_lru_eviction(self):
+        self.add_segment(0)
+        self.add_segment(1)
+        # use segment 0, so segment 1 is the least recently used
+        self.cache.get(self.key(0)).close()
+        self.add_segment(2)
+        self.assert_(self.cache.contains(self.key(0)))
+        self.assert_(not self.cache.contains(self.key(1)))
+        self.assert_(self.cache.contains(self.key(2)))
+        stats = self.cache.get_stats()
+        self.assertEquals(stats['evictions'], 1)
+        self.assertEquals(stats['bytes'], 200)
+        self.assertEquals(len(os.listdir(self.cache_dir)), 2)
+
+    def test_file_changed(self):
+        self.add_segment(0)
+        mtime = os.stat(self.path).st_mtime
+        os.utime(self.path, (mtime + 10, mtime + 10))
+        self.assertEquals(self.cache.get(self.key(0)), None)
+
+    def test_disabled(self):
+        self.cache = transcode.SegmentCache(self.cache_dir, 0)
+        self.add_segment(0)
+        self.assertEquals(self.cache.get(self.key(0)), None)
+
+    def test_wait_for(self):
+        def add_segments():
+            # adding a different segment shouldn't end the wait
+            self.add_segment(1)
+            time.sleep(0.1)
+            self.add_segment(0)
+        thread = threading.Thread(target=add_segments)
+        thread.start()
+        try:
+            segment = self.cache.wait_for(self.key(0), 5.0)
+        finally:
+            thread.join()
+        self.assertEquals(segment.read(), '0' * 100)
+        self.assertEquals(self.cache.wait_for(self.key(2), 0.1), None)
+
+    def test_media_info(self):
+        info = (100, True, 'aac', 44100, False, None, None)
+        mock_needs_transcode = self.patch_for_test(
+            'miro.transcode.needs_transcode')
+        mock_needs_transcode.return_value = (True, info)
+        self.assertEquals(self.cache.get_media_info(self.path), info)
+        self.assertEquals(self.cache.get_media_info(self.path), info)
+        self.assertEquals(mock_needs_transcode.call_count, 1)
+
+class TranscodeFileTest(MiroTestCase):
+    """Test getting transcoded files from SharingManagerBackend."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'movie.avi')
+        open(self.path, 'wb').write('movie data')
+        # 100 seconds is 10 segments
+        self.media_info = (100, True, 'aac', 44100, False, None, None)
+        mock_needs_transcode = self.patch_for_test(
+            'miro.transcode.needs_transcode')
+        mock_needs_transcode.return_value = (True, self.media_info)
+        real_transcode_object = transcode.TranscodeObject
+        self.mock_transcode_object = self.patch_for_test(
+            'miro.transcode.TranscodeObject')
+        # the transcode module uses these class attributes
+        for name in ('segment_duration', 'output_args', 'segmenter_args',
+                     'buffer_high_watermark'):
+            setattr(self.mock_transcode_object, name,
+                    getattr(real_transcode_object, name))
+        self.backend = sharing.SharingManagerBackend()
+        self.backend.data_set._store_item(1, {
+            'path': self.path,
+            'revision': 1,
+            'valid': True,
+        })
+        self.cache = self.backend.segment_cache
+        profile = transcode.get_transcode_profile(self.media_info)
+        self.media_key = self.cache.media_key(self.path, profile)
+
+    def request_path(self, itemid, ext):
+        return 'daap://127.0.0.1:3689/databases/1/items/%d.%s?session-id=1' % (
+            itemid, ext)
+
+    def get_file(self, ext, chunk=None):
+        file_obj, name = self.backend.get_file(1, 0, ext, 1,
+                                               self.request_path,
+                                               chunk=chunk)
+        return file_obj
+
+    def add_segments(self, *indexes):
+        for index in indexes:
+            self.cache.add(self.media_key + (index,),
+                           StringIO('segment %d' % index))
+
+    def check_transcode_started(self, chunk):
+        self.assertEquals(self.mock_transcode_object.call_count, 1)
+        self.assertEquals(self.mock_transcode_object.call_args[0][3], chunk)
+        transcode_obj = self.mock_transcode_object.return_value
+        self.assertEquals(transcode_obj.transcode.call_count, 1)
+        self.mock_transcode_object.reset_mock()
+
+    def test_playlist(self):
+        playlist = self.get_file('m3u8').read()
+        self.assert_('chunk=9\n' in playlist)
+        self.assert_('chunk=10\n' not in playlist)
+        self.check_transcode_started(0)
+
+    def test_playlist_cached(self):
+        # If the first segments are cached, we should start transcoding
+        # after them
+        self.add_segments(0, 1, 2)
+        self.get_file('m3u8')
+        self.check_transcode_started(3)
+
+    def test_cached_segment(self):
+        self.add_segments(4)
+        self.assertEquals(self.get_file('ts', 4).read(), 'segment 4')
+        # we should start transcoding the segments after it
+        self.check_transcode_started(5)
+        self.assertEquals(self.cache.get_stats()['hits'], 1)
+
+    def test_all_cached(self):
+        self.add_segments(*range(10))
+        for i in range(10):
+            self.assertEquals(self.get_file('ts', i).read(), 'segment %d' % i)
+        self.assertEquals(self.mock_transcode_object.call_count, 0)
+
+    def test_uncached_segment(self):
+        transcode_obj = self.mock_transcode_object.return_value
+        transcode_obj.covers.return_value = True
+        transcode_obj.itemid = 1
+        transcode_obj.generation = 0
+        self.get_file('ts', 2)
+        transcode_obj.get_chunk.assert_called_with(2)
+        self.check_transcode_started(2)
+        # The next segment should come from the same transcode
+        self.get_file('ts', 3)
+        self.assertEquals(self.mock_transcode_object.call_count, 0)
+        transcode_obj.get_chunk.assert_called_with(3)
+        # If the transcode won't give us a segment soon, we should start a
+        # new one.
+        transcode_obj.covers.return_value = False
+        self.get_file('m3u8')
+        self.check_transcode_started(0)
@@ -278,6 +278,54 @@ class DeviceDBUpgradeTest(DBUpgradeTest):
                         os.path.join(device_mount, '.miro', 'sqlite'))
         self.db = devices.load_sqlite_database(device_mount, 1024)
 
+class ThumbnailPathUpgradeTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.connection = sqlite3.connect(':memory:')
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("CREATE TABLE item (id INTEGER PRIMARY KEY, "
+                            "cover_art TEXT, icon_cache_id INTEGER, "
+                            "screenshot TEXT)")
+        self.cursor.execute("CREATE TABLE icon_cache "
+                            "(id INTEGER PRIMARY KEY, url TEXT, "
+                            "filename TEXT)")
+
+    def tearDown(self):
+        self.connection.close()
+        MiroTestCase.tearDown(self)
+
+    def add_item(self, item_id, cover_art=None, icon_url=None,
+                 icon_filename=None, screenshot=None):
+        self.cursor.execute("INSERT INTO icon_cache (id, url, filename) "
+                            "VALUES (?, ?, ?)",
+                            (item_id, icon_url, icon_filename))
+        self.cursor.execute("INSERT INTO item (id, cover_art, icon_cache_id, "
+                            "screenshot) VALUES (?, ?, ?, ?)",
+                            (item_id, cover_art, item_id, screenshot))
+
+    def get_thumbnail_paths(self):
+        self.cursor.execute("SELECT id, thumbnail_path FROM item")
+        return dict(self.cursor.fetchall())
+
+    def test_upgrade(self):
+        existing = [unicode(self.make_temp_path('.jpg')) for i in range(3)]
+        missing = unicode(os.path.join(self.tempdir, 'missing.jpg'))
+        self.add_item(1, cover_art=missing, icon_filename=existing[0],
+                      screenshot=existing[1])
+        # IconCache.get_filename() uses local URLs over the filename
+        self.add_item(2, icon_url=u'file://' + existing[2],
+                      icon_filename=existing[0])
+        self.add_item(3, icon_url=u'http://example.com/icon.jpg',
+                      icon_filename=missing, screenshot=existing[1])
+        self.add_item(4, cover_art=missing, screenshot=missing)
+        databaseupgrade.upgrade204(self.cursor)
+        self.assertEquals(self.get_thumbnail_paths(), {
+            1: existing[0],
+            2: existing[2],
+            3: existing[1],
+            4: None,
+        })
+
 class FakeSchemaTest(StoreDatabaseTest):
     OBJECT_SCHEMAS = test_object_schemas
 
@@ -631,6 +679,49 @@ class CorruptReprTest(FakeSchemaTest):
         with self.allow_warnings():
             self.assertRaises(SyntaxError, self.reload_object, self.ben)
 
+class LazyRestoreTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        self.lee.id_code = 'abc'
+        self.lee.signal_change()
+        self.reload_database(self.save_path, schema_version=0,
+                object_schemas=self.OBJECT_SCHEMAS, lazy_restore=True)
+
+    def test_lazy_restore(self):
+        restored_lee = Human.get_by_id(self.lee.id)
+        # expensive columns shouldn't be converted until we access them
+        self.assertSameSet(restored_lee._lazy_columns.keys(),
+                ['friend_names', 'high_scores', 'stuff', 'id_code'])
+        self.assertEquals(restored_lee.name, u'lee')
+        self.assertEquals(restored_lee.high_scores,
+                {u'virtual bowling': 212})
+        self.assertEquals(restored_lee.id_code, 'abc')
+        self.assert_('high_scores' not in restored_lee._lazy_columns)
+        self.assertEquals(restored_lee.changed_attributes, set())
+
+    def test_update_lazy_object(self):
+        restored_lee = Human.get_by_id(self.lee.id)
+        restored_lee.name = u'new lee'
+        restored_lee.friend_names = [u'joe']
+        restored_lee.signal_change()
+        # unconverted values should be left alone
+        self.assert_('high_scores' in restored_lee._lazy_columns)
+        restored_lee = self.reload_object(restored_lee)
+        self.assertEquals(restored_lee.name, u'new lee')
+        self.assertEquals(restored_lee.friend_names, [u'joe'])
+        self.assertEquals(restored_lee.high_scores,
+                {u'virtual bowling': 212})
+
+    def test_lazy_malformed_data(self):
+        app.db.cursor.execute("UPDATE human SET stuff='{baddata' "
+                              "WHERE name='lee'")
+        restored_lee = Human.get_by_id(self.lee.id)
+        with self.allow_warnings():
+            self.assertEqual(restored_lee.stuff, 'testing123')
+        app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
+        row = app.db.cursor.fetchone()
+        self.assertEqual(row[0], "'testing123'")
+
 class ConverterTest(StoreDatabaseTest):
     def test_convert_repr(self):
         converter = storedatabase.SQLiteConverter()
@@ -226,6 +226,62 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+class PipeTest(EventLoopTest):
+    """Test the code that sends messages over our pipes."""
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.path = os.path.join(self.tempdir, 'pipe-data')
+        self.pipe = open(self.path, 'wb')
+
+    def read_messages(self):
+        self.pipe.close()
+        return list(subprocessmanager._read_from_pipe(open(self.path, 'rb')))
+
+    def test_batches(self):
+        subprocessmanager._dump_obj(SawEvent('one'), self.pipe)
+        subprocessmanager._dump_objs([SawEvent('two'), SawEvent('three')],
+                                     self.pipe)
+        subprocessmanager._dump_objs([SawEvent('four')], self.pipe)
+        subprocessmanager._dump_objs([SawEvent('five'), None], self.pipe)
+        # None should end the stream
+        subprocessmanager._dump_obj(SawEvent('six'), self.pipe)
+        events = [msg.event for msg in self.read_messages()]
+        self.assertEquals(events, ['one', 'two', 'three', 'four', 'five'])
+
+    def test_big_message(self):
+        # test a message bigger than our read buffer
+        big_event = 'a' * (subprocessmanager._PipeReader.MAX_BUFFER_SIZE * 2)
+        subprocessmanager._dump_obj(SawEvent('small'), self.pipe)
+        subprocessmanager._dump_obj(SawEvent(big_event), self.pipe)
+        subprocessmanager._dump_obj(SawEvent('small'), self.pipe)
+        subprocessmanager._dump_obj(None, self.pipe)
+        events = [msg.event for msg in self.read_messages()]
+        self.assertEquals(events, ['small', big_event, 'small'])
+
+    def test_truncated_data(self):
+        subprocessmanager._dump_obj(SawEvent('one'), self.pipe)
+        self.pipe.write('\xff' * 4)
+        self.assertRaises(subprocessmanager.LoadError, self.read_messages)
+
+    def test_message_proxy(self):
+        proxy = subprocessmanager.PipeMessageProxy(self.pipe)
+        proxy.handle(SawEvent('one'))
+        proxy.handle(SawEvent('two'))
+        proxy.handle(None)
+        events = [msg.event for msg in self.read_messages()]
+        self.assertEquals(events, ['one', 'two'])
+
+class Python26PipeTest(PipeTest):
+    # run the pipe tests without memoryview, like on Python 2.6
+    def setUp(self):
+        PipeTest.setUp(self)
+        self.old_memoryview = subprocessmanager._memoryview
+        subprocessmanager._memoryview = None
+
+    def tearDown(self):
+        subprocessmanager._memoryview = self.old_memoryview
+        PipeTest.tearDown(self)
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
     def handle_feedparser_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
@@ -299,15 +355,15 @@ class FeedParserTest(WorkerProcessTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(process_count=1)
+        member = workerprocess._subprocess_manager.members[0]
+        original_pid = member.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        member.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, member.process.pid)
         self.check_successful_result()
 
     def test_queue_before_start(self):
@@ -320,6 +376,49 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+class WorkerProcessPoolTest(WorkerProcessTest):
+    def setUp(self):
+        WorkerProcessTest.setUp(self)
+        self.results = []
+
+    def callback(self, msg, result):
+        self.results.append(msg)
+        if len(self.results) == self.task_count:
+            self.stopEventLoop(abnormal=False)
+
+    def send_slow_tasks(self, count):
+        self.task_count = count
+        for i in xrange(count):
+            workerprocess.send(SlowRunningTask(), self.callback,
+                               self.errback)
+
+    def test_tasks_spread_out(self):
+        workerprocess.startup(thread_count=1, process_count=2)
+        self.send_slow_tasks(8)
+        self.runEventLoop(10.0)
+        self.assertEquals(len(self.results), 8)
+        stats = workerprocess.get_stats()
+        self.assertEquals(len(stats), 2)
+        # both processes should have done their share of the work
+        for process_stats in stats:
+            self.assert_(process_stats['tasks_completed'] >= 2)
+            self.assertEquals(process_stats['tasks_in_progress'], 0)
+
+    def test_crash_one_process(self):
+        workerprocess.startup(thread_count=1, process_count=2)
+        crashed, other = workerprocess._subprocess_manager.members
+        crashed_pid = crashed.process.pid
+        other_pid = other.process.pid
+        self.send_slow_tasks(4)
+        crashed.process.terminate()
+        with self.allow_warnings():
+            self.runEventLoop(10.0)
+        # the tasks sent to the crashed process should get re-run
+        self.assertEquals(len(self.results), 4)
+        self.assertNotEqual(crashed.process.pid, crashed_pid)
+        # the other process shouldn't have been restarted
+        self.assertEquals(other.process.pid, other_pid)
+
 class MovieDataTest(WorkerProcessTest):
 
     def setUp(self):
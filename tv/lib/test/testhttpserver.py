@@ -5,6 +5,7 @@ The code here is based off of the standard SimpleHTTPServer code.
 
 
 import BaseHTTPServer
+import SocketServer
 import hashlib
 import cgi
 import os
@@ -12,6 +13,7 @@ import posixpath
 import urllib
 import socket
 import threading
+import time
 
 from miro.plat import utils
 from miro.plat import resources
@@ -55,19 +57,30 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if self.start_pos > 0:
                     f.seek(self.start_pos, os.SEEK_CUR)
                 if self.end_pos > 0:
-                    count = self.end_pos - self.start_pos
+                    # the end of a HTTP range is inclusive
+                    count = self.end_pos - max(self.start_pos, 0) + 1
                 else:
                     count = -1
                 data = f.read(count)
                 if self.server.pause_after >= 0:
                     data = data[:self.server.pause_after]
-                self.wfile.write(data)
+                if self.server.rate_limit is not None:
+                    self.write_slowly(data)
+                else:
+                    self.wfile.write(data)
             f.close()
         if self.server.close_connection:
             self.close_connection = 1
             self.rfile.close()
             self.wfile.close()
 
+    def write_slowly(self, data):
+        """Write data at rate_limit bytes/second."""
+        chunk_size = max(1, self.server.rate_limit / 10)
+        for pos in xrange(0, len(data), chunk_size):
+            self.wfile.write(data[pos:pos+chunk_size])
+            time.sleep(0.1)
+
     def do_GET(self):
         """Serve a GET request."""
         self.server.last_info = {
@@ -240,7 +253,7 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         fs = os.fstat(f.fileno())
         length = fs[6]
         if self.end_pos > 0:
-            length = min(self.end_pos, length)
+            length = min(self.end_pos + 1, length)
         if self.start_pos > 0:
             length -= self.start_pos
         if 'content-length' not in self.server.headers_to_send:
@@ -291,10 +304,20 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_error(self, *args):
         pass
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
 class HTTPServer(threading.Thread):
-    def __init__(self):
+    def __init__(self, threaded=False):
+        """Create an HTTPServer.
+
+        :param threaded: handle each connection in its own thread.  Use this
+            for tests that need several connections at once.
+        """
         threading.Thread.__init__(self)
         self.event = threading.Event()
+        self.threaded = threaded
 
     def start(self):
         threading.Thread.start(self)
@@ -312,7 +335,11 @@ class HTTPServer(threading.Thread):
         else:
             utils.finish_thread_loop(self)
             raise AssertionError("Can't find an open port")
-        self.httpserver = BaseHTTPServer.HTTPServer(('', self.port),
+        if self.threaded:
+            server_class = ThreadingHTTPServer
+        else:
+            server_class = BaseHTTPServer.HTTPServer
+        self.httpserver = server_class(('', self.port),
                 MiroHTTPRequestHandler)
         self.httpserver.allow_head = True
         self.httpserver.headers_to_send = []
@@ -320,6 +347,7 @@ class HTTPServer(threading.Thread):
         self.httpserver.close_connection = False
         self.httpserver.allow_resume = True
         self.httpserver.pause_after = -1
+        self.httpserver.rate_limit = None
         self.httpserver.custom_redirect_url = None
         self.event.set()
         try:
@@ -373,5 +401,9 @@ class HTTPServer(threading.Thread):
     def pause_after(self, bytes):
         self.httpserver.pause_after = bytes
 
+    def set_rate_limit(self, rate):
+        """Limit each connection to rate bytes/second."""
+        self.httpserver.rate_limit = rate
+
     def custom_redirect_url(self, url):
         self.httpserver.custom_redirect_url = url
@@ -45,13 +45,17 @@ class MockCache(util.Cache):
     the value passed in and a counter value, incremented each time a new value
     is made.
     """
-    def __init__(self, size):
-        util.Cache.__init__(self, size)
+    def __init__(self, size, max_bytes=None):
+        util.Cache.__init__(self, size, max_bytes)
         self.value_counter = itertools.count()
 
     def create_new_value(self, val, invalidator=None):
         return (val, self.value_counter.next())
 
+    def value_size(self, value):
+        # use the key as the size of the value
+        return value[0]
+
 class AutoFlushingStreamTest(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
@@ -1089,6 +1093,105 @@ class CacheTestCase(MiroTestCase):
         self.assertEquals(self.cache.get(1, invalidator=invalidator),
                           (1, 1))
 
+    def test_lru_get_updates_order(self):
+        self.cache.get(1)
+        self.cache.get(2)
+        # accessing 1 makes 2 the least recently used key
+        self.cache.get(1)
+        self.cache.get(3)
+        self.assertEquals(set(self.cache.keys()), set((1, 3)))
+        # invalidators for expired keys should be dropped too
+        self.assertEquals(set(self.cache.invalidators.keys()), set((1, 3)))
+
+    def test_max_bytes(self):
+        cache = MockCache(100, max_bytes=10)
+        cache.get(3)
+        cache.get(4)
+        cache.get(2)
+        self.assertEquals(cache.total_bytes, 9)
+        # adding 5 pushes us over max_bytes, 3 and 4 should be dropped
+        cache.get(5)
+        self.assertEquals(set(cache.keys()), set((2, 5)))
+        self.assertEquals(cache.total_bytes, 7)
+        cache.remove(2)
+        self.assertEquals(cache.total_bytes, 5)
+        # we always keep the newest value, even if it's too big by itself
+        cache.get(20)
+        self.assertEquals(list(cache.keys()), [20])
+        self.assertEquals(cache.total_bytes, 20)
+
+    def test_get_cached(self):
+        self.assertEquals(self.cache.get_cached(1), None)
+        self.assertEquals(self.cache.get_cached(1, 'default'), 'default')
+        # get_cached() shouldn't create values
+        self.assertEquals(list(self.cache.keys()), [])
+        self.cache.get(1)
+        self.assertEquals(self.cache.get_cached(1), (1, 0))
+        self.cache.set(2, 2, invalidator=lambda key: True)
+        self.assertEquals(self.cache.get_cached(2), None)
+
+    def test_stats(self):
+        self.cache.get(1)
+        self.cache.get(1)
+        self.cache.get(2)
+        self.cache.get(3)
+        stats = self.cache.stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 3)
+        self.assertEquals(stats['evictions'], 1)
+        self.assertEquals(stats['size'], 2)
+
+
+class Python26CacheTestCase(CacheTestCase):
+    # run the Cache tests using the OrderedDict stand-in for Python 2.6
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.patch_function('miro.util.OrderedDict', util._OrderedDict)
+        self.cache = MockCache(2)
+
+class OrderedDictTestCase(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.dict = util._OrderedDict()
+        for key in (3, 1, 2):
+            self.dict[key] = str(key)
+
+    def test_order(self):
+        self.assertEquals(self.dict.keys(), [3, 1, 2])
+        self.assertEquals(list(reversed(self.dict)), [2, 1, 3])
+        self.assertEquals(self.dict.items(), [(3, '3'), (1, '1'), (2, '2')])
+        self.assertEquals(list(self.dict.itervalues()), ['3', '1', '2'])
+        # setting an existing key doesn't move it
+        self.dict[3] = 'three'
+        self.assertEquals(self.dict.keys(), [3, 1, 2])
+        self.assertEquals(self.dict[3], 'three')
+        # but removing and re-adding one does
+        del self.dict[1]
+        self.dict[1] = 'one'
+        self.assertEquals(self.dict.keys(), [3, 2, 1])
+        self.assertEquals(self.dict.copy().keys(), [3, 2, 1])
+
+    def test_pop(self):
+        self.assertEquals(self.dict.pop(1), '1')
+        self.assertEquals(self.dict.pop(1, None), None)
+        self.assertRaises(KeyError, self.dict.pop, 1)
+        self.assertEquals(self.dict.keys(), [3, 2])
+        self.assertEquals(len(self.dict), 2)
+
+    def test_popitem(self):
+        self.assertEquals(self.dict.popitem(last=False), (3, '3'))
+        self.assertEquals(self.dict.popitem(), (2, '2'))
+        self.assertEquals(self.dict.popitem(), (1, '1'))
+        self.assertRaises(KeyError, self.dict.popitem)
+        self.dict[4] = '4'
+        self.assertEquals(self.dict.items(), [(4, '4')])
+
+    def test_clear(self):
+        self.dict.clear()
+        self.assertEquals(self.dict.keys(), [])
+        self.assertEquals(len(self.dict), 0)
+        self.dict[5] = '5'
+        self.assertEquals(self.dict.keys(), [5])
 
 class AlarmTestCase(MiroTestCase):
     @staticmethod
@@ -6,6 +6,7 @@ from miro import models
 from miro import signals
 from miro.test import mock
 from miro.test.framework import MiroTestCase, EventLoopTest
+from miro.test import testobjects
 from miro.plat import resources
 from miro.plat.utils import make_url_safe
 
@@ -72,6 +73,33 @@ class WatchedFolderTest(EventLoopTest):
         self.run_feed_update()
         self.check_items('a.mp3', 'b.mp3')
 
+    def test_scan_in_batches(self):
+        self.feed.actualFeed.SCAN_BATCH_SIZE = 2
+        filenames = ['%s.mp3' % c for c in 'abcde']
+        for filename in filenames:
+            self.copy_new_file(filename)
+        # each batch should be added separately, which means metadata
+        # processing can start before the scan finishes
+        mock_bulk_add = mock.MagicMock()
+        with mock.patch.object(app.local_metadata_manager, 'bulk_add',
+                               mock_bulk_add):
+            self.run_feed_update()
+        self.check_items(*filenames)
+        self.assertEquals(mock_bulk_add.call_count, 3)
+        # running the scan again shouldn't add anything
+        self.run_feed_update()
+        self.check_items(*filenames)
+
+    def test_skip_files_in_other_feeds(self):
+        self.copy_new_file('a.mp3')
+        self.copy_new_file('b.mp3')
+        # the file check should be case-insensitive
+        manual_feed = testobjects.make_manual_feed()
+        testobjects.make_file_item(manual_feed,
+                                   path=os.path.join(self.dir, 'A.MP3'))
+        self.run_feed_update()
+        self.check_items('b.mp3')
+
     def send_watcher_signal(self, signal, filename):
         self.directory_watcher.emit(signal, os.path.join(self.dir, filename))
 
@@ -93,6 +121,20 @@ class WatchedFolderTest(EventLoopTest):
         self.runPendingIdles()
         self.check_items('a.mp3', 'b.mp3', 'c.mp3')
 
+    def test_watcher_added_during_scan(self):
+        # make the scan yield after each file, so that the watcher update
+        # runs in the middle of it.
+        self.feed.actualFeed.SCAN_BATCH_SIZE = 1
+        filenames = ['%s.mp3' % c for c in 'abcde']
+        for filename in filenames:
+            self.copy_new_file(filename)
+        self.feed.update()
+        for filename in filenames:
+            self.send_watcher_signal("added", filename)
+        self.run_pending_timeouts()
+        self.runPendingIdles()
+        self.check_items(*filenames)
+
     def test_watcher_deleted(self):
         self.copy_new_file('a.mp3')
         self.copy_new_file('b.mp3')
@@ -34,11 +34,14 @@ import tempfile
 import re
 import os
 import select
+import shutil
 import socket
 import subprocess
 import sys
 import SocketServer
 import threading
+import time
+from hashlib import md5
 
 from miro import util
 from miro.plat.utils import (get_ffmpeg_executable_path, setup_ffmpeg_presets,
@@ -210,6 +213,245 @@ def needs_transcode(media_file):
     return (transcode, (seconds, has_audio, acodec, sample_rate,
                         has_video, vcodec, size))
 
+def get_codec_args(media_info):
+    """Get the ffmpeg codec arguments to transcode a file.
+
+    :param media_info: info tuple returned by needs_transcode()
+    """
+    d, has_audio, acodec, rate, has_video, vcodec, size = media_info
+    args = []
+    if has_video:
+        if video_can_copy(vcodec, size):
+            args += get_transcode_video_copy_options()
+        else:
+            args += get_transcode_video_options()
+    if has_audio:
+        if (valid_av_combo(vcodec, acodec) and
+          audio_can_copy(acodec, rate)):
+            args += get_transcode_audio_copy_options()
+        else:
+            args += get_transcode_audio_options()
+    return args
+
+def get_transcode_profile(media_info):
+    """Get a string that identifies how a file gets transcoded.
+
+    Segments transcoded with the same profile from the same file are the
+    same, so this is part of the key for SegmentCache.
+    """
+    return ' '.join(get_codec_args(media_info) +
+                    TranscodeObject.output_args +
+                    TranscodeObject.segmenter_args)
+
+def get_chunk_count(media_info):
+    """Estimate how many segments a transcode will have.
+
+    :returns: (chunk count, duration of the last chunk) tuple.  The duration
+    of the last chunk is 0 if it's a full segment.
+    """
+    duration = media_info[0]
+    nchunks = duration / TranscodeObject.segment_duration
+    trailer = duration % TranscodeObject.segment_duration
+    if trailer:
+        nchunks += 1
+    return nchunks, trailer
+
+def build_playlist(media_info, itemid, request_path_func):
+    """Build the m3u8 playlist for a transcode.
+
+    :param media_info: info tuple returned by needs_transcode().  Only the
+    duration is used.
+    """
+    nchunks, trailer = get_chunk_count(media_info)
+    parts = []
+    parts.append('#EXTM3U\n')
+    parts.append('#EXT-X-TARGETDURATION:%d\n' %
+                 TranscodeObject.segment_duration)
+    parts.append('#EXT-X-MEDIA-SEQUENCE:0\n')
+    parts.append('#EXT-X-ALLOW-CACHE:NO\n')
+    urlpath = request_path_func(itemid, 'ts')
+    # This returns us a pedantically correct path but we want to be
+    # able to use http, which is understood by everybody and is 
+    # what's used by the underlying.
+    urlpath = urlpath.replace('daap://', 'http://')
+    for i in xrange(nchunks):
+        # XXX check corner case
+        # Special case
+        if i == (nchunks - 1) and trailer:
+            chunk_duration = trailer
+        else:
+            chunk_duration = TranscodeObject.segment_duration
+        parts.append('#EXTINF:%d,\n' % chunk_duration)
+        # Append our chunk XXX - bad way to append a query like this
+        parts.append(urlpath + '&chunk=%d\n' % i)
+    parts.append('#EXT-X-ENDLIST\n')
+    return ''.join(parts)
+
+def make_temp_file(data):
+    tmpf = tempfile.TemporaryFile()
+    tmpf.write(data)
+    tmpf.flush()
+    tmpf.seek(0, os.SEEK_SET)
+    return tmpf
+
+class SegmentCache(object):
+    """Disk-backed cache of transcoded segments.
+
+    The cache is shared by all sharing sessions.  Segments are keyed by
+    (path, mtime, profile, segment index), so if the file changes or we
+    transcode it differently we won't find the old segments.
+
+    The least recently used segments get thrown away once the cache goes over
+    max_bytes.  We also keep the results of needs_transcode(), so that
+    building the m3u8 playlist for a file we've seen before doesn't need to
+    run ffmpeg.
+
+    The cache directory is cleared when the cache is created, since the index
+    only lives in memory.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # signaled when a segment is added
+        self.condition = threading.Condition(self.lock)
+        # maps keys to (filename, size), least recently used first
+        self.segments = util.OrderedDict()
+        # maps (path, mtime) to needs_transcode() results
+        self.media_info = dict()
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.segments = util.OrderedDict()
+            self.media_info = dict()
+            self.total_bytes = 0
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def media_key(self, path, profile):
+        """Get the key for a transcode of a file.
+
+        Add the segment index to the end to get the key for a segment.
+        """
+        return (path, os.stat(path).st_mtime, profile)
+
+    def get_media_info(self, path):
+        """Get the needs_transcode() info for a file."""
+        key = (path, os.stat(path).st_mtime)
+        with self.lock:
+            try:
+                return self.media_info[key]
+            except KeyError:
+                pass
+        yes, info = needs_transcode(path)
+        with self.lock:
+            self.media_info[key] = info
+        return info
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.segments
+
+    def get(self, key):
+        """Get a segment.
+
+        :returns: file object for the segment, or None if it isn't cached
+        """
+        with self.lock:
+            try:
+                filename, size = self.segments.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.segments[key] = (filename, size)
+            self.hits += 1
+        try:
+            return open(filename, 'rb')
+        except IOError:
+            with self.lock:
+                self._remove(key)
+            return None
+
+    def wait_for(self, key, timeout):
+        """Wait for another transcode to add a segment.
+
+        :returns: file object for the segment, or None if it didn't show up
+        in time
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            # the condition gets notified for every segment that's added, so
+            # keep waiting until ours shows up
+            while key not in self.segments:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+        return self.get(key)
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def add(self, key, file_obj):
+        """Copy a segment into the cache.
+
+        file_obj gets rewound to the start afterwards.
+        """
+        if not self.enabled():
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        filename = os.path.join(self.directory,
+                                md5(repr(key)).hexdigest() + '.ts')
+        file_obj.seek(0, os.SEEK_SET)
+        with open(filename, 'wb') as f:
+            shutil.copyfileobj(file_obj, f)
+            size = f.tell()
+        file_obj.seek(0, os.SEEK_SET)
+        with self.lock:
+            self._remove(key, delete_file=False)
+            self.segments[key] = (filename, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+                oldest = iter(self.segments).next()
+                self._remove(oldest)
+                self.evictions += 1
+            self.condition.notify_all()
+
+    def _remove(self, key, delete_file=True):
+        try:
+            filename, size = self.segments.pop(key)
+        except KeyError:
+            return
+        self.total_bytes -= size
+        if delete_file:
+            try:
+                os.remove(filename)
+            except OSError, e:
+                # On windows we can't remove a file that is being served.
+                # It'll get cleaned up next time the cache is created.
+                logging.debug('SegmentCache: error removing %s: %s',
+                              filename, e)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            if lookups:
+                hit_rate = float(self.hits) / lookups
+            else:
+                hit_rate = 0.0
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': hit_rate,
+                'evictions': self.evictions,
+                'segments': len(self.segments),
+                'bytes': self.total_bytes,
+            }
+
 class TranscodeSinkServer(SocketServer.TCPServer):
     pass
 
@@ -292,13 +534,19 @@ class TranscodeObject(object):
     buffer_high_watermark = 6
 
     def __init__(self, media_file, itemid, generation, chunk, media_info,
-                 request_path_func):
+                 request_path_func, segment_cache=None):
         self.media_file = media_file
+        # Finished segments get copied here
+        self.segment_cache = segment_cache
+        self.profile = get_transcode_profile(media_info)
+        if segment_cache is not None:
+            self.cache_key = segment_cache.media_key(media_file, self.profile)
         self.in_shutdown = False
         if chunk is not None:
             self.time_offset = chunk * TranscodeObject.segment_duration
         else:
             self.time_offset = 0
+        self.media_info = media_info
         d, a, acodec, rate, v, vcodec, siz = media_info
         self.generation = generation
         self.duration = d
@@ -324,10 +572,7 @@ class TranscodeObject(object):
 
         # note: nchunks is an estimate only.  We don't know how many
         # chunks there are until we do the actual segmentation.
-        self.nchunks = self.duration / TranscodeObject.segment_duration
-        self.trailer = self.duration % TranscodeObject.segment_duration
-        if self.trailer:
-            self.nchunks += 1
+        self.nchunks, self.trailer = get_chunk_count(media_info)
         logging.debug('TRANSCODE INFO, duration %s' % self.duration)
         logging.debug('TRANSCODE INFO, nchunks %s' % self.nchunks)
         logging.debug('TRANSCODE INFO, trailer %s' % self.trailer)
@@ -336,6 +581,9 @@ class TranscodeObject(object):
             self.current_chunk = self.start_chunk = chunk
         else:
             self.current_chunk = self.start_chunk = 0
+        # index of the next segment that the segmenter will give us
+        self.next_chunk = self.start_chunk
+        # list of (index, file) tuples for segments that haven't been sent
         self.chunk_buffer = []
         self.chunk_throttle = threading.Event()
         self.chunk_throttle.set()
@@ -353,42 +601,49 @@ class TranscodeObject(object):
         self.shutdown()
 
     def create_playlist(self):
-        self.playlist = ''
-        self.playlist += '#EXTM3U\n'
-        self.playlist += ('#EXT-X-TARGETDURATION:%d\n' % 
-                          TranscodeObject.segment_duration)
-        self.playlist += '#EXT-X-MEDIA-SEQUENCE:0\n'
-        self.playlist += '#EXT-X-ALLOW-CACHE:NO\n'
-        for i in xrange(self.nchunks):
-            # XXX check corner case
-            # Special case
-            if i == (self.nchunks - 1) and self.trailer:
-                chunk_duration = self.trailer
-            else:
-                chunk_duration = self.segment_duration
-            self.playlist += '#EXTINF:%d,\n' % chunk_duration
-            urlpath = self.request_path_func(self.itemid, 'ts')
-            # This returns us a pedantically correct path but we want to be
-            # able to use http, which is understood by everybody and is 
-            # what's used by the underlying.
-            urlpath = urlpath.replace('daap://', 'http://')
-            # Append our chunk XXX - bad way to append a query like this
-            urlpath += '&chunk=%d' % i
-            self.playlist += urlpath + '\n'
-        self.playlist += '#EXT-X-ENDLIST\n'
+        self.playlist = build_playlist(self.media_info, self.itemid,
+                                       self.request_path_func)
 
     def get_playlist(self):
-        tmpf = tempfile.TemporaryFile()
-        tmpf.write(self.playlist)
-        tmpf.flush()
-        tmpf.seek(0, os.SEEK_SET)
-        return tmpf
-
-    def isseek(self, chunk):
-        # Is it requesting the next available chunk in the sequence?
-        if self.current_chunk == chunk:
-            return False
-        return True
+        return make_temp_file(self.playlist)
+
+    def covers(self, chunk):
+        """Will this transcode give us chunk soon?
+
+        True if the chunk is buffered, or if it's one of the next few the
+        segmenter will give us.  If this returns False the caller should
+        start a new transcode at chunk instead.
+        """
+        with self.chunk_lock:
+            if self.in_shutdown:
+                return False
+            if chunk in [index for index, tmpf in self.chunk_buffer]:
+                return True
+            if self.finished:
+                return False
+            return (self.next_chunk <= chunk <
+                    self.next_chunk + TranscodeObject.buffer_high_watermark)
+
+    def throttled(self):
+        """Is the transcode paused waiting for segments to be consumed?"""
+        return not self.chunk_throttle.is_set()
+
+    def discard_before(self, chunk):
+        """Throw away buffered segments before chunk.
+
+        Call this when the client got segments from somewhere else, so that
+        we keep transcoding ahead of it.
+        """
+        with self.chunk_lock:
+            self._discard_before(chunk)
+
+    def _discard_before(self, chunk):
+        while self.chunk_buffer and self.chunk_buffer[0][0] < chunk:
+            index, tmpf = self.chunk_buffer.pop(0)
+            tmpf.close()
+        self.current_chunk = max(self.current_chunk, chunk)
+        if len(self.chunk_buffer) < TranscodeObject.buffer_high_watermark:
+            self.chunk_throttle.set()
 
     def transcode(self):
         rc = True
@@ -403,25 +658,13 @@ class TranscodeObject(object):
                 logging.debug('transcode: start job @ %d' % self.time_offset)
                 args += TranscodeObject.time_offset_args + [
                     str(self.time_offset)]
-            video_needs_trancode = False
-            if self.has_video:
-                logging.debug('Video codec: %s', self.video_codec)
-                logging.debug('Video size: %s', self.video_size)
-                if video_can_copy(self.video_codec, self.video_size):
-                    args += get_transcode_video_copy_options()
-                else:
-                    args += get_transcode_video_options()
-                    video_needs_transcode = True
-            if self.has_audio:
-                logging.debug('Audio codec: %s', self.audio_codec)
-                logging.debug('Audio sample rate: %s', self.audio_sample_rate)
-                if (valid_av_combo(self.video_codec, self.audio_codec) and
-                  audio_can_copy(self.audio_codec, self.audio_sample_rate)):
-                    args += get_transcode_audio_copy_options()
-                else:
-                    args += get_transcode_audio_options()
-            else:
+            logging.debug('Video codec: %s', self.video_codec)
+            logging.debug('Video size: %s', self.video_size)
+            logging.debug('Audio codec: %s', self.audio_codec)
+            logging.debug('Audio sample rate: %s', self.audio_sample_rate)
+            if not self.has_audio:
                raise ValueError('no video or audio stream present')
+            args += get_codec_args(self.media_info)
 
             args += TranscodeObject.output_args
             logging.debug('Running command %s' % ' '.join(args))
@@ -465,7 +708,10 @@ class TranscodeObject(object):
                     self.finished = True
                 else:
                     self.tmp_file.seek(0, os.SEEK_SET)
-                    self.chunk_buffer.append(self.tmp_file)
+                    if self.segment_cache is not None:
+                        self.add_to_cache(self.next_chunk, self.tmp_file)
+                    self.chunk_buffer.append((self.next_chunk, self.tmp_file))
+                    self.next_chunk += 1
                     chunk_buffer_size = len(self.chunk_buffer)
                     if (chunk_buffer_size >= 
                       TranscodeObject.buffer_high_watermark):
@@ -480,6 +726,14 @@ class TranscodeObject(object):
             self.tmp_file = tempfile.TemporaryFile()
            
 
+    def add_to_cache(self, index, tmp_file):
+        try:
+            self.segment_cache.add(self.cache_key + (index,), tmp_file)
+        except (IOError, OSError), e:
+            logging.warning('TranscodeObject: error caching segment %d: %s',
+                            index, e)
+            tmp_file.seek(0, os.SEEK_SET)
+
     # Data consumer from segmenter.  Here, we listen for incoming request.
     # no need to handle quit signal - the sink should return a zero read
     # when the segmenter goes away.
@@ -503,28 +757,31 @@ class TranscodeObject(object):
             except StandardError:
                 raise
 
-    def get_chunk(self):
-        # End of transcode check: if the transcode returned not enough
-        # chunks, then send an empty file.
-        with self.chunk_lock:
-            if self.finished and not self.chunk_buffer:
-                return tempfile.TemporaryFile()
+    def get_chunk(self, chunk=None):
+        """Get a segment, waiting for the segmenter if needed.
 
-        # Consume an item
-        self.chunk_sem.acquire()
-        with self.chunk_lock:
-            # If we got woken up, and there is nothing there, maybe it's
-            # because the job has been aborted?  If this is the case,
-            # ensure we return a sensible empty file. (or maybe alternatively
-            # an error).
-            if self.chunk_buffer:
-                tmpf = self.chunk_buffer[0]
-                self.current_chunk += 1
-                self.chunk_buffer = self.chunk_buffer[1:]
-                self.chunk_throttle.set()
-            else:
-                tmpf = tempfile.TemporaryFile()
-        return tmpf
+        :param chunk: index of the segment to get, or None for the next one.
+        Only ask for chunks that covers() returns True for.
+        """
+        if chunk is None:
+            chunk = self.current_chunk
+        while True:
+            with self.chunk_lock:
+                self._discard_before(chunk)
+                if self.chunk_buffer and self.chunk_buffer[0][0] == chunk:
+                    index, tmpf = self.chunk_buffer.pop(0)
+                    self.current_chunk = chunk + 1
+                    self.chunk_throttle.set()
+                    return tmpf
+                # End of transcode check: if the transcode returned not
+                # enough chunks, or the job has been aborted, then send an
+                # empty file.  Same if the chunk has already been thrown
+                # away.
+                if (self.finished or self.in_shutdown or
+                        chunk < self.next_chunk):
+                    return tempfile.TemporaryFile()
+            # Wait for the next segment
+            self.chunk_sem.acquire()
 
     # Shutdown the transcode job.  If we quitting, make sure you call this
     # so the segmenter et al have a chance to clean up.
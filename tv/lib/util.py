@@ -38,7 +38,6 @@ from StringIO import StringIO
 import cgi
 import collections
 import contextlib
-import itertools
 import logging
 import os
 import random
@@ -1116,6 +1115,117 @@ class DebuggingTimer:
     def log_total_time(self):
         logging.timing("total time: %0.3f", clock() - self.start_time)
 
+class _OrderedDict(dict):
+    """Dict that remembers the order keys were added in.
+
+    This is a stand-in for collections.OrderedDict, which Python 2.6
+    doesn't have.  Keys are kept in a doubly linked list of
+    [prev, next, key] nodes, so adding, removing and popping from either
+    end are all O(1).
+    """
+    def __init__(self, other=(), **kwargs):
+        dict.__init__(self)
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._nodes = {}
+        self.update(other, **kwargs)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._nodes[key] = [last, root, key]
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        prev, next, key = self._nodes.pop(key)
+        prev[1] = next
+        next[0] = prev
+
+    def __iter__(self):
+        root = self._root
+        node = root[1]
+        while node is not root:
+            yield node[2]
+            node = node[1]
+
+    def __reversed__(self):
+        root = self._root
+        node = root[0]
+        while node is not root:
+            yield node[2]
+            node = node[0]
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+    def clear(self):
+        dict.clear(self)
+        self._root[:] = [self._root, self._root, None]
+        self._nodes.clear()
+
+    def copy(self):
+        return self.__class__(self)
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, 'keys'):
+            other = [(key, other[key]) for key in other.keys()]
+        for key, value in other:
+            self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+        elif default:
+            return default[0]
+        else:
+            raise KeyError(key)
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError('dictionary is empty')
+        if last:
+            key = self._root[0][2]
+        else:
+            key = self._root[1][2]
+        return key, self.pop(key)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+try:
+    OrderedDict = collections.OrderedDict
+except AttributeError:
+    # Python 2.6
+    OrderedDict = _OrderedDict
+
 def mtime_invalidator(path):
     """
     Returns a function which returns True if the mtime of path is greater than
@@ -1140,60 +1250,124 @@ def mtime_invalidator(path):
     return invalidator
 
 class Cache(object):
-    def __init__(self, size):
+    """Least recently used cache.
+
+    Subclasses implement create_new_value() to make values for keys that
+    aren't in the cache.  They can also implement value_size() to make the
+    cache limit the total size of its values, rather than just the number of
+    them.
+
+    :attribute hits: number of times get() returned a cached value
+    :attribute misses: number of times get() had to create a new value
+    :attribute evictions: number of values dropped to stay within our limits
+    """
+    def __init__(self, size, max_bytes=None):
+        """Create a Cache
+
+        :param size: max number of values to keep
+        :param max_bytes: max total of value_size() for the values we keep,
+        or None to only limit the number of values
+        """
         self.size = size
-        self.dict = {}
-        self.counter = itertools.count()
-        self.access_times = {}
+        self.max_bytes = max_bytes
+        # maps keys to values, the least recently used key first
+        self.dict = OrderedDict()
         self.invalidators = {}
+        self.value_sizes = {}
+        self.total_bytes = 0
+        self.reset_stats()
+
+    # sentinel for get_cached() to use when get() calls it
+    _MISSING = object()
 
     def get(self, key, invalidator=None):
+        value = self.get_cached(key, Cache._MISSING)
+        if value is Cache._MISSING:
+            value = self.create_new_value(key, invalidator=invalidator)
+            self.set(key, value, invalidator=invalidator)
+        return value
+
+    def get_cached(self, key, default=None):
+        """Get a value only if it's already in the cache.
+
+        :returns: the cached value, or default if there isn't one or its
+        invalidator says it's no longer valid
+        """
         if key in self.dict:
             existing_invalidator = self.invalidators[key]
             if (existing_invalidator is None or
                 not existing_invalidator(key)):
-                self.access_times[key] = self.counter.next()
-                return self.dict[key]
-
-        value = self.create_new_value(key, invalidator=invalidator)
-        self.set(key, value, invalidator=invalidator)
-        return value
+                self.hits += 1
+                # move key to the most recently used end
+                value = self.dict.pop(key)
+                self.dict[key] = value
+                return value
+        self.misses += 1
+        return default
 
     def set(self, key, value, invalidator=None):
-        if len(self.dict) == self.size:
-            self.shrink_size()
-        self.access_times[key] = self.counter.next()
+        self.remove(key)
         self.dict[key] = value
         self.invalidators[key] = invalidator
+        if self.max_bytes is not None:
+            size = self.value_size(value)
+            self.value_sizes[key] = size
+            self.total_bytes += size
+        self.shrink_size()
 
     def remove(self, key):
         if key in self.dict:
             del self.dict[key]
-            del self.access_times[key]
-        if key in self.invalidators:
             del self.invalidators[key]
+            self.total_bytes -= self.value_sizes.pop(key, 0)
 
     def keys(self):
         return self.dict.iterkeys()
 
     def shrink_size(self):
-        # shrink by LRU
-        to_sort = self.access_times.items()
-        to_sort.sort(key=lambda m: m[1])
-        new_dict = {}
-        new_access_times = {}
-        new_invalidators = {}
-        latest_times = to_sort[len(self.dict) // 2:]
-        for (key, time) in latest_times:
-            new_dict[key] = self.dict[key]
-            new_invalidators[key] = self.invalidators[key]
-            new_access_times[key] = time
-        self.dict = new_dict
-        self.access_times = new_access_times
+        """Drop least recently used values until we are within our limits.
+
+        We always keep the most recently used value, even if it's bigger
+        than max_bytes by itself.
+        """
+        while len(self.dict) > 1 and (len(self.dict) > self.size or
+                                      (self.max_bytes is not None and
+                                       self.total_bytes > self.max_bytes)):
+            key, value = self.dict.popitem(last=False)
+            del self.invalidators[key]
+            self.total_bytes -= self.value_sizes.pop(key, 0)
+            self.evictions += 1
+
+    def clear(self):
+        self.dict.clear()
+        self.invalidators.clear()
+        self.value_sizes.clear()
+        self.total_bytes = 0
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Get a dict that describes how well we are doing."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.dict),
+            'bytes': self.total_bytes,
+        }
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
 
+    def value_size(self, value):
+        """Get the size of a value for max_bytes accounting.
+
+        Only called if max_bytes was given.  Subclasses that use max_bytes
+        should override this.
+        """
+        return 0
+
 def all_subclasses(cls):
     """Find all subclasses of a given new-style class.
 
@@ -30,13 +30,17 @@
 """```workerprocess.py``` -- Miro worker subprocess
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to worker processes.  See #17328 for more details.  This includes
+feedparser, mutagen and movie data tasks.
+
+We run a pool of worker processes, by default one per CPU, so that things
+like importing a big library can use all of them.
 """
 
 from collections import deque, namedtuple
 import itertools
 import logging
+import multiprocessing
 import threading
 
 from miro import clock
@@ -322,6 +326,11 @@ class WorkerTaskQueue(object):
                 return None
             return self._get_next_task()
 
+    def get_next_task_nowait(self):
+        """Like get_next_task(), but return None instead of blocking."""
+        with self.condition:
+            return self._get_next_task()
+
     def _get_next_task(self):
         for queue in self.queues_by_priority:
             next_for_queue = queue.get_next_task()
@@ -385,16 +394,12 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, manager):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.manager = manager
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
-    def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
-
     def on_shutdown(self):
         # do the tasks that we've already gotten
         self.process_handler_queue()
@@ -404,7 +409,7 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
         self.worker_ready = False
 
     def handle_task_result(self, msg):
-        _miro_task_queue.process_result(msg)
+        self.manager.task_finished(msg)
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -438,7 +443,12 @@ class MiroTaskQueue(object):
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        except KeyError:
+            # CancelFileOperations gets sent to each worker process, so we
+            # can get multiple results for it.
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
@@ -451,15 +461,31 @@ class MiroTaskQueue(object):
 
 _miro_task_queue = MiroTaskQueue()
 
-# Manage subprocess
+# Manage subprocesses
 class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+    """Manages a single process in a WorkerProcessPool."""
+    def __init__(self, pool):
+        # Pass in None for the message class, since WorkerProcessPool handles
+        # WorkerMessages and decides which process to send them to.
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(self), pool.handler_class,
+                restart_delay=pool.restart_delay)
+        self.pool = pool
         self.check_hung_timeout = None
+        # maps task ids to the TaskMessages that we've sent to our process,
+        # but haven't gotten a result for yet.
+        self.tasks_in_progress = {}
+        self.tasks_completed = 0
+        self.created_time = clock.clock()
 
     def _start(self):
         subprocessmanager.SubprocessManager._start(self)
+        self.send_message(WorkerStartupInfo(self.pool.thread_count))
+        # if we are restarting after a crash, the old process took our tasks
+        # with it.  Give them back to the pool.
+        lost_tasks = self.tasks_in_progress.values()
+        self.tasks_in_progress = {}
+        self.pool.requeue_tasks(self, lost_tasks)
         self.schedule_check_subprocess_hung()
 
     def shutdown(self):
@@ -471,6 +497,27 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         self.responder.movie_data_task_status = None
         subprocessmanager.SubprocessManager.restart(self, clean)
 
+    def send_task(self, msg):
+        self.tasks_in_progress[msg.task_id] = msg
+        self.send_message(msg)
+
+    def send_tasks(self, messages):
+        for msg in messages:
+            self.tasks_in_progress[msg.task_id] = msg
+        self.send_messages(messages)
+
+    def task_finished(self, reply):
+        if self.tasks_in_progress.pop(reply.task_id, None) is not None:
+            self.tasks_completed += 1
+        self.pool.task_finished(self, reply)
+
+    def throughput(self):
+        """Get the number of tasks we've completed per second."""
+        elapsed = clock.clock() - self.created_time
+        if elapsed <= 0:
+            return 0.0
+        return self.tasks_completed / elapsed
+
     def schedule_check_subprocess_hung(self):
         self.check_hung_timeout = eventloop.add_timeout(90,
                 self.check_subprocess_hung, 'check workerprocess hung')
@@ -493,19 +540,170 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         else:
             self.schedule_check_subprocess_hung()
 
-_subprocess_manager = WorkerSubprocessManager()
+def default_process_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+class WorkerProcessPool(object):
+    """Runs TaskMessages in a pool of worker processes.
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    Tasks wait in a WorkerTaskQueue in the main process, which orders them
+    the same way the worker processes do.  We only send each process a few
+    tasks at a time.  When a process finishes a task, we send it the next
+    one from the queue, so slow tasks don't pile up on one process while the
+    others sit idle.
+
+    Each process gets restarted independently if it crashes or hangs.
+    """
+    def __init__(self):
+        WorkerMessage.install_handler(self)
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.thread_count = 3
+        self.members = []
+        self.task_queue = None
+        self.is_running = False
+
+    def start(self, process_count, thread_count):
+        if self.is_running:
+            return
+        self.thread_count = thread_count
+        # Create this now rather than in __init__(), since WorkerTaskQueue
+        # needs to know about all TaskMessage subclasses
+        self.task_queue = WorkerTaskQueue()
+        self.members = [WorkerSubprocessManager(self)
+                        for i in xrange(process_count)]
+        self.is_running = True
+        for member in self.members:
+            member.start()
+        _miro_task_queue.run_pending_tasks()
+
+    def shutdown(self):
+        if not self.is_running:
+            return
+        self.is_running = False
+        for member in self.members:
+            member.shutdown()
+        self.members = []
+        self.task_queue = None
+
+    def restart(self, clean=False):
+        for member in self.members:
+            member.restart(clean)
+
+    def max_tasks_per_process(self):
+        # Keep enough tasks in each process that its threads don't have to
+        # wait on us, but not so many that it builds up a backlog.
+        return self.thread_count + 1
+
+    def handle(self, msg):
+        # WorkerMessage handler.  This gets called from send_to_process().
+        if isinstance(msg, CancelFileOperations):
+            self.task_queue.cancel_file_operations(set(msg.paths))
+            for member in self.members:
+                if member.is_running:
+                    member.send_task(msg)
+        elif isinstance(msg, TaskMessage):
+            self.task_queue.add_task(None, msg)
+            self.dispatch_tasks()
+        else:
+            for member in self.members:
+                if member.is_running:
+                    member.send_message(msg)
+
+    def requeue_tasks(self, member, tasks):
+        """Re-run tasks that were lost when a worker process quit."""
+        for msg in tasks:
+            if isinstance(msg, CancelFileOperations):
+                # Nothing to cancel in the new process
+                member.task_finished(TaskResult(msg.task_id, None))
+            else:
+                self.task_queue.add_task(None, msg)
+        self.dispatch_tasks()
+
+    def dispatch_tasks(self):
+        """Send tasks from our queue to processes that can take them."""
+        # map members to the tasks to send them, so that we can send all the
+        # tasks for a process in one batch
+        to_send = {}
+        while True:
+            member = self._pick_member(to_send)
+            if member is None:
+                break
+            next_task = self.task_queue.get_next_task_nowait()
+            if next_task is None:
+                break
+            to_send.setdefault(member, []).append(next_task[1])
+        for member, messages in to_send.items():
+            member.send_tasks(messages)
+
+    def _pick_member(self, to_send):
+        """Pick the running process with the least tasks, if there is one
+        that can take another task.
+
+        :param to_send: dict mapping members to tasks that we're about to
+            send them
+        """
+        def task_count(member):
+            return (len(member.tasks_in_progress) +
+                    len(to_send.get(member, ())))
+        max_tasks = self.max_tasks_per_process()
+        candidates = [m for m in self.members
+                      if m.is_running and task_count(m) < max_tasks]
+        if not candidates:
+            return None
+        return min(candidates, key=task_count)
+
+    def task_finished(self, member, reply):
+        _miro_task_queue.process_result(reply)
+        if self.is_running:
+            self.dispatch_tasks()
+
+    def stats(self):
+        """Get stats for each of our processes.
+
+        :returns: list of dicts, one for each process
+        """
+        stats = []
+        for member in self.members:
+            if member.process is not None:
+                pid = member.process.pid
+            else:
+                pid = None
+            stats.append({
+                'pid': pid,
+                'tasks_in_progress': len(member.tasks_in_progress),
+                'tasks_completed': member.tasks_completed,
+                'tasks_per_second': member.throughput(),
+            })
+        return stats
+
+_subprocess_manager = WorkerProcessPool()
+
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
+
+    :param thread_count: number of threads to run in each process
+    :param process_count: number of processes to start, defaults to the
+        number of CPUs
+    """
+    if process_count is None:
+        process_count = default_process_count()
+    _subprocess_manager.start(process_count, thread_count)
 
 def shutdown():
-    """Shutdown the worker process."""
+    """Shutdown the worker processes."""
     _subprocess_manager.shutdown()
 
+def get_stats():
+    """Get stats for the worker processes.
+
+    See WorkerProcessPool.stats() for details.
+    """
+    return _subprocess_manager.stats()
+
 # API for sending tasks
 def send(msg, callback, errback):
     """Send a message to the worker process.
@@ -57,6 +57,14 @@ class Image(object):
             raise ValueError('Image has invalid size: (%d, %d)' % (
                     self.width, self.height))
 
+    def save(self, path):
+        """Save the image to path as a PNG file."""
+        rep = NSBitmapImageRep.imageRepWithData_(
+            self.nsimage.TIFFRepresentation())
+        data = rep.representationUsingType_properties_(NSPNGFileType, None)
+        if not data.writeToFile_atomically_(filename_to_unicode(path), NO):
+            raise IOError("error writing %s" % path)
+
     def resize(self, width, height):
         return ResizedImage(self, width, height)
 